@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of rendering the coverage histogram SVGs served by the web
+interface: pygal compared to the lightweight built-in SVG emitter, and to
+cached re-renders of the same histogram.
+
+Run from the python/ directory:
+
+    pipenv run python -m benchmarks.chart_render
+"""
+
+import time
+import argparse
+
+from fatcat_web.graphics import preservation_by_year_histogram, render_chart_svg
+
+
+def year_rows(years):
+    return [dict(year=y, none=y % 7 * 100, shadows_only=y % 3, dark=y % 5 * 10, bright=y % 11 * 200)
+            for y in range(2020 - years + 1, 2021)]
+
+def bench(name, func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    elapsed = time.perf_counter() - start
+    print("    {:<24} {:>10.3f} ms/chart".format(name, elapsed * 1000 / rounds))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rounds',
+        help="number of renders of each chart",
+        default=50, type=int)
+    args = parser.parse_args()
+
+    for years in (10, 120, 250):
+        rows = year_rows(years)
+        print("preservation by year, {} bars".format(years))
+
+        def uncached(renderer):
+            render_chart_svg.cache_clear()
+            preservation_by_year_histogram(rows).render(renderer=renderer)
+
+        old = bench("pygal", lambda: uncached("pygal"), args.rounds)
+        new = bench("svg", lambda: uncached("svg"), args.rounds)
+        cached = bench("svg (cached)",
+            lambda: preservation_by_year_histogram(rows).render(renderer="svg"),
+            args.rounds)
+        print("        speedup: {:.1f}x (uncached), {:.1f}x (cached)".format(old / new, old / cached))
+
+if __name__ == '__main__':
+    main()
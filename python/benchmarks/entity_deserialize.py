@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of converting release (and other entity) JSON into
+fatcat_openapi_client model objects: the old code-generated ApiClient path
+compared to fatcat_tools.transforms.deserialize, both from JSON strings (as
+in the elasticsearch worker and fatcat_transform.py) and from dicts (as in
+cleanups and TOML editing).
+
+Run from the python/ directory:
+
+    pipenv run python -m benchmarks.entity_deserialize
+
+Optionally pass a release dump (JSON-lines, one release per line) to
+benchmark against instead of the small test fixtures.
+"""
+
+import sys
+import json
+import time
+import argparse
+import collections
+
+from fatcat_openapi_client import ApiClient, ReleaseEntity, FileEntity, ChangelogEntry
+
+from fatcat_tools import entity_from_json, entity_from_dict
+
+
+FIXTURES = [
+    ("tests/files/release_3mssw2qnlnblbk7oqyv2dafgey.json", ReleaseEntity),
+    ("tests/files/release_etodop5banbndg3faecnfm6ozi.json", ReleaseEntity),
+    ("tests/files/release_mjtqtuyhwfdr7j2c3l36uor7uy.json", ReleaseEntity),
+    ("tests/files/file_bcah4zp5tvdhjl5bqci2c2lgfa.json", FileEntity),
+    ("tests/files/changelog_3469683.json", ChangelogEntry),
+]
+
+
+def apiclient_from_json(api_client, json_str, entity_type):
+    thing = collections.namedtuple('Thing', ['data'])
+    thing.data = json_str
+    return api_client.deserialize(thing, entity_type)
+
+def bench(name, func, docs, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for doc in docs:
+            func(doc)
+    elapsed = time.perf_counter() - start
+    print("    {:<28} {:>10.0f} entities/sec".format(name, len(docs) * rounds / elapsed))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rounds',
+        help="number of passes over each input",
+        default=200, type=int)
+    parser.add_argument('--limit',
+        help="max number of releases to read from a dump file",
+        default=10000, type=int)
+    parser.add_argument('release_dump',
+        nargs='?',
+        help="JSON-lines release dump to benchmark against (instead of fixtures)",
+        type=argparse.FileType('r'))
+    args = parser.parse_args()
+
+    inputs = []
+    if args.release_dump:
+        lines = []
+        for line in args.release_dump:
+            if line.strip():
+                lines.append(line)
+            if len(lines) >= args.limit:
+                break
+        inputs.append((args.release_dump.name, ReleaseEntity, lines))
+        args.rounds = max(1, args.rounds // 100)
+    else:
+        for (path, entity_type) in FIXTURES:
+            with open(path, 'r') as f:
+                inputs.append((path, entity_type, [f.read()]))
+
+    ac = ApiClient()
+    for (name, entity_type, lines) in inputs:
+        dicts = [json.loads(l) for l in lines]
+        # sanity check before timing anything
+        for (l, d) in zip(lines, dicts):
+            old = apiclient_from_json(ac, l, entity_type)
+            if entity_from_json(l, entity_type) != old or entity_from_dict(d, entity_type) != old:
+                print("MISMATCH: {}".format(name), file=sys.stderr)
+                sys.exit(-1)
+
+        print("{} ({} entities, {} rounds)".format(name, len(lines), args.rounds))
+        old_json = bench("ApiClient from JSON (old)",
+            lambda l: apiclient_from_json(ac, l, entity_type), lines, args.rounds)
+        new_json = bench("entity_from_json",
+            lambda l: entity_from_json(l, entity_type), lines, args.rounds)
+        print("        speedup: {:.2f}x".format(old_json / new_json))
+        old_dict = bench("ApiClient from dict (old)",
+            lambda d: apiclient_from_json(ac, json.dumps(d), entity_type), dicts, args.rounds)
+        new_dict = bench("entity_from_dict",
+            lambda d: entity_from_dict(d, entity_type), dicts, args.rounds)
+        print("        speedup: {:.2f}x".format(old_dict / new_dict))
+
+if __name__ == '__main__':
+    main()
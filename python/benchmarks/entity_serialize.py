@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of converting expanded release (and other) entities to dicts
+and JSON bytes, as done by the entity updates worker: the old code-generated
+ApiClient.sanitize_for_serialization() compared to
+fatcat_tools.transforms.serialize.
+
+Run from the python/ directory:
+
+    pipenv run python -m benchmarks.entity_serialize
+
+Optionally pass a release dump (JSON-lines, one expanded release per line)
+to benchmark against instead of the small test fixtures.
+"""
+
+import sys
+import json
+import time
+import argparse
+
+from fatcat_openapi_client import ApiClient, ReleaseEntity, FileEntity, ChangelogEntry
+
+from fatcat_tools import entity_from_json, entity_to_dict, entity_to_json
+
+
+FIXTURES = [
+    ("tests/files/release_3mssw2qnlnblbk7oqyv2dafgey.json", ReleaseEntity),
+    ("tests/files/release_etodop5banbndg3faecnfm6ozi.json", ReleaseEntity),
+    ("tests/files/release_mjtqtuyhwfdr7j2c3l36uor7uy.json", ReleaseEntity),
+    ("tests/files/file_bcah4zp5tvdhjl5bqci2c2lgfa.json", FileEntity),
+    ("tests/files/changelog_3469683.json", ChangelogEntry),
+]
+
+
+def bench(name, func, entities, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for entity in entities:
+            func(entity)
+    elapsed = time.perf_counter() - start
+    print("    {:<32} {:>10.0f} entities/sec".format(name, len(entities) * rounds / elapsed))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rounds',
+        help="number of passes over each input",
+        default=200, type=int)
+    parser.add_argument('--limit',
+        help="max number of releases to read from a dump file",
+        default=10000, type=int)
+    parser.add_argument('release_dump',
+        nargs='?',
+        help="JSON-lines release dump to benchmark against (instead of fixtures)",
+        type=argparse.FileType('r'))
+    args = parser.parse_args()
+
+    inputs = []
+    if args.release_dump:
+        entities = []
+        for line in args.release_dump:
+            if line.strip():
+                entities.append(entity_from_json(line, ReleaseEntity))
+            if len(entities) >= args.limit:
+                break
+        inputs.append((args.release_dump.name, entities))
+        args.rounds = max(1, args.rounds // 100)
+    else:
+        for (path, entity_type) in FIXTURES:
+            with open(path, 'r') as f:
+                inputs.append((path, [entity_from_json(f.read(), entity_type)]))
+
+    ac = ApiClient()
+    for (name, entities) in inputs:
+        # sanity check before timing anything
+        for entity in entities:
+            if entity_to_dict(entity) != ac.sanitize_for_serialization(entity):
+                print("MISMATCH: {}".format(name), file=sys.stderr)
+                sys.exit(-1)
+
+        print("{} ({} entities, {} rounds)".format(name, len(entities), args.rounds))
+        old_dict = bench("sanitize_for_serialization (old)",
+            ac.sanitize_for_serialization, entities, args.rounds)
+        new_dict = bench("entity_to_dict",
+            entity_to_dict, entities, args.rounds)
+        print("        speedup: {:.2f}x".format(old_dict / new_dict))
+        old_json = bench("sanitize + json.dumps (old)",
+            lambda e: json.dumps(ac.sanitize_for_serialization(e)).encode('utf-8'),
+            entities, args.rounds)
+        new_json = bench("entity_to_json",
+            entity_to_json, entities, args.rounds)
+        print("        speedup: {:.2f}x".format(old_json / new_json))
+
+if __name__ == '__main__':
+    main()
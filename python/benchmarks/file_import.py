@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the CPU-bound parts of file importing: classifying URLs by
+domain (make_rel_url), MatchedImporter.parse_record(), and
+EntityImporter.generic_file_cleanups(). The old per-domain substring scan is
+compared to the UrlRelMatcher lookup. API lookups are stubbed out.
+
+Run from the python/ directory:
+
+    pipenv run python -m benchmarks.file_import
+
+Optionally pass a matched file dump (JSON-lines, as consumed by
+MatchedImporter) to benchmark against instead of the small test fixture.
+"""
+
+import sys
+import json
+import time
+import argparse
+
+from fatcat_openapi_client import ReleaseEntity, ReleaseExtIds
+
+import fatcat_tools.importers.matched
+from fatcat_tools.importers import MatchedImporter
+from fatcat_tools.importers.common import (DOMAIN_REL_MAP, EntityImporter,
+    make_rel_url, make_rel_urls)
+
+
+def make_rel_url_scan(raw_url, default_link_rel="web"):
+    # the old implementation
+    rel = default_link_rel
+    for domain, domain_rel in DOMAIN_REL_MAP.items():
+        if "//{}/".format(domain) in raw_url:
+            rel = domain_rel
+            break
+    return (rel, raw_url)
+
+def make_rel_urls_scan(raw_urls, default_link_rel="web"):
+    return [make_rel_url_scan(u, default_link_rel) for u in raw_urls]
+
+class StubApi:
+    """
+    Every release lookup succeeds, instantly
+    """
+
+    def __init__(self):
+        self.release = ReleaseEntity(ident="aaaaaaaaaaaaarceaaaaaaaaai", ext_ids=ReleaseExtIds())
+
+    def lookup_release(self, **kwargs):
+        return self.release
+
+def bench(name, func, inputs, rounds, unit):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for obj in inputs:
+            func(obj)
+    elapsed = time.perf_counter() - start
+    print("    {:<36} {:>10.0f} {}/sec".format(name, len(inputs) * rounds / elapsed, unit))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rounds',
+        help="number of passes over the input",
+        default=200, type=int)
+    parser.add_argument('--limit',
+        help="max number of records to read from a dump file",
+        default=10000, type=int)
+    parser.add_argument('matched_dump',
+        nargs='?',
+        help="JSON-lines matched file dump to benchmark against (instead of fixtures)",
+        type=argparse.FileType('r'))
+    args = parser.parse_args()
+
+    records = []
+    input_file = args.matched_dump or open("tests/files/matched_sample.json", 'r')
+    for line in input_file:
+        if line.strip():
+            records.append(json.loads(line))
+        if len(records) >= args.limit:
+            break
+    if args.matched_dump:
+        args.rounds = max(1, args.rounds // 100)
+
+    urls = []
+    for obj in records:
+        urls.extend(obj.get('urls', []))
+        for cdx in obj.get('cdx', []):
+            urls.append(cdx['url'])
+            urls.append("https://web.archive.org/web/{}/{}".format(cdx.get('dt'), cdx['url']))
+
+    # sanity check before timing anything
+    if make_rel_urls(urls) != make_rel_urls_scan(urls):
+        print("MISMATCH in URL classification", file=sys.stderr)
+        sys.exit(-1)
+
+    print("URL classification ({} URLs, {} rounds)".format(len(urls), args.rounds))
+    old = bench("substring scan (old)", make_rel_url_scan, urls, args.rounds, "URLs")
+    new = bench("make_rel_url", make_rel_url, urls, args.rounds, "URLs")
+    print("        speedup: {:.2f}x".format(old / new))
+
+    importer = MatchedImporter(StubApi())
+    print("MatchedImporter.parse_record() ({} records, {} rounds)".format(len(records), args.rounds))
+    fatcat_tools.importers.matched.make_rel_urls = make_rel_urls_scan
+    old = bench("with substring scan (old)", importer.parse_record, records, args.rounds, "records")
+    fatcat_tools.importers.matched.make_rel_urls = make_rel_urls
+    new = bench("with make_rel_urls", importer.parse_record, records, args.rounds, "records")
+    print("        speedup: {:.2f}x".format(old / new))
+
+    entities = [importer.parse_record(obj) for obj in records]
+    entities = [fe for fe in entities if fe]
+    print("generic_file_cleanups() ({} entities, {} rounds)".format(len(entities), args.rounds))
+    bench("generic_file_cleanups", EntityImporter.generic_file_cleanups, entities, args.rounds, "entities")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of JSON decoding as done by JsonLinePusher and
+KafkaJsonPusher: the old path (decode bytes to str, then stdlib json.loads)
+compared to each fatcat_tools.fastjson backend parsing directly from bytes.
+
+Run from the python/ directory:
+
+    pipenv run python -m benchmarks.json_decode
+"""
+
+import sys
+import gzip
+import json
+import time
+import argparse
+
+from fatcat_tools.fastjson import get_json_decoder, orjson
+
+
+FIXTURES = [
+    "tests/files/crossref-works.2018-01-21.badsample.json",
+    "tests/files/datacite_sample.jsonl",
+    "tests/files/datacite_1k_records.jsonl.gz",
+    "tests/files/example_ingest.json",
+    "tests/files/huge_crossref_doi.json.gz",
+]
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rb') as f:
+        return [line for line in f if line.strip()]
+
+def bench(name, func, lines, rounds):
+    total_bytes = sum(len(l) for l in lines) * rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for line in lines:
+            func(line)
+    elapsed = time.perf_counter() - start
+    print("    {:<24} {:>10.0f} records/sec {:>8.1f} MByte/sec".format(
+        name,
+        len(lines) * rounds / elapsed,
+        total_bytes / elapsed / 1024 / 1024,
+    ))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rounds',
+        help="number of passes over each fixture file",
+        default=20, type=int)
+    parser.add_argument('files',
+        nargs='*',
+        help="JSON-lines files to benchmark against",
+        default=FIXTURES)
+    args = parser.parse_args()
+
+    candidates = [
+        ("str + json.loads (old)", lambda raw: json.loads(raw.decode('utf-8'))),
+        ("fastjson stdlib", get_json_decoder("stdlib")),
+    ]
+    if orjson is not None:
+        candidates.append(("fastjson orjson", get_json_decoder("orjson")))
+    else:
+        print("NOTE: orjson not installed; only benchmarking stdlib", file=sys.stderr)
+
+    for path in args.files:
+        lines = read_lines(path)
+        print("{} ({} records)".format(path, len(lines)))
+        baseline = None
+        for (name, func) in candidates:
+            elapsed = bench(name, func, lines, args.rounds)
+            if baseline is None:
+                baseline = elapsed
+            else:
+                print("        speedup: {:.2f}x".format(baseline / elapsed))
+
+if __name__ == '__main__':
+    main()
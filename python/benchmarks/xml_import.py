@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of XML record ingestion: parsing a PubMed XML file with
+Bs4XmlLargeFilePusher and running PubmedImporter.parse_record() on every
+article, with records either re-parsed by BeautifulSoup (the default) or
+passed through as lxml elements (`lxml_records`). API lookups are stubbed
+out, so this is all CPU.
+
+Run from the python/ directory:
+
+    pipenv run python -m benchmarks.xml_import
+
+Optionally pass a PubMed baseline/update XML file (uncompressed) to
+benchmark against instead of the small test fixture.
+"""
+
+import sys
+import time
+import argparse
+
+from fatcat_openapi_client import ApiClient
+from fatcat_openapi_client.rest import ApiException
+
+from fatcat_tools.importers import Bs4XmlLargeFilePusher, PubmedImporter
+from fatcat_tools.transforms import entity_to_dict
+
+
+class StubApi:
+    """
+    Every lookup is a miss, instantly
+    """
+
+    api_client = ApiClient()
+
+    def __getattr__(self, name):
+        def not_found(*args, **kwargs):
+            raise ApiException(status=404)
+        return not_found
+
+class ParseOnly:
+    """
+    Stands in for an importer in a pusher: only runs parse_record()
+    """
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.entities = []
+
+    def push_record(self, raw_record):
+        if self.importer.want(raw_record):
+            self.entities.append(self.importer.parse_record(raw_record))
+
+    def finish(self):
+        return dict(parsed=len(self.entities))
+
+def run_pusher(path, importer, rounds, **kwargs):
+    entities = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        recorder = ParseOnly(importer)
+        with open(path, 'rb') as xml_file:
+            Bs4XmlLargeFilePusher(recorder, xml_file, ["PubmedArticle"], **kwargs).run()
+        entities = recorder.entities
+    return (time.perf_counter() - start, entities)
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rounds',
+        help="number of passes over the input",
+        default=5, type=int)
+    parser.add_argument('--issn-map-file',
+        help="ISSN to ISSN-L mapping file",
+        default="tests/files/ISSN-to-ISSN-L.snip.txt")
+    parser.add_argument('pubmed_xml',
+        nargs='?',
+        help="PubMed XML file to benchmark against (instead of fixtures)",
+        default="tests/files/pubmedsample_2019.xml")
+    args = parser.parse_args()
+
+    with open(args.issn_map_file, 'r') as issn_file:
+        importer = PubmedImporter(StubApi(), issn_file, lookup_refs=True, create_containers=False)
+
+    (old, old_entities) = run_pusher(args.pubmed_xml, importer, args.rounds)
+    (new, new_entities) = run_pusher(args.pubmed_xml, importer, args.rounds, lxml_records=True)
+
+    # sanity check; the only expected difference is MathML abstracts, which
+    # the ElementTree re-serialization mangles (ns0: prefixes)
+    mismatch = 0
+    for (a, b) in zip(old_entities, new_entities):
+        a = a and entity_to_dict(a)
+        b = b and entity_to_dict(b)
+        if a and b:
+            a.pop('abstracts', None)
+            b.pop('abstracts', None)
+        if a != b:
+            mismatch += 1
+    if mismatch or len(old_entities) != len(new_entities):
+        print("MISMATCH in {} parsed records".format(mismatch), file=sys.stderr)
+        sys.exit(-1)
+
+    count = len(new_entities) * args.rounds
+    print("PubmedImporter via Bs4XmlLargeFilePusher ({} records, {} rounds)".format(
+        len(new_entities), args.rounds))
+    print("    {:<36} {:>10.0f} records/sec".format("BeautifulSoup re-parse (old)", count / old))
+    print("    {:<36} {:>10.0f} records/sec".format("lxml_records", count / new))
+    print("        speedup: {:.2f}x".format(old / new))
+
+if __name__ == '__main__':
+    main()
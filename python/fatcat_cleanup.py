@@ -17,8 +17,11 @@ sentry_client = raven.Client()
 def run_files(args):
     fmi = FileCleaner(args.api,
         dry_run_mode=args.dry_run,
+        dry_run_output=args.dry_run_output,
         edit_batch_size=args.batch_size,
-        editgroup_description=args.editgroup_description_override)
+        editgroup_description=args.editgroup_description_override,
+        workers=args.workers,
+        fetch_threads=args.fetch_threads)
     JsonLinePusher(fmi, args.json_file).run()
 
 def main():
@@ -36,6 +39,15 @@ def main():
     parser.add_argument('--dry-run',
         help="dry-run mode (don't actually update)",
         default=False, type=bool)
+    parser.add_argument('--dry-run-output',
+        help="in dry-run mode, print entities which would be updated as JSON: 'cleaned' (as they would be updated), or 'original' (as they were; the output of older versions of this script)",
+        default='cleaned', choices=['cleaned', 'original'])
+    parser.add_argument('--workers',
+        help="number of worker processes for cleaning entities",
+        default=1, type=int)
+    parser.add_argument('--fetch-threads',
+        help="number of concurrent API fetches of entities to be updated",
+        default=8, type=int)
     subparsers = parser.add_subparsers()
 
     sub_files = subparsers.add_parser('files',
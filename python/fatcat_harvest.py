@@ -19,7 +19,8 @@ def run_crossref(args):
         state_topic=f"fatcat-{args.env}.api-crossref-state",
         contact_email=args.contact_email,
         start_date=args.start_date,
-        end_date=args.end_date)
+        end_date=args.end_date,
+        concurrency=args.concurrency)
     worker.run(continuous=args.continuous)
 
 def run_datacite(args):
@@ -29,7 +30,8 @@ def run_datacite(args):
         state_topic=f"fatcat-{args.env}.api-datacite-state",
         contact_email=args.contact_email,
         start_date=args.start_date,
-        end_date=args.end_date)
+        end_date=args.end_date,
+        concurrency=args.concurrency)
     worker.run(continuous=args.continuous)
 
 def run_arxiv(args):
@@ -38,7 +40,8 @@ def run_arxiv(args):
         produce_topic=f"fatcat-{args.env}.oaipmh-arxiv",
         state_topic=f"fatcat-{args.env}.oaipmh-arxiv-state",
         start_date=args.start_date,
-        end_date=args.end_date)
+        end_date=args.end_date,
+        concurrency=args.concurrency)
     worker.run(continuous=args.continuous)
 
 def run_pubmed(args):
@@ -47,7 +50,8 @@ def run_pubmed(args):
         produce_topic=f"fatcat-{args.env}.ftp-pubmed",
         state_topic=f"fatcat-{args.env}.ftp-pubmed-state",
         start_date=args.start_date,
-        end_date=args.end_date)
+        end_date=args.end_date,
+        concurrency=args.concurrency)
     worker.run(continuous=args.continuous)
 
 def run_doaj_article(args):
@@ -56,7 +60,8 @@ def run_doaj_article(args):
         produce_topic=f"fatcat-{args.env}.oaipmh-doaj-article",
         state_topic="fatcat-{args.env}.oaipmh-doaj-article-state",
         start_date=args.start_date,
-        end_date=args.end_date)
+        end_date=args.end_date,
+        concurrency=args.concurrency)
     worker.run(continuous=args.continuous)
 
 def run_doaj_journal(args):
@@ -65,7 +70,8 @@ def run_doaj_journal(args):
         produce_topic=f"fatcat-{args.env}.oaipmh-doaj-journal",
         state_topic=f"fatcat-{args.env}.oaipmh-doaj-journal-state",
         start_date=args.start_date,
-        end_date=args.end_date)
+        end_date=args.end_date,
+        concurrency=args.concurrency)
     worker.run(continuous=args.continuous)
 
 
@@ -93,6 +99,9 @@ def main():
     parser.add_argument('--continuous',
         action='store_true',
         help="continue harvesting indefinitely in a loop?")
+    parser.add_argument('--concurrency',
+        default=1, type=int,
+        help="number of dates to harvest in parallel when catching up (capped per source)")
     subparsers = parser.add_subparsers()
 
     sub_crossref = subparsers.add_parser('crossref',
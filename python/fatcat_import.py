@@ -12,13 +12,44 @@ from fatcat_tools.importers import *
 # Yep, a global. Gets DSN from `SENTRY_DSN` environment variable
 sentry_client = raven.Client()
 
+def parallel_wrap(importer, args):
+    """
+    Wraps importer for parallel parsing/updating if --workers was passed.
+    Only used for file-based (not kafka) imports, where records are not
+    mutated after being pushed.
+    """
+    if args.workers > 1:
+        return ParallelImporter(importer, workers=args.workers)
+    return importer
+
+def lookup_cache_kwargs(args):
+    """
+    Identifier lookup cache options, for importers which resolve DOIs, PMIDs,
+    ISSN-Ls or ORCIDs.
+    """
+    return dict(
+        lookup_cache_file=args.lookup_cache_file,
+        lookup_cache_size=args.lookup_cache_size,
+        lookup_cache_ttl=args.lookup_cache_ttl,
+    )
+
+def fuzzy_match_kwargs(args):
+    """
+    Batched fuzzy matching options, for importers which fuzzy match releases
+    against the existing catalog.
+    """
+    return dict(
+        fuzzy_match_batch_size=args.fuzzy_match_batch_size,
+        fuzzy_verify_workers=args.fuzzy_verify_workers,
+    )
 
 def run_crossref(args):
     fci = CrossrefImporter(args.api,
         args.issn_map_file,
         extid_map_file=args.extid_map_file,
         edit_batch_size=args.batch_size,
-        bezerk_mode=args.bezerk_mode)
+        bezerk_mode=args.bezerk_mode,
+        **lookup_cache_kwargs(args))
     if args.kafka_mode:
         KafkaJsonPusher(
             fci,
@@ -29,13 +60,16 @@ def run_crossref(args):
             consume_batch_size=args.batch_size,
         ).run()
     else:
-        JsonLinePusher(fci, args.json_file).run()
+        JsonLinePusher(parallel_wrap(fci, args), args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_jalc(args):
     ji = JalcImporter(args.api,
         args.issn_map_file,
-        extid_map_file=args.extid_map_file)
-    Bs4XmlLinesPusher(ji, args.xml_file, "<rdf:Description").run()
+        extid_map_file=args.extid_map_file,
+        **lookup_cache_kwargs(args))
+    Bs4XmlLinesPusher(ji, args.xml_file, "<rdf:Description",
+        lxml_records=args.lxml_records).run()
 
 def run_arxiv(args):
     ari = ArxivRawImporter(args.api,
@@ -47,18 +81,21 @@ def run_arxiv(args):
             args.kafka_env,
             "oaipmh-arxiv",
             "fatcat-{}-import-arxiv".format(args.kafka_env),
+            lxml_records=args.lxml_records,
         ).run()
     else:
         if args.xml_file == sys.stdin:
             print('note: reading from stdin', file=sys.stderr)
-        Bs4XmlFilePusher(ari, args.xml_file, "record").run()
+        Bs4XmlFilePusher(ari, args.xml_file, "record",
+            lxml_records=args.lxml_records).run()
 
 def run_pubmed(args):
     pi = PubmedImporter(args.api,
         args.issn_map_file,
         edit_batch_size=args.batch_size,
         do_updates=args.do_updates,
-        lookup_refs=(not args.no_lookup_refs))
+        lookup_refs=(not args.no_lookup_refs),
+        **lookup_cache_kwargs(args))
     if args.kafka_mode:
         KafkaBs4XmlPusher(
             pi,
@@ -66,35 +103,45 @@ def run_pubmed(args):
             args.kafka_env,
             "ftp-pubmed",
             "fatcat-{}-import-pubmed".format(args.kafka_env),
+            lxml_records=args.lxml_records,
         ).run()
     else:
         Bs4XmlLargeFilePusher(
             pi,
             args.xml_file,
             ["PubmedArticle"],
+            lxml_records=args.lxml_records,
+            progress_interval=args.progress_interval,
         ).run()
 
 def run_jstor(args):
     ji = JstorImporter(args.api,
         args.issn_map_file,
-        edit_batch_size=args.batch_size)
-    Bs4XmlFileListPusher(ji, args.list_file, "article").run()
+        edit_batch_size=args.batch_size,
+        **lookup_cache_kwargs(args))
+    Bs4XmlFileListPusher(ji, args.list_file, "article",
+        lxml_records=args.lxml_records,
+        workers=args.workers,
+        ordered=not args.unordered).run()
 
 def run_orcid(args):
     foi = OrcidImporter(args.api,
         edit_batch_size=args.batch_size)
-    JsonLinePusher(foi, args.json_file).run()
+    JsonLinePusher(parallel_wrap(foi, args), args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def run_journal_metadata(args):
     fii = JournalMetadataImporter(args.api,
         edit_batch_size=args.batch_size)
-    JsonLinePusher(fii, args.json_file).run()
+    JsonLinePusher(fii, args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def run_chocula(args):
     fii = ChoculaImporter(args.api,
         edit_batch_size=args.batch_size,
         do_updates=args.do_updates)
-    JsonLinePusher(fii, args.json_file).run()
+    JsonLinePusher(fii, args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def run_matched(args):
     fmi = MatchedImporter(args.api,
@@ -102,7 +149,8 @@ def run_matched(args):
         editgroup_description=args.editgroup_description_override,
         default_link_rel=args.default_link_rel,
         default_mimetype=args.default_mimetype)
-    JsonLinePusher(fmi, args.json_file).run()
+    JsonLinePusher(parallel_wrap(fmi, args), args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def run_arabesque_match(args):
     if (args.sqlite_file and args.json_file) or not (args.sqlite_file or
@@ -120,7 +168,8 @@ def run_arabesque_match(args):
         SqlitePusher(ami, args.sqlite_file, "crawl_result",
             ARABESQUE_MATCH_WHERE_CLAUSE).run()
     elif args.json_file:
-        JsonLinePusher(ami, args.json_file).run()
+        JsonLinePusher(parallel_wrap(ami, args), args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_ingest_file(args):
     ifri = IngestFileResultImporter(args.api,
@@ -141,7 +190,8 @@ def run_ingest_file(args):
             consume_batch_size=args.batch_size,
         ).run()
     else:
-        JsonLinePusher(ifri, args.json_file).run()
+        JsonLinePusher(parallel_wrap(ifri, args), args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_ingest_web(args):
     iwri = IngestWebResultImporter(args.api,
@@ -161,7 +211,8 @@ def run_ingest_web(args):
             consume_batch_size=args.batch_size,
         ).run()
     else:
-        JsonLinePusher(iwri, args.json_file).run()
+        JsonLinePusher(parallel_wrap(iwri, args), args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_savepapernow_file(args):
     ifri = SavePaperNowFileImporter(args.api,
@@ -178,19 +229,22 @@ def run_savepapernow_file(args):
             consume_batch_size=args.batch_size,
         ).run()
     else:
-        JsonLinePusher(ifri, args.json_file).run()
+        JsonLinePusher(ifri, args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_grobid_metadata(args):
     fmi = GrobidMetadataImporter(args.api,
         edit_batch_size=args.batch_size,
         longtail_oa=args.longtail_oa,
         bezerk_mode=args.bezerk_mode)
-    LinePusher(fmi, args.tsv_file).run()
+    LinePusher(parallel_wrap(fmi, args), args.tsv_file,
+        progress_interval=args.progress_interval).run()
 
 def run_shadow_lib(args):
     fmi = ShadowLibraryImporter(args.api,
         edit_batch_size=100)
-    JsonLinePusher(fmi, args.json_file).run()
+    JsonLinePusher(parallel_wrap(fmi, args), args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def run_wayback_static(args):
     api = args.api
@@ -242,7 +296,8 @@ def run_datacite(args):
         bezerk_mode=args.bezerk_mode,
         debug=args.debug,
         extid_map_file=args.extid_map_file,
-        insert_log_file=args.insert_log_file)
+        insert_log_file=args.insert_log_file,
+        **lookup_cache_kwargs(args))
     if args.kafka_mode:
         KafkaJsonPusher(
             dci,
@@ -253,13 +308,16 @@ def run_datacite(args):
             consume_batch_size=args.batch_size,
         ).run()
     else:
-        JsonLinePusher(dci, args.json_file).run()
+        JsonLinePusher(parallel_wrap(dci, args), args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_doaj_article(args):
     dai = DoajArticleImporter(args.api,
         args.issn_map_file,
         edit_batch_size=args.batch_size,
         do_updates=args.do_updates,
+        **lookup_cache_kwargs(args),
+        **fuzzy_match_kwargs(args)
     )
     if args.kafka_mode:
         KafkaJsonPusher(
@@ -271,7 +329,8 @@ def run_doaj_article(args):
             consume_batch_size=args.batch_size,
         ).run()
     else:
-        JsonLinePusher(dai, args.json_file).run()
+        JsonLinePusher(parallel_wrap(dai, args), args.json_file,
+            progress_interval=args.progress_interval).run()
 
 def run_dblp_release(args):
     dri = DblpReleaseImporter(args.api,
@@ -279,12 +338,16 @@ def run_dblp_release(args):
         edit_batch_size=args.batch_size,
         do_updates=args.do_updates,
         dump_json_mode=args.dump_json_mode,
+        **lookup_cache_kwargs(args),
+        **fuzzy_match_kwargs(args)
     )
     Bs4XmlLargeFilePusher(
         dri,
         args.xml_file,
         DblpReleaseImporter.ELEMENT_TYPES,
         use_lxml=True,
+        lxml_records=args.lxml_records,
+        progress_interval=args.progress_interval,
     ).run()
 
 def run_dblp_container(args):
@@ -295,7 +358,8 @@ def run_dblp_container(args):
         edit_batch_size=args.batch_size,
         do_updates=args.do_updates,
     )
-    JsonLinePusher(dci, args.json_file).run()
+    JsonLinePusher(dci, args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def run_file_meta(args):
     # do_updates defaults to true for this importer
@@ -303,7 +367,8 @@ def run_file_meta(args):
         edit_batch_size=100,
         editgroup_description=args.editgroup_description_override,
     )
-    JsonLinePusher(fmi, args.json_file).run()
+    JsonLinePusher(fmi, args.json_file,
+        progress_interval=args.progress_interval).run()
 
 def main():
     parser = argparse.ArgumentParser(
@@ -323,6 +388,27 @@ def main():
     parser.add_argument('--editgroup-description-override',
         help="editgroup description override",
         default=None, type=str)
+    parser.add_argument('--workers',
+        help="number of parallel parsing processes (file imports only)",
+        default=1, type=int)
+    parser.add_argument('--progress-interval',
+        help="print input file progress every this many seconds (file imports only)",
+        default=None, type=float)
+    parser.add_argument('--lookup-cache-file',
+        help="sqlite3 file to persist (and share) identifier lookups in",
+        default=None, type=str)
+    parser.add_argument('--lookup-cache-size',
+        help="max in-memory identifier lookups to cache, per identifier type",
+        default=250000, type=int)
+    parser.add_argument('--lookup-cache-ttl',
+        help="seconds after which cached identifier lookups are re-checked (default: never, or 1 day with --lookup-cache-file)",
+        default=None, type=float)
+    parser.add_argument('--fuzzy-match-batch-size',
+        help="fuzzy match releases in windows of this many, with batched elasticsearch queries (doaj-article, dblp-release; 0 for one at a time)",
+        default=0, type=int)
+    parser.add_argument('--fuzzy-verify-workers',
+        help="number of processes for verifying batched fuzzy matches (0 for inline)",
+        default=0, type=int)
     subparsers = parser.add_subparsers()
 
     sub_crossref = subparsers.add_parser('crossref',
@@ -333,9 +419,9 @@ def main():
     )
     sub_crossref.add_argument('json_file',
         help="crossref JSON file to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_crossref.add_argument('issn_map_file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
     sub_crossref.add_argument('--extid-map-file',
         help="DOI-to-other-identifiers sqlite3 database",
@@ -358,13 +444,16 @@ def main():
     )
     sub_jalc.add_argument('xml_file',
         help="Jalc RDF XML file (record-per-line) to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('r'))
     sub_jalc.add_argument('issn_map_file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
     sub_jalc.add_argument('--extid-map-file',
         help="DOI-to-other-identifiers sqlite3 database",
         default=None, type=str)
+    sub_jalc.add_argument('--lxml-records',
+        action='store_true',
+        help="pass lxml-parsed records to the importer, instead of re-parsing with BeautifulSoup (faster)")
 
     sub_arxiv = subparsers.add_parser('arxiv',
         help="import arxiv.org metadata from XML files")
@@ -375,10 +464,13 @@ def main():
     sub_arxiv.add_argument('xml_file',
         nargs='?',
         help="arXivRaw XML file to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('r'))
     sub_arxiv.add_argument('--kafka-mode',
         action='store_true',
         help="consume from kafka topic (not stdin)")
+    sub_arxiv.add_argument('--lxml-records',
+        action='store_true',
+        help="pass lxml-parsed records to the importer, instead of re-parsing with BeautifulSoup (faster)")
 
     sub_pubmed = subparsers.add_parser('pubmed',
         help="import MEDLINE/PubMed work-level metadata (XML)")
@@ -389,9 +481,9 @@ def main():
     sub_pubmed.add_argument('xml_file',
         nargs='?',
         help="Pubmed XML file to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('r'))
     sub_pubmed.add_argument('issn_map_file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
     sub_pubmed.add_argument('--no-lookup-refs',
         action='store_true',
@@ -402,6 +494,9 @@ def main():
     sub_pubmed.add_argument('--kafka-mode',
         action='store_true',
         help="consume from kafka topic (not stdin)")
+    sub_pubmed.add_argument('--lxml-records',
+        action='store_true',
+        help="pass lxml-parsed records to the importer, instead of re-parsing with BeautifulSoup (faster)")
 
     sub_jstor = subparsers.add_parser('jstor',
         help="import JSTOR work-level metadata from XML dump")
@@ -411,10 +506,16 @@ def main():
     )
     sub_jstor.add_argument('list_file',
         help="List of JSTOR XML file paths to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('r'))
     sub_jstor.add_argument('issn_map_file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
+    sub_jstor.add_argument('--lxml-records',
+        action='store_true',
+        help="pass lxml-parsed records to the importer, instead of re-parsing with BeautifulSoup (faster)")
+    sub_jstor.add_argument('--unordered',
+        action='store_true',
+        help="with --workers, submit files in the order they finish parsing, instead of list order")
 
     sub_orcid = subparsers.add_parser('orcid',
         help="import creator entities from ORCID XML dump")
@@ -424,7 +525,7 @@ def main():
     )
     sub_orcid.add_argument('json_file',
         help="orcid JSON file to import from (or stdin)",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
 
     sub_journal_metadata = subparsers.add_parser('journal-metadata',
         help="import/update container metadata from old manual munging format")
@@ -434,7 +535,7 @@ def main():
     )
     sub_journal_metadata.add_argument('json_file',
         help="Journal JSON metadata file to import from (or stdin)",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
 
     sub_chocula = subparsers.add_parser('chocula',
         help="import/update container metadata from chocula JSON export")
@@ -444,7 +545,7 @@ def main():
     )
     sub_chocula.add_argument('json_file',
         help="chocula JSON entities file (or stdin)",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_chocula.add_argument('--do-updates',
         action='store_true',
         help="update pre-existing container entities")
@@ -457,7 +558,7 @@ def main():
     )
     sub_matched.add_argument('json_file',
         help="JSON file to import from (or stdin)",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_matched.add_argument('--default-mimetype',
         default=None,
         help="default mimetype for imported files (if not specified per-file)")
@@ -478,7 +579,7 @@ def main():
         help="sqlite database file to import from")
     sub_arabesque_match.add_argument('--json-file',
         help="JSON file to import from (or stdin)",
-        type=argparse.FileType('r'))
+        type=CompressedFileType('rb'))
     sub_arabesque_match.add_argument('--do-updates',
         action='store_true',
         help="update pre-existing file entities if new match (instead of skipping)")
@@ -502,7 +603,7 @@ def main():
     )
     sub_ingest_file.add_argument('json_file',
         help="ingest_file JSON file to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_ingest_file.add_argument('--skip-source-allowlist',
         action='store_true',
         help="don't filter import based on request source allowlist")
@@ -527,7 +628,7 @@ def main():
     )
     sub_ingest_web.add_argument('json_file',
         help="ingest_web JSON file to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_ingest_web.add_argument('--skip-source-allowlist',
         action='store_true',
         help="don't filter import based on request source allowlist")
@@ -549,7 +650,7 @@ def main():
     )
     sub_savepapernow_file.add_argument('json_file',
         help="ingest-file JSON file to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_savepapernow_file.add_argument('--kafka-mode',
         action='store_true',
         help="consume from kafka topic (not stdin)")
@@ -562,7 +663,7 @@ def main():
     )
     sub_grobid_metadata.add_argument('tsv_file',
         help="TSV file to import from (or stdin)",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('r'))
     sub_grobid_metadata.add_argument('--group-size',
         help="editgroup group size to use",
         default=75, type=int)
@@ -581,7 +682,7 @@ def main():
     )
     sub_shadow_lib.add_argument('json_file',
         help="JSON file to import from (or stdin)",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
 
     sub_wayback_static = subparsers.add_parser('wayback-static',
         help="crude crawl+ingest tool for single-page HTML docs from wayback")
@@ -622,9 +723,9 @@ def main():
         help="import datacite.org metadata")
     sub_datacite.add_argument('json_file',
         help="File with jsonlines from datacite.org v2 API to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_datacite.add_argument('issn_map_file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
     sub_datacite.add_argument('--extid-map-file',
         help="DOI-to-other-identifiers sqlite3 database",
@@ -651,9 +752,9 @@ def main():
         help="import doaj.org article metadata")
     sub_doaj_article.add_argument('json_file',
         help="File with JSON lines from DOAJ API (or bulk dump) to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_doaj_article.add_argument('--issn-map-file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
     sub_doaj_article.add_argument('--kafka-mode',
         action='store_true',
@@ -670,7 +771,7 @@ def main():
         help="import dblp release metadata")
     sub_dblp_release.add_argument('xml_file',
         help="File with DBLP XML to import from",
-        default=sys.stdin, type=argparse.FileType('rb'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_dblp_release.add_argument('--dblp-container-map-file',
         help="file path to dblp prefix to container_id TSV file",
         default=None, type=argparse.FileType('r'))
@@ -680,6 +781,9 @@ def main():
     sub_dblp_release.add_argument('--dump-json-mode',
         action='store_true',
         help="print release entities to stdout instead of importing")
+    sub_dblp_release.add_argument('--lxml-records',
+        action='store_true',
+        help="pass lxml-parsed records to the importer, instead of re-parsing with BeautifulSoup (faster)")
     sub_dblp_release.set_defaults(
         func=run_dblp_release,
         auth_var="FATCAT_AUTH_WORKER_DBLP",
@@ -689,7 +793,7 @@ def main():
         help="import dblp container metadata")
     sub_dblp_container.add_argument('json_file',
         help="File with DBLP container JSON to import from (see extra/dblp/)",
-        default=sys.stdin, type=argparse.FileType('rb'))
+        default=sys.stdin, type=CompressedFileType('rb'))
     sub_dblp_container.add_argument('--dblp-container-map-file',
         help="file path to dblp pre-existing prefix to container_id TSV file",
         default=None, type=argparse.FileType('r'))
@@ -697,7 +801,7 @@ def main():
         help="file path to output new dblp container map TSV to",
         default=None, type=argparse.FileType('w'))
     sub_dblp_container.add_argument('--issn-map-file',
-        help="ISSN to ISSN-L mapping file",
+        help="ISSN to ISSN-L mapping file (text, or binary index)",
         default=None, type=argparse.FileType('r'))
     sub_dblp_container.add_argument('--do-updates',
         action='store_true',
@@ -715,7 +819,7 @@ def main():
     )
     sub_file_meta.add_argument('json_file',
         help="File with jsonlines from file_meta schema to import from",
-        default=sys.stdin, type=argparse.FileType('r'))
+        default=sys.stdin, type=CompressedFileType('rb'))
 
     args = parser.parse_args()
     if not args.__dict__.get("func"):
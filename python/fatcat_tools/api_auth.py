@@ -4,14 +4,20 @@ import sys
 import fatcat_openapi_client
 
 
-def public_api(host_uri):
+def public_api(host_uri, pool_maxsize=None):
     """
     Note: unlike the authenticated variant, this helper might get called even
     if the API isn't going to be used, so it's important that it doesn't try to
     actually connect to the API host or something.
+
+    `pool_maxsize` sets the number of connections kept open per host; callers
+    making requests from several threads at once should set it to (at least)
+    the number of threads.
     """
     conf = fatcat_openapi_client.Configuration()
     conf.host = host_uri
+    if pool_maxsize:
+        conf.connection_pool_maxsize = pool_maxsize
     return fatcat_openapi_client.DefaultApi(fatcat_openapi_client.ApiClient(conf))
 
 def authenticated_api(host_uri, token=None):
@@ -0,0 +1,139 @@
+
+"""
+Runs a function over chunks of work (eg, lists of records) in a pool of forked
+worker processes, with a bounded number of chunks in flight, and hands back
+results in submission order, or optionally in completion order.
+
+Shared by the bulk code paths which parallelize this way: ParallelImporter
+(fatcat_tools.importers.parallel), EntityCleaner (fatcat_tools.cleanups) and
+BulkTransformer (fatcat_tools.transforms.bulk).
+
+Workers are forked, so they inherit a copy of the `state` object (eg, an
+importer, with its API client and lookup tables, which usually can't be
+pickled); only the function, its arguments and results cross process
+boundaries.
+"""
+
+import queue
+import itertools
+import collections
+import multiprocessing
+from typing import Any, Callable, Optional
+
+
+# the pool's `state`; set in the parent process just before forking, and
+# inherited by the worker processes
+_WORKER_STATE = None
+
+def _worker_init(initializer: Optional[Callable]) -> None:
+    if initializer is not None:
+        initializer(_WORKER_STATE)
+
+def _call_with_state(func: Callable, args: tuple) -> Any:
+    return func(_WORKER_STATE, *args)
+
+
+class ChunkPool:
+    """
+    Parameters:
+
+        func: module-level function, called in a worker process for each
+            chunk; if `state` is set, as func(state, *args), otherwise as
+            func(*args)
+        handle: called in this process as handle(tag, result) for each chunk,
+            with the `tag` it was submitted with
+        workers: number of worker processes (forked on creation)
+        ordered: if False, chunks are handled as soon as they are done,
+            instead of in submission order
+        max_inflight: max number of chunks submitted but not handled yet
+            (default: twice the number of workers); submit() handles
+            finished chunks (blocking if needed) to stay under it
+        state: object for workers to inherit (see module docstring)
+        initializer: called as initializer(state) in each worker process on
+            start
+
+    Exceptions raised by `func` are re-raised from submit() or drain(), when
+    the chunk is handled.
+    """
+
+    def __init__(self, func: Callable, handle: Callable, workers: int, ordered: bool = True,
+                 max_inflight: Optional[int] = None, state: Any = None,
+                 initializer: Optional[Callable] = None):
+        global _WORKER_STATE
+        self.func = func
+        self.handle = handle
+        self.ordered = ordered
+        self.max_inflight = max_inflight or (2 * workers)
+        self.with_state = state is not None
+        # chunk_id -> (tag, AsyncResult), in submission order
+        self._inflight: "collections.OrderedDict[int, Any]" = collections.OrderedDict()
+        # chunk_ids of finished chunks, in completion order (unordered mode)
+        self._done: "queue.Queue[int]" = queue.Queue()
+        self._chunk_ids = itertools.count()
+        _WORKER_STATE = state
+        self._pool = multiprocessing.get_context('fork').Pool(
+            workers,
+            initializer=_worker_init,
+            initargs=(initializer,),
+        )
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def submit(self, *args: Any, tag: Any = None) -> None:
+        chunk_id = next(self._chunk_ids)
+        callback = None
+        if not self.ordered:
+            callback = lambda _result: self._done.put(chunk_id)
+        if self.with_state:
+            result = self._pool.apply_async(_call_with_state, (self.func, args),
+                callback=callback, error_callback=callback)
+        else:
+            result = self._pool.apply_async(self.func, args,
+                callback=callback, error_callback=callback)
+        self._inflight[chunk_id] = (tag, result)
+        while len(self._inflight) > self.max_inflight:
+            self.handle_next()
+
+    def handle_next(self) -> None:
+        """
+        Waits for the next chunk (in order, or the next one to finish) and
+        handles it
+        """
+        if self.ordered:
+            (_chunk_id, (tag, result)) = self._inflight.popitem(last=False)
+        else:
+            (tag, result) = self._inflight.pop(self._done.get())
+        self.handle(tag, result.get())
+
+    def drain(self) -> None:
+        """
+        Waits for and handles all submitted chunks
+        """
+        while self._inflight:
+            self.handle_next()
+
+    def close(self) -> None:
+        """
+        Waits for the worker processes to exit; unhandled results are dropped
+        """
+        self._pool.close()
+        self._pool.join()
+        self._inflight.clear()
+
+    def terminate(self) -> None:
+        """
+        Stops the worker processes immediately
+        """
+        self._pool.terminate()
+        self._pool.join()
+        self._inflight.clear()
+
+    def __enter__(self) -> "ChunkPool":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -1,13 +1,23 @@
 
+import sys
 import json
-import copy
 import subprocess
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from fatcat_openapi_client import ApiClient, Editgroup
+from fatcat_tools.chunk_pool import ChunkPool
 from fatcat_tools.transforms import entity_from_dict, entity_to_dict
 
 
+def _clean_chunk(cleaner, chunk):
+    """
+    Runs in a worker process (with the worker's copy of the cleaner); returns
+    a list of clean_record() results.
+    """
+    return [cleaner.clean_record(record) for record in chunk]
+
+
 class EntityCleaner:
     """
     API for individual jobs:
@@ -22,9 +32,24 @@ class EntityCleaner:
         counts({'lines', 'skip', 'merged', 'updated'})
 
         # implemented per-task
-        try_merge(idents, primary=None) -> int (entities updated)
+        want(record) -> bool (optional cheap pre-filter on raw dicts)
+        clean_entity(entity) -> entity
+        get_existing(ident) -> entity or None (if not found)
+        try_update(entity, existing) -> int (entities updated)
 
     This class is pretty similar to EntityImporter, but isn't subclassed.
+
+    For bulk runs over full dumps:
+
+    - with `workers` > 1, records are deserialized and cleaned in a pool of
+      forked worker processes, `chunk_size` records at a time
+    - cleaned entities are collected in batches of `fetch_batch_size`, and
+      the current version of each is fetched with `fetch_threads` concurrent
+      requests; updates themselves are made serially, in input order
+    - in dry-run mode, entities which would be updated are written as JSON
+      lines to `output` (default stdout), serialized by the workers; with
+      `dry_run_output` of 'cleaned' (the default) the cleaned entities, or
+      with 'original' the entities as they were before cleaning
     """
 
     def __init__(self, api, entity_type, **kwargs):
@@ -37,21 +62,32 @@ class EntityCleaner:
         self.api = api
         self.entity_type = entity_type
         self.dry_run_mode = kwargs.get('dry_run_mode', True)
+        self.dry_run_output = kwargs.get('dry_run_output', 'cleaned')
+        if self.dry_run_output not in ('cleaned', 'original'):
+            raise ValueError("unknown dry_run_output: {}".format(self.dry_run_output))
         self.edit_batch_size = kwargs.get('edit_batch_size', 50)
         self.editgroup_description = kwargs.get('editgroup_description', "Generic Entity Cleaner Bot")
         self.editgroup_extra = eg_extra
+        self.workers = kwargs.get('workers', 1)
+        self.chunk_size = kwargs.get('chunk_size', 200)
+        self.fetch_threads = kwargs.get('fetch_threads', 8)
+        self.fetch_batch_size = kwargs.get('fetch_batch_size', 50)
+        self.output = kwargs.get('output') or sys.stdout
+        self._pool = None
+        self._fetch_executor = None
         self.reset()
         self.ac = ApiClient()
 
         if self.dry_run_mode:
-            print("Running in dry-run mode!")
+            print("Running in dry-run mode!", file=sys.stderr)
 
     def reset(self):
         self.counts = Counter({'lines': 0, 'cleaned': 0, 'updated': 0})
         self._edit_count = 0
         self._editgroup_id = None
         self._entity_queue = []
-        self._idents_inflight = []
+        self._idents_inflight = set()
+        self._chunk = []
 
     def push_record(self, record):
         """
@@ -62,44 +98,102 @@ class EntityCleaner:
 
         Returns nothing.
         """
-        self.counts['lines'] += 1
-        if (not record):
-            self.counts['skip-null'] += 1
+        if self.workers <= 1:
+            self._handle_result(self.clean_record(record))
             return
+        self._chunk.append(record)
+        if len(self._chunk) >= self.chunk_size:
+            self._dispatch_chunk()
 
-        entity = entity_from_dict(record, self.entity_type, api_client=self.ac)
+    def clean_record(self, record):
+        """
+        Deserializes and cleans a single record, without touching the API.
 
-        if entity.state != 'active':
-            self.counts['skip-inactive'] += 1
+        Returns a (status, value) tuple, where status is a counts key. For
+        'cleaned' records, value is the cleaned entity (or, in dry-run mode,
+        the JSON serialization of the entity per `dry_run_output`).
+        """
+        if (not record):
+            return ('skip-null', None)
+        if record.get('state') != 'active':
+            return ('skip-inactive', None)
+        if not self.want(record):
+            return ('skip-clean', None)
+
+        # a second deserialization is cheaper than copy.deepcopy()
+        entity = entity_from_dict(record, self.entity_type)
+        cleaned = self.clean_entity(entity_from_dict(record, self.entity_type))
+        if entity == cleaned:
+            return ('skip-clean', None)
+
+        if self.dry_run_mode:
+            if self.dry_run_output == 'original':
+                return ('cleaned', json.dumps(entity_to_dict(entity)))
+            return ('cleaned', json.dumps(entity_to_dict(cleaned)))
+        return ('cleaned', cleaned)
+
+    def _handle_result(self, result):
+        (status, value) = result
+        self.counts['lines'] += 1
+        self.counts[status] += 1
+        if status != 'cleaned':
             return
+        if self.dry_run_mode:
+            self.output.write(value + "\n")
+            return
+        self._entity_queue.append(value)
+        if len(self._entity_queue) >= self.fetch_batch_size:
+            self._flush_entities()
 
-        cleaned = self.clean_entity(copy.deepcopy(entity))
-        if entity == cleaned:
-            self.counts['skip-clean'] += 1
+    def _dispatch_chunk(self):
+        if self._pool is None:
+            self._pool = ChunkPool(_clean_chunk, self._handle_chunk, self.workers, state=self)
+        self._pool.submit(self._chunk)
+        self._chunk = []
+
+    def _handle_chunk(self, _tag, results):
+        for result in results:
+            self._handle_result(result)
+
+    def _flush_entities(self):
+        """
+        Fetches the current version of all queued entities concurrently, then
+        updates them in order.
+        """
+        entities = self._entity_queue
+        self._entity_queue = []
+        if not entities:
             return
+        if self.fetch_threads > 1 and len(entities) > 1:
+            if self._fetch_executor is None:
+                self._fetch_executor = ThreadPoolExecutor(max_workers=self.fetch_threads)
+            existing = list(self._fetch_executor.map(self.get_existing, [e.ident for e in entities]))
         else:
-            self.counts['cleaned'] += 1
+            existing = [self.get_existing(e.ident) for e in entities]
 
-        if self.dry_run_mode:
-            entity_dict = entity_to_dict(entity, api_client=self.ac)
-            print(json.dumps(entity_dict))
-            return
+        for (entity, current) in zip(entities, existing):
+            if entity.ident in self._idents_inflight:
+                raise ValueError("Entity already part of in-process update: {}".format(entity.ident))
 
-        if entity.ident in self._idents_inflight:
-            raise ValueError("Entity already part of in-process update: {}".format(entity.ident))
+            updated = self.try_update(entity, current)
+            if updated:
+                self.counts['updated'] += updated
+                self._edit_count += updated
+                self._idents_inflight.add(entity.ident)
 
-        updated = self.try_update(cleaned)
-        if updated:
-            self.counts['updated'] += updated
-            self._edit_count += updated
-            self._idents_inflight.append(entity.ident)
+            if self._edit_count >= self.edit_batch_size:
+                self.api.accept_editgroup(self._editgroup_id)
+                self._editgroup_id = None
+                self._edit_count = 0
+                self._idents_inflight = set()
 
-        if self._edit_count >= self.edit_batch_size:
-            self.api.accept_editgroup(self._editgroup_id)
-            self._editgroup_id = None
-            self._edit_count = 0
-            self._idents_inflight = []
-        return
+    def want(self, record):
+        """
+        Cheap check on the raw record dict; returning False skips it as
+        already clean, without deserializing it. Default is to check all
+        records.
+        """
+        return True
 
     def clean_entity(self, entity):
         """
@@ -108,10 +202,20 @@ class EntityCleaner:
         # implementations should fill this in
         raise NotImplementedError
 
-    def try_update(self, entity):
+    def get_existing(self, ident):
+        """
+        Fetches the current version of an entity from the API, or returns None
+        if it doesn't exist. Called from multiple threads.
+        """
+        # implementations should fill this in
+        raise NotImplementedError
+
+    def try_update(self, entity, existing):
         """
         Returns edit count (number of entities updated).
 
+        `existing` is the current version of the entity (from get_existing()).
+
         If >= 1, does not need to update self.counts. If no entities updated,
         do need to update counts internally.
         """
@@ -119,11 +223,23 @@ class EntityCleaner:
         raise NotImplementedError
 
     def finish(self):
+        if self._chunk:
+            self._dispatch_chunk()
+        if self._pool is not None:
+            self._pool.drain()
+            self._pool.close()
+            self._pool = None
+        self._flush_entities()
+        if self._fetch_executor is not None:
+            self._fetch_executor.shutdown(wait=True)
+            self._fetch_executor = None
+        self.output.flush()
+
         if self._edit_count > 0:
             self.api.accept_editgroup(self._editgroup_id)
             self._editgroup_id = None
             self._edit_count = 0
-            self._idents_inflight = []
+            self._idents_inflight = set()
 
         return self.counts
 
@@ -21,6 +21,21 @@ class FileCleaner(EntityCleaner):
             editgroup_extra=eg_extra,
             **kwargs)
 
+    def want(self, record):
+        """
+        Only records with URLs which clean_entity() might change need to be
+        looked at more closely.
+        """
+        for u in record.get('urls') or []:
+            url = u.get('url') or ''
+            if '://web.archive.org/web/None/' in url:
+                return True
+            if '://web.archive.org/web/' in url and len(url.split('/')[4]) <= 8:
+                return True
+            if '://archive.org/' in url and u.get('rel') == 'repository':
+                return True
+        return False
+
     def clean_entity(self, entity):
         """
         TODO: mimetype is bogus like (???) => clean mimetype
@@ -50,16 +65,20 @@ class FileCleaner(EntityCleaner):
 
         return entity
 
-    def try_update(self, entity):
+    def get_existing(self, ident):
 
         try:
-            existing = self.api.get_file(entity.ident)
+            return self.api.get_file(ident)
         except ApiException as err:
             if err.status != 404:
                 raise err
+            return None
+
+    def try_update(self, entity, existing):
+
+        if existing is None:
             self.counts['skip-not-found'] += 1
             return 0
-
         if existing.state != 'active':
             self.counts['skip-existing-inactive'] += 1
             return 0
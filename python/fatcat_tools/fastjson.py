@@ -0,0 +1,73 @@
+
+"""
+Pluggable JSON decoding for high-volume record streams (Kafka messages,
+JSON-lines dumps).
+
+If the `orjson` library is installed it is used to parse directly from bytes
+(eg, Kafka message values, or lines read from a binary file), skipping the
+intermediate UTF-8 decode to str. Otherwise, or if orjson rejects a document
+which the standard library would accept (eg, NaN or Infinity), falls back to the stdlib `json` module.
+
+Results are the same either way, with one known exception: orjson parses
+integers which don't fit in 64 bits as floats (none of the bibliographic
+metadata sources we consume have these).
+"""
+
+import json
+from typing import Any, Callable, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JsonInput = Union[bytes, bytearray, memoryview, str]
+
+
+def stdlib_json_loads(raw: JsonInput) -> Any:
+    if isinstance(raw, memoryview):
+        raw = raw.tobytes()
+    return json.loads(raw)
+
+def orjson_loads(raw: JsonInput) -> Any:
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than the stdlib; try again before giving up
+        return stdlib_json_loads(raw)
+
+def get_json_decoder(backend: str = "auto") -> Callable[[JsonInput], Any]:
+    """
+    Returns a decoding function for the given backend: "orjson", "stdlib", or
+    "auto" (orjson if available).
+    """
+    if backend == "auto":
+        backend = "orjson" if orjson is not None else "stdlib"
+    if backend == "orjson":
+        if orjson is None:
+            raise ValueError("orjson JSON backend requested, but not installed")
+        return orjson_loads
+    elif backend == "stdlib":
+        return stdlib_json_loads
+    raise ValueError("unknown JSON backend: {}".format(backend))
+
+# default decoder for all the pushers and workers
+json_loads = get_json_decoder()
+
+
+def test_json_loads() -> None:
+
+    for backend in ("stdlib", "auto"):
+        loads = get_json_decoder(backend)
+        assert loads('{"a": [1, 2.5, null, "\\u00e9"]}') == {"a": [1, 2.5, None, "é"]}
+        assert loads(b'{"a": "\xc3\xa9"}\n') == {"a": "é"}
+        assert loads(bytearray(b'[1]')) == [1]
+        assert loads(memoryview(b'{"x": {}}')) == {"x": {}}
+        # accepted by stdlib, but not by orjson
+        assert loads('{"x": NaN}')['x'] != 0
+        try:
+            loads(b'{"blah"')
+            assert False, "should have raised"
+        except ValueError:
+            pass
@@ -2,10 +2,11 @@
 import sys
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from confluent_kafka import Producer, KafkaException
 from urllib.parse import urlparse, parse_qs
 
-from .harvest_common import HarvestState, requests_retry_session
+from .harvest_common import HarvestState, requests_retry_session, split_json_items
 
 
 class HarvestCrossrefWorker:
@@ -54,13 +55,26 @@ class HarvestCrossrefWorker:
         - start a loop for just that date, using resumption token for this query
         - when done, publish to state feed, with immediate sync
 
-    TODO: what sort of parallelism? I guess multi-processing on dates, but need
-    to be careful how state is serialized back into kafka.
+    Several dates can be harvested concurrently (eg, when catching up after
+    downtime) by passing `concurrency`; this is capped per-source by
+    `max_concurrency`, to stay polite to the API. HarvestState takes care of
+    only publishing state once all earlier dates are done.
+
+    Within a date, fetching is pipelined: the request for the next cursor
+    page is sent as soon as the cursor is known, and runs while the current
+    page is being produced to Kafka. Records are produced with their original
+    JSON text from the API response, without a decode/re-encode cycle.
     """
 
+    # crossref asks API users to keep concurrent requests low
+    max_concurrency = 4
+
+    # location of the records array in API responses
+    items_path = ('message', 'items')
+
     def __init__(self, kafka_hosts, produce_topic, state_topic, contact_email,
             api_host_url="https://api.crossref.org/works", start_date=None,
-            end_date=None):
+            end_date=None, concurrency=1):
 
         self.api_host_url = api_host_url
         self.produce_topic = produce_topic
@@ -76,6 +90,7 @@ class HarvestCrossrefWorker:
 
         self.loop_sleep = 60*60 # how long to wait, in seconds, between date checks
         self.api_batch_size = 50
+        self.concurrency = max(1, min(concurrency, self.max_concurrency))
         self.name = "Crossref"
         self.producer = self._kafka_producer()
 
@@ -115,16 +130,14 @@ class HarvestCrossrefWorker:
     def extract_key(self, obj):
         return obj['DOI'].encode('utf-8')
 
-    def fetch_date(self, date):
+    def fetch_page(self, http_session, params):
+        """
+        Fetches and parses a single page of API results.
 
-        date_str = date.isoformat()
-        params = self.params(date_str)
-        http_session = requests_retry_session()
-        http_session.headers.update({
-            'User-Agent': 'fatcat_tools/0.1.0 (https://fatcat.wiki; mailto:{}) python-requests'.format(
-                self.contact_email),
-        })
-        count = 0
+        Returns a tuple of the parsed response, the raw JSON (bytes) of each
+        record, and how long the fetch took (in seconds).
+        """
+        start = time.monotonic()
         while True:
             http_resp = http_session.get(self.api_host_url, params=params)
             if http_resp.status_code == 503:
@@ -136,29 +149,57 @@ class HarvestCrossrefWorker:
                 time.sleep(30.0)
                 continue
             http_resp.raise_for_status()
+            break
+        resp_body = http_resp.text
+        try:
+            resp, raw_items = split_json_items(resp_body, self.items_path)
+        except ValueError:
             try:
-                resp_body = http_resp.text
                 resp = json.loads(resp_body)
             except json.JSONDecodeError as exc:
                 # Datacite API returned HTTP 200, but JSON seemed unparseable.
                 # It might be a glitch, so we retry.
                 print("failed to decode body from {}: {}".format(http_resp.url, resp_body), file=sys.stderr)
                 raise
-            items = self.extract_items(resp)
-            count += len(items)
-            print("... got {} ({} of {}), HTTP fetch took {}".format(len(items), count,
-                self.extract_total(resp), http_resp.elapsed), file=sys.stderr)
-            #print(json.dumps(resp))
-            for work in items:
-                self.producer.produce(
-                    self.produce_topic,
-                    json.dumps(work).encode('utf-8'),
-                    key=self.extract_key(work),
-                    on_delivery=self._kafka_fail_fast)
-            self.producer.poll(0)
-            if len(items) < self.api_batch_size:
-                break
-            params = self.update_params(params, resp)
+            # valid JSON, but not laid out as expected; re-encode records
+            raw_items = [json.dumps(work).encode('utf-8') for work in self.extract_items(resp)]
+        return (resp, raw_items, time.monotonic() - start)
+
+    def fetch_date(self, date):
+
+        date_str = date.isoformat()
+        params = self.params(date_str)
+        http_session = requests_retry_session()
+        http_session.headers.update({
+            'User-Agent': 'fatcat_tools/0.1.0 (https://fatcat.wiki; mailto:{}) python-requests'.format(
+                self.contact_email),
+        })
+        count = 0
+        # single background fetcher, so at most one request is ahead of us
+        with ThreadPoolExecutor(max_workers=1) as fetcher:
+            next_page = fetcher.submit(self.fetch_page, http_session, dict(params))
+            while next_page is not None:
+                wait_start = time.monotonic()
+                (resp, raw_items, fetch_time) = next_page.result()
+                wait_time = time.monotonic() - wait_start
+                items = self.extract_items(resp)
+                next_page = None
+                if len(items) >= self.api_batch_size:
+                    params = self.update_params(params, resp)
+                    next_page = fetcher.submit(self.fetch_page, http_session, dict(params))
+
+                produce_start = time.monotonic()
+                for (work, raw) in zip(items, raw_items):
+                    self.producer.produce(
+                        self.produce_topic,
+                        raw,
+                        key=self.extract_key(work),
+                        on_delivery=self._kafka_fail_fast)
+                self.producer.poll(0)
+                count += len(items)
+                print("... got {} ({} of {}), HTTP fetch took {:.2f}s (waited {:.2f}s), produce took {:.2f}s".format(
+                    len(items), count, self.extract_total(resp), fetch_time, wait_time,
+                    time.monotonic() - produce_start), file=sys.stderr)
         self.producer.flush()
 
     def extract_items(self, resp):
@@ -170,14 +211,20 @@ class HarvestCrossrefWorker:
     def run(self, continuous=False):
 
         while True:
-            current = self.state.next_span(continuous)
-            if current:
-                print("Fetching DOIs updated on {} (UTC)".format(current), file=sys.stderr)
-                self.fetch_date(current)
-                self.state.complete(current,
+            if self.concurrency > 1:
+                self.state.harvest_concurrently(self.fetch_date, self.concurrency,
+                    continuous=continuous,
                     kafka_topic=self.state_topic,
                     kafka_config=self.kafka_config)
-                continue
+            else:
+                current = self.state.next_span(continuous)
+                if current:
+                    print("Fetching DOIs updated on {} (UTC)".format(current), file=sys.stderr)
+                    self.fetch_date(current)
+                    self.state.complete(current,
+                        kafka_topic=self.state_topic,
+                        kafka_config=self.kafka_config)
+                    continue
 
             if continuous:
                 print("Sleeping {} seconds...".format(self.loop_sleep), file=sys.stderr)
@@ -199,16 +246,22 @@ class HarvestDataciteWorker(HarvestCrossrefWorker):
     could/should use this script for that, and dump to JSON?
     """
 
+    # datacite API is prone to HTTP 500s under load
+    max_concurrency = 2
+
+    items_path = ('data',)
+
     def __init__(self, kafka_hosts, produce_topic, state_topic, contact_email,
             api_host_url="https://api.datacite.org/dois",
-            start_date=None, end_date=None):
+            start_date=None, end_date=None, concurrency=1):
         super().__init__(kafka_hosts=kafka_hosts,
                          produce_topic=produce_topic,
                          state_topic=state_topic,
                          api_host_url=api_host_url,
                          contact_email=contact_email,
                          start_date=start_date,
-                         end_date=end_date)
+                         end_date=end_date,
+                         concurrency=concurrency)
 
         # for datecite, it's "from-update-date"
         self.name = "Datacite"
@@ -1,7 +1,9 @@
 
+import re
 import sys
 import json
 import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
 from requests.adapters import HTTPAdapter
 # unclear why pylint chokes on this import. Recent 'requests' and 'urllib3' are
@@ -31,33 +33,135 @@ def requests_retry_session(retries=10, backoff_factor=3,
     session.mount('https://', adapter)
     return session
 
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
+def split_json_items(body, path):
+    """
+    Parses a JSON API response body (str) which contains an array of records
+    at `path`, a tuple of object keys (eg, `('message', 'items')`).
+
+    Returns a tuple of the parsed document and a list with the original JSON
+    text (as UTF-8 bytes) of each record in the array, so records can be
+    passed along as-is instead of being re-encoded. The body is only decoded
+    once.
+
+    Raises ValueError if the body isn't valid JSON or has an unexpected
+    structure.
+    """
+    raw_items = []
+
+    def skip(pos):
+        return _JSON_WS.match(body, pos).end()
+
+    def expect(pos, char):
+        pos = skip(pos)
+        if body[pos:pos+1] != char:
+            raise ValueError("expected '{}' at position {}".format(char, pos))
+        return pos + 1
+
+    def parse_items(pos):
+        items = []
+        pos = skip(expect(pos, '['))
+        if body[pos:pos+1] == ']':
+            return items, pos + 1
+        while True:
+            pos = skip(pos)
+            item, end = _json_decoder.raw_decode(body, pos)
+            items.append(item)
+            raw_items.append(body[pos:end].encode('utf-8'))
+            pos = skip(end)
+            if body[pos:pos+1] == ']':
+                return items, pos + 1
+            pos = expect(pos, ',')
+
+    def parse_object(pos, path):
+        obj = dict()
+        pos = skip(expect(pos, '{'))
+        if body[pos:pos+1] == '}':
+            return obj, pos + 1
+        while True:
+            key, pos = _json_decoder.raw_decode(body, skip(pos))
+            if not isinstance(key, str):
+                raise ValueError("expected object key at position {}".format(pos))
+            pos = skip(expect(pos, ':'))
+            if key == path[0] and len(path) == 1:
+                obj[key], pos = parse_items(pos)
+            elif key == path[0]:
+                obj[key], pos = parse_object(pos, path[1:])
+            else:
+                obj[key], pos = _json_decoder.raw_decode(body, pos)
+            pos = skip(pos)
+            if body[pos:pos+1] == '}':
+                return obj, pos + 1
+            pos = expect(pos, ',')
+
+    doc, pos = parse_object(0, path)
+    if skip(pos) != len(body):
+        raise ValueError("extra data at position {}".format(pos))
+    return doc, raw_items
+
+def date_ranges(dates):
+    """
+    Collapses a collection of dates into a sorted list of (first, last)
+    tuples of consecutive runs.
+    """
+    ranges = []
+    for d in sorted(dates):
+        if ranges and ranges[-1][1] + datetime.timedelta(days=1) == d:
+            ranges[-1] = (ranges[-1][0], d)
+        else:
+            ranges.append((d, d))
+    return ranges
+
 class HarvestState:
     """
     First version of this works with full days (dates)
 
     General concept is to have harvesters serialize state when they make
     progress and push to kafka. On startup, harvesters are given a task (extend
-    of work), and consume the full history to see what work remains to be done.
+    of work), and consume the history to see what work remains to be done.
+
+    Every `snapshot_interval` completions, a compacted snapshot of all
+    completed dates (as date ranges) is published to the state topic as well,
+    so that on startup only the most recent snapshot and the messages after it
+    need to be read, instead of the full history.
 
     The simplest flow is:
     - harvester is told to collect last N days of updates
     - creates an to_process set
     - for each update, pops date from in_progress (if exits)
 
+    For harvesting several dates concurrently, start_span() and finish() are
+    used instead of next_span() and complete(). Dates which have been started
+    are tracked as in_progress, and dates which have been harvested (but not
+    yet marked completed) as finished. A date is only marked as completed
+    (and published) once it and all earlier dates still to be processed are
+    finished, so a restart after a crash never skips over a gap.
+
     NOTE: this thing is sorta over-engineered... but might grow in the future
     NOTE: should this class manage the state topic as well? Hrm.
     """
 
+    snapshot_interval = 30
+
     def __init__(self, start_date=None, end_date=None, catchup_days=14):
         self.to_process = set()
         self.completed = set()
+        self.in_progress = set()
+        self.finished = set()
+        # number of completions published since the last snapshot
+        self.since_snapshot = 0
+        # long-lived producer for state updates, created on first use
+        self._producer = None
+        self._producer_config = None
 
         if catchup_days or start_date or end_date:
             self.enqueue_period(start_date, end_date, catchup_days)
 
     def __str__(self):
-        return '<HarvestState to_process={}, completed={}>'.format(
-            len(self.to_process), len(self.completed))
+        return '<HarvestState to_process={}, completed={}, in_progress={}>'.format(
+            len(self.to_process), len(self.completed), len(self.in_progress))
 
     def enqueue_period(self, start_date=None, end_date=None, catchup_days=14):
         """
@@ -96,6 +200,49 @@ class HarvestState:
             return None
         return sorted(list(self.to_process))[0]
 
+    def start_span(self, continuous=False):
+        """
+        Like next_span(), but for concurrent harvesting: returns the earliest
+        date which needs processing and hasn't been started yet, and marks it
+        as in progress. Returns None if there is no such date.
+        """
+        if continuous:
+            self.enqueue_period(start_date=datetime.datetime.utcnow().date() - datetime.timedelta(days=1))
+        available = self.to_process - self.in_progress - self.finished
+        if not available:
+            return None
+        date = min(available)
+        self.in_progress.add(date)
+        return date
+
+    def finish(self, date, kafka_topic=None, kafka_config=None):
+        """
+        Records that a date started with start_span() has been processed
+        successfully.
+
+        The date, and any later dates which were waiting on it, are marked as
+        completed (see complete()) only once all earlier dates are done.
+        Returns a list of the JSON state updates published (if any).
+        """
+        self.in_progress.discard(date)
+        if date not in self.to_process:
+            return []
+        self.finished.add(date)
+        published = []
+        for d in sorted(self.to_process):
+            if d not in self.finished:
+                break
+            self.finished.remove(d)
+            published.append(self.complete(d, kafka_topic=kafka_topic, kafka_config=kafka_config))
+        return published
+
+    def fail(self, date):
+        """
+        Records that processing of a date started with start_span() failed;
+        it will be returned by start_span() again.
+        """
+        self.in_progress.discard(date)
+
     def update(self, state_json):
         """
         Merges a state JSON object into the current state.
@@ -104,36 +251,34 @@ class HarvestState:
         state stored on disk or in Kafka.
         """
         state = json.loads(state_json)
+        if 'completed-ranges' in state:
+            for (first, last) in state['completed-ranges']:
+                current = datetime.datetime.strptime(first, DATE_FMT).date()
+                last = datetime.datetime.strptime(last, DATE_FMT).date()
+                while current <= last:
+                    self._mark_completed(current)
+                    current += datetime.timedelta(days=1)
         if 'completed-date' in state:
             date = datetime.datetime.strptime(state['completed-date'], DATE_FMT).date()
-            self.complete(date)
+            self._mark_completed(date)
 
-    def complete(self, date, kafka_topic=None, kafka_config=None):
-        """
-        Records that a date has been processed successfully.
+    def _mark_completed(self, date):
+        self.to_process.discard(date)
+        self.completed.add(date)
 
-        Updates internal state and returns a JSON representation to be
-        serialized. Will publish to a kafka topic if passed as an argument.
+    def _publish(self, kafka_topic, kafka_config, state_json):
+        """
+        Publishes a state message, and waits for it to be confirmed.
 
-        kafka_topic should be a string. A producer will be created and destroyed.
+        The producer is kept around between calls (for the same config).
         """
-        try:
-            self.to_process.remove(date)
-        except KeyError:
-            pass
-        self.completed.add(date)
-        state_json = json.dumps({
-            'in-progress-dates': [str(d) for d in self.to_process],
-            'completed-date': str(date),
-        }).encode('utf-8')
-        if kafka_topic:
-            assert(kafka_config)
+        if self._producer is None or self._producer_config != kafka_config:
 
             def fail_fast(err, msg):
                 if err:
                     raise KafkaException(err)
 
-            print("Committing status to Kafka: {}".format(kafka_topic), file=sys.stderr)
+            self._kafka_fail_fast = fail_fast
             producer_conf = kafka_config.copy()
             producer_conf.update({
                 'delivery.report.only.error': True,
@@ -141,18 +286,120 @@ class HarvestState:
                     'request.required.acks': -1, # all brokers must confirm
                 },
             })
-            producer = Producer(producer_conf)
-            producer.produce(
-                kafka_topic,
-                state_json,
-                on_delivery=fail_fast)
-            producer.flush()
+            self._producer = Producer(producer_conf)
+            self._producer_config = kafka_config.copy()
+        self._producer.produce(
+            kafka_topic,
+            state_json,
+            on_delivery=self._kafka_fail_fast)
+        self._producer.flush()
+
+    def snapshot(self):
+        """
+        Returns a compacted JSON representation of all completed dates.
+        """
+        return json.dumps({
+            'completed-ranges': [[str(first), str(last)] for (first, last) in date_ranges(self.completed)],
+        }).encode('utf-8')
+
+    def publish_snapshot(self, kafka_topic, kafka_config):
+        print("Committing state snapshot to Kafka: {}".format(kafka_topic), file=sys.stderr)
+        self._publish(kafka_topic, kafka_config, self.snapshot())
+        self.since_snapshot = 0
+
+    def complete(self, date, kafka_topic=None, kafka_config=None):
+        """
+        Records that a date has been processed successfully.
+
+        Updates internal state and returns a JSON representation to be
+        serialized. Will publish to a kafka topic if passed as an argument
+        (along with a snapshot, every `snapshot_interval` completions).
+
+        kafka_topic should be a string. The producer is re-used across calls.
+        """
+        self._mark_completed(date)
+        state_json = json.dumps({
+            'in-progress-dates': [str(d) for d in self.to_process],
+            'completed-date': str(date),
+        }).encode('utf-8')
+        if kafka_topic:
+            assert(kafka_config)
+            print("Committing status to Kafka: {}".format(kafka_topic), file=sys.stderr)
+            self._publish(kafka_topic, kafka_config, state_json)
+            self.since_snapshot += 1
+            if self.since_snapshot >= self.snapshot_interval:
+                self.publish_snapshot(kafka_topic, kafka_config)
         return state_json
 
+    def harvest_concurrently(self, fetch_date, concurrency, continuous=False,
+            kafka_topic=None, kafka_config=None):
+        """
+        Runs fetch_date(date) for all dates to be processed, with up to
+        `concurrency` dates in flight at a time (in threads), and marks dates
+        completed in order.
+
+        If fetching any date fails, no new dates are started; the exception is
+        re-raised after the remaining in-flight dates are done.
+        """
+        inflight = dict()
+        error = None
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                while error is None and len(inflight) < concurrency:
+                    date = self.start_span(continuous)
+                    if date is None:
+                        break
+                    print("Fetching updates for {} (UTC), {} dates in flight".format(
+                        date, len(inflight) + 1), file=sys.stderr)
+                    inflight[executor.submit(fetch_date, date)] = date
+                if not inflight:
+                    break
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    date = inflight.pop(fut)
+                    exc = fut.exception()
+                    if exc is not None:
+                        print("Failed to fetch {}: {}".format(date, exc), file=sys.stderr)
+                        self.fail(date)
+                        error = error or exc
+                        continue
+                    self.finish(date, kafka_topic=kafka_topic, kafka_config=kafka_config)
+        if error is not None:
+            raise error
+
+    def _read_state_messages(self, consumer, kafka_topic, start, end):
+        """
+        Returns the values (str) of messages at offsets [start, end) of the
+        state topic.
+        """
+        consumer.assign([TopicPartition(kafka_topic, 0, start)])
+        values = []
+        last_offset = start - 1
+        while last_offset < end - 1:
+            msg = consumer.poll(timeout=2.0)
+            if not msg:
+                break
+            if msg.error():
+                raise KafkaException(msg.error())
+            if msg.offset() >= end:
+                break
+            values.append(msg.value().decode('utf-8'))
+            last_offset = msg.offset()
+        # verify that we got at least to the end of the window
+        if last_offset < end - 1:
+            raise Exception("Kafka consumer timeout reading state topic {} (offset {} of {})".format(
+                kafka_topic, last_offset + 1, end))
+        return values
+
     def initialize_from_kafka(self, kafka_topic, kafka_config):
         """
         kafka_topic should have type str
 
+        Reads backwards from the end of the topic, a window at a time, until
+        the most recent snapshot turns up, then applies that snapshot and all
+        later messages. Topics without any snapshot are replayed in full, and
+        if many messages had to be replayed, a fresh snapshot gets published.
+
         TODO: this method does not fail if client can't connect to host.
         """
         if not kafka_topic:
@@ -160,10 +407,6 @@ class HarvestState:
 
         print("Fetching state from kafka topic: {}".format(kafka_topic), file=sys.stderr)
 
-        def fail_fast(err, msg):
-            if err:
-                raise KafkaException(err)
-
         conf = kafka_config.copy()
         conf.update({
             'group.id': 'dummy_init_group', # should never be committed
@@ -182,19 +425,28 @@ class HarvestState:
         if not hwm:
             raise Exception("Kafka consumer timeout, or topic {} doesn't exist".format(kafka_topic))
 
-        consumer.assign([TopicPartition(kafka_topic, 0, 0)])
-        c = 0
-        while True:
-            msg = consumer.poll(timeout=2.0)
-            if not msg:
-                break
-            if msg.error():
-                raise KafkaException(msg.error())
-            #sys.stdout.write('.')
-            self.update(msg.value().decode('utf-8'))
-            c += 1
+        (low, end) = hwm
+        snapshot = None
+        tail = []
+        while end > low and snapshot is None:
+            start = max(low, end - 2 * self.snapshot_interval)
+            window = self._read_state_messages(consumer, kafka_topic, start, end)
+            for i in reversed(range(len(window))):
+                if 'completed-ranges' in json.loads(window[i]):
+                    snapshot = window[i]
+                    window = window[i+1:]
+                    break
+            tail = window + tail
+            end = start
         consumer.close()
 
-        # verify that we got at least to HWM
-        assert c >= hwm[1]
-        print("... got {} state update messages, done".format(c), file=sys.stderr)
+        if snapshot is not None:
+            self.update(snapshot)
+        for value in tail:
+            self.update(value)
+        print("... got {} and {} state update messages, done".format(
+            "snapshot" if snapshot else "no snapshot", len(tail)), file=sys.stderr)
+
+        self.since_snapshot = len(tail)
+        if self.since_snapshot >= self.snapshot_interval:
+            self.publish_snapshot(kafka_topic, kafka_config)
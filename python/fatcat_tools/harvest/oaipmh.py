@@ -22,10 +22,15 @@ class HarvestOaiPmhWorker:
     Was very tempted to re-use <https://github.com/miku/metha> for this OAI-PMH
     stuff to save on dev time, but i'd already built the Crossref harvester and
     would want something similar operationally. Oh well!
+
+    Several dates can be harvested concurrently (see HarvestCrossrefWorker),
+    up to a per-endpoint `max_concurrency`.
     """
 
+    max_concurrency = 2
+
     def __init__(self, kafka_hosts, produce_topic, state_topic,
-            start_date=None, end_date=None):
+            start_date=None, end_date=None, concurrency=1):
 
         self.produce_topic = produce_topic
         self.state_topic = state_topic
@@ -35,6 +40,7 @@ class HarvestOaiPmhWorker:
         }
 
         self.loop_sleep = 60*60 # how long to wait, in seconds, between date checks
+        self.concurrency = max(1, min(concurrency, self.max_concurrency))
 
         self.endpoint_url = None # needs override
         self.metadata_prefix = None  # needs override
@@ -90,14 +96,20 @@ class HarvestOaiPmhWorker:
     def run(self, continuous=False):
 
         while True:
-            current = self.state.next_span(continuous)
-            if current:
-                print("Fetching DOIs updated on {} (UTC)".format(current), file=sys.stderr)
-                self.fetch_date(current)
-                self.state.complete(current,
+            if self.concurrency > 1:
+                self.state.harvest_concurrently(self.fetch_date, self.concurrency,
+                    continuous=continuous,
                     kafka_topic=self.state_topic,
                     kafka_config=self.kafka_config)
-                continue
+            else:
+                current = self.state.next_span(continuous)
+                if current:
+                    print("Fetching DOIs updated on {} (UTC)".format(current), file=sys.stderr)
+                    self.fetch_date(current)
+                    self.state.complete(current,
+                        kafka_topic=self.state_topic,
+                        kafka_config=self.kafka_config)
+                    continue
 
             if continuous:
                 print("Sleeping {} seconds...".format(self.loop_sleep), file=sys.stderr)
@@ -115,8 +127,13 @@ class HarvestArxivWorker(HarvestOaiPmhWorker):
 
     All records are work-level. Some metadata formats have internal info about
     specific versions. The 'arXivRaw' format does, so i'm using that.
+
+    arxiv.org rate-limits OAI-PMH clients, so dates are always harvested one
+    at a time.
     """
 
+    max_concurrency = 1
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.endpoint_url = "https://export.arxiv.org/oai2"
@@ -11,18 +11,16 @@ Assumptions:
 import collections
 import gzip
 import io
-import os
+import queue
 import re
-import shutil
 import sys
-import tempfile
+import threading
 import time
 import xml.etree.ElementTree as ET
 from ftplib import FTP
 from urllib.parse import urlparse
 
 import dateparser
-from bs4 import BeautifulSoup
 from confluent_kafka import KafkaException, Producer
 
 from .harvest_common import HarvestState
@@ -56,8 +54,13 @@ class PubmedFTPWorker:
         <table cellspacing="0" cellpadding="0" border="0" width="300">
         <tr>
 
+    Several dates can be harvested concurrently (see HarvestCrossrefWorker),
+    up to `max_concurrency` (NCBI limits concurrent FTP connections).
     """
-    def __init__(self, kafka_hosts, produce_topic, state_topic, start_date=None, end_date=None):
+
+    max_concurrency = 3
+
+    def __init__(self, kafka_hosts, produce_topic, state_topic, start_date=None, end_date=None, concurrency=1):
         self.name = 'Pubmed'
         self.host = 'ftp.ncbi.nlm.nih.gov'
         self.produce_topic = produce_topic
@@ -67,6 +70,7 @@ class PubmedFTPWorker:
             'message.max.bytes': 20000000,  # ~20 MBytes; broker is ~50 MBytes
         }
         self.loop_sleep = 60 * 60  # how long to wait, in seconds, between date checks
+        self.concurrency = max(1, min(concurrency, self.max_concurrency))
         self.state = HarvestState(start_date, end_date)
         self.state.initialize_from_kafka(self.state_topic, self.kafka_config)
         self.producer = self._kafka_producer()
@@ -97,6 +101,11 @@ class PubmedFTPWorker:
         the fetched XML does not contain a PMID, this method will fail.
 
         If no date file mapping is found, this will fail.
+
+        Files are streamed: the FTP download feeds gzip decompression, which
+        feeds an incremental XML parser, so nothing is written to disk. The
+        download of the next file (if any) starts while the current one is
+        being processed.
         """
         if self.date_file_map is None:
             raise ValueError("cannot fetch date without date file mapping")
@@ -108,33 +117,31 @@ class PubmedFTPWorker:
             return False
 
         count = 0
-        for path in paths:
-            # Fetch and decompress file.
-            url = "ftp://{}{}".format(self.host, path)
-            filename = ftpretr(url)
-            with tempfile.NamedTemporaryFile(prefix='fatcat-ftp-tmp-', delete=False) as decomp:
-                gzf = gzip.open(filename)
-                shutil.copyfileobj(gzf, decomp)
-
-            # Here, blob is the unparsed XML; we peek into it to use PMID as
-            # message key. We need streaming, since some updates would consume
-            # GBs otherwise.
-            # WARNING: Parsing foreign XML exposes us at some
-            # https://docs.python.org/3/library/xml.html#xml-vulnerabilities
-            # here.
-            for blob in xmlstream(decomp.name, 'PubmedArticle', encoding='utf-8'):
-                soup = BeautifulSoup(blob, 'xml')
-                pmid = soup.find('PMID')
-                if pmid is None:
-                    raise ValueError("no PMID found, please adjust identifier extraction")
-                count += 1
-                if count % 50 == 0:
-                    print("... up to {}".format(count), file=sys.stderr)
-                self.producer.produce(self.produce_topic, blob, key=pmid.text, on_delivery=self._kafka_fail_fast)
-
-            self.producer.flush()
-            os.remove(filename)
-            os.remove(decomp.name)
+        urls = ["ftp://{}{}".format(self.host, path) for path in sorted(paths)]
+        readers = [FTPStreamReader(urls[0])]
+        try:
+            for i in range(len(urls)):
+                if i + 1 < len(urls):
+                    readers.append(FTPStreamReader(urls[i + 1]))
+                # Here, blob is the unparsed XML; we use the PMID from the
+                # parsed element as message key.
+                # WARNING: Parsing foreign XML exposes us at some
+                # https://docs.python.org/3/library/xml.html#xml-vulnerabilities
+                # here.
+                with gzip.GzipFile(fileobj=readers[i]) as gzf:
+                    for (blob, elem) in xmlstream_elements(gzf, 'PubmedArticle', encoding='utf-8'):
+                        pmid = elem.find('.//PMID')
+                        if pmid is None:
+                            raise ValueError("no PMID found, please adjust identifier extraction")
+                        count += 1
+                        if count % 50 == 0:
+                            print("... up to {}".format(count), file=sys.stderr)
+                        self.producer.produce(self.produce_topic, blob, key=pmid.text, on_delivery=self._kafka_fail_fast)
+                readers[i].close()
+                self.producer.flush()
+        finally:
+            for reader in readers:
+                reader.close()
 
         return True
 
@@ -144,12 +151,18 @@ class PubmedFTPWorker:
             if len(self.date_file_map) == 0:
                 raise ValueError("map from dates to files should not be empty, maybe the HTML changed?")
 
-            current = self.state.next_span(continuous)
-            if current:
-                print("Fetching citations updated on {} (UTC)".format(current), file=sys.stderr)
-                self.fetch_date(current)
-                self.state.complete(current, kafka_topic=self.state_topic, kafka_config=self.kafka_config)
-                continue
+            if self.concurrency > 1:
+                self.state.harvest_concurrently(self.fetch_date, self.concurrency,
+                    continuous=continuous,
+                    kafka_topic=self.state_topic,
+                    kafka_config=self.kafka_config)
+            else:
+                current = self.state.next_span(continuous)
+                if current:
+                    print("Fetching citations updated on {} (UTC)".format(current), file=sys.stderr)
+                    self.fetch_date(current)
+                    self.state.complete(current, kafka_topic=self.state_topic, kafka_config=self.kafka_config)
+                    continue
 
             if continuous:
                 print("Sleeping {} seconds...".format(self.loop_sleep))
@@ -159,6 +172,23 @@ class PubmedFTPWorker:
         print("{} FTP ingest caught up".format(self.name))
 
 
+# seconds; applies to connecting, and to each blocking socket operation
+# after that (so a stalled transfer raises instead of hanging the harvester)
+FTP_TIMEOUT = 120
+
+
+def ftp_connect(netloc, timeout=FTP_TIMEOUT):
+    """
+    Returns a logged-in (anonymous) FTP connection to a host, which may
+    include a port number (eg, "localhost:2121").
+    """
+    parsed = urlparse("ftp://{}".format(netloc))
+    ftp = FTP(timeout=timeout)
+    ftp.connect(parsed.hostname, parsed.port or 21)
+    ftp.login()
+    return ftp
+
+
 def generate_date_file_map(host='ftp.ncbi.nlm.nih.gov'):
     """
     Generate a DefaultDict[string, set] mapping dates to absolute filepaths on
@@ -168,8 +198,7 @@ def generate_date_file_map(host='ftp.ncbi.nlm.nih.gov'):
     """
     mapping = collections.defaultdict(set)
     pattern = re.compile(r'Filename: ([^ ]*.xml) -- Created: ([^<]*)')
-    ftp = FTP(host)
-    ftp.login()
+    ftp = ftp_connect(host)
     filenames = ftp.nlst('/pubmed/updatefiles')
 
     for name in filenames:
@@ -193,36 +222,97 @@ def generate_date_file_map(host='ftp.ncbi.nlm.nih.gov'):
     return mapping
 
 
-def ftpretr(url):
+class FTPStreamReader(io.RawIOBase):
     """
-    Note: This might move into a generic place in the future.
-
-    Fetch (RETR) a remote file given by its URL (e.g.
-    "ftp://ftp.ncbi.nlm.nih.gov/pubmed/updatefiles/pubmed20n1016.xml.gz") to a
-    local temporary file. Returns the name of the local, closed temporary file.
+    Streams a remote file (given by an ftp:// URL) as a read-only, file-like
+    object, without writing it to disk.
 
-    It is the reponsibility of the caller to cleanup the temporary file.
+    The transfer runs in a background thread, which fills a bounded buffer
+    (`buffer_size` bytes, at most), so downloading can start (and run ahead)
+    before the consumer starts reading. Closing the reader aborts an
+    unfinished transfer. Transfer errors are raised from read().
     """
-    parsed = urlparse(url)
-    server, path = parsed.netloc, parsed.path
-    ftp = FTP(server)
-    ftp.login()
-    with tempfile.NamedTemporaryFile(prefix='fatcat-ftp-tmp-', delete=False) as f:
-        print('retrieving {} from {} to {} ...'.format(path, server, f.name), file=sys.stderr)
-        ftp.retrbinary('RETR %s' % path, f.write)
-    ftp.close()
-    return f.name
 
+    def __init__(self, url, buffer_size=64*1024*1024, block_size=64*1024):
+        self.url = url
+        self.block_size = block_size
+        self._queue = queue.Queue(maxsize=max(1, buffer_size // block_size))
+        self._buf = b""
+        self._eof = False
+        self._error = None
+        self._abort = threading.Event()
+        self._thread = threading.Thread(target=self._download, daemon=True)
+        self._thread.start()
+
+    def _put(self, block):
+        while not self._abort.is_set():
+            try:
+                self._queue.put(block, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        # raising here aborts the transfer
+        raise EOFError("FTP transfer aborted")
+
+    def _download(self):
+        parsed = urlparse(self.url)
+        try:
+            ftp = ftp_connect(parsed.netloc)
+            print('streaming {} from {} ...'.format(parsed.path, parsed.netloc), file=sys.stderr)
+            try:
+                ftp.retrbinary('RETR {}'.format(parsed.path), self._put, blocksize=self.block_size)
+            finally:
+                ftp.close()
+        except Exception as e:
+            if not self._abort.is_set():
+                self._error = e
+        finally:
+            # the buffer may well be full (eg, when prefetching the next file),
+            # so keep trying until the consumer makes room or goes away;
+            # otherwise EOF (and any error) would never be seen
+            while not self._abort.is_set():
+                try:
+                    self._queue.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def readable(self):
+        return True
 
-def xmlstream(filename, tag, encoding='utf-8'):
+    def readinto(self, b):
+        while not self._buf and not self._eof:
+            block = self._queue.get()
+            if block is None:
+                self._eof = True
+                if self._error is not None:
+                    raise IOError("FTP transfer of {} failed: {}".format(self.url, self._error))
+            else:
+                self._buf = block
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._abort.set()
+            # unblock the download thread if it's waiting on a full buffer
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        super().close()
+
+
+def xmlstream_elements(source, tag, encoding='utf-8'):
     """
-    Note: This might move into a generic place in the future.
+    Given an XML file (path or file-like object) and a tag name (without
+    namespace), stream through the XML and yield (serialized element, element)
+    tuples for each element denoted by tag.
 
-    Given a path to an XML file and a tag name (without namespace), stream
-    through the XML and yield elements denoted by tag as string.
-
-    for snippet in xmlstream("sample.xml", "sometag"):
-        print(len(snippet))
+    The element is only valid until the next one is yielded.
 
     Known vulnerabilities: https://docs.python.org/3/library/xml.html#xml-vulnerabilities
     """
@@ -232,7 +322,7 @@ def xmlstream(filename, tag, encoding='utf-8'):
         return tag.split('}')[1]
 
     # https://stackoverflow.com/a/13261805, http://effbot.org/elementtree/iterparse.htm
-    context = iter(ET.iterparse(filename, events=(
+    context = iter(ET.iterparse(source, events=(
         'start',
         'end',
     )))
@@ -245,5 +335,21 @@ def xmlstream(filename, tag, encoding='utf-8'):
         if not strip_ns(elem.tag) == tag or event == 'start':
             continue
 
-        yield ET.tostring(elem, encoding=encoding)
+        yield (ET.tostring(elem, encoding=encoding), elem)
         root.clear()
+
+
+def xmlstream(filename, tag, encoding='utf-8'):
+    """
+    Note: This might move into a generic place in the future.
+
+    Given a path to an XML file and a tag name (without namespace), stream
+    through the XML and yield elements denoted by tag as string.
+
+    for snippet in xmlstream("sample.xml", "sometag"):
+        print(len(snippet))
+
+    Known vulnerabilities: https://docs.python.org/3/library/xml.html#xml-vulnerabilities
+    """
+    for (blob, _elem) in xmlstream_elements(filename, tag, encoding=encoding):
+        yield blob
@@ -33,3 +33,5 @@ from .file_meta import FileMetaImporter
 from .doaj_article import DoajArticleImporter
 from .dblp_release import DblpReleaseImporter
 from .dblp_container import DblpContainerImporter
+from .parallel import ParallelImporter
+from .compressed import open_compressed, CompressedFileType
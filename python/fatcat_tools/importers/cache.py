@@ -0,0 +1,248 @@
+
+"""
+Identifier lookup caches for importers (DOI, PMID, ISSN-L, ORCID to fatcat
+ident).
+
+Importers used to keep these in plain dicts, which grow without bound in long
+running (eg, Kafka) importers and are lost on restart. LookupCache is a
+dict-like LRU cache with optional time-to-live and hit/miss metrics. It can
+optionally be backed by a LookupStore (eg, SqliteLookupStore), which persists
+entries across restarts and is shared by all processes using the same file.
+
+Note that "not found" results (None) are cached too, same as before, but
+only in memory. Only results which came from the API (see put_lookup()) are
+written to a persistent store, and then only positive ones: negative results,
+and idents of entities the importer just created (which may be in an
+editgroup that never gets accepted), stay local to the process. A TTL is
+required with a persistent store, so that persisted entries eventually get
+re-checked.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, Counter
+from typing import Any, Optional
+
+
+# marker for cache misses, because None is a valid (cached) value
+MISSING = object()
+
+# default TTL for persisted lookups, if none is given
+DEFAULT_STORE_TTL = 24 * 60 * 60
+
+
+class LookupStore:
+    """
+    Base class for persistent lookup cache backends.
+    """
+
+    def get(self, namespace: str, key: str) -> Any:
+        """
+        Returns a (value, updated) tuple, or MISSING. 'updated' is a UNIX
+        timestamp.
+        """
+        raise NotImplementedError
+
+    def put(self, namespace: str, key: str, value: Optional[str], updated: float) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+
+class SqliteLookupStore(LookupStore):
+    """
+    Local sqlite3 file as a lookup store. Safe to share between threads, and
+    between processes (including forked ones) on the same host; WAL mode is
+    used so that readers don't block on writers.
+
+    Writes are committed every commit_interval writes, and on flush().
+    """
+
+    def __init__(self, db_path: str, commit_interval: int = 100):
+        self.db_path = db_path
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._pending_writes = 0
+        with self._lock:
+            self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections must not be used across fork(); re-open per process
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS lookup_cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (namespace, key))""")
+            self._db.commit()
+            self._db_pid = os.getpid()
+            self._pending_writes = 0
+        return self._db
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value, updated FROM lookup_cache WHERE namespace=? AND key=? LIMIT 1",
+                [namespace, key]).fetchone()
+        if row is None:
+            return MISSING
+        return (row[0], row[1])
+
+    def put(self, namespace: str, key: str, value: Optional[str], updated: float) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO lookup_cache VALUES (?, ?, ?, ?)",
+                [namespace, key, value, updated])
+            self._pending_writes += 1
+            if self._pending_writes >= self.commit_interval:
+                db.commit()
+                self._pending_writes = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._pending_writes:
+                self._connect().commit()
+                self._pending_writes = 0
+
+
+class LookupCache:
+    """
+    Thread-safe LRU cache mapping identifiers (str) to fatcat idents (str or
+    None). Supports the subset of the dict interface that importers use:
+    `key in cache`, `cache[key]`, `cache[key] = value`, get(), len().
+
+    Parameters:
+
+        namespace: eg, "doi"; used as the key prefix in the store
+        max_size: max number of in-memory entries (None for unbounded)
+        ttl: seconds after which entries are considered stale (None for never;
+            required if there is a store)
+        store: optional LookupStore, checked on in-memory misses, and written
+            through by put_lookup() for positive API results
+
+    `cache[key] = value` only updates the in-memory cache.
+    """
+
+    def __init__(self, namespace: str, max_size: Optional[int] = None,
+                 ttl: Optional[float] = None, store: Optional[LookupStore] = None):
+        if store is not None and ttl is None:
+            raise ValueError("a TTL is required for persisted lookup caches")
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self.counts = Counter({'hit': 0, 'miss': 0})
+        self._lock = threading.Lock()
+        # key -> (value, updated)
+        self._entries = OrderedDict()
+
+    def _fresh(self, updated: float) -> bool:
+        return self.ttl is None or (time.time() - updated) < self.ttl
+
+    def _lookup(self, key: str) -> Any:
+        """
+        Returns the cached value, or MISSING; doesn't update hit/miss counts.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._fresh(entry[1]):
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+                self.counts['expired'] += 1
+        if self.store is not None:
+            entry = self.store.get(self.namespace, key)
+            if entry is not MISSING and self._fresh(entry[1]):
+                self._insert(key, entry[0], entry[1])
+                with self._lock:
+                    self.counts['store-hit'] += 1
+                return entry[0]
+        return MISSING
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._lookup(key)
+        with self._lock:
+            if value is MISSING:
+                self.counts['miss'] += 1
+                return default
+            self.counts['hit'] += 1
+        return value
+
+    def _insert(self, key: str, value: Optional[str], updated: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, updated)
+            self._entries.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.counts['evicted'] += 1
+
+    def __setitem__(self, key: str, value: Optional[str]) -> None:
+        self._insert(key, value, time.time())
+
+    def put_lookup(self, key: str, value: Optional[str]) -> None:
+        """
+        Caches the result of an API lookup; found idents are also persisted
+        in the store (if any).
+        """
+        updated = time.time()
+        self._insert(key, value, updated)
+        if self.store is not None and value is not None:
+            self.store.put(self.namespace, key, value, updated)
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self._lookup(key) is not MISSING
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def flush(self) -> None:
+        if self.store is not None:
+            self.store.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counts)
+            stats['size'] = len(self._entries)
+        return stats
+
+
+def test_lookup_cache_lru() -> None:
+
+    cache = LookupCache("doi", max_size=2)
+    cache["10.123/a"] = "aaaaaaaaaaaaarceaaaaaaaaai"
+    cache["10.123/b"] = None
+    assert "10.123/a" in cache
+    assert cache["10.123/b"] is None
+    assert cache.get("10.123/c", MISSING) is MISSING
+
+    # "a" was used more recently than "b", so "b" gets evicted
+    cache.get("10.123/a")
+    cache["10.123/c"] = None
+    assert len(cache) == 2
+    assert "10.123/b" not in cache
+    assert "10.123/a" in cache
+    assert cache.stats()['evicted'] == 1
+
+def test_lookup_cache_ttl() -> None:
+
+    cache = LookupCache("doi", ttl=60)
+    cache["10.123/a"] = None
+    cache._entries["10.123/a"] = (None, time.time() - 120)
+    assert "10.123/a" not in cache
+    assert cache.stats()['expired'] == 1
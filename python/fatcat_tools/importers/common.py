@@ -1,13 +1,17 @@
 
+import os
+import io
 import re
 import sys
 import csv
-import json
+import codecs
 import sqlite3
 import datetime
+import threading
 import subprocess
 from collections import Counter
-from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Iterable
 from confluent_kafka import Consumer, KafkaException
 import lxml
 import xml.parsers.expat
@@ -27,6 +31,12 @@ import fuzzycat.verify
 # TODO: refactor so remove need for this (re-imports for backwards compatibility)
 from fatcat_tools.normal import (clean_str as clean, is_cjk, b32_hex, LANG_MAP_MARC) # noqa: F401
 from fatcat_tools.transforms import entity_to_dict
+from fatcat_tools.fastjson import json_loads
+from .cache import LookupCache, SqliteLookupStore, MISSING, DEFAULT_STORE_TTL
+from .issn_index import IssnIndex, is_issn_index_file
+from .fuzzy import FuzzyReleaseMatcher
+from .lxmlsoup import iter_xml_records, parse_xml_document
+from .compressed import open_input, InputProgress
 
 DATE_FMT = "%Y-%m-%d"
 SANE_MAX_RELEASES = 200
@@ -96,15 +106,57 @@ DOMAIN_REL_MAP = {
     "archive.is": "webarchive",
 }
 
+class UrlRelMatcher:
+    """
+    Classifies URLs by domain, using a map of domain to link 'rel'.
+
+    A URL matches a domain if it contains "//<domain>/" anywhere (so the
+    domain of a URL wrapped in a wayback URL counts as well); if several
+    domains match, the one which comes first in the map wins. Instead of
+    searching for every domain in every URL, each "//" in the URL is found,
+    the host-like text after it is sliced out, and looked up in a dict.
+    """
+
+    def __init__(self, domain_rel_map):
+        # domain -> (priority, rel)
+        self.domains = dict([(domain, (i, rel)) for (i, (domain, rel)) in enumerate(domain_rel_map.items())])
+
+    def rel(self, raw_url, default_link_rel="web"):
+        domains = self.domains
+        best = None
+        start = raw_url.find('//')
+        while start >= 0:
+            end = raw_url.find('/', start + 2)
+            if end < 0:
+                break
+            match = domains.get(raw_url[start+2:end])
+            if match is not None and (best is None or match[0] < best[0]):
+                best = match
+            start = raw_url.find('//', start + 1)
+        if best is None:
+            return default_link_rel
+        return best[1]
+
+    def rels(self, raw_urls, default_link_rel="web"):
+        """
+        Batch version of rel(); returns a list.
+        """
+        rel = self.rel
+        return [rel(u, default_link_rel) for u in raw_urls]
+
+DOMAIN_REL_MATCHER = UrlRelMatcher(DOMAIN_REL_MAP)
+
 def make_rel_url(raw_url, default_link_rel="web"):
     # this is where we map specific domains to rel types, and also filter out
     # bad domains, invalid URLs, etc
-    rel = default_link_rel
-    for domain, domain_rel in DOMAIN_REL_MAP.items():
-        if "//{}/".format(domain) in raw_url:
-            rel = domain_rel
-            break
-    return (rel, raw_url)
+    return (DOMAIN_REL_MATCHER.rel(raw_url, default_link_rel), raw_url)
+
+def make_rel_urls(raw_urls, default_link_rel="web"):
+    """
+    Batch version of make_rel_url(), eg for all the URLs of an entity.
+    """
+    raw_urls = list(raw_urls)
+    return list(zip(DOMAIN_REL_MATCHER.rels(raw_urls, default_link_rel), raw_urls))
 
 def test_make_rel_url():
     assert make_rel_url("http://example.com/thing.pdf")[0] == "web"
@@ -112,6 +164,33 @@ def test_make_rel_url():
     assert make_rel_url("https://web.archive.org/web/*/http://example.com/thing.pdf")[0] == "webarchive"
     assert make_rel_url("http://cell.com/thing.pdf")[0] == "publisher"
 
+def test_make_rel_urls():
+
+    def make_rel_url_scan(raw_url, default_link_rel="web"):
+        # the original implementation
+        for domain, domain_rel in DOMAIN_REL_MAP.items():
+            if "//{}/".format(domain) in raw_url:
+                return (domain_rel, raw_url)
+        return (default_link_rel, raw_url)
+
+    urls = [
+        "http://example.com/thing.pdf",
+        "https://www.cell.com/thing.pdf",
+        "https://web.archive.org/web/2017/http://arxiv.org/pdf/1234.pdf",
+        "https://web.archive.org/web/2017/http://example.com/thing.pdf",
+        "https://archive.org/download/item/thing.pdf",
+        "http://www.researchgate.net",
+        "http://www.researchgate.net:80/thing.pdf",
+        "https://zenodo.org//record/123",
+        "https:///zenodo.org/record/123",
+        "zenodo.org/record/123",
+        "",
+    ]
+    expected = [make_rel_url_scan(u, "jeans") for u in urls]
+    assert [make_rel_url(u, "jeans") for u in urls] == expected
+    assert make_rel_urls(urls, "jeans") == expected
+    assert make_rel_urls(iter(urls[:2])) == [("web", urls[0]), ("publisher", urls[1])]
+
 class EntityImporter:
     """
     Base class for fatcat entity importers.
@@ -144,6 +223,14 @@ class EntityImporter:
 
         submit_mode: instead of accepting editgroups, only submits them.
             implementors must write insert_batch appropriately
+        fuzzy_match_batch_size: if > 1, parsed releases are collected in
+            windows of this size, and fuzzy matched all at once (see
+            fatcat_tools.importers.fuzzy) before try_update() runs on each;
+            match_existing_release_fuzzy() then returns the pre-computed
+            result. Matches are computed for every release in the window, even
+            ones which turn out to have an identifier match.
+        fuzzy_verify_workers: number of worker processes for verifying fuzzy
+            match candidates in batched mode
     """
 
     def __init__(self, api, **kwargs):
@@ -159,21 +246,63 @@ class EntityImporter:
         self.bezerk_mode = kwargs.get('bezerk_mode', False)
         self.submit_mode = kwargs.get('submit_mode', False)
         self.edit_batch_size = kwargs.get('edit_batch_size', 100)
+        self.lookup_threads = kwargs.get('lookup_threads', 8)
         self.editgroup_description = kwargs.get('editgroup_description')
         self.editgroup_extra = eg_extra
 
         self.es_client = kwargs.get('es_client')
         if not self.es_client:
             self.es_client = elasticsearch.Elasticsearch("https://search.fatcat.wiki", timeout=120)
-
-        self._issnl_id_map = dict()
-        self._orcid_id_map = dict()
+        self.fuzzy_match_batch_size = kwargs.get('fuzzy_match_batch_size', 0)
+        self.fuzzy_verify_workers = kwargs.get('fuzzy_verify_workers', 0)
+        self._fuzzy_matcher = None
+        self._fuzzy_window = []
+        # id(release) -> pre-computed fuzzy match result, for the current window
+        self._fuzzy_results = dict()
+
+        # identifier lookup caches; bounded, and optionally persisted (and
+        # shared between processes) in a local sqlite3 file
+        cache_store = None
+        cache_ttl = kwargs.get('lookup_cache_ttl')
+        if kwargs.get('lookup_cache_file'):
+            cache_store = SqliteLookupStore(kwargs['lookup_cache_file'])
+            if cache_ttl is None:
+                cache_ttl = DEFAULT_STORE_TTL
+        cache_kwargs = dict(
+            max_size=kwargs.get('lookup_cache_size', 250000),
+            ttl=cache_ttl,
+            store=cache_store,
+        )
+        self._issnl_id_map = LookupCache("issnl", **cache_kwargs)
+        self._orcid_id_map = LookupCache("orcid", **cache_kwargs)
         self._orcid_regex = re.compile(r"^\d{4}-\d{4}-\d{4}-\d{3}[\dX]$")
-        self._doi_id_map = dict()
-        self._pmid_id_map = dict()
+        self._doi_id_map = LookupCache("doi", **cache_kwargs)
+        self._pmid_id_map = LookupCache("pmid", **cache_kwargs)
+        self._lookup_executor = None
+        self._lookup_executor_pid = None
+
+        # used by ParallelImporter; see fatcat_tools.importers.parallel
+        self._local = threading.local()
+        self._editgroup_gate = None
 
         self.reset()
 
+    @property
+    def counts(self):
+        """
+        Usually just a Counter. When try_update() is being called from a
+        ParallelImporter worker thread, returns a per-thread Counter instead,
+        which gets merged back in to the main counts in record order.
+        """
+        local_counts = getattr(self._local, 'counts', None)
+        if local_counts is not None:
+            return local_counts
+        return self._counts
+
+    @counts.setter
+    def counts(self, value):
+        self._counts = value
+
     def reset(self):
         self.counts = Counter({'total': 0, 'skip': 0, 'insert': 0, 'update': 0, 'exists': 0})
         self._edit_count = 0
@@ -196,10 +325,35 @@ class EntityImporter:
         if self.bezerk_mode:
             self.push_entity(entity)
             return
+        if self.fuzzy_match_batch_size > 1 and self.do_fuzzy_match:
+            self._fuzzy_window.append(entity)
+            if len(self._fuzzy_window) >= self.fuzzy_match_batch_size:
+                self._flush_fuzzy_window()
+            return
         if self.try_update(entity):
             self.push_entity(entity)
         return
 
+    def _flush_fuzzy_window(self):
+        window = self._fuzzy_window
+        self._fuzzy_window = []
+        releases = [e for e in window if isinstance(e, ReleaseEntity)]
+        try:
+            for (release, result) in zip(releases, self.get_fuzzy_matcher().match_batch(releases)):
+                self._fuzzy_results[id(release)] = result
+            for entity in window:
+                if self.try_update(entity):
+                    self.push_entity(entity)
+        finally:
+            self._fuzzy_results.clear()
+
+    def get_fuzzy_matcher(self) -> FuzzyReleaseMatcher:
+        if self._fuzzy_matcher is None:
+            self._fuzzy_matcher = FuzzyReleaseMatcher(self.es_client,
+                fetch_threads=self.lookup_threads,
+                verify_workers=self.fuzzy_verify_workers)
+        return self._fuzzy_matcher
+
     def parse_record(self, raw_record):
         """
         Returns an entity class type, or None if we should skip this one.
@@ -220,6 +374,8 @@ class EntityImporter:
         no new entities fed in for more than some time period, to ensure that
         entities actually get created within a reasonable time frame.
         """
+        if self._fuzzy_window:
+            self._flush_fuzzy_window()
         if self._edit_count > 0:
             if self.submit_mode:
                 self.api.submit_editgroup(self._editgroup_id)
@@ -234,9 +390,16 @@ class EntityImporter:
             self.counts['insert'] += len(self._entity_queue)
             self._entity_queue = []
 
+        for cache in self._lookup_caches():
+            cache.flush()
+
         return self.counts
 
     def get_editgroup_id(self, edits=1):
+        if self._editgroup_gate:
+            # blocks (or raises) until it is safe to touch editgroup state
+            self._editgroup_gate()
+
         if self._edit_count >= self.edit_batch_size:
             if self.submit_mode:
                 self.api.submit_editgroup(self._editgroup_id)
@@ -312,11 +475,12 @@ class EntityImporter:
         return self._orcid_regex.match(orcid) is not None
 
     def lookup_orcid(self, orcid):
-        """Caches calls to the Orcid lookup API endpoint in a local dict"""
+        """Caches calls to the Orcid lookup API endpoint in a local LookupCache"""
         if not self.is_orcid(orcid):
             return None
-        if orcid in self._orcid_id_map:
-            return self._orcid_id_map[orcid]
+        cached = self._orcid_id_map.get(orcid, MISSING)
+        if cached is not MISSING:
+            return cached
         creator_id = None
         try:
             rv = self.api.lookup_creator(orcid=orcid)
@@ -325,7 +489,7 @@ class EntityImporter:
             # If anything other than a 404 (not found), something is wrong
             if ae.status != 404:
                 raise ae
-        self._orcid_id_map[orcid] = creator_id # might be None
+        self._orcid_id_map.put_lookup(orcid, creator_id) # might be None
         return creator_id
 
     def is_doi(self, doi):
@@ -333,13 +497,14 @@ class EntityImporter:
         return doi.startswith("10.") and doi.count("/") >= 1
 
     def lookup_doi(self, doi):
-        """Caches calls to the doi lookup API endpoint in a local dict
+        """Caches calls to the doi lookup API endpoint in a local LookupCache
 
         For identifier lookups only (not full object fetches)"""
         assert self.is_doi(doi)
         doi = doi.lower()
-        if doi in self._doi_id_map:
-            return self._doi_id_map[doi]
+        cached = self._doi_id_map.get(doi, MISSING)
+        if cached is not MISSING:
+            return cached
         release_id = None
         try:
             rv = self.api.lookup_release(doi=doi, hide="abstracts,refs,contribs")
@@ -348,15 +513,16 @@ class EntityImporter:
             # If anything other than a 404 (not found), something is wrong
             if ae.status != 404:
                 raise ae
-        self._doi_id_map[doi] = release_id # might be None
+        self._doi_id_map.put_lookup(doi, release_id) # might be None
         return release_id
 
     def lookup_pmid(self, pmid):
-        """Caches calls to the pmid lookup API endpoint in a local dict
+        """Caches calls to the pmid lookup API endpoint in a local LookupCache
 
         For identifier lookups only (not full object fetches)"""
-        if pmid in self._pmid_id_map:
-            return self._pmid_id_map[pmid]
+        cached = self._pmid_id_map.get(pmid, MISSING)
+        if cached is not MISSING:
+            return cached
         release_id = None
         try:
             rv = self.api.lookup_release(pmid=pmid, hide="abstracts,refs,contribs")
@@ -365,16 +531,17 @@ class EntityImporter:
             # If anything other than a 404 (not found), something is wrong
             if ae.status != 404:
                 raise ae
-        self._pmid_id_map[pmid] = release_id # might be None
+        self._pmid_id_map.put_lookup(pmid, release_id) # might be None
         return release_id
 
     def is_issnl(self, issnl):
         return len(issnl) == 9 and issnl[4] == '-'
 
     def lookup_issnl(self, issnl):
-        """Caches calls to the ISSN-L lookup API endpoint in a local dict"""
-        if issnl in self._issnl_id_map:
-            return self._issnl_id_map[issnl]
+        """Caches calls to the ISSN-L lookup API endpoint in a local LookupCache"""
+        cached = self._issnl_id_map.get(issnl, MISSING)
+        if cached is not MISSING:
+            return cached
         container_id = None
         try:
             rv = self.api.lookup_container(issnl=issnl)
@@ -383,10 +550,80 @@ class EntityImporter:
             # If anything other than a 404 (not found), something is wrong
             if ae.status != 404:
                 raise ae
-        self._issnl_id_map[issnl] = container_id # might be None
+        self._issnl_id_map.put_lookup(issnl, container_id) # might be None
         return container_id
 
+    def _lookup_caches(self):
+        return (self._doi_id_map, self._pmid_id_map, self._issnl_id_map, self._orcid_id_map)
+
+    def lookup_cache_stats(self) -> dict:
+        """
+        Returns hit/miss/eviction counts and current size of each identifier
+        lookup cache, keyed by namespace (eg, "doi").
+        """
+        return {cache.namespace: cache.stats() for cache in self._lookup_caches()}
+
+    def lookup_bulk(self,
+                    dois: Iterable[str] = (),
+                    pmids: Iterable[str] = (),
+                    issnls: Iterable[str] = (),
+                    orcids: Iterable[str] = ()) -> None:
+        """
+        Warms the lookup caches used by lookup_doi(), lookup_pmid(),
+        lookup_issnl() and lookup_orcid() for a whole set of identifiers at
+        once, eg all the references or authors of a record (or of a batch of
+        records).
+
+        Identifiers which are already cached (or invalid, or duplicated) are
+        skipped; the rest are looked up concurrently, at most lookup_threads
+        requests at a time, over the shared API connection pool. Doesn't
+        return anything; callers should use the regular lookup_*() methods
+        afterwards, which won't hit the API again.
+        """
+        todo = []
+        for doi in set(d.lower() for d in dois if d and self.is_doi(d)):
+            if doi not in self._doi_id_map:
+                todo.append((self.lookup_doi, doi))
+        for pmid in set(p for p in pmids if p):
+            if pmid not in self._pmid_id_map:
+                todo.append((self.lookup_pmid, pmid))
+        for issnl in set(i for i in issnls if i and self.is_issnl(i)):
+            if issnl not in self._issnl_id_map:
+                todo.append((self.lookup_issnl, issnl))
+        for orcid in set(o for o in orcids if o and self.is_orcid(o)):
+            if orcid not in self._orcid_id_map:
+                todo.append((self.lookup_orcid, orcid))
+
+        if len(todo) <= 1 or self.lookup_threads <= 1:
+            for (func, ident) in todo:
+                func(ident)
+            return
+
+        executor = self._get_lookup_executor()
+        futures = [executor.submit(func, ident) for (func, ident) in todo]
+        for f in futures:
+            # re-raises any non-404 API errors
+            f.result()
+
+    def _get_lookup_executor(self) -> ThreadPoolExecutor:
+        # executor threads don't survive a fork (eg, ParallelImporter worker
+        # processes), so keep one per process
+        if self._lookup_executor is None or self._lookup_executor_pid != os.getpid():
+            self._lookup_executor = ThreadPoolExecutor(max_workers=self.lookup_threads)
+            self._lookup_executor_pid = os.getpid()
+        return self._lookup_executor
+
     def read_issn_map_file(self, issn_map_file):
+        """
+        Takes either an ISSN-to-ISSN-L text file (open file or iterable of
+        lines), or a binary index file built from one by build_issn_index()
+        (path, or open file), which gets mmap'd instead of loaded in to RAM.
+        """
+        issn_map_path = getattr(issn_map_file, 'name', issn_map_file)
+        if isinstance(issn_map_path, str) and is_issn_index_file(issn_map_path):
+            self._issn_issnl_map = IssnIndex(issn_map_path)
+            print("Using ISSN-L index file ({} mappings).".format(len(self._issn_issnl_map)), file=sys.stderr)
+            return
         print("Loading ISSN map file...", file=sys.stderr)
         self._issn_issnl_map = dict()
         for line in issn_map_file:
@@ -424,17 +661,17 @@ class EntityImporter:
                 u.rel = 'academicsocial'
 
         # remove URLs which are near-duplicates
-        redundant_urls = []
-        all_urls = [u.url for u in existing.urls]
+        redundant_urls = set()
+        all_urls = set([u.url for u in existing.urls])
         all_wayback_urls = [u.url for u in existing.urls if '://web.archive.org/web/' in u.url]
         for url in all_urls:
             # https/http redundancy
             if url.startswith('http://') and url.replace('http://', 'https://', 1) in all_urls:
-                redundant_urls.append(url)
+                redundant_urls.add(url)
                 continue
             # default HTTP port included and not included
             if ':80/' in url and url.replace(':80', '', 1) in all_urls:
-                redundant_urls.append(url)
+                redundant_urls.add(url)
                 continue
             # partial and complete wayback timestamps
             if '://web.archive.org/web/2017/' in url:
@@ -443,7 +680,7 @@ class EntityImporter:
                 for wb_url in all_wayback_urls:
                     alt_timestamp = wb_url.split("/")[4]
                     if len(alt_timestamp) >= 10 and original_url in wb_url:
-                        redundant_urls.append(url)
+                        redundant_urls.add(url)
                         break
 
         existing.urls = [u for u in existing.urls if u.url not in redundant_urls]
@@ -467,7 +704,13 @@ class EntityImporter:
 
         Eg, if there is any EXACT match that is always returned; an AMBIGIOUS
         result is only returned if all the candidate matches were ambiguous.
+
+        In batched mode (fuzzy_match_batch_size), the result for releases in
+        the current window has already been computed.
         """
+        prefetched = self._fuzzy_results.get(id(release), MISSING)
+        if prefetched is not MISSING:
+            return prefetched
 
         # this map used to establish priority order of verified matches
         STATUS_SORT = {
@@ -518,18 +761,57 @@ class RecordPusher:
         raise NotImplementedError
 
 
+def unread_utf8_text_file(f):
+    """
+    True if `f` is a UTF-8 text file which nothing has been read from (so its
+    binary buffer can be read directly instead)
+    """
+    try:
+        if codecs.lookup(f.encoding).name != 'utf-8':
+            return False
+        return f.seekable() and f.tell() == 0
+    except (LookupError, OSError, ValueError):
+        return False
+
+
 class JsonLinePusher(RecordPusher):
+    """
+    json_file can be an open file (text or binary), or any iterable of lines
+    (str or bytes).
+
+    For UTF-8 text files which haven't been read from yet (seekable, and at
+    position 0), lines are read from the underlying binary buffer and parsed
+    as bytes, skipping the decode step. Other text files (eg, stdin) are
+    iterated as text; pass binary files (eg, sys.stdin.buffer) for the fast
+    path.
+
+    JsonLinePusher, LinePusher, CsvPusher and Bs4XmlLargeFilePusher also take
+    a path instead of a file, which may be compressed (.gz, .xz, .zst; see
+    compressed.open_compressed()). With `progress_interval` (seconds), input
+    progress is printed to stderr, by compressed-byte position.
+    """
 
-    def __init__(self, importer, json_file, **kwargs):
+    def __init__(self, importer, json_file, progress_interval=None, **kwargs):
         self.importer = importer
         self.json_file = json_file
+        self.progress_interval = progress_interval
 
     def run(self):
-        for line in self.json_file:
-            if not line:
-                continue
-            record = json.loads(line)
-            self.importer.push_record(record)
+        (json_file, opened) = open_input(self.json_file, 'rb')
+        progress = InputProgress(json_file, self.progress_interval)
+        lines = json_file
+        if isinstance(lines, io.TextIOWrapper) and unread_utf8_text_file(lines):
+            lines = lines.buffer
+        try:
+            for line in lines:
+                if not line:
+                    continue
+                record = json_loads(line)
+                self.importer.push_record(record)
+                progress.tick()
+        finally:
+            if opened:
+                json_file.close()
         counts = self.importer.finish()
         print(counts, file=sys.stderr)
         return counts
@@ -537,15 +819,25 @@ class JsonLinePusher(RecordPusher):
 
 class CsvPusher(RecordPusher):
 
-    def __init__(self, importer, csv_file, **kwargs):
+    def __init__(self, importer, csv_file, progress_interval=None, **kwargs):
         self.importer = importer
-        self.reader = csv.DictReader(csv_file, delimiter=kwargs.get('delimiter', ','))
+        self.csv_file = csv_file
+        self.delimiter = kwargs.get('delimiter', ',')
+        self.progress_interval = progress_interval
 
     def run(self):
-        for line in self.reader:
-            if not line:
-                continue
-            self.importer.push_record(line)
+        (csv_file, opened) = open_input(self.csv_file, 'r', newline='')
+        progress = InputProgress(csv_file, self.progress_interval)
+        reader = csv.DictReader(csv_file, delimiter=self.delimiter)
+        try:
+            for line in reader:
+                if not line:
+                    continue
+                self.importer.push_record(line)
+                progress.tick()
+        finally:
+            if opened:
+                csv_file.close()
         counts = self.importer.finish()
         print(counts, file=sys.stderr)
         return counts
@@ -553,15 +845,23 @@ class CsvPusher(RecordPusher):
 
 class LinePusher(RecordPusher):
 
-    def __init__(self, importer, text_file, **kwargs):
+    def __init__(self, importer, text_file, progress_interval=None, **kwargs):
         self.importer = importer
         self.text_file = text_file
+        self.progress_interval = progress_interval
 
     def run(self):
-        for line in self.text_file:
-            if not line:
-                continue
-            self.importer.push_record(line)
+        (text_file, opened) = open_input(self.text_file, 'r')
+        progress = InputProgress(text_file, self.progress_interval)
+        try:
+            for line in text_file:
+                if not line:
+                    continue
+                self.importer.push_record(line)
+                progress.tick()
+        finally:
+            if opened:
+                text_file.close()
         counts = self.importer.finish()
         print(counts, file=sys.stderr)
         return counts
@@ -587,11 +887,18 @@ class SqlitePusher(RecordPusher):
 
 
 class Bs4XmlLinesPusher(RecordPusher):
+    """
+    All the Bs4Xml pushers take an `lxml_records` flag: if set, records are
+    passed to the importer as lxmlsoup.LxmlTag objects (a bs4-compatible
+    wrapper around the lxml parse) instead of BeautifulSoup tags, which is
+    much faster.
+    """
 
-    def __init__(self, importer, xml_file, prefix_filter=None, **kwargs):
+    def __init__(self, importer, xml_file, prefix_filter=None, lxml_records=False, **kwargs):
         self.importer = importer
         self.xml_file = xml_file
         self.prefix_filter = prefix_filter
+        self.lxml_records = lxml_records
 
     def run(self):
         for line in self.xml_file:
@@ -599,6 +906,9 @@ class Bs4XmlLinesPusher(RecordPusher):
                 continue
             if self.prefix_filter and not line.startswith(self.prefix_filter):
                 continue
+            if self.lxml_records:
+                self.importer.push_record(parse_xml_document(line))
+                continue
             soup = BeautifulSoup(line, "xml")
             self.importer.push_record(soup)
             soup.decompose()
@@ -609,12 +919,20 @@ class Bs4XmlLinesPusher(RecordPusher):
 
 class Bs4XmlFilePusher(RecordPusher):
 
-    def __init__(self, importer, xml_file, record_tag, **kwargs):
+    def __init__(self, importer, xml_file, record_tag, lxml_records=False, **kwargs):
         self.importer = importer
         self.xml_file = xml_file
         self.record_tag = record_tag
+        self.lxml_records = lxml_records
 
     def run(self):
+        if self.lxml_records:
+            # streams the file, instead of loading it all first
+            for record in iter_xml_records(self.xml_file, self.record_tag):
+                self.importer.push_record(record)
+            counts = self.importer.finish()
+            print(counts, file=sys.stderr)
+            return counts
         soup = BeautifulSoup(self.xml_file, "xml")
         for record in soup.find_all(self.record_tag):
             self.importer.push_record(record)
@@ -641,20 +959,46 @@ class Bs4XmlLargeFilePusher(RecordPusher):
     Did at least casual testing and all of: record.decompose(),
     soup.decompose(), element.clear(), root.clear() helped with memory usage.
     With all of these, memory growth is very slow and can probably be explained
-    by inner container/release API lookup caches.
+    by inner container/release API lookup caches (which are bounded; see
+    lookup_cache_size).
+
+    With `lxml_records`, the re-parse is skipped entirely: importers get the
+    lxml elements directly, through the bs4-compatible LxmlTag wrapper. The
+    file is always parsed with lxml in that mode (`use_lxml` then only
+    controls DTD loading, eg for dblp entities).
     """
 
-    def __init__(self, importer, xml_file, record_tags, use_lxml=False, **kwargs):
+    def __init__(self, importer, xml_file, record_tags, use_lxml=False, lxml_records=False,
+                 progress_interval=None, **kwargs):
         self.importer = importer
         self.xml_file = xml_file
         self.record_tags = record_tags
         self.use_lxml = use_lxml
+        self.lxml_records = lxml_records
+        self.progress_interval = progress_interval
 
     def run(self):
+        (xml_file, opened) = open_input(self.xml_file, 'rb')
+        try:
+            self._push_records(xml_file)
+        finally:
+            if opened:
+                xml_file.close()
+        counts = self.importer.finish()
+        print(counts, file=sys.stderr)
+        return counts
+
+    def _push_records(self, xml_file):
+        progress = InputProgress(xml_file, self.progress_interval)
+        if self.lxml_records:
+            for record in iter_xml_records(xml_file, self.record_tags, load_dtd=self.use_lxml):
+                self.importer.push_record(record)
+                progress.tick()
+            return
         if self.use_lxml:
-            elem_iter = lxml.etree.iterparse(self.xml_file, ["start", "end"], load_dtd=True)
+            elem_iter = lxml.etree.iterparse(xml_file, ["start", "end"], load_dtd=True)
         else:
-            elem_iter = ET.iterparse(self.xml_file, ["start", "end"])
+            elem_iter = ET.iterparse(xml_file, ["start", "end"])
         root = None
         for (event, element) in elem_iter:
             if (root is not None) and event == "start":
@@ -675,29 +1019,65 @@ class Bs4XmlLargeFilePusher(RecordPusher):
             element.clear()
             if root is not None:
                 root.clear()
-        counts = self.importer.finish()
-        print(counts, file=sys.stderr)
-        return counts
+            progress.tick()
 
 
+def xml_file_records(xml_path, record_tag, lxml_records=False):
+    """
+    Yields every `record_tag` element of the XML file at `xml_path`, as a
+    BeautifulSoup tag (or lxmlsoup.LxmlTag, if `lxml_records` is set). Each
+    record is decomposed after the consumer moves on.
+    """
+    if lxml_records:
+        with open(xml_path, 'rb') as xml_file:
+            yield from iter_xml_records(xml_file, record_tag)
+        return
+    with open(xml_path, 'r') as xml_file:
+        soup = BeautifulSoup(xml_file, "xml")
+        for record in soup.find_all(record_tag):
+            yield record
+            record.decompose()
+        soup.decompose()
+
 class Bs4XmlFileListPusher(RecordPusher):
+    """
+    Imports every `record_tag` element from each of a list of XML files (one
+    path per line in `list_file`).
+
+    With `workers` > 1, files are parsed, and records run through
+    parse_record(), in a pool of worker processes (see
+    parallel.ParallelXmlFileImporter); entities are submitted from this
+    process, in file order unless `ordered` is False.
+    """
 
-    def __init__(self, importer, list_file, record_tag, **kwargs):
+    def __init__(self, importer, list_file, record_tag, lxml_records=False, workers=1, ordered=True, **kwargs):
         self.importer = importer
         self.list_file = list_file
         self.record_tag = record_tag
+        self.lxml_records = lxml_records
+        self.workers = workers
+        self.ordered = ordered
 
-    def run(self):
+    def xml_paths(self):
         for xml_path in self.list_file:
             xml_path = xml_path.strip()
             if not xml_path or xml_path.startswith("#"):
                 continue
-            with open(xml_path, 'r') as xml_file:
-                soup = BeautifulSoup(xml_file, "xml")
-                for record in soup.find_all(self.record_tag):
-                    self.importer.push_record(record)
-                    record.decompose()
-                soup.decompose()
+            yield xml_path
+
+    def run(self):
+        if self.workers > 1:
+            from .parallel import ParallelXmlFileImporter
+            pi = ParallelXmlFileImporter(self.importer, self.record_tag,
+                lxml_records=self.lxml_records, workers=self.workers, ordered=self.ordered)
+            for xml_path in self.xml_paths():
+                pi.push_record(xml_path)
+            counts = pi.finish()
+            print(counts)
+            return counts
+        for xml_path in self.xml_paths():
+            for record in xml_file_records(xml_path, self.record_tag, self.lxml_records):
+                self.importer.push_record(record)
         counts = self.importer.finish()
         print(counts)
         return counts
@@ -717,6 +1097,7 @@ class KafkaBs4XmlPusher(RecordPusher):
         )
         self.poll_interval = kwargs.get('poll_interval', 5.0)
         self.consume_batch_size = kwargs.get('consume_batch_size', 25)
+        self.lxml_records = kwargs.get('lxml_records', False)
 
     def run(self):
         count = 0
@@ -749,9 +1130,12 @@ class KafkaBs4XmlPusher(RecordPusher):
                     raise KafkaException(msg.error())
             # ... then process
             for msg in batch:
-                soup = BeautifulSoup(msg.value().decode('utf-8'), "xml")
-                self.importer.push_record(soup)
-                soup.decompose()
+                if self.lxml_records:
+                    self.importer.push_record(parse_xml_document(msg.value()))
+                else:
+                    soup = BeautifulSoup(msg.value().decode('utf-8'), "xml")
+                    self.importer.push_record(soup)
+                    soup.decompose()
                 count += 1
                 if count % 500 == 0:
                     print("Import counts: {}".format(self.importer.counts))
@@ -813,7 +1197,7 @@ class KafkaJsonPusher(RecordPusher):
                     raise KafkaException(msg.error())
             # ... then process
             for msg in batch:
-                record = json.loads(msg.value().decode('utf-8'))
+                record = json_loads(msg.value())
                 self.importer.push_record(record)
                 count += 1
                 if count % 500 == 0:
@@ -0,0 +1,339 @@
+
+"""
+Native reading of compressed (.gz, .xz, .zst) input files, for the file-based
+pushers.
+
+Bulk dumps are usually compressed, and piping `zcat` into stdin serializes
+decompression with parsing in a single pipeline stage. open_compressed()
+instead decompresses off the main thread, and hands out a regular buffered
+file object (binary, or text):
+
+- if a suitable command is installed (`pigz`, `xz -T0`, `zstd`; listed in
+  DECOMPRESS_COMMANDS), decompression runs in a child process, which is
+  multithreaded for pigz and for multi-block xz files
+- otherwise the python module (gzip, lzma, or the optional `zstandard`
+  package) runs in a read-ahead thread; these all release the GIL while
+  decompressing, so this still overlaps with parsing
+
+In both cases the compressed file itself is read in large blocks, and the
+compressed-byte position is tracked for progress reporting (see
+InputProgress), since the uncompressed size isn't known up front.
+"""
+
+import io
+import os
+import sys
+import time
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+
+# read size for compressed blocks, and buffer size of the returned file
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# max decompressed blocks queued up by the read-ahead thread
+READ_AHEAD_BLOCKS = 8
+
+COMPRESSION_SUFFIXES = {
+    '.gz': 'gzip',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+# first command found on $PATH is used (all read stdin, write stdout)
+DECOMPRESS_COMMANDS = {
+    'gzip': [["pigz", "-dc"]],
+    'xz': [["xz", "-dc", "-T0"]],
+    'zstd': [["zstd", "-dc", "-q"]],
+}
+
+
+def compression_format(path: Any) -> Optional[str]:
+    """
+    Returns 'gzip', 'xz', 'zstd' (by file suffix), or None
+    """
+    if not isinstance(path, (str, os.PathLike)):
+        return None
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(os.fspath(path))[1].lower())
+
+def decompress_command(fmt: str) -> Optional[list]:
+    for cmd in DECOMPRESS_COMMANDS.get(fmt, []):
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+def _module_reader(fmt: str, raw_file: Any) -> Any:
+    if fmt == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=raw_file, mode='rb')
+    elif fmt == 'xz':
+        import lzma
+        return lzma.LZMAFile(raw_file, mode='rb')
+    elif fmt == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("reading .zst files requires the 'zstd' command or the 'zstandard' package")
+        return zstandard.ZstdDecompressor().stream_reader(raw_file, read_across_frames=True)
+    raise ValueError("unknown compression format: {}".format(fmt))
+
+
+class ReadAheadStream(io.RawIOBase):
+    """
+    Raw (unbuffered) stream over blocks from `blocks`, which is iterated in a
+    background thread, at most READ_AHEAD_BLOCKS ahead of the reader.
+    Exceptions in the background thread are raised to the reader.
+
+    `compressed_tell` returns the current position in the compressed input.
+    `name` is the path of the compressed file (lxml uses it to resolve
+    relative DTD paths). On close, `interrupt` is called to unblock the background thread (if it
+    could be waiting on I/O), and `on_close` after it has exited.
+    """
+
+    def __init__(self, blocks: Iterator[bytes], compressed_tell: Callable[[], int],
+                 compressed_size: Optional[int] = None, interrupt: Optional[Callable] = None,
+                 on_close: Optional[Callable] = None, name: Optional[str] = None):
+        super().__init__()
+        self.name = name
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=READ_AHEAD_BLOCKS)
+        self._pending = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._interrupt = interrupt
+        self._on_close = on_close
+        self.compressed_tell = compressed_tell
+        self.compressed_size = compressed_size
+        self._thread = threading.Thread(target=self._read_ahead, args=(blocks,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_ahead(self, blocks: Iterator[bytes]) -> None:
+        try:
+            for block in blocks:
+                if block and not self._put(block):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(None)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        while not self._pending:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._pending = memoryview(item)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stop.set()
+            if self._interrupt:
+                self._interrupt()
+            # unblock the read-ahead thread, if it is waiting on a full queue
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._thread.join()
+            if self._on_close:
+                self._on_close()
+        super().close()
+
+
+def _subprocess_stream(cmd: list, raw_file: Any, size: Optional[int]) -> ReadAheadStream:
+    """
+    Decompresses with an external command. The compressed file is fed to it
+    from a thread in this process, so the compressed position is known.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+    def feed() -> None:
+        try:
+            while True:
+                block = raw_file.read(READ_BUFFER_SIZE)
+                if not block:
+                    break
+                proc.stdin.write(block)
+        except (BrokenPipeError, ValueError):
+            # decompressor exited (or the stream was closed) early
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    def blocks() -> Iterator[bytes]:
+        while True:
+            block = proc.stdout.read(READ_BUFFER_SIZE)
+            if not block:
+                break
+            yield block
+        if proc.wait() != 0:
+            raise IOError("{} exited with status {}".format(cmd[0], proc.returncode))
+
+    def interrupt() -> None:
+        if proc.poll() is None:
+            proc.kill()
+
+    def on_close() -> None:
+        proc.wait()
+        feeder.join()
+        proc.stdout.close()
+        raw_file.close()
+
+    return ReadAheadStream(blocks(), raw_file.tell, size, interrupt=interrupt, on_close=on_close,
+        name=raw_file.name)
+
+def _module_stream(fmt: str, raw_file: Any, size: Optional[int]) -> ReadAheadStream:
+    reader = _module_reader(fmt, raw_file)
+
+    def blocks() -> Iterator[bytes]:
+        while True:
+            block = reader.read(READ_BUFFER_SIZE)
+            if not block:
+                break
+            yield block
+
+    def on_close() -> None:
+        raw_file.close()
+
+    return ReadAheadStream(blocks(), raw_file.tell, size, on_close=on_close, name=raw_file.name)
+
+def open_compressed(path: Any, mode: str = 'rb', external: bool = True,
+                    encoding: str = 'utf-8', newline: Optional[str] = None) -> Any:
+    """
+    Opens a file for reading, decompressing (in the background) according to
+    the suffix. Returns a buffered binary file, or a text file for mode 'r'.
+    Uncompressed files are just opened, with a large buffer.
+
+    With `external=False`, python modules are used even if decompression
+    commands are installed.
+    """
+    if mode not in ('r', 'rt', 'rb'):
+        raise ValueError("only read modes are supported: {}".format(mode))
+    fmt = compression_format(path)
+    if fmt is None:
+        if 'b' in mode:
+            return open(path, mode, buffering=READ_BUFFER_SIZE)
+        return open(path, mode, buffering=READ_BUFFER_SIZE, encoding=encoding, newline=newline)
+    raw_file = open(path, 'rb', buffering=READ_BUFFER_SIZE)
+    size = os.fstat(raw_file.fileno()).st_size
+    cmd = decompress_command(fmt) if external else None
+    try:
+        if cmd:
+            stream = _subprocess_stream(cmd, raw_file, size)
+        else:
+            stream = _module_stream(fmt, raw_file, size)
+    except Exception:
+        raw_file.close()
+        raise
+    f = io.BufferedReader(stream, buffer_size=READ_BUFFER_SIZE)
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, newline=newline)
+
+def open_input(f: Any, mode: str = 'rb', **kwargs) -> Tuple[Any, bool]:
+    """
+    For pushers which take either a path or an open file: opens paths (see
+    open_compressed()), and passes anything else through. Returns (file,
+    opened), where `opened` is whether the caller should close the file.
+    """
+    if isinstance(f, (str, os.PathLike)):
+        return (open_compressed(f, mode, **kwargs), True)
+    return (f, False)
+
+
+def input_position(f: Any) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Returns (position, size) in bytes of the underlying (compressed, if
+    applicable) file, or None for either if not known (eg, stdin).
+    """
+    while True:
+        if isinstance(f, ReadAheadStream):
+            return (f.compressed_tell(), f.compressed_size)
+        inner = getattr(f, 'buffer', None) or getattr(f, 'raw', None)
+        if inner is None:
+            break
+        f = inner
+    if not hasattr(f, 'fileno'):
+        return (None, None)
+    try:
+        return (f.tell(), os.fstat(f.fileno()).st_size)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return (None, None)
+
+
+class InputProgress:
+    """
+    Prints input progress (compressed bytes read, for compressed files) to
+    stderr, at most every `interval` seconds. Does nothing if `interval` is
+    not set.
+    """
+
+    def __init__(self, f: Any, interval: Optional[float] = None):
+        self.f = f
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def tick(self) -> None:
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        (pos, size) = input_position(self.f)
+        if pos is None:
+            return
+        rate = pos / (now - self.start) / 1024 / 1024
+        if size:
+            print("progress: {:.1f}% ({} of {} bytes, {:.1f} MiB/sec)".format(
+                100.0 * pos / size, pos, size, rate), file=sys.stderr)
+        else:
+            print("progress: {} bytes ({:.1f} MiB/sec)".format(pos, rate), file=sys.stderr)
+
+
+class CompressedFileType(argparse.FileType):
+    """
+    argparse.FileType which transparently decompresses .gz/.xz/.zst paths
+    (see open_compressed())
+    """
+
+    def __call__(self, string: str) -> Any:
+        if string != '-' and compression_format(string) and 'r' in self._mode:
+            try:
+                return open_compressed(string, self._mode)
+            except OSError as e:
+                raise argparse.ArgumentTypeError("can't open '{}': {}".format(string, e))
+        return super().__call__(string)
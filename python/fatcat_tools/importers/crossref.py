@@ -247,6 +247,12 @@ class CrossrefImporter(EntityImporter):
                     role=ctype,
                     extra=extra))
             return contribs
+        self.lookup_bulk(orcids=[
+            am['ORCID'].split('/')[-1]
+            for ctype in ('author', 'editor', 'translator')
+            for am in obj.get(ctype, [])
+            if 'ORCID' in am.keys()
+        ])
         contribs = do_contribs(obj.get('author', []), "author")
         contribs.extend(do_contribs(obj.get('editor', []), "editor"))
         contribs.extend(do_contribs(obj.get('translator', []), "translator"))
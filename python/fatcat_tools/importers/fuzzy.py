@@ -0,0 +1,234 @@
+"""
+Batched fuzzy matching of releases against the existing catalog.
+
+EntityImporter.match_existing_release_fuzzy() does, per release, up to a
+handful of sequential elasticsearch queries (via fuzzycat), fetches each
+candidate from the API one after the other, and verifies the candidates with
+fuzzycat. FuzzyReleaseMatcher does the same for a whole window of releases at
+once, with the same results:
+
+- the fuzzycat query cascade (external identifiers, then exact title, then
+  fuzzy title) runs as one `_msearch` request per step, for all the releases
+  which haven't found candidates yet
+- candidates are fetched concurrently, with each distinct ident only fetched
+  once per window
+- candidate dict conversions are memoized by revision
+- fuzzycat.verify runs in a pool of worker processes (if `verify_workers` is
+  set), one task per release
+"""
+
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import fuzzycat.common
+import fuzzycat.verify
+from fuzzycat.matching import public_api
+from elasticsearch.exceptions import TransportError
+from fatcat_openapi_client import ReleaseEntity
+from fatcat_openapi_client.rest import ApiException
+
+from fatcat_tools.transforms import entity_to_dict
+
+
+# release ext_id attribute to elasticsearch field, in fuzzycat's lookup order
+# (the "core" field name is a quirk of fuzzycat, kept for identical results)
+FUZZY_EXTID_FIELDS = [
+    ("doi", "doi"),
+    ("wikidata_qid", "wikidata_qid"),
+    ("isbn13", "isbn13"),
+    ("pmid", "pmid"),
+    ("pmcid", "pmcid"),
+    ("core", "code_id"),
+    ("arxiv", "arxiv_id"),
+    ("jstor", "jstor_id"),
+    ("ark", "ark_id"),
+    ("mag", "mag_id"),
+]
+
+# priority order of verified matches
+FUZZY_STATUS_SORT = {
+    fuzzycat.common.Status.TODO: 0,
+    fuzzycat.common.Status.EXACT: 10,
+    fuzzycat.common.Status.STRONG: 20,
+    fuzzycat.common.Status.WEAK: 30,
+    fuzzycat.common.Status.AMBIGUOUS: 40,
+    fuzzycat.common.Status.DIFFERENT: 60,
+}
+
+FuzzyMatch = Optional[Tuple[str, str, ReleaseEntity]]
+
+
+def fuzzy_queries(release: ReleaseEntity, size: int) -> List[Tuple[str, dict]]:
+    """
+    Returns the elasticsearch queries fuzzycat would run for a release, in
+    order, as (kind, body) tuples. The first query with any hits determines
+    the candidates.
+    """
+    queries = []
+    for (attr, es_field) in FUZZY_EXTID_FIELDS:
+        value = getattr(release.ext_ids, attr)
+        if value:
+            queries.append(("extid", {"query": {"term": {es_field: value}}, "size": size}))
+    for fuzziness in (None, "AUTO"):
+        title_query: Dict[str, Any] = {"query": release.title, "operator": "AND"}
+        if fuzziness:
+            title_query["fuzziness"] = fuzziness
+        queries.append(("title", {"query": {"match": {"title": title_query}}, "size": size}))
+    return queries
+
+def verify_candidates(release_dict: dict, candidate_dicts: List[dict]) -> list:
+    """
+    Runs fuzzycat.verify for each candidate; returns (status, reason) tuples.
+    Module-level so it can run in worker processes.
+    """
+    results = []
+    for c in candidate_dicts:
+        v = fuzzycat.verify.verify(release_dict, c)
+        results.append((v.status, v.reason))
+    return results
+
+def pick_closest(verified: list, candidates: List[ReleaseEntity]) -> FuzzyMatch:
+    if not candidates:
+        return None
+    closest = sorted(zip(verified, candidates), key=lambda v: FUZZY_STATUS_SORT[v[0][0]])[0]
+    ((status, reason), entity) = closest
+    if status == fuzzycat.common.Status.DIFFERENT:
+        return None
+    elif status == fuzzycat.common.Status.TODO:
+        raise NotImplementedError("fuzzycat verify hit a Status.TODO")
+    return (status.name, reason.value, entity)
+
+
+class FuzzyReleaseMatcher:
+    """
+    Parameters:
+
+        es_client: elasticsearch client
+        api: API client for fetching candidates; by default (like fuzzycat)
+            the public fatcat API
+        size: number of candidates per release (same as the per-record path)
+        fetch_threads: concurrent candidate fetches
+        verify_workers: if > 0, number of worker processes for verification
+        dict_cache_size: number of candidate dict conversions to keep
+    """
+
+    def __init__(self, es_client, api=None, size=10, fetch_threads=8, verify_workers=0,
+                 dict_cache_size=10000, es_index="fatcat_release"):
+        self.es_client = es_client
+        self.api = api or public_api("https://api.fatcat.wiki/v0")
+        self.size = size
+        self.fetch_threads = fetch_threads
+        self.verify_workers = verify_workers
+        self.dict_cache_size = dict_cache_size
+        self.es_index = es_index
+        self._dict_cache: "collections.OrderedDict[str, dict]" = collections.OrderedDict()
+        self._fetch_executor: Optional[ThreadPoolExecutor] = None
+        self._verify_executor: Optional[ProcessPoolExecutor] = None
+
+    def close(self) -> None:
+        if self._fetch_executor is not None:
+            self._fetch_executor.shutdown(wait=True)
+            self._fetch_executor = None
+        if self._verify_executor is not None:
+            self._verify_executor.shutdown(wait=True)
+            self._verify_executor = None
+
+    def candidate_idents(self, releases: List[ReleaseEntity]) -> List[List[str]]:
+        """
+        Runs the fuzzycat query cascade for all releases, one `_msearch`
+        request per step. Returns a list of candidate idents per release.
+        """
+        queries = [fuzzy_queries(r, self.size) for r in releases]
+        results: List[List[str]] = [[] for _ in releases]
+        pending = list(range(len(releases)))
+        step = 0
+        while pending:
+            body = []
+            for i in pending:
+                body.append({"index": self.es_index})
+                body.append(queries[i][step][1])
+            resp = self.es_client.msearch(body=body)
+            still_pending = []
+            for (i, item) in zip(pending, resp['responses']):
+                if 'error' in item:
+                    raise TransportError(item.get('status', 500), "msearch error", item['error'])
+                hits = item['hits']['hits']
+                if queries[i][step][0] == "extid":
+                    found = len(hits) > 0
+                    idents = [h['_source'].get('ident') for h in hits]
+                else:
+                    total = item['hits']['total']
+                    if isinstance(total, dict):
+                        total = total['value']
+                    found = total > 0
+                    # fuzzycat only looks at the first 5 title hits
+                    idents = [h['_source']['ident'] for h in hits][:5]
+                if found:
+                    results[i] = idents
+                elif step + 1 < len(queries[i]):
+                    still_pending.append(i)
+            pending = still_pending
+            step += 1
+        return results
+
+    def _fetch(self, ident: str) -> Optional[ReleaseEntity]:
+        try:
+            return self.api.get_release(ident, hide="refs,abstracts", expand="container")
+        except ApiException:
+            # fuzzycat skips candidates which can't be fetched
+            return None
+
+    def fetch_candidates(self, idents_lists: List[List[str]]) -> List[List[ReleaseEntity]]:
+        distinct = list(dict.fromkeys([i for idents in idents_lists for i in idents if i]))
+        if len(distinct) > 1 and self.fetch_threads > 1:
+            if self._fetch_executor is None:
+                self._fetch_executor = ThreadPoolExecutor(max_workers=self.fetch_threads)
+            fetched = dict(zip(distinct, self._fetch_executor.map(self._fetch, distinct)))
+        else:
+            fetched = dict([(i, self._fetch(i)) for i in distinct])
+        return [[fetched[i] for i in idents if i and fetched[i] is not None] for idents in idents_lists]
+
+    def candidate_dict(self, entity: ReleaseEntity) -> dict:
+        """
+        entity_to_dict(), memoized by revision (revisions are immutable)
+        """
+        rev = entity.revision
+        if rev is None:
+            return entity_to_dict(entity)
+        d = self._dict_cache.get(rev)
+        if d is not None:
+            self._dict_cache.move_to_end(rev)
+            return d
+        d = entity_to_dict(entity)
+        self._dict_cache[rev] = d
+        while len(self._dict_cache) > self.dict_cache_size:
+            self._dict_cache.popitem(last=False)
+        return d
+
+    def match_batch(self, releases: List[ReleaseEntity]) -> List[FuzzyMatch]:
+        """
+        Same result as EntityImporter.match_existing_release_fuzzy() for each
+        release, in order.
+        """
+        if not releases:
+            return []
+        candidates = self.fetch_candidates(self.candidate_idents(releases))
+        tasks = []
+        for (release, cands) in zip(releases, candidates):
+            if cands:
+                tasks.append((entity_to_dict(release), [self.candidate_dict(c) for c in cands]))
+            else:
+                tasks.append(None)
+
+        if self.verify_workers > 0 and len([t for t in tasks if t]) > 1:
+            if self._verify_executor is None:
+                self._verify_executor = ProcessPoolExecutor(max_workers=self.verify_workers,
+                    mp_context=multiprocessing.get_context('fork'))
+            futures = [self._verify_executor.submit(verify_candidates, *t) if t else None for t in tasks]
+            verified = [f.result() if f else [] for f in futures]
+        else:
+            verified = [verify_candidates(*t) if t else [] for t in tasks]
+
+        return [pick_closest(v, c) for (v, c) in zip(verified, candidates)]
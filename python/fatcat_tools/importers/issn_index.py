@@ -0,0 +1,151 @@
+
+"""
+Compact, memory-mapped ISSN to ISSN-L index.
+
+Loading the full ISSN-to-ISSN-L text file into a python dict takes a lot of
+RAM (and a while) at start-up, and every importer process pays that again. The
+binary index format here is built once from the text file, and then mmap'd;
+lookups are a binary search, and page cache is shared between all processes
+using the same index file.
+
+File format (all little-endian):
+
+- 16 byte header: magic (b"ISSNLIDX"), format version (uint32), record count
+  (uint32)
+- records: pairs of (issn, issnl) as packed uint32, sorted by issn
+
+ISSNs are packed as the first seven digits times 11, plus the check digit
+(with 'X' as 10). Both ISSN -> ISSN-L and ISSN-L -> ISSN-L mappings are
+included (same as the dict used to be), so lookups work with either.
+"""
+
+import sys
+import mmap
+import struct
+from typing import Optional, Iterable
+
+ISSN_INDEX_MAGIC = b"ISSNLIDX"
+ISSN_INDEX_VERSION = 1
+_HEADER = struct.Struct("<8sII")
+_RECORD = struct.Struct("<II")
+
+
+def pack_issn(issn: str) -> Optional[int]:
+    """
+    "1234-567X" (or "1234567X") to an integer; returns None if not a
+    syntactically valid ISSN.
+    """
+    issn = issn.replace('-', '')
+    if len(issn) != 8 or not issn[:7].isdigit():
+        return None
+    check = issn[7].upper()
+    if check == 'X':
+        check_val = 10
+    elif check.isdigit():
+        check_val = int(check)
+    else:
+        return None
+    return int(issn[:7]) * 11 + check_val
+
+def unpack_issn(val: int) -> str:
+    (digits, check_val) = divmod(val, 11)
+    check = 'X' if check_val == 10 else str(check_val)
+    digits = "{:07d}".format(digits)
+    return "{}-{}{}".format(digits[:4], digits[4:], check)
+
+def build_issn_index(issn_map_file: Iterable[str], output_path: str) -> int:
+    """
+    Converts an ISSN-to-ISSN-L text file (as distributed by issn.org; tab
+    separated, with a header line) into a binary index file. Returns the
+    number of records written.
+    """
+    mapping = dict()
+    for line in issn_map_file:
+        if line.startswith("ISSN") or not line.strip():
+            continue
+        (issn, issnl) = line.split()[0:2]
+        issn_val = pack_issn(issn)
+        issnl_val = pack_issn(issnl)
+        if issn_val is None or issnl_val is None:
+            continue
+        mapping[issn_val] = issnl_val
+        # double mapping makes lookups easy
+        mapping[issnl_val] = issnl_val
+
+    with open(output_path, 'wb') as out:
+        out.write(_HEADER.pack(ISSN_INDEX_MAGIC, ISSN_INDEX_VERSION, len(mapping)))
+        for issn_val in sorted(mapping):
+            out.write(_RECORD.pack(issn_val, mapping[issn_val]))
+    return len(mapping)
+
+def is_issn_index_file(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(ISSN_INDEX_MAGIC)) == ISSN_INDEX_MAGIC
+    except (OSError, IOError):
+        return False
+
+
+class IssnIndex:
+    """
+    Read-only, dict-like (get(), `in` and len() only) view of a binary ISSN-L index
+    file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, count) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != ISSN_INDEX_MAGIC or version != ISSN_INDEX_VERSION:
+            raise ValueError("not an ISSN-L index file (or unsupported version): {}".format(path))
+        if len(self._mmap) != _HEADER.size + count * _RECORD.size:
+            raise ValueError("truncated ISSN-L index file: {}".format(path))
+        self._count = count
+        view = memoryview(self._mmap)[_HEADER.size:]
+        if sys.byteorder == 'little':
+            # fast path: index directly into the mapped uint32 array
+            self._values = view.cast('I')
+        else:
+            self._values = None
+            self._view = view
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _value(self, i: int) -> int:
+        if self._values is not None:
+            return self._values[i]
+        return struct.unpack_from("<I", self._view, i * 4)[0]
+
+    def get(self, issn: Optional[str], default: Optional[str] = None) -> Optional[str]:
+        if not issn:
+            return default
+        key = pack_issn(issn)
+        if key is None:
+            return default
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._value(2 * mid)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return unpack_issn(self._value(2 * mid + 1))
+        return default
+
+    def __contains__(self, issn: str) -> bool:
+        return self.get(issn) is not None
+
+
+def test_pack_issn() -> None:
+    assert pack_issn("0000-0027") == 2 * 11 + 7
+    assert unpack_issn(pack_issn("1234-567X")) == "1234-567X"
+    assert unpack_issn(pack_issn("2049-3630")) == "2049-3630"
+    assert pack_issn("1234567x") == pack_issn("1234-567X")
+    assert pack_issn("1234-56") is None
+    assert pack_issn("123a-5678") is None
+    assert pack_issn("1234-567Y") is None
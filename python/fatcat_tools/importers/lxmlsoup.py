@@ -0,0 +1,378 @@
+
+"""
+Thin BeautifulSoup-compatible wrapper around lxml elements, for XML importers.
+
+The XML pushers (Bs4XmlLargeFilePusher, etc) used to serialize each lxml
+element and re-parse it with BeautifulSoup ("xml" mode), and importers then
+walk the soup. For large dumps (PubMed baseline, dblp) that second parse
+dominates CPU time. LxmlTag exposes the subset of the bs4 Tag interface that
+the XML importers (pubmed, arxiv, jstor, jalc, dblp) actually use, directly
+on top of the already-parsed lxml tree:
+
+- `tag.child_name` (first matching descendant, like `find()`)
+- `find()` / `find_all()`, by name, attribute filters (`attrs` dict or
+  keyword arguments) or exact string, with `recursive` and `limit`
+- `.string`, `.text`, `get_text()` and `stripped_strings`
+- `.name`, `.prefix`, `.attrs`, `get()` and `tag['attr']`
+
+Results are meant to be identical to the bs4 parse, including some quirks:
+tags match on local name (or "prefix:name"), whitespace-only strings are
+collapsed to a single space or newline, comments are not text, and tags are
+always truthy. Strings are returned as plain `str`.
+"""
+
+import copy
+from typing import Any, Dict, Iterator, List, Optional
+
+import lxml.etree
+
+
+# same definition as bs4.BeautifulSoup.ASCII_SPACES
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+
+def soup_string(s: str) -> str:
+    """
+    BeautifulSoup replaces strings which are entirely ASCII whitespace with a
+    single newline (if there was one) or space.
+    """
+    if s.strip(ASCII_SPACES):
+        return s
+    return '\n' if '\n' in s else ' '
+
+def split_tag(elem: Any) -> tuple:
+    """
+    Returns (prefix, local name) for an lxml element. Undeclared namespace
+    prefixes (which lxml keeps as part of the tag in recover mode) are
+    dropped, like bs4 does.
+    """
+    tag = elem.tag
+    if tag[0] == '{':
+        return (elem.prefix, tag[tag.index('}') + 1:])
+    if ':' in tag:
+        return (None, tag.split(':', 1)[1])
+    return (None, tag)
+
+def soup_attrs(elem: Any) -> Dict[str, str]:
+    attrs = dict()
+    for (key, value) in elem.attrib.items():
+        if key[0] == '{':
+            (ns, local) = key[1:].split('}', 1)
+            if ns == XML_NAMESPACE:
+                key = 'xml:' + local
+            else:
+                prefixes = [p for (p, uri) in elem.nsmap.items() if uri == ns and p]
+                key = "{}:{}".format(prefixes[0], local) if prefixes else local
+        elif ':' in key:
+            key = key.split(':', 1)[1]
+        attrs[key] = value
+    return attrs
+
+def _tag_filters(name: Any) -> Optional[List[str]]:
+    """
+    lxml iter() tag filters for a bs4-style name argument, or None if the
+    name needs to be checked in python.
+    """
+    if name is None:
+        return []
+    if isinstance(name, str):
+        name = [name]
+    if any([':' in n for n in name]):
+        return None
+    return ["{*}" + n for n in name]
+
+
+class LxmlTag:
+    """
+    Wraps an lxml element. Like bs4 tags, attribute access on unknown names
+    (`tag.title`) returns the first descendant with that name, or None.
+    """
+
+    __slots__ = ('_elem',)
+
+    def __init__(self, elem: Any):
+        self._elem = elem
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.find(name)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __getitem__(self, key: str) -> str:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __str__(self) -> str:
+        # serialized like bs4 does, with whitespace-only strings collapsed
+        elem = copy.deepcopy(self._elem)
+        for e in elem.iter():
+            if isinstance(e.tag, str) and e.text:
+                e.text = soup_string(e.text)
+            if e.tail:
+                e.tail = soup_string(e.tail)
+        return lxml.etree.tostring(elem, encoding='unicode', with_tail=False)
+
+    def __repr__(self) -> str:
+        return str(self)
+
+    @property
+    def element(self) -> Any:
+        return self._elem
+
+    @property
+    def name(self) -> str:
+        return split_tag(self._elem)[1]
+
+    @property
+    def prefix(self) -> Optional[str]:
+        return split_tag(self._elem)[0]
+
+    @property
+    def attrs(self) -> Dict[str, str]:
+        return soup_attrs(self._elem)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._elem.get(key)
+        if value is None:
+            value = soup_attrs(self._elem).get(key)
+        return default if value is None else value
+
+    def _descendants(self, tags: List[str]) -> Iterator[Any]:
+        return self._elem.iterdescendants(*tags)
+
+    def _children(self, tags: List[str]) -> Iterator[Any]:
+        return self._elem.iterchildren(*tags)
+
+    def _strings(self, elem: Any = None) -> Iterator[str]:
+        """
+        All text nodes, in document order, as bs4 would see them
+        """
+        if elem is None:
+            elem = self._elem
+        if elem.text:
+            yield soup_string(elem.text)
+        for child in elem:
+            if isinstance(child.tag, str):
+                yield from self._strings(child)
+            if child.tail:
+                yield soup_string(child.tail)
+
+    def _contents(self, limit: int) -> list:
+        # first `limit` items of bs4 `contents` (strings and child tags)
+        elem = self._elem
+        contents: List[Any] = []
+        if elem.text:
+            contents.append(soup_string(elem.text))
+        for child in elem:
+            if len(contents) >= limit:
+                break
+            if isinstance(child.tag, str):
+                contents.append(child)
+            elif child.text is not None:
+                # comments and processing instructions
+                contents.append(child.text)
+            if child.tail:
+                contents.append(soup_string(child.tail))
+        return contents[:limit]
+
+    def _matches(self, elem: Any, name: Any, attrs: Dict[str, Any], string: Any) -> bool:
+        if not isinstance(elem.tag, str):
+            return False
+        if name is not None:
+            (prefix, local) = split_tag(elem)
+            names = [name] if isinstance(name, str) else name
+            if not (local in names or (prefix and "{}:{}".format(prefix, local) in names)):
+                return False
+        if attrs:
+            tag = LxmlTag(elem)
+            for (key, want) in attrs.items():
+                value = tag.get(key)
+                if want is True:
+                    if value is None:
+                        return False
+                elif want is False or want is None:
+                    if value is not None:
+                        return False
+                elif isinstance(want, (list, tuple, set)):
+                    if value not in want:
+                        return False
+                elif value != want:
+                    return False
+        if string is not None and LxmlTag(elem).string != string:
+            return False
+        return True
+
+    def find_all(self, name: Any = None, attrs: Optional[Dict[str, Any]] = None,
+                 recursive: bool = True, string: Optional[str] = None,
+                 limit: Optional[int] = None, **kwargs) -> List[Any]:
+        """
+        Same arguments as bs4 find_all(). With only `string`, returns matching
+        strings instead of tags.
+        """
+        if attrs is None:
+            attrs = dict()
+        elif not isinstance(attrs, dict):
+            raise NotImplementedError("only dict attrs filters are supported")
+        attrs = dict(attrs, **kwargs)
+
+        if string is not None and name is None and not attrs:
+            found = [s for s in self._strings() if s == string]
+            return found[:limit] if limit else found
+
+        tags = _tag_filters(name)
+        candidates = self._descendants(tags or []) if recursive else self._children(tags or [])
+        check_name = name if tags is None else None
+        results = []
+        for elem in candidates:
+            if not isinstance(elem.tag, str):
+                continue
+            if (check_name is not None or attrs or string is not None) \
+                    and not self._matches(elem, check_name, attrs, string):
+                continue
+            results.append(LxmlTag(elem))
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    findAll = find_all
+
+    def find(self, name: Any = None, attrs: Optional[Dict[str, Any]] = None,
+             recursive: bool = True, string: Optional[str] = None, **kwargs) -> Any:
+        if isinstance(name, str) and recursive and not (attrs or kwargs or string) \
+                and ':' not in name:
+            # fast path for the common `tag.find("name")` / `tag.name` case
+            elem = next(self._descendants(["{*}" + name]), None)
+            return LxmlTag(elem) if elem is not None else None
+        found = self.find_all(name, attrs, recursive=recursive, string=string, limit=1, **kwargs)
+        return found[0] if found else None
+
+    @property
+    def string(self) -> Optional[str]:
+        contents = self._contents(2)
+        if len(contents) != 1:
+            return None
+        if isinstance(contents[0], str):
+            return contents[0]
+        return LxmlTag(contents[0]).string
+
+    def get_text(self, separator: str = "", strip: bool = False) -> str:
+        strings = self._strings()
+        if strip:
+            return separator.join([s.strip() for s in strings if s.strip()])
+        return separator.join(strings)
+
+    getText = get_text
+
+    @property
+    def text(self) -> str:
+        return self.get_text()
+
+    @property
+    def stripped_strings(self) -> Iterator[str]:
+        for s in self._strings():
+            s = s.strip()
+            if s:
+                yield s
+
+    def decompose(self) -> None:
+        self._elem.clear()
+
+
+class LxmlDocument(LxmlTag):
+    """
+    Wraps a parsed document (by root element), like a bs4 BeautifulSoup
+    object: the root element itself is included in searches.
+    """
+
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        return "[document]"
+
+    @property
+    def prefix(self) -> Optional[str]:
+        return None
+
+    @property
+    def attrs(self) -> Dict[str, str]:
+        return dict()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return default
+
+    def _descendants(self, tags: List[str]) -> Iterator[Any]:
+        return self._elem.iter(*tags)
+
+    def _children(self, tags: List[str]) -> Iterator[Any]:
+        if tags and "{*}" + split_tag(self._elem)[1] not in tags:
+            return iter([])
+        return iter([self._elem])
+
+    def _contents(self, limit: int) -> list:
+        return [self._elem]
+
+
+# bs4 parses XML with lxml in recover mode
+XML_PARSER_KWARGS = dict(recover=True)
+
+def strip_undeclared_prefixes(root: Any) -> None:
+    """
+    In recover mode, lxml keeps undeclared namespace prefixes as part of tag
+    and attribute names ("rdf:Description"); bs4 drops them. Renames in place.
+    """
+    for elem in root.iter(lxml.etree.Element):
+        if ':' in elem.tag and elem.tag[0] != '{':
+            elem.tag = elem.tag.split(':', 1)[1]
+        for key in elem.attrib.keys():
+            if ':' in key and key[0] != '{':
+                elem.attrib[key.split(':', 1)[1]] = elem.attrib.pop(key)
+
+def parse_xml_document(blob: Any) -> LxmlDocument:
+    """
+    Parses a complete XML document (str or bytes) in the same lenient way
+    BeautifulSoup does.
+    """
+    if isinstance(blob, str):
+        blob = blob.encode('utf-8')
+    parser = lxml.etree.XMLParser(**XML_PARSER_KWARGS)
+    root = lxml.etree.fromstring(blob, parser)
+    strip_undeclared_prefixes(root)
+    return LxmlDocument(root)
+
+def iter_xml_records(xml_file: Any, record_tags: Any, load_dtd: bool = False) -> Iterator[LxmlTag]:
+    """
+    Streams elements matching any of `record_tags` (local names) out of a
+    (possibly very large) XML file, as LxmlTag objects. Each element is
+    cleared, and dropped from the tree, after the consumer moves on.
+
+    `xml_file` can be a path, or a binary or text file object.
+    """
+    if isinstance(record_tags, str):
+        record_tags = [record_tags]
+    if hasattr(xml_file, 'read') and not isinstance(xml_file.read(0), bytes):
+        # lxml needs bytes; text-mode files (including stdin) wrap a buffer
+        xml_file = xml_file.buffer
+    elem_iter = lxml.etree.iterparse(
+        xml_file,
+        events=("end",),
+        tag=["{*}" + t for t in record_tags],
+        load_dtd=load_dtd,
+        **XML_PARSER_KWARGS,
+    )
+    for (_event, elem) in elem_iter:
+        yield LxmlTag(elem)
+        elem.clear(keep_tail=True)
+        # drop references to already-processed siblings, so memory use stays
+        # flat on huge files
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
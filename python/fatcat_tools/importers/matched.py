@@ -2,7 +2,7 @@
 import fatcat_openapi_client
 
 from fatcat_tools.normal import *
-from .common import EntityImporter, make_rel_url, SANE_MAX_RELEASES, SANE_MAX_URLS
+from .common import EntityImporter, make_rel_urls, SANE_MAX_RELEASES, SANE_MAX_URLS
 
 
 class MatchedImporter(EntityImporter):
@@ -91,10 +91,7 @@ class MatchedImporter(EntityImporter):
 
         # parse URLs and CDX
         urls = set()
-        for url in obj.get('urls', []):
-            url = make_rel_url(url, default_link_rel=self.default_link_rel)
-            if url != None:
-                urls.add(url)
+        raw_urls = list(obj.get('urls', []))
         for cdx in obj.get('cdx', []):
             original = cdx['url']
             if cdx.get('dt'):
@@ -102,9 +99,8 @@ class MatchedImporter(EntityImporter):
                     cdx['dt'],
                     original)
                 urls.add(("webarchive", wayback))
-            url = make_rel_url(original, default_link_rel=self.default_link_rel)
-            if url != None:
-                urls.add(url)
+            raw_urls.append(original)
+        urls.update(make_rel_urls(raw_urls, default_link_rel=self.default_link_rel))
         urls = [fatcat_openapi_client.FileUrl(rel=rel, url=url) for (rel, url) in urls]
         if len(urls) == 0:
             self.counts['skip-no-urls'] += 1
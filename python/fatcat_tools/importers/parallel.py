@@ -0,0 +1,471 @@
+
+"""
+Parallel record processing for EntityImporter.
+
+ParallelImporter wraps an existing importer and exposes the same
+push_record()/finish() interface, so it can be handed to any RecordPusher
+which doesn't mutate records after pushing them (eg, JsonLinePusher,
+LinePusher, CsvPusher).
+
+Work is split in three stages:
+
+- want() and parse_record() run in a pool of forked worker processes, in
+  chunks of records. This is the CPU-heavy part (string cleaning, etc).
+- try_update() runs in a pool of threads in the parent process. This is
+  usually dominated by API lookups (network latency).
+- a single "submitter" (the thread calling push_record()) walks the records in
+  input order, merges counts, and calls push_entity(). This is the only place
+  insert_batch() gets called from.
+
+Anything which needs an editgroup (get_editgroup_id(), and thus all the
+create_*() helpers) is serialized in input order: a try_update() thread blocks
+in get_editgroup_id() until all previous records have been submitted, and
+keeps that "turn" until it returns. If parse_record() needs an editgroup (eg,
+to create a container), the worker process gives up on that record and the
+submitter re-parses it in the parent process, in order.
+
+Existence lookups in try_update() running ahead of their turn could miss
+entities created (or updated) by earlier records which have not been submitted
+yet, or are still sitting in an unflushed insert batch or an unaccepted
+editgroup. To avoid that, each entity's lookup keys (its own external
+identifiers, ISSNs, hashes, etc; see entity_lookup_keys()) are compared
+against those of all earlier records whose effects may not be visible yet; on
+any overlap, try_update() for that record is held back and run by the
+submitter at its turn, exactly as in serial mode. With that, editgroup sizing,
+the sequence of edits, and the final counts are the same as in serial mode, as
+long as try_update() only looks up entities by the entity's own identifiers.
+
+Caveats:
+
+- worker processes are forked once per run (until finish() is called) and
+  get a copy of the importer; lookup caches filled in by workers are not
+  shared back with the parent, or between workers
+- records must be pickle-able (JSON dicts, lines, CSV rows are all fine)
+- lookups in try_update() by anything other than the entity's lookup keys (eg,
+  fuzzy title matching, or other entities referenced by the record) see the
+  catalog as of when they run, which can be before earlier records have been
+  submitted
+
+By default, chunks are collected from the worker pool in the order they were
+pushed, so the import is deterministic. With `ordered=False`, chunks are
+collected as soon as they are done; this avoids stalling on one slow chunk
+(eg, a very large XML file), at the cost of a different (but still
+consistent) edit order.
+
+ParallelXmlFileImporter is a variant for XML importers, where the unit of work
+pushed is an XML file path: files are read and parsed entirely in the worker
+processes, and only entities are sent back.
+"""
+
+import threading
+import itertools
+import collections
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from fatcat_tools.chunk_pool import ChunkPool
+
+
+class SubmitterRequired(Exception):
+    """
+    Raised in worker processes when parse_record() tries to get an editgroup.
+    The record is re-parsed by the submitter in the parent process instead.
+    """
+    pass
+
+
+class ParallelImportAborted(Exception):
+    pass
+
+
+# identifier fields (on the entity itself) which importers look up existing
+# entities by; release/container `ext_ids` fields are all included
+LOOKUP_KEY_FIELDS = ('issnl', 'issne', 'issnp', 'wikidata_qid', 'orcid', 'sha1', 'sha256', 'md5')
+
+def entity_lookup_keys(entity):
+    """
+    Returns a set of (field, value) tuples identifying the entity
+    """
+    keys = set()
+    ext_ids = getattr(entity, 'ext_ids', None)
+    if ext_ids is not None:
+        for field in ext_ids.attribute_map:
+            value = getattr(ext_ids, field)
+            if value:
+                keys.add((field, value))
+    for field in LOOKUP_KEY_FIELDS:
+        value = getattr(entity, field, None)
+        if value:
+            keys.add((field, value))
+    return keys
+
+def _refuse_editgroup():
+    raise SubmitterRequired()
+
+def _worker_init(importer):
+    importer._editgroup_gate = _refuse_editgroup
+    # don't share any open keep-alive API connections with the parent
+    api_client = getattr(importer.api, 'api_client', None)
+    if api_client is not None:
+        api_client.rest_client.pool_manager.clear()
+
+def _parse_one(importer, raw_record):
+    """
+    Returns a (status, entity, counts) tuple, where status is one of 'skip',
+    'entity', or 'reparse'.
+    """
+    importer.counts = Counter()
+    try:
+        if (not raw_record) or (not importer.want(raw_record)):
+            importer.counts['skip'] += 1
+            return ('skip', None, importer.counts)
+        entity = importer.parse_record(raw_record)
+    except SubmitterRequired:
+        return ('reparse', None, None)
+    if not entity:
+        importer.counts['skip'] += 1
+        return ('skip', None, importer.counts)
+    return ('entity', entity, importer.counts)
+
+def _parse_chunk(importer, chunk):
+    """
+    Runs in a worker process (with the worker's copy of the importer).
+    Returns a list of (status, entity, counts) tuples, one per record.
+    """
+    return [_parse_one(importer, raw_record) for raw_record in chunk]
+
+def _parse_xml_files(importer, xml_paths, record_tag, lxml_records):
+    """
+    Runs in a worker process. Parses every record in each of the files, and
+    returns a list of (status, entity, counts, (xml_path, index)) tuples.
+    """
+    from .common import xml_file_records
+    results = []
+    for xml_path in xml_paths:
+        for (i, record) in enumerate(xml_file_records(xml_path, record_tag, lxml_records)):
+            results.append(_parse_one(importer, record) + ((xml_path, i),))
+    return results
+
+
+class ParallelImporter:
+    """
+    Wraps an EntityImporter to parse records in worker processes and run
+    try_update() in threads, while submitting in input order. See module
+    docstring for details.
+
+    Parameters:
+
+        workers: number of forked worker processes for parse_record()
+        update_threads: number of threads for try_update() (default: twice
+            the number of workers)
+        chunk_size: number of records sent to a worker process at a time
+        ordered: if False, collect chunks in completion order instead of
+            input order
+    """
+
+    def __init__(self, importer, workers=4, update_threads=None, chunk_size=50, ordered=True, **kwargs):
+        self.importer = importer
+        self.workers = workers
+        self.update_threads = update_threads or (2 * workers)
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.max_inflight_chunks = kwargs.get('max_inflight_chunks', 2 * workers)
+        self.max_pending_updates = kwargs.get('max_pending_updates', 4 * self.update_threads)
+
+        self._pool = None
+        self._executor = None
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._aborted = False
+        self._reset_queues()
+
+    # worker function, called as parse_chunk(importer, chunk, *_parse_args())
+    parse_chunk = staticmethod(_parse_chunk)
+
+    def _reset_queues(self):
+        self._chunk = []
+        # (seq, status, raw_record, entity, counts, Future)
+        self._update_queue = collections.deque()
+        # lookup keys of records which are queued but not yet submitted, of
+        # entities in the importer's insert batch, and of entities edited in
+        # the current (not yet accepted) editgroup
+        self._unsubmitted_keys = Counter()
+        self._unflushed_keys = Counter()
+        self._unaccepted_keys = Counter()
+        # re-parsed records' keys are only known once they are submitted
+        self._unsubmitted_reparses = 0
+        # seqs are assigned as chunks are collected, in submission order
+        self._next_seq = 0
+        # seq of the next record to be submitted (whose try_update() may run
+        # up to its edits before the submitter gets to it), and the importer
+        # state (see _importer_state()) as of when that turn started
+        self._turn = 0
+        self._turn_state = None
+
+    @property
+    def counts(self):
+        return self.importer.counts
+
+    def push_record(self, raw_record):
+        self._chunk.append(raw_record)
+        if len(self._chunk) >= self.chunk_size:
+            self._guarded(self._dispatch_chunk)
+
+    def finish(self):
+        """
+        Waits for all pushed records to be processed and submitted, shuts down
+        the worker pools, and then calls finish() on the wrapped importer.
+
+        Safe to continue pushing records after this; pools will be re-created.
+        """
+        self._guarded(self._drain)
+        self._shutdown()
+        return self.importer.finish()
+
+    def _guarded(self, func):
+        try:
+            func()
+        except BaseException:
+            self._abort()
+            raise
+
+    def _start(self):
+        # fork the process pool before starting any threads
+        self._pool = ChunkPool(
+            self.parse_chunk,
+            self._handle_chunk,
+            self.workers,
+            ordered=self.ordered,
+            max_inflight=self.max_inflight_chunks,
+            state=self.importer,
+            initializer=_worker_init,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=self.update_threads)
+        self._aborted = False
+        self._turn_state = self._importer_state()
+        self.importer._editgroup_gate = self._editgroup_gate
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.importer._editgroup_gate = None
+        self._reset_queues()
+
+    def _abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        for pending in self._update_queue:
+            if pending[5] is not None:
+                pending[5].cancel()
+        self._shutdown()
+
+    def _editgroup_gate(self):
+        seq = getattr(self._local, 'seq', None)
+        if seq is None:
+            # submitter thread; always has the turn
+            return
+        with self._cond:
+            while self._turn < seq and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise ParallelImportAborted()
+
+    def _parse_args(self):
+        """
+        Extra arguments for parse_chunk(), after the chunk
+        """
+        return ()
+
+    def _chunk_records(self, chunk, results):
+        """
+        Yields (status, entity, counts, raw_record) for each record of a
+        parsed chunk. `raw_record` is what gets passed to _reparse().
+        """
+        for (raw_record, (status, entity, counts)) in zip(chunk, results):
+            yield (status, entity, counts, raw_record)
+
+    def _reparse(self, raw_record):
+        """
+        Parses and pushes a record in this process; returns the entity (if any)
+        """
+        return self._push_serial(raw_record)
+
+    def _push_serial(self, raw_record):
+        # same as EntityImporter.push_record(), but returns the entity
+        importer = self.importer
+        importer.counts['total'] += 1
+        if (not raw_record) or (not importer.want(raw_record)):
+            importer.counts['skip'] += 1
+            return None
+        entity = importer.parse_record(raw_record)
+        if not entity:
+            importer.counts['skip'] += 1
+            return None
+        if importer.bezerk_mode or importer.try_update(entity):
+            importer.push_entity(entity)
+        return entity
+
+    def _pending_conflict(self, keys):
+        if self._unsubmitted_reparses:
+            return True
+        for key in keys:
+            if self._unsubmitted_keys[key] or self._unflushed_keys[key] or self._unaccepted_keys[key]:
+                return True
+        return False
+
+    def _dispatch_chunk(self):
+        if self._pool is None:
+            self._start()
+        chunk = self._chunk
+        self._chunk = []
+        # parsed chunks are passed to _handle_chunk() (from here, once too
+        # many are in flight, or from _drain())
+        self._pool.submit(chunk, *self._parse_args(), tag=chunk)
+
+    def _handle_chunk(self, chunk, results):
+        for (status, entity, counts, raw_record) in self._chunk_records(chunk, results):
+            seq = self._next_seq
+            self._next_seq += 1
+            future = None
+            if status == 'entity' and not self.importer.bezerk_mode:
+                keys = entity_lookup_keys(entity)
+                if self._pending_conflict(keys):
+                    # an earlier record with the same identifier may not be
+                    # visible yet; run try_update() at this record's turn
+                    status = 'deferred'
+                else:
+                    future = self._executor.submit(self._run_try_update, seq, entity)
+                self._unsubmitted_keys.update(keys)
+            elif status == 'reparse':
+                self._unsubmitted_reparses += 1
+            self._update_queue.append((seq, status, raw_record, entity, counts, future))
+            while len(self._update_queue) > self.max_pending_updates:
+                self._submit_next()
+
+    def _run_try_update(self, seq, entity):
+        self._local.seq = seq
+        self.importer._local.counts = Counter()
+        try:
+            keep = self.importer.try_update(entity)
+            return (keep, self.importer._local.counts)
+        finally:
+            self.importer._local.counts = None
+            self._local.seq = None
+
+    def _submit_next(self):
+        (seq, status, raw_record, entity, counts, future) = self._update_queue.popleft()
+        assert seq == self._turn
+        importer = self.importer
+        keys = entity_lookup_keys(entity) if entity is not None else set()
+        # (-= also drops the zero counts)
+        self._unsubmitted_keys -= Counter(keys)
+        # not the current importer state: this record's try_update() thread
+        # can have made edits already, once the previous record was submitted
+        (batch_len, editgroup_id, edit_count) = self._turn_state
+        if status == 'reparse':
+            # all earlier records are submitted and no other thread can have
+            # the turn, so just run through the regular serial path
+            self._unsubmitted_reparses -= 1
+            entity = self._reparse(raw_record)
+            keys = entity_lookup_keys(entity) if entity is not None else set()
+        else:
+            importer.counts['total'] += 1
+            importer.counts.update(counts)
+            if status == 'entity' and future is None:
+                # bezerk mode
+                importer.push_entity(entity)
+            elif status == 'entity':
+                (keep, update_counts) = future.result()
+                importer.counts.update(update_counts)
+                if keep:
+                    importer.push_entity(entity)
+            elif status == 'deferred':
+                if importer.try_update(entity):
+                    importer.push_entity(entity)
+        self._track_visibility(keys, batch_len, editgroup_id, edit_count)
+        with self._cond:
+            self._turn_state = self._importer_state()
+            self._turn = seq + 1
+            self._cond.notify_all()
+
+    def _importer_state(self):
+        """
+        Insert batch length and editgroup state, for _track_visibility()
+        """
+        importer = self.importer
+        return (len(importer._entity_queue), importer._editgroup_id, importer._edit_count)
+
+    def _track_visibility(self, keys, batch_len, editgroup_id, edit_count):
+        """
+        Called after each record is submitted, with the importer's insert
+        batch length and editgroup state from just before its turn started
+        """
+        importer = self.importer
+        if len(importer._entity_queue) < batch_len:
+            # insert batch was flushed
+            self._unflushed_keys.clear()
+        elif len(importer._entity_queue) > batch_len:
+            self._unflushed_keys.update(keys)
+        if importer._editgroup_id != editgroup_id:
+            # previous editgroup was accepted (or submitted)
+            self._unaccepted_keys.clear()
+            if importer._edit_count > 0:
+                self._unaccepted_keys.update(keys)
+        elif importer._edit_count > edit_count:
+            self._unaccepted_keys.update(keys)
+
+    def _drain(self):
+        if self._chunk:
+            self._dispatch_chunk()
+        if self._pool is not None:
+            self._pool.drain()
+        while self._update_queue:
+            self._submit_next()
+
+
+class ParallelXmlFileImporter(ParallelImporter):
+    """
+    ParallelImporter variant where push_record() takes the path of an XML file.
+    Worker processes read and parse the whole file (with BeautifulSoup, or
+    lxml if `lxml_records` is set), and run want()/parse_record() on every
+    `record_tag` element in it. Only the resulting entities are sent back.
+
+    Records which need to be re-parsed in the parent process (see module
+    docstring) are found again by file path and index.
+
+    `chunk_size` is a number of files.
+    """
+
+    def __init__(self, importer, record_tag, lxml_records=False, chunk_size=4, **kwargs):
+        super().__init__(importer, chunk_size=chunk_size, **kwargs)
+        self.record_tag = record_tag
+        self.lxml_records = lxml_records
+
+    parse_chunk = staticmethod(_parse_xml_files)
+
+    def _parse_args(self):
+        return (self.record_tag, self.lxml_records)
+
+    def _chunk_records(self, chunk, results):
+        for (status, entity, counts, ref) in results:
+            yield (status, entity, counts, ref)
+
+    def _reparse(self, raw_record):
+        from .common import xml_file_records
+        (xml_path, index) = raw_record
+        records = xml_file_records(xml_path, self.record_tag, self.lxml_records)
+        entity = None
+        for record in itertools.islice(records, index, None):
+            entity = self._push_serial(record)
+            break
+        # finish the generator, to close the file
+        records.close()
+        return entity
@@ -625,14 +625,23 @@ class PubmedImporter(EntityImporter):
             # note that Reference always exists within a ReferenceList, but
             # that there may be multiple ReferenceList (eg, sometimes one per
             # Reference)
+            ref_list = []
             for ref in pubmed.find_all('Reference'):
-                ref_extra = dict()
                 ref_doi = ref.find("ArticleId", IdType="doi")
                 if ref_doi:
                     ref_doi = clean_doi(ref_doi.string)
                 ref_pmid = ref.find("ArticleId", IdType="pubmed")
                 if ref_pmid:
                     ref_pmid = clean_pmid(ref_pmid.string)
+                ref_list.append((ref, ref_doi, ref_pmid))
+            if self.lookup_refs:
+                # fetch all the reference identifiers concurrently up front
+                self.lookup_bulk(
+                    dois=[r[1] for r in ref_list],
+                    pmids=[r[2] for r in ref_list],
+                )
+            for (ref, ref_doi, ref_pmid) in ref_list:
+                ref_extra = dict()
                 ref_release_id = None
                 if ref_doi:
                     ref_extra['doi'] = ref_doi
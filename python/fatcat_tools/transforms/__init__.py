@@ -1,5 +1,6 @@
 
-from .entities import entity_to_dict, entity_from_json, entity_from_dict, entity_from_toml, entity_to_toml
+from .entities import entity_to_dict, entity_to_json, entity_from_json, entity_from_dict, entity_from_toml, entity_to_toml
 from .elasticsearch import release_to_elasticsearch, container_to_elasticsearch, changelog_to_elasticsearch, file_to_elasticsearch
 from .csl import release_to_csl, citeproc_csl
 from .ingest import release_ingest_request
+from .bulk import BulkTransformer
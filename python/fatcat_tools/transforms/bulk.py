@@ -0,0 +1,145 @@
+
+"""
+Bulk conversion of entity JSON dumps (one entity per line) to elasticsearch
+documents, as used by `fatcat_transform.py`.
+
+For a full reindex the dumps are hundreds of millions of lines, so with
+`workers` > 1 the input is split into chunks of `chunk_size` lines, which
+are deserialized, transformed and serialized to JSON in a pool of forked
+worker processes. Only the input lines and output text cross process
+boundaries. At most a couple of chunks per worker are in flight at a time,
+so memory use stays bounded regardless of input size.
+
+Output is written in input order by default (identical to a serial run);
+with `ordered=False`, chunks are written as soon as they are done.
+"""
+
+import sys
+import json
+import time
+import itertools
+from collections import Counter
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from fatcat_openapi_client import ReleaseEntity, ContainerEntity, FileEntity, ChangelogEntry
+
+from fatcat_tools.chunk_pool import ChunkPool
+from .entities import entity_from_json
+from .elasticsearch import release_to_elasticsearch, container_to_elasticsearch, \
+    file_to_elasticsearch, changelog_to_elasticsearch
+
+
+# transform kind: (entity type, transform, whether to skip non-active entities)
+ELASTICSEARCH_TRANSFORMS = {
+    'releases': (ReleaseEntity, release_to_elasticsearch, True),
+    'containers': (ContainerEntity, container_to_elasticsearch, True),
+    'files': (FileEntity, file_to_elasticsearch, True),
+    'changelogs': (ChangelogEntry, changelog_to_elasticsearch, False),
+}
+
+
+def elasticsearch_transform_line(kind: str, line: str) -> Optional[str]:
+    """
+    Transforms a single line of entity JSON; returns a line of elasticsearch
+    document JSON (with newline), or None if the line should be skipped.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    (entity_type, transform, active_only) = ELASTICSEARCH_TRANSFORMS[kind]
+    entity = entity_from_json(line, entity_type)
+    if active_only and entity.state != 'active':
+        return None
+    return json.dumps(transform(entity)) + '\n'
+
+def elasticsearch_transform_chunk(kind: str, lines: List[str]) -> Tuple[str, int]:
+    """
+    Runs in worker processes. Returns (output text, number of output lines).
+    """
+    out = []
+    for line in lines:
+        doc = elasticsearch_transform_line(kind, line)
+        if doc is not None:
+            out.append(doc)
+    return ("".join(out), len(out))
+
+def _chunks(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    it = iter(lines)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BulkTransformer:
+    """
+    Parameters:
+
+        kind: one of ELASTICSEARCH_TRANSFORMS ('releases', 'containers',
+            'files', 'changelogs')
+        workers: number of worker processes (1 means transform in-process)
+        chunk_size: number of input lines per worker task
+        ordered: if False, write chunks in completion order
+        progress_interval: if set, print throughput to stderr every this many
+            seconds
+
+    run() returns counts of input ('lines') and output ('docs') lines.
+    """
+
+    def __init__(self, kind, workers=1, chunk_size=1000, ordered=True, progress_interval=None):
+        if kind not in ELASTICSEARCH_TRANSFORMS:
+            raise ValueError("unknown transform: {}".format(kind))
+        self.kind = kind
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.progress_interval = progress_interval
+        self.max_inflight_chunks = 2 * workers
+
+    def run(self, json_input: Iterable[str], json_output: Any) -> Counter:
+        self.counts: Counter = Counter()
+        self._start = self._last_report = time.monotonic()
+        self._last_counts: Counter = Counter()
+        if self.workers <= 1:
+            for chunk in _chunks(json_input, self.chunk_size):
+                self._write(json_output, len(chunk),
+                    elasticsearch_transform_chunk(self.kind, chunk))
+        else:
+            self._run_pool(json_input, json_output)
+        if self.progress_interval:
+            self._report(time.monotonic())
+        return self.counts
+
+    def _run_pool(self, json_input: Iterable[str], json_output: Any) -> None:
+
+        def handle(line_count: int, result: Tuple[str, int]) -> None:
+            self._write(json_output, line_count, result)
+
+        with ChunkPool(elasticsearch_transform_chunk, handle, self.workers, ordered=self.ordered,
+                max_inflight=self.max_inflight_chunks) as pool:
+            for chunk in _chunks(json_input, self.chunk_size):
+                pool.submit(self.kind, chunk, tag=len(chunk))
+            pool.drain()
+
+    def _write(self, json_output: Any, line_count: int, result: Tuple[str, int]) -> None:
+        (text, doc_count) = result
+        json_output.write(text)
+        self.counts['lines'] += line_count
+        self.counts['docs'] += doc_count
+        if self.progress_interval:
+            now = time.monotonic()
+            if now - self._last_report >= self.progress_interval:
+                self._report(now)
+
+    def _report(self, now: float) -> None:
+        interval = max(now - self._last_report, 1e-6)
+        total = max(now - self._start, 1e-6)
+        print("{} lines, {} docs; {:.0f} lines/sec (overall {:.0f} lines/sec)".format(
+            self.counts['lines'],
+            self.counts['docs'],
+            (self.counts['lines'] - self._last_counts['lines']) / interval,
+            self.counts['lines'] / total,
+        ), file=sys.stderr)
+        self._last_report = now
+        self._last_counts = Counter(self.counts)
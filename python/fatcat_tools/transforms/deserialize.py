@@ -0,0 +1,211 @@
+
+"""
+Fast conversion of parsed JSON (dicts, lists, strings, etc) into
+fatcat_openapi_client model objects.
+
+The code-generated ApiClient.deserialize() only accepts serialized JSON, so
+converting a dict meant a json.dumps()/json.loads() round-trip, and it
+re-interprets type strings like 'list[ReleaseRef]' (with regexes) for every
+single field of every object. Here the openapi_types of each model class are
+compiled once into a "plan" of (attribute, JSON key, converter function)
+tuples, which is then used for every object of that type.
+
+Model constructors are still called with keyword arguments, so the resulting
+objects (and any validation errors) are the same as from ApiClient.
+"""
+
+import re
+import datetime
+import threading
+from typing import Any, Callable, Dict, Tuple, Union
+
+import dateutil.parser
+import fatcat_openapi_client
+from fatcat_openapi_client.rest import ApiException
+
+
+Deserializer = Callable[[Any], Any]
+
+_LIST_TYPE_RE = re.compile(r'list\[(.*)\]')
+_DICT_TYPE_RE = re.compile(r'dict\(([^,]*), (.*)\)')
+_ISO_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+# timestamps as returned by the fatcat API, eg "2020-01-30T05:04:39.738601Z"
+_API_DATETIME_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(Z?)$')
+# whatever dateutil uses for a "Z" suffix (which is tzlocal() if the local
+# timezone is UTC, otherwise tzutc())
+_UTC_TZINFO = dateutil.parser.parse("2000-01-01T00:00:00Z").tzinfo
+
+_PRIMITIVE_TYPES = {
+    'int': int,
+    'long': int,
+    'float': float,
+    'str': str,
+    'bool': bool,
+}
+
+# (type, copy_objects) -> deserializer function
+_DESERIALIZERS: Dict[Tuple[Any, bool], Deserializer] = dict()
+# deserializers which are still being compiled; only moved to _DESERIALIZERS
+# (which is read without locking) once complete
+_PENDING: Dict[Tuple[Any, bool], Deserializer] = dict()
+_COMPILE_LOCK = threading.RLock()
+
+
+def _copy_json(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _copy_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_copy_json(v) for v in value]
+    return value
+
+def _passthrough(value: Any) -> Any:
+    return value
+
+def _primitive_deserializer(klass: type) -> Deserializer:
+    def deserialize(data: Any) -> Any:
+        if data is None or type(data) is klass:
+            return data
+        try:
+            return klass(data)
+        except UnicodeEncodeError:
+            return str(data)
+        except TypeError:
+            return data
+    return deserialize
+
+def _deserialize_date(data: Any) -> Any:
+    if data is None:
+        return None
+    # common case; gives the same result as dateutil, which is much slower
+    if isinstance(data, str) and _ISO_DATE_RE.match(data):
+        try:
+            return datetime.date.fromisoformat(data)
+        except ValueError:
+            pass
+    try:
+        return dateutil.parser.parse(data).date()
+    except ValueError:
+        raise ApiException(
+            status=0,
+            reason="Failed to parse `{0}` as date object".format(data),
+        )
+
+def _deserialize_datetime(data: Any) -> Any:
+    if data is None:
+        return None
+    # common case; constructs the same datetime (including tzinfo) as dateutil
+    m = isinstance(data, str) and _API_DATETIME_RE.match(data)
+    if m:
+        (year, month, day, hour, minute, second, fraction, utc) = m.groups()
+        try:
+            return datetime.datetime(
+                int(year), int(month), int(day), int(hour), int(minute), int(second),
+                int(fraction.ljust(6, '0')) if fraction else 0,
+                tzinfo=_UTC_TZINFO if utc else None,
+            )
+        except ValueError:
+            pass
+    try:
+        return dateutil.parser.parse(data)
+    except ValueError:
+        raise ApiException(
+            status=0,
+            reason="Failed to parse `{0}` as datetime object".format(data),
+        )
+
+def _model_deserializer(klass: type, copy_objects: bool) -> Deserializer:
+
+    # filled in after this function has been registered, so that
+    # self-referential (or mutually recursive) models work
+    plan = []
+
+    def deserialize(data: Any) -> Any:
+        if data is None:
+            return None
+        kwargs = dict()
+        if isinstance(data, dict):
+            for (attr, key, field_deserializer) in plan:
+                if key in data:
+                    kwargs[attr] = field_deserializer(data[key])
+        instance = klass(**kwargs)
+        if hasattr(instance, 'get_real_child_model'):
+            klass_name = instance.get_real_child_model(data)
+            if klass_name:
+                instance = get_deserializer(klass_name, copy_objects=copy_objects)(data)
+        return instance
+
+    _PENDING[(klass, copy_objects)] = deserialize
+    for (attr, attr_type) in klass.openapi_types.items():
+        plan.append((
+            attr,
+            klass.attribute_map[attr],
+            get_deserializer(attr_type, copy_objects=copy_objects),
+        ))
+    return deserialize
+
+def _compile(klass: Union[str, type], copy_objects: bool) -> Deserializer:
+    if isinstance(klass, str):
+        if klass.startswith('list['):
+            item_deserializer = get_deserializer(
+                _LIST_TYPE_RE.match(klass).group(1), copy_objects=copy_objects)
+            def deserialize_list(data: Any) -> Any:
+                if data is None:
+                    return None
+                return [item_deserializer(v) for v in data]
+            return deserialize_list
+
+        if klass.startswith('dict('):
+            value_deserializer = get_deserializer(
+                _DICT_TYPE_RE.match(klass).group(2), copy_objects=copy_objects)
+            def deserialize_dict(data: Any) -> Any:
+                if data is None:
+                    return None
+                return {k: value_deserializer(v) for k, v in data.items()}
+            return deserialize_dict
+
+        if klass in _PRIMITIVE_TYPES:
+            return _primitive_deserializer(_PRIMITIVE_TYPES[klass])
+        elif klass == 'object':
+            return _copy_json if copy_objects else _passthrough
+        elif klass == 'date':
+            return _deserialize_date
+        elif klass == 'datetime':
+            return _deserialize_datetime
+        return get_deserializer(
+            getattr(fatcat_openapi_client.models, klass), copy_objects=copy_objects)
+
+    if not klass.openapi_types and not hasattr(klass, 'get_real_child_model'):
+        return _copy_json if copy_objects else _passthrough
+    return _model_deserializer(klass, copy_objects)
+
+def get_deserializer(klass: Union[str, type], copy_objects: bool = True) -> Deserializer:
+    """
+    Returns a (cached) function which converts parsed JSON to the given type.
+    `klass` can be a model class (eg, ReleaseEntity) or an openapi type string
+    (eg, "list[ReleaseRef]").
+
+    If `copy_objects` is true, free-form fields (like `extra`) are copied, so
+    the returned entity doesn't share any mutable state with the input; this
+    can be disabled if the input was freshly parsed and won't be re-used.
+    """
+    key = (klass, copy_objects)
+    func = _DESERIALIZERS.get(key)
+    if func is not None:
+        return func
+    with _COMPILE_LOCK:
+        func = _DESERIALIZERS.get(key) or _PENDING.get(key)
+        if func is not None:
+            return func
+        # if nothing else was pending, everything compiled from here down is
+        # complete once we return
+        outermost = not _PENDING
+        func = _compile(klass, copy_objects)
+        _PENDING[key] = func
+        if outermost:
+            _DESERIALIZERS.update(_PENDING)
+            _PENDING.clear()
+    return func
+
+def deserialize_entity(obj: Any, entity_type: Union[str, type], copy_objects: bool = True) -> Any:
+    return get_deserializer(entity_type, copy_objects=copy_objects)(obj)
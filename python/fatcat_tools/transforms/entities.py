@@ -1,38 +1,48 @@
 
-import json
 import toml
-import collections
-from fatcat_openapi_client import ApiClient
+
+from fatcat_tools.fastjson import json_loads
+from .serialize import serialize_entity, entity_to_json
+from .deserialize import deserialize_entity
 
 def entity_to_dict(entity, api_client=None) -> dict:
     """
-    Hack to take advantage of the code-generated serialization code.
+    Converts an entity (or any other API model object) to a JSON-compatible
+    dict; same result as the code-generated serialization code, but faster
+    (see `fatcat_tools.transforms.serialize`).
 
-    Initializing/destroying ApiClient objects is surprisingly expensive
-    (because it involves a threadpool), so we allow passing an existing
-    instance. If you already have a full-on API connection `api`, you can
-    access the ApiClient object as `api.api_client`. This is such a speed-up
-    that this argument may become mandatory.
+    The api_client argument is no longer used, and only kept for backwards
+    compatibility.
     """
-    if not api_client:
-        api_client = ApiClient()
-    return api_client.sanitize_for_serialization(entity)
+    return serialize_entity(entity)
 
 def entity_from_json(json_str: str, entity_type, api_client=None):
     """
-    Hack to take advantage of the code-generated deserialization code
+    Parses JSON (str or bytes) into an entity of the given type; same result
+    as the code-generated deserialization code, but faster (see
+    `fatcat_tools.transforms.deserialize`).
 
-    See note on `entity_to_dict()` about api_client argument.
+    The api_client argument is no longer used, and only kept for backwards
+    compatibility.
     """
-    if not api_client:
-        api_client = ApiClient()
-    thing = collections.namedtuple('Thing', ['data'])
-    thing.data = json_str
-    return api_client.deserialize(thing, entity_type)
+    try:
+        obj = json_loads(json_str)
+    except ValueError:
+        # same as ApiClient.deserialize(): try with the raw string
+        obj = json_str
+    # freshly parsed, so no need to copy 'extra' dicts
+    return deserialize_entity(obj, entity_type, copy_objects=False)
 
 def entity_from_dict(obj: dict, entity_type, api_client=None):
-    json_str = json.dumps(obj)
-    return entity_from_json(json_str, entity_type, api_client=api_client)
+    """
+    Converts a dict (eg, parsed JSON or TOML) into an entity of the given
+    type. The input is not modified, and the returned entity doesn't share any
+    mutable state with it.
+
+    The api_client argument is no longer used, and only kept for backwards
+    compatibility.
+    """
+    return deserialize_entity(obj, entity_type)
 
 def entity_to_toml(entity, api_client=None, pop_fields=None) -> str:
     """
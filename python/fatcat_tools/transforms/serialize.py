@@ -0,0 +1,147 @@
+
+"""
+Fast conversion of fatcat_openapi_client model objects into JSON-compatible
+dicts; the reverse of `fatcat_tools.transforms.deserialize`.
+
+The code-generated ApiClient.sanitize_for_serialization() walks the
+openapi_types and attribute_map of every nested object, calling getattr()
+twice per attribute, and dispatches on isinstance() checks for every value.
+Here each model class gets a serializer function built once from its
+openapi_types, which reads the (private) attribute values directly and uses
+the declared type to skip the generic dispatch in the common case.
+
+The output is the same as from sanitize_for_serialization(): None-valued
+attributes are omitted, dates and datetimes become ISO 8601 strings, and
+lists, dicts and models are recursively converted.
+"""
+
+import json
+import datetime
+from typing import Any, Callable, Dict
+
+
+Serializer = Callable[[Any], Any]
+
+# same as ApiClient.PRIMITIVE_TYPES
+_PRIMITIVE_TYPES = (float, bool, bytes, str, int)
+_PRIMITIVE_TYPE_NAMES = {
+    'int': int,
+    'long': int,
+    'float': float,
+    'str': str,
+    'bool': bool,
+}
+
+# model class -> serializer function
+_SERIALIZERS: Dict[type, Serializer] = dict()
+
+
+def sanitize(obj: Any) -> Any:
+    """
+    Generic (slow path) conversion of any value; same behavior as
+    ApiClient.sanitize_for_serialization().
+    """
+    if obj is None:
+        return None
+    elif isinstance(obj, _PRIMITIVE_TYPES):
+        return obj
+    elif isinstance(obj, list):
+        return [sanitize(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(sanitize(v) for v in obj)
+    elif isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    elif isinstance(obj, dict):
+        return {k: sanitize(v) for k, v in obj.items()}
+    return get_serializer(type(obj))(obj)
+
+def _field_serializer(attr_type: str) -> Serializer:
+    """
+    Returns a function for serializing a (non-None) attribute value of the
+    given openapi type. Falls back to sanitize() if the value isn't of the
+    declared type.
+    """
+    if attr_type in _PRIMITIVE_TYPE_NAMES:
+        klass = _PRIMITIVE_TYPE_NAMES[attr_type]
+        def serialize_primitive(value: Any) -> Any:
+            if type(value) is klass:
+                return value
+            return sanitize(value)
+        return serialize_primitive
+    elif attr_type in ('date', 'datetime'):
+        def serialize_date(value: Any) -> Any:
+            if isinstance(value, datetime.date):
+                return value.isoformat()
+            return sanitize(value)
+        return serialize_date
+    elif attr_type.startswith('list['):
+        item_type = attr_type[5:-1]
+        item_serializer = _field_serializer(item_type)
+        def serialize_list(value: Any) -> Any:
+            if type(value) is list:
+                return [None if v is None else item_serializer(v) for v in value]
+            return sanitize(value)
+        return serialize_list
+    elif attr_type.startswith('dict(') or attr_type == 'object':
+        # free-form; can contain anything
+        return sanitize
+    else:
+        # model class name; classes are resolved lazily, on first use
+        model_serializers = dict()
+        def serialize_model(value: Any) -> Any:
+            klass = type(value)
+            func = model_serializers.get(klass)
+            if func is None:
+                if not hasattr(klass, 'openapi_types'):
+                    return sanitize(value)
+                func = get_serializer(klass)
+                model_serializers[klass] = func
+            return func(value)
+        return serialize_model
+
+def _model_serializer(klass: type) -> Serializer:
+
+    plan = []
+    for (attr, attr_type) in klass.openapi_types.items():
+        # generated models store attributes as eg, "_ident", with properties
+        # wrapping them
+        plan.append(("_" + attr, klass.attribute_map[attr], _field_serializer(attr_type)))
+
+    def serialize(obj: Any) -> dict:
+        values = obj.__dict__
+        result = dict()
+        for (private_attr, key, field_serializer) in plan:
+            value = values.get(private_attr)
+            if value is not None:
+                result[key] = field_serializer(value)
+        return result
+
+    return serialize
+
+def get_serializer(klass: type) -> Serializer:
+    """
+    Returns a (cached) function which converts model objects of the given
+    class (eg, ReleaseEntity) to dicts.
+    """
+    func = _SERIALIZERS.get(klass)
+    if func is None:
+        # compiling doesn't recurse (nested model classes are resolved on
+        # first use), so a race here at worst compiles the same class twice
+        func = _model_serializer(klass)
+        _SERIALIZERS[klass] = func
+    return func
+
+def serialize_entity(entity: Any) -> Any:
+    if entity is None:
+        return None
+    func = _SERIALIZERS.get(type(entity))
+    if func is not None:
+        return func(entity)
+    return sanitize(entity)
+
+def entity_to_json(entity: Any) -> bytes:
+    """
+    Serializes an entity to UTF-8 JSON bytes (eg, for Kafka messages). Same
+    output as json.dumps() of entity_to_dict().
+    """
+    return json.dumps(serialize_entity(entity)).encode('utf-8')
@@ -1,9 +1,10 @@
 
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from confluent_kafka import Consumer, Producer, KafkaException
 
-from fatcat_tools.transforms import release_ingest_request, release_to_elasticsearch
+from fatcat_tools.transforms import release_ingest_request, release_to_elasticsearch, entity_to_json
 
 from .worker_common import FatcatWorker, most_recent_message
 
@@ -58,10 +59,9 @@ class ChangelogWorker(FatcatWorker):
                     self.offset+1, latest))
             for i in range(self.offset+1, latest+1):
                 cle = self.api.get_changelog_entry(i)
-                obj = self.api.api_client.sanitize_for_serialization(cle)
                 producer.produce(
                     self.produce_topic,
-                    json.dumps(obj).encode('utf-8'),
+                    entity_to_json(cle),
                     key=str(i),
                     on_delivery=fail_fast,
                     #NOTE timestamp could be timestamp=cle.timestamp (?)
@@ -80,10 +80,16 @@ class EntityUpdatesWorker(FatcatWorker):
 
     def __init__(self, api, kafka_hosts, consume_topic, release_topic,
             file_topic, container_topic, ingest_file_request_topic,
-            work_ident_topic, poll_interval=5.0):
+            work_ident_topic, poll_interval=5.0, fetch_workers=8, batch_size=1):
         super().__init__(kafka_hosts=kafka_hosts,
                          consume_topic=consume_topic,
                          api=api)
+        self.fetch_workers = fetch_workers
+        # number of changelog entries to consume and process at a time
+        self.batch_size = batch_size
+        # all fetch threads share the API client's urllib3 connection pool,
+        # so `api` should be created with a pool of at least fetch_workers
+        # connections (eg, public_api(host, pool_maxsize=fetch_workers))
         self.release_topic = release_topic
         self.file_topic = file_topic
         self.container_topic = container_topic
@@ -247,6 +253,145 @@ class EntityUpdatesWorker(FatcatWorker):
 
         return True
 
+    def publish_changelog_entry(self, cle, producer, executor, on_delivery=None):
+        """
+        Fetches all the entities edited in a changelog entry (as a dict) from
+        the API, and publishes them to Kafka. See `publish_changelog_entries()`.
+        """
+        self.publish_changelog_entries([cle], producer, executor, on_delivery=on_delivery)
+
+    def publish_changelog_entries(self, cles, producer, executor, on_delivery=None):
+        """
+        Fetches all the entities edited in a batch of changelog entries (as
+        dicts) from the API, and publishes them to Kafka.
+
+        Entities edited in (or linked from) several entries in the batch are
+        only fetched and published once, at their current (newest) state.
+        Work update messages are attributed to the newest changelog entry
+        which touched the work (or the release it was found via).
+
+        Fetches run concurrently on the given executor, and each entity is
+        published as soon as it arrives. Releases linked from edited files,
+        filesets and webcaptures are fetched (once) as well. Does not flush
+        the producer; the caller should do so before storing the offsets of
+        the changelog messages.
+        """
+        cles = sorted(cles, key=lambda cle: cle['index'])
+
+        # entity type -> ident -> newest changelog entry with an edit
+        edited = dict(files=dict(), filesets=dict(), webcaptures=dict(),
+            containers=dict(), releases=dict(), works=dict())
+        new_release_ids = set()
+        for cle in cles:
+            edits = cle['editgroup']['edits']
+            for (entity_type, idents) in edited.items():
+                for e in edits[entity_type]:
+                    idents[e['ident']] = cle
+            # filter to direct release edits which are not updates
+            for e in edits['releases']:
+                if not e.get('prev_revision') and not e.get('redirect_ident'):
+                    new_release_ids.add(e['ident'])
+        work_sources = edited['works']
+        release_sources = dict()
+
+        # future -> (entity type, ident)
+        pending = dict()
+
+        def fetch_release(ident, cle):
+            if ident in release_sources:
+                if cle['index'] > release_sources[ident]['index']:
+                    release_sources[ident] = cle
+                return
+            release_sources[ident] = cle
+            future = executor.submit(self.api.get_release, ident,
+                expand="files,filesets,webcaptures,container")
+            pending[future] = ('release', ident)
+
+        for (ident, cle) in edited['releases'].items():
+            fetch_release(ident, cle)
+        for ident in edited['files']:
+            pending[executor.submit(self.api.get_file, ident, expand=None)] = ('file', ident)
+        for ident in edited['filesets']:
+            pending[executor.submit(self.api.get_fileset, ident, expand=None)] = ('fileset', ident)
+        for ident in edited['webcaptures']:
+            pending[executor.submit(self.api.get_webcapture, ident, expand=None)] = ('webcapture', ident)
+        for ident in edited['containers']:
+            pending[executor.submit(self.api.get_container, ident)] = ('container', ident)
+
+        try:
+            while pending:
+                (done, _) = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    (entity_type, ident) = pending.pop(future)
+                    entity = future.result()
+
+                    if entity_type in ('file', 'fileset', 'webcapture'):
+                        # update release when a file changes
+                        # TODO: also fetch old version of file and update any *removed*
+                        # release idents (and same for filesets, webcapture updates)
+                        cle = edited[entity_type + 's'][ident]
+                        for release_id in (entity.release_ids or []):
+                            fetch_release(release_id, cle)
+
+                    if entity_type == 'file':
+                        producer.produce(
+                            self.file_topic,
+                            entity_to_json(entity),
+                            key=ident.encode('utf-8'),
+                            on_delivery=on_delivery,
+                        )
+                    # TODO: topics for fileset and webcapture updates
+                    elif entity_type == 'container':
+                        producer.produce(
+                            self.container_topic,
+                            entity_to_json(entity),
+                            key=ident.encode('utf-8'),
+                            on_delivery=on_delivery,
+                        )
+                    elif entity_type == 'release':
+                        if entity.work_id:
+                            cle = release_sources[ident]
+                            if entity.work_id not in work_sources or cle['index'] > work_sources[entity.work_id]['index']:
+                                work_sources[entity.work_id] = cle
+                        producer.produce(
+                            self.release_topic,
+                            entity_to_json(entity),
+                            key=ident.encode('utf-8'),
+                            on_delivery=on_delivery,
+                        )
+                        # for ingest requests, filter to "new" active releases with no matched files
+                        if entity.ident in new_release_ids:
+                            ir = release_ingest_request(entity, ingest_request_source='fatcat-changelog')
+                            if ir and not entity.files and self.want_live_ingest(entity, ir):
+                                producer.produce(
+                                    self.ingest_file_request_topic,
+                                    json.dumps(ir).encode('utf-8'),
+                                    #key=None,
+                                    on_delivery=on_delivery,
+                                )
+        finally:
+            # on error, don't leave fetches queued up behind us
+            for future in pending:
+                future.cancel()
+
+        # send work updates (just ident and changelog metadata) to scholar for re-indexing
+        for (ident, cle) in work_sources.items():
+            assert ident
+            key = f"work_{ident}"
+            work_ident_dict = dict(
+                key=key,
+                type="fatcat_work",
+                work_ident=ident,
+                updated=cle['timestamp'],
+                fatcat_changelog_index=cle['index'],
+            )
+            producer.produce(
+                self.work_ident_topic,
+                json.dumps(work_ident_dict).encode('utf-8'),
+                key=key.encode('utf-8'),
+                on_delivery=on_delivery,
+            )
+
     def run(self):
 
         def fail_fast(err, msg):
@@ -312,123 +457,33 @@ class EntityUpdatesWorker(FatcatWorker):
         )
         print("Kafka consuming {}".format(self.consume_topic))
 
+        executor = ThreadPoolExecutor(max_workers=self.fetch_workers)
+
         while True:
-            msg = consumer.poll(self.poll_interval)
-            if not msg:
+            batch = consumer.consume(
+                num_messages=self.batch_size,
+                timeout=self.poll_interval)
+            if not batch:
                 print("nothing new from kafka (poll_interval: {} sec)".format(self.poll_interval))
                 continue
-            if msg.error():
-                raise KafkaException(msg.error())
-
-            cle = json.loads(msg.value().decode('utf-8'))
-            #print(cle)
-            print("processing changelog index {}".format(cle['index']))
-            release_ids = []
-            new_release_ids = []
-            file_ids = []
-            fileset_ids = []
-            webcapture_ids = []
-            container_ids = []
-            work_ids = []
-            release_edits = cle['editgroup']['edits']['releases']
-            for re in release_edits:
-                release_ids.append(re['ident'])
-                # filter to direct release edits which are not updates
-                if not re.get('prev_revision') and not re.get('redirect_ident'):
-                    new_release_ids.append(re['ident'])
-            file_edits = cle['editgroup']['edits']['files']
-            for e in file_edits:
-                file_ids.append(e['ident'])
-            fileset_edits = cle['editgroup']['edits']['filesets']
-            for e in fileset_edits:
-                fileset_ids.append(e['ident'])
-            webcapture_edits = cle['editgroup']['edits']['webcaptures']
-            for e in webcapture_edits:
-                webcapture_ids.append(e['ident'])
-            container_edits = cle['editgroup']['edits']['containers']
-            for e in container_edits:
-                container_ids.append(e['ident'])
-            work_edits = cle['editgroup']['edits']['works']
-            for e in work_edits:
-                work_ids.append(e['ident'])
-
-            # TODO: do these fetches in parallel using a thread pool?
-            for ident in set(file_ids):
-                file_entity = self.api.get_file(ident, expand=None)
-                # update release when a file changes
-                # TODO: also fetch old version of file and update any *removed*
-                # release idents (and same for filesets, webcapture updates)
-                release_ids.extend(file_entity.release_ids or [])
-                file_dict = self.api.api_client.sanitize_for_serialization(file_entity)
-                producer.produce(
-                    self.file_topic,
-                    json.dumps(file_dict).encode('utf-8'),
-                    key=ident.encode('utf-8'),
-                    on_delivery=fail_fast,
-                )
-
-            # TODO: topic for fileset updates
-            for ident in set(fileset_ids):
-                fileset_entity = self.api.get_fileset(ident, expand=None)
-                # update release when a fileset changes
-                release_ids.extend(file_entity.release_ids or [])
-
-            # TODO: topic for webcapture updates
-            for ident in set(webcapture_ids):
-                webcapture_entity = self.api.get_webcapture(ident, expand=None)
-                # update release when a webcapture changes
-                release_ids.extend(webcapture_entity.release_ids or [])
-
-            for ident in set(container_ids):
-                container = self.api.get_container(ident)
-                container_dict = self.api.api_client.sanitize_for_serialization(container)
-                producer.produce(
-                    self.container_topic,
-                    json.dumps(container_dict).encode('utf-8'),
-                    key=ident.encode('utf-8'),
-                    on_delivery=fail_fast,
-                )
-
-            for ident in set(release_ids):
-                release = self.api.get_release(ident, expand="files,filesets,webcaptures,container")
-                if release.work_id:
-                    work_ids.append(release.work_id)
-                release_dict = self.api.api_client.sanitize_for_serialization(release)
-                producer.produce(
-                    self.release_topic,
-                    json.dumps(release_dict).encode('utf-8'),
-                    key=ident.encode('utf-8'),
-                    on_delivery=fail_fast,
-                )
-                # for ingest requests, filter to "new" active releases with no matched files
-                if release.ident in new_release_ids:
-                    ir = release_ingest_request(release, ingest_request_source='fatcat-changelog')
-                    if ir and not release.files and self.want_live_ingest(release, ir):
-                        producer.produce(
-                            self.ingest_file_request_topic,
-                            json.dumps(ir).encode('utf-8'),
-                            #key=None,
-                            on_delivery=fail_fast,
-                        )
-
-            # send work updates (just ident and changelog metadata) to scholar for re-indexing
-            for ident in set(work_ids):
-                assert ident
-                key = f"work_{ident}"
-                work_ident_dict = dict(
-                    key=key,
-                    type="fatcat_work",
-                    work_ident=ident,
-                    updated=cle['timestamp'],
-                    fatcat_changelog_index=cle['index'],
-                )
-                producer.produce(
-                    self.work_ident_topic,
-                    json.dumps(work_ident_dict).encode('utf-8'),
-                    key=key.encode('utf-8'),
-                    on_delivery=fail_fast,
-                )
-
+            for msg in batch:
+                if msg.error():
+                    raise KafkaException(msg.error())
+
+            cles = [json.loads(msg.value().decode('utf-8')) for msg in batch]
+            #print(cles)
+            if len(cles) == 1:
+                print("processing changelog index {}".format(cles[0]['index']))
+            else:
+                print("processing {} changelog entries, index {} through {}".format(
+                    len(cles),
+                    min([cle['index'] for cle in cles]),
+                    max([cle['index'] for cle in cles]),
+                ))
+            self.publish_changelog_entries(cles, producer, executor, on_delivery=fail_fast)
+            # one flush per batch; offsets only get stored (in order) once
+            # everything from the whole batch has been delivered
             producer.flush()
             # TODO: publish updated 'work' entities to a topic
-            consumer.store_offsets(message=msg)
+            for msg in batch:
+                consumer.store_offsets(message=msg)
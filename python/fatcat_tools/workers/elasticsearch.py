@@ -1,24 +1,218 @@
 
 import json
+import time
+import threading
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from typing import Any, List, Optional, Tuple
+
 import requests
 from confluent_kafka import Consumer, KafkaException
 
 from fatcat_openapi_client import ReleaseEntity, ContainerEntity, ApiClient, ChangelogEntry
 from fatcat_tools import *
+from fatcat_tools.fastjson import json_loads
+from fatcat_tools.transforms.deserialize import deserialize_entity
 from .worker_common import FatcatWorker
 
 
+class ElasticsearchBulkError(Exception):
+    pass
+
+
+class ElasticsearchBulkIndexer:
+    """
+    Sends batches of documents to an elasticsearch _bulk endpoint, with up to
+    `concurrency` requests in flight at a time (on a shared HTTP session).
+
+    Requests rejected with HTTP 429 (too many requests), and individual items
+    rejected with status 429 (eg, es_rejected_execution_exception), are
+    retried with exponential backoff, up to `max_retries` times. Any other
+    item error fails the whole batch.
+
+    Documents are ordered per id, so an older version of a document never
+    overwrites a newer one: within a batch only the last document for each
+    id is sent (before any retries), and a batch which shares ids with a
+    batch still in flight isn't submitted until that batch is done.
+    """
+
+    def __init__(self, endpoint: str, concurrency: int = 1, max_retries: int = 8,
+            backoff: float = 1.0, max_backoff: float = 60.0,
+            session: Optional[requests.Session] = None):
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = session or requests.Session()
+        self.session.mount(endpoint, requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        self.counts = collections.Counter()
+        self._counts_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        # (set of document ids, future) of submitted batches
+        self._inflight: List[Tuple[set, Any]] = []
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._counts_lock:
+            self.counts[key] += n
+
+    def _sleep_backoff(self, attempt: int) -> None:
+        time.sleep(min(self.backoff * (2 ** attempt), self.max_backoff))
+
+    def index(self, actions: List[Tuple[Any, dict]]) -> None:
+        """
+        Synchronously indexes a batch of (document id, document) pairs;
+        returns only once every document has been acknowledged.
+
+        If an id appears more than once, only the last document is indexed.
+        """
+        actions = dedupe_actions(actions)
+        attempt = 0
+        while actions:
+            body = []
+            for (doc_id, doc) in actions:
+                body.append(json.dumps({"index": {"_id": doc_id}}))
+                body.append(json.dumps(doc))
+            resp = self.session.post(self.endpoint,
+                headers={"Content-Type": "application/x-ndjson"},
+                data="\n".join(body) + "\n")
+            if resp.status_code == 429:
+                retry_actions = actions
+            else:
+                resp.raise_for_status()
+                resp_json = resp.json()
+                retry_actions = []
+                if resp_json['errors']:
+                    failed = []
+                    for (action, item) in zip(actions, resp_json['items']):
+                        # item is eg, {"index": {"_id": ..., "status": 201}}
+                        result = list(item.values())[0]
+                        if result.get('status') == 429:
+                            retry_actions.append(action)
+                        elif result.get('error'):
+                            failed.append(result)
+                    if failed:
+                        self._count('failed', len(failed))
+                        desc = "Elasticsearch errors from post to {}:".format(self.endpoint)
+                        print(desc)
+                        print(json.dumps(failed[:10]))
+                        raise ElasticsearchBulkError(desc)
+                self._count('indexed', len(actions) - len(retry_actions))
+            if retry_actions:
+                if attempt >= self.max_retries:
+                    raise ElasticsearchBulkError("Elasticsearch still rejecting {} documents after {} retries".format(
+                        len(retry_actions), self.max_retries))
+                self._count('retried', len(retry_actions))
+                print("Elasticsearch rejected {} documents (429), backing off and retrying".format(len(retry_actions)))
+                self._sleep_backoff(attempt)
+                attempt += 1
+            actions = retry_actions
+
+    def submit(self, actions: List[Tuple[Any, dict]]) -> Any:
+        """
+        Like index(), but runs in the background; returns a Future.
+
+        Blocks until any in-flight batches with ids in common are done.
+        """
+        ids = set([doc_id for (doc_id, _doc) in actions])
+        self._inflight = [(batch_ids, f) for (batch_ids, f) in self._inflight if not f.done()]
+        conflicts = [f for (batch_ids, f) in self._inflight if not ids.isdisjoint(batch_ids)]
+        if conflicts:
+            self._count('ordering_waits')
+            wait(conflicts)
+        future = self._executor.submit(self.index, actions)
+        self._inflight.append((ids, future))
+        return future
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+def dedupe_actions(actions: List[Tuple[Any, dict]]) -> List[Tuple[Any, dict]]:
+    """
+    Drops all but the last (most recent) document for each id, keeping the
+    order of the remaining documents.
+    """
+    last = dict()
+    for (n, (doc_id, _doc)) in enumerate(actions):
+        last[doc_id] = n
+    if len(last) == len(actions):
+        return actions
+    return [a for (n, a) in enumerate(actions) if last[a[0]] == n]
+
+
+# per-process API client for transforms which need to fetch from the API
+_TRANSFORM_API = None
+
+def _noop() -> None:
+    pass
+
+def start_transform_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Creates a pool of forked worker processes, and forks them right away
+    (ProcessPoolExecutor only does so on first use). Call this before starting
+    any threads: a process forked while other threads hold locks can deadlock.
+    """
+    pool = ProcessPoolExecutor(max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'))
+    wait([pool.submit(_noop) for _ in range(workers)])
+    return pool
+
+def transform_es_batch(entity_type, document_name: str, transform_func, api_host: str,
+        values: List[bytes]) -> List[Tuple[Any, dict]]:
+    """
+    Transforms a batch of Kafka message values (entity JSON) into
+    (document id, elasticsearch document) pairs.
+
+    Module-level (not a method) so that it can be run in a process pool.
+    """
+    global _TRANSFORM_API
+    actions = []
+    for value in values:
+        # HACK: work around a bug where container entities got published to
+        # release_v03 topic
+        if document_name == "release":
+            entity_dict = json_loads(value)
+            if entity_dict.get('name') and not entity_dict.get('title'):
+                continue
+            # freshly parsed, so no need to copy
+            entity = deserialize_entity(entity_dict, entity_type, copy_objects=False)
+        else:
+            entity = entity_from_json(value, entity_type)
+        if document_name == "changelog":
+            key = entity.index
+            # might need to fetch from API
+            if not (entity.editgroup and entity.editgroup.editor):
+                if _TRANSFORM_API is None:
+                    _TRANSFORM_API = public_api(api_host)
+                entity = _TRANSFORM_API.get_changelog_entry(entity.index)
+        else:
+            key = entity.ident
+        # TODO: handle deletions from index
+        actions.append((key, transform_func(entity)))
+    return actions
+
+
 class ElasticsearchReleaseWorker(FatcatWorker):
     """
     Consumes from release-updates topic and pushes into (presumably local)
     elasticsearch.
 
     Uses a consumer group to manage offset.
+
+    Kafka batches are transformed (in a pool of `transform_workers`
+    processes, or inline if zero) while up to `bulk_concurrency` bulk
+    requests are in flight. Offsets are only stored once a batch, and all
+    batches before it, have been fully acknowledged by elasticsearch.
+    Concurrent batches never contain the same document id (see
+    ElasticsearchBulkIndexer), so updates to an entity are applied in order.
     """
 
     def __init__(self, kafka_hosts, consume_topic, poll_interval=10.0, offset=None,
             elasticsearch_backend="http://localhost:9200", elasticsearch_index="fatcat",
-            batch_size=200, api_host="https://api.fatcat.wiki/v0"):
+            batch_size=200, api_host="https://api.fatcat.wiki/v0",
+            transform_workers=0, bulk_concurrency=1):
         super().__init__(kafka_hosts=kafka_hosts,
                          consume_topic=consume_topic)
         self.consumer_group = "elasticsearch-updates3"
@@ -30,10 +224,55 @@ class ElasticsearchReleaseWorker(FatcatWorker):
         self.elasticsearch_document_name = "release"
         self.transform_func = release_to_elasticsearch
         self.api_host = api_host
+        self.transform_workers = transform_workers
+        self.bulk_concurrency = bulk_concurrency
+
+    def transform_batch(self, values: List[bytes], pool=None) -> List[Tuple[Any, dict]]:
+        """
+        Transforms message values to (document id, document) pairs, split
+        across the process pool (if any).
+        """
+        if pool is None or len(values) < 2:
+            return transform_es_batch(self.entity_type, self.elasticsearch_document_name,
+                self.transform_func, self.api_host, values)
+        chunk_size = -(-len(values) // self.transform_workers)
+        chunks = [values[i:i+chunk_size] for i in range(0, len(values), chunk_size)]
+        results = pool.map(transform_es_batch,
+            [self.entity_type] * len(chunks),
+            [self.elasticsearch_document_name] * len(chunks),
+            [self.transform_func] * len(chunks),
+            [self.api_host] * len(chunks),
+            chunks)
+        actions = []
+        for chunk_actions in results:
+            actions.extend(chunk_actions)
+        return actions
 
     def run(self):
-        ac = ApiClient()
-        api = public_api(self.api_host)
+
+        # fork transform workers before the Kafka consumer and bulk indexer
+        # start their threads
+        pool = None
+        if self.transform_workers > 0:
+            pool = start_transform_pool(self.transform_workers)
+
+        # batches (list of messages, future) in consumed order
+        inflight = collections.deque()
+
+        def store_completed(wait_for=0):
+            """
+            Stores offsets for all acknowledged batches at the head of the
+            queue, first waiting for the oldest `wait_for` batches to finish.
+            """
+            while inflight and (wait_for > 0 or inflight[0][1].done()):
+                (msgs, future) = inflight.popleft()
+                # raises if the batch failed
+                future.result()
+                wait_for -= 1
+                for msg in msgs:
+                    # offsets are *committed* (to brokers) automatically, but need
+                    # to be marked as processed here
+                    consumer.store_offsets(message=msg)
 
         def fail_fast(err, partitions):
             if err is not None:
@@ -58,6 +297,11 @@ class ElasticsearchReleaseWorker(FatcatWorker):
             print("Kafka partitions rebalanced: {} / {}".format(
                 consumer, partitions))
 
+        def on_revoke(consumer, partitions):
+            # finish up everything in flight while we still own the partitions
+            store_completed(wait_for=len(inflight))
+            on_rebalance(consumer, partitions)
+
         consumer_conf = self.kafka_config.copy()
         consumer_conf.update({
             'group.id': self.consumer_group,
@@ -76,13 +320,21 @@ class ElasticsearchReleaseWorker(FatcatWorker):
         consumer = Consumer(consumer_conf)
         consumer.subscribe([self.consume_topic],
             on_assign=on_rebalance,
-            on_revoke=on_rebalance,
+            on_revoke=on_revoke,
         )
 
+        elasticsearch_endpoint = "{}/{}/{}/_bulk".format(
+            self.elasticsearch_backend,
+            self.elasticsearch_index,
+            self.elasticsearch_document_name)
+        indexer = ElasticsearchBulkIndexer(elasticsearch_endpoint,
+            concurrency=self.bulk_concurrency)
+
         while True:
             batch = consumer.consume(
                 num_messages=self.batch_size,
                 timeout=self.poll_interval)
+            store_completed()
             if not batch:
                 if not consumer.assignment():
                     print("... no Kafka consumer partitions assigned yet")
@@ -94,61 +346,29 @@ class ElasticsearchReleaseWorker(FatcatWorker):
                 if msg.error():
                     raise KafkaException(msg.error())
             # ... then process
-            bulk_actions = []
-            for msg in batch:
-                json_str = msg.value().decode('utf-8')
-                # HACK: work around a bug where container entities got published to
-                # release_v03 topic
-                if self.elasticsearch_document_name == "release":
-                    entity_dict = json.loads(json_str)
-                    if entity_dict.get('name') and not entity_dict.get('title'):
-                        continue
-                entity = entity_from_json(json_str, self.entity_type, api_client=ac)
-                if self.elasticsearch_document_name == "changelog":
-                    key = entity.index
-                    # might need to fetch from API
-                    if not (entity.editgroup and entity.editgroup.editor):
-                        entity = api.get_changelog_entry(entity.index)
-                else:
-                    key = entity.ident
-                # TODO: handle deletions from index
-                bulk_actions.append(json.dumps({
-                    "index": { "_id": key, },
-                }))
-                bulk_actions.append(json.dumps(
-                    self.transform_func(entity)))
-            print("Upserting, eg, {} (of {} {} in elasticsearch)".format(key, len(batch), self.elasticsearch_document_name))
-            elasticsearch_endpoint = "{}/{}/{}/_bulk".format(
-                self.elasticsearch_backend,
-                self.elasticsearch_index,
-                self.elasticsearch_document_name)
-            resp = requests.post(elasticsearch_endpoint,
-                headers={"Content-Type": "application/x-ndjson"},
-                data="\n".join(bulk_actions) + "\n")
-            resp.raise_for_status()
-            if resp.json()['errors']:
-                desc = "Elasticsearch errors from post to {}:".format(elasticsearch_endpoint)
-                print(desc)
-                print(resp.content)
-                raise Exception(desc)
-            for msg in batch:
-                # offsets are *committed* (to brokers) automatically, but need
-                # to be marked as processed here
-                consumer.store_offsets(message=msg)
+            actions = self.transform_batch([msg.value() for msg in batch], pool=pool)
+            if actions:
+                print("Upserting, eg, {} (of {} {} in elasticsearch)".format(actions[-1][0], len(batch), self.elasticsearch_document_name))
+            # backpressure: wait for a slot to free up
+            if len(inflight) >= self.bulk_concurrency:
+                store_completed(wait_for=len(inflight) - self.bulk_concurrency + 1)
+            inflight.append((batch, indexer.submit(actions)))
 
 
 class ElasticsearchContainerWorker(ElasticsearchReleaseWorker):
 
     def __init__(self, kafka_hosts, consume_topic, poll_interval=10.0, offset=None,
             elasticsearch_backend="http://localhost:9200", elasticsearch_index="fatcat",
-            batch_size=200):
+            batch_size=200, transform_workers=0, bulk_concurrency=1):
         super().__init__(kafka_hosts=kafka_hosts,
                          consume_topic=consume_topic,
                          poll_interval=poll_interval,
                          offset=offset,
                          elasticsearch_backend=elasticsearch_backend,
                          elasticsearch_index=elasticsearch_index,
-                         batch_size=batch_size)
+                         batch_size=batch_size,
+                         transform_workers=transform_workers,
+                         bulk_concurrency=bulk_concurrency)
         # previous group got corrupted (by pykafka library?)
         self.consumer_group = "elasticsearch-updates3"
         self.entity_type = ContainerEntity
@@ -165,9 +385,11 @@ class ElasticsearchChangelogWorker(ElasticsearchReleaseWorker):
     """
     def __init__(self, kafka_hosts, consume_topic, poll_interval=10.0, offset=None,
             elasticsearch_backend="http://localhost:9200", elasticsearch_index="fatcat_changelog",
-            batch_size=200):
+            batch_size=200, transform_workers=0, bulk_concurrency=1):
         super().__init__(kafka_hosts=kafka_hosts,
-                         consume_topic=consume_topic)
+                         consume_topic=consume_topic,
+                         transform_workers=transform_workers,
+                         bulk_concurrency=bulk_concurrency)
         self.consumer_group = "elasticsearch-updates3"
         self.batch_size = batch_size
         self.poll_interval = poll_interval
@@ -6,57 +6,32 @@ other formats
 """
 
 import sys
-import json
 import argparse
 
-from fatcat_openapi_client import ReleaseEntity, ContainerEntity, FileEntity, ChangelogEntry
-from fatcat_tools import entity_from_json, \
-    release_to_elasticsearch, container_to_elasticsearch, \
-    file_to_elasticsearch, changelog_to_elasticsearch, public_api, \
-    release_to_csl, citeproc_csl
+from fatcat_openapi_client import ReleaseEntity
+from fatcat_tools import entity_from_json, public_api, \
+    release_to_csl, citeproc_csl, BulkTransformer
 
 
+def run_elasticsearch(kind, args):
+    BulkTransformer(kind,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        ordered=not args.unordered,
+        progress_interval=args.progress_interval,
+    ).run(args.json_input, args.json_output)
+
 def run_elasticsearch_releases(args):
-    for line in args.json_input:
-        line = line.strip()
-        if not line:
-            continue
-        entity = entity_from_json(line, ReleaseEntity, api_client=args.api.api_client)
-        if entity.state != 'active':
-            continue
-        args.json_output.write(
-            json.dumps(release_to_elasticsearch(entity)) + '\n')
+    run_elasticsearch('releases', args)
 
 def run_elasticsearch_containers(args):
-    for line in args.json_input:
-        line = line.strip()
-        if not line:
-            continue
-        entity = entity_from_json(line, ContainerEntity, api_client=args.api.api_client)
-        if entity.state != 'active':
-            continue
-        args.json_output.write(
-            json.dumps(container_to_elasticsearch(entity)) + '\n')
+    run_elasticsearch('containers', args)
 
 def run_elasticsearch_files(args):
-    for line in args.json_input:
-        line = line.strip()
-        if not line:
-            continue
-        entity = entity_from_json(line, FileEntity, api_client=args.api.api_client)
-        if entity.state != 'active':
-            continue
-        args.json_output.write(
-            json.dumps(file_to_elasticsearch(entity)) + '\n')
+    run_elasticsearch('files', args)
 
 def run_elasticsearch_changelogs(args):
-    for line in args.json_input:
-        line = line.strip()
-        if not line:
-            continue
-        entity = entity_from_json(line, ChangelogEntry, api_client=args.api.api_client)
-        args.json_output.write(
-            json.dumps(changelog_to_elasticsearch(entity)) + '\n')
+    run_elasticsearch('changelogs', args)
 
 def run_citeproc_releases(args):
     for line in args.json_input:
@@ -77,6 +52,18 @@ def main():
     parser.add_argument('--fatcat-api-url',
         default="http://localhost:9411/v0",
         help="connect to this host/port")
+    parser.add_argument('--workers',
+        help="number of parallel transform processes (elasticsearch transforms only)",
+        default=1, type=int)
+    parser.add_argument('--chunk-size',
+        help="number of input lines per worker task",
+        default=1000, type=int)
+    parser.add_argument('--unordered',
+        action='store_true',
+        help="with --workers, write output in the order it is ready, not input order")
+    parser.add_argument('--progress-interval',
+        help="print throughput to stderr every this many seconds (eg, 1)",
+        default=None, type=float)
     subparsers = parser.add_subparsers()
 
     sub_elasticsearch_releases = subparsers.add_parser('elasticsearch-releases',
@@ -11,6 +11,7 @@ import sys
 import argparse
 
 from fatcat_tools import uuid2fcid, fcid2uuid, authenticated_api
+from fatcat_tools.importers.issn_index import build_issn_index
 
 
 def run_uuid2fcid(args):
@@ -26,6 +27,10 @@ def run_editgroup_submit(args):
     eg = args.api.get_editgroup(args.editgroup_id)
     args.api.update_editgroup(args.editgroup_id, eg, submit=True)
 
+def run_issn_index(args):
+    count = build_issn_index(args.issn_map_file, args.output_path)
+    print("Wrote {} ISSN-L mappings to {}".format(count, args.output_path))
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -58,6 +63,15 @@ def main():
     sub_editgroup_submit.add_argument('editgroup_id',
         help="editgroup to submit")
 
+    sub_issn_index = subparsers.add_parser('issn-index',
+        help="convert an ISSN-to-ISSN-L text file to a binary (mmap-able) index for importers")
+    sub_issn_index.set_defaults(func=run_issn_index)
+    sub_issn_index.add_argument('issn_map_file',
+        help="ISSN to ISSN-L mapping file (text)",
+        type=argparse.FileType('r'))
+    sub_issn_index.add_argument('output_path',
+        help="path to write binary index file to")
+
     args = parser.parse_args()
     if not args.__dict__.get("func"):
         print("tell me what to do!")
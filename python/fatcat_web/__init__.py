@@ -1,4 +1,6 @@
 
+from concurrent.futures import ThreadPoolExecutor
+
 from flask import Flask
 from flask.logging import create_logger
 from flask_uuid import FlaskUUID
@@ -14,6 +16,8 @@ import fatcat_openapi_client
 import elasticsearch
 
 from fatcat_web.web_config import Config
+from fatcat_web.cache import ResponseCache, RedisCacheBackend
+from fatcat_web.ratelimit import RateLimiter
 
 
 toolbar = DebugToolbarExtension()
@@ -74,6 +78,23 @@ app.register_blueprint(mwoauth.bp, url_prefix='/auth/wikipedia')
 
 app.es_client = elasticsearch.Elasticsearch(Config.ELASTICSEARCH_BACKEND)
 
+response_cache = ResponseCache(
+    max_size=Config.FATCAT_WEB_CACHE_SIZE,
+    ttl=Config.FATCAT_WEB_CACHE_TTL,
+    stale_ttl=Config.FATCAT_WEB_CACHE_STALE_TTL,
+    backend=RedisCacheBackend(Config.FATCAT_WEB_CACHE_REDIS_URL) if Config.FATCAT_WEB_CACHE_REDIS_URL else None,
+)
+
+export_limiter = RateLimiter(
+    max_requests=Config.FATCAT_WEB_EXPORT_RATE_LIMIT,
+    period=60.0,
+    max_concurrent=Config.FATCAT_WEB_EXPORT_CONCURRENCY,
+)
+
+# threads are only started on first use, so this is safe to create before
+# forking web workers
+backend_pool = ThreadPoolExecutor(max_workers=Config.FATCAT_WEB_BACKEND_WORKERS)
+
 from fatcat_web import routes, editing_routes, auth, cors, forms
 
 # TODO: blocking on ORCID support in loginpass
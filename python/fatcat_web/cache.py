@@ -0,0 +1,360 @@
+
+"""
+Application-level cache for expensive (elasticsearch aggregation) responses
+in the web interface.
+
+Values are kept in an in-process LRU, and optionally also in a shared
+backend (redis) so that all web workers benefit from each other's work.
+Entries have two lifetimes:
+
+- for `ttl` seconds after being computed, an entry is "fresh" and returned
+  as-is
+- for a further `stale_ttl` seconds, the entry is "stale": it is still
+  returned immediately, but a background refresh gets kicked off
+  (stale-while-revalidate)
+
+After that the value is recomputed synchronously. Concurrent misses for the
+same key share a single computation.
+
+Callers get a copy of the cached value, so they can mutate it freely.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import pickle
+import threading
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class RedisCacheBackend:
+    """
+    Shared cache tier, stored in redis. The `redis` python package is only
+    required if this backend is configured.
+
+    Values are pickled along with the time they were computed, and expire
+    from redis entirely once they are too stale to be served.
+    """
+
+    def __init__(self, url: str, prefix: str = "fatcat_web:cache:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Tuple[float, Any]]:
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        return pickle.loads(raw)
+
+    def set(self, key: str, created: float, value: Any, expire: float) -> None:
+        self.client.set(
+            self.prefix + key,
+            pickle.dumps((created, value)),
+            ex=max(1, int(expire)),
+        )
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+
+class ResponseCache:
+
+    def __init__(self,
+                 max_size: int = 1024,
+                 ttl: float = 300,
+                 stale_ttl: float = 3600,
+                 backend: Optional[Any] = None,
+                 refresh_workers: int = 2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.backend = backend
+        self.refresh_workers = refresh_workers
+        self.counts: collections.Counter = collections.Counter()
+
+        # key -> (created, value)
+        self._entries: "collections.OrderedDict[str, Tuple[float, Any]]" = collections.OrderedDict()
+        # key -> Future, for in-progress (re)computations
+        self._inflight: Dict[str, Future] = dict()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 or self.backend is not None
+
+    def _refresh_executor(self) -> ThreadPoolExecutor:
+        # created lazily, and re-created after a fork (eg, in gunicorn
+        # workers), because threads don't survive fork()
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.refresh_workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _lookup(self, key: str) -> Optional[Tuple[float, Any]]:
+        # must be called with self._lock held
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, created: float, value: Any, ttl: float, stale_ttl: float) -> None:
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = (created, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.counts['evict'] += 1
+        if self.backend is not None:
+            try:
+                self.backend.set(key, created, value, ttl + stale_ttl)
+            except Exception as e:
+                self.counts['backend-error'] += 1
+                print("response cache backend error: {}".format(e), file=sys.stderr)
+
+    def _compute(self, key: str, func: Callable[[], Any], ttl: float, stale_ttl: float) -> Any:
+        value = func()
+        self._store(key, time.time(), value, ttl, stale_ttl)
+        return value
+
+    def _start(self, key: str, func: Callable[[], Any], ttl: float, stale_ttl: float,
+               background: bool) -> Tuple[Future, bool]:
+        """
+        Returns the in-flight Future for key, starting a new computation if
+        there isn't one already. The boolean indicates whether the caller is
+        responsible for running the computation (only for foreground calls).
+        """
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                return (fut, False)
+            if background:
+                fut = self._refresh_executor().submit(self._refresh, key, func, ttl, stale_ttl)
+            else:
+                fut = Future()
+            self._inflight[key] = fut
+            return (fut, not background)
+
+    def _refresh(self, key: str, func: Callable[[], Any], ttl: float, stale_ttl: float) -> Any:
+        try:
+            self.counts['refresh'] += 1
+            return self._compute(key, func, ttl, stale_ttl)
+        except Exception as e:
+            # keep serving the stale value; it will get retried on the next hit
+            self.counts['error'] += 1
+            print("response cache refresh failed ({}): {}".format(key, e), file=sys.stderr)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def get_or_compute(self,
+                       key: str,
+                       func: Callable[[], Any],
+                       ttl: Optional[float] = None,
+                       stale_ttl: Optional[float] = None) -> Any:
+        """
+        Returns a copy of the cached value for `key`, calling `func()` to
+        compute it if required. Exceptions from `func` are passed through (and
+        nothing gets cached).
+        """
+        if not self.enabled:
+            return func()
+        if ttl is None:
+            ttl = self.ttl
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+
+        with self._lock:
+            entry = self._lookup(key)
+        if entry is None and self.backend is not None:
+            try:
+                entry = self.backend.get(key)
+            except Exception as e:
+                self.counts['backend-error'] += 1
+                print("response cache backend error: {}".format(e), file=sys.stderr)
+            if entry is not None:
+                self.counts['backend-hit'] += 1
+                if self.max_size > 0:
+                    with self._lock:
+                        self._entries[key] = entry
+                        while len(self._entries) > self.max_size:
+                            self._entries.popitem(last=False)
+
+        if entry is not None:
+            (created, value) = entry
+            age = time.time() - created
+            if age < ttl:
+                self.counts['hit'] += 1
+                return copy.deepcopy(value)
+            if age < ttl + stale_ttl:
+                self.counts['stale'] += 1
+                self._start(key, func, ttl, stale_ttl, background=True)
+                return copy.deepcopy(value)
+
+        self.counts['miss'] += 1
+        (fut, owner) = self._start(key, func, ttl, stale_ttl, background=False)
+        if owner:
+            try:
+                fut.set_result(self._compute(key, func, ttl, stale_ttl))
+            except Exception as e:
+                fut.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        else:
+            self.counts['wait'] += 1
+        return copy.deepcopy(fut.result())
+
+    def cached(self, namespace: str, ttl: Optional[float] = None,
+               stale_ttl: Optional[float] = None) -> Callable:
+        """
+        Decorator for caching the return value of a function, keyed on the
+        function arguments. Arguments which have a `cache_key()` method (like
+        ReleaseQuery) are normalized using that; all others must be JSON
+        serializable.
+
+        The undecorated function is available as `.uncached`.
+        """
+        def decorator(func: Callable) -> Callable:
+            def wrapper(*args, **kwargs):
+                key = namespace + ":" + make_cache_key(args, kwargs)
+                return self.get_or_compute(key, lambda: func(*args, **kwargs),
+                    ttl=ttl, stale_ttl=stale_ttl)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            wrapper.uncached = func  # type: ignore
+            return wrapper
+        return decorator
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        stats = dict(self.counts)
+        stats['size'] = size
+        stats['max_size'] = self.max_size
+        stats['shared_backend'] = self.backend is not None
+        return stats
+
+
+def make_cache_key(args: tuple, kwargs: dict) -> str:
+
+    def normalize(v: Any) -> Any:
+        if hasattr(v, 'cache_key'):
+            return v.cache_key()
+        return v
+
+    return json.dumps(
+        [[normalize(a) for a in args], {k: normalize(v) for k, v in kwargs.items()}],
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+
+
+def test_response_cache_ttl():
+
+    cache = ResponseCache(max_size=2, ttl=0.2, stale_ttl=0.5, refresh_workers=1)
+    calls = []
+
+    @cache.cached("thing")
+    def get_thing(n, extra=None):
+        calls.append(n)
+        return dict(n=n, extra=extra)
+
+    assert get_thing(1) == dict(n=1, extra=None)
+    assert get_thing(1) == dict(n=1, extra=None)
+    assert calls == [1]
+
+    # returned values are copies
+    get_thing(1)['n'] = 5
+    assert get_thing(1)['n'] == 1
+
+    # keyword arguments are part of the key
+    get_thing(1, extra="a")
+    assert calls == [1, 1]
+
+    # LRU eviction
+    get_thing(2)
+    get_thing(1, extra="a")
+    assert calls == [1, 1, 2]
+    get_thing(1)
+    assert calls == [1, 1, 2, 1]
+    assert cache.stats()['size'] == 2
+    assert cache.counts['evict'] == 2
+
+    # stale value is returned immediately, and refreshed in the background
+    time.sleep(0.3)
+    assert get_thing(1) == dict(n=1, extra=None)
+    assert cache.counts['stale'] == 1
+    # (single refresh worker, so this waits for the refresh to finish)
+    cache._refresh_executor().submit(lambda: None).result()
+    assert calls == [1, 1, 2, 1, 1]
+    get_thing(1)
+    assert calls == [1, 1, 2, 1, 1]
+
+    # past stale_ttl, the value is recomputed synchronously
+    time.sleep(0.8)
+    get_thing(1)
+    assert calls == [1, 1, 2, 1, 1, 1]
+    assert cache.counts['stale'] == 1
+
+    cache.clear()
+    get_thing(1)
+    assert calls == [1, 1, 2, 1, 1, 1, 1]
+    assert get_thing.uncached(3) == dict(n=3, extra=None)
+    assert calls[-1] == 3
+
+def test_response_cache_single_flight():
+
+    cache = ResponseCache(ttl=10, stale_ttl=10)
+    calls = []
+    started = threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return [1, 2, 3]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("k", slow)))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [[1, 2, 3]] * 4
+
+    # errors are passed through, and not cached
+    def broken():
+        raise ValueError("nope")
+
+    for _ in range(2):
+        try:
+            cache.get_or_compute("broken", broken)
+            assert False, "expected exception"
+        except ValueError:
+            pass
+    assert cache.stats()['size'] == 1
+
+    # disabled cache
+    cache = ResponseCache(max_size=0)
+    assert not cache.enabled
+    cache.get_or_compute("k", slow)
+    cache.get_or_compute("k", slow)
+    assert len(calls) == 3
@@ -1,12 +1,228 @@
 
-from typing import List, Tuple, Dict
+import math
+import base64
+import functools
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Optional
+from xml.sax.saxutils import escape
 
 import pygal
 from pygal.style import CleanStyle
 
-def ia_coverage_histogram(rows: List[Tuple]) -> pygal.Graph:
+from fatcat_web.web_config import Config
+
+
+@dataclass(frozen=True)
+class StackedBarChart:
+    """
+    Description of a stacked bar chart (the only shape of chart we serve).
+
+    Series are tuples of: (title: str, color: str, values: Tuple[int])
+
+    This is immutable and hashable, so rendered SVG can be cached keyed on the
+    chart data. Has the same render methods as a pygal chart.
+    """
+    x_title: str
+    x_labels: Tuple[str, ...]
+    series: Tuple[Tuple[str, str, Tuple[int, ...]], ...]
+    x_labels_major_count: int
+    x_label_rotation: int = 0
+    width: int = 1000
+    height: int = 500
+
+    def to_pygal(self) -> pygal.Graph:
+        style = CleanStyle(colors=tuple([s[1] for s in self.series]))
+        chart = pygal.StackedBar(dynamic_print_values=True, style=style,
+            width=self.width, height=self.height,
+            x_labels_major_count=self.x_labels_major_count,
+            show_minor_x_labels=False, x_label_rotation=self.x_label_rotation)
+        chart.x_title = self.x_title
+        chart.x_labels = list(self.x_labels)
+        for (title, _color, values) in self.series:
+            chart.add(title, list(values))
+        return chart
+
+    def render(self, renderer: Optional[str] = None) -> bytes:
+        return render_chart_svg(self, renderer or Config.FATCAT_WEB_CHART_RENDERER)
+
+    def render_response(self, renderer: Optional[str] = None):
+        from flask import Response
+        return Response(self.render(renderer=renderer), mimetype='image/svg+xml')
+
+    def render_data_uri(self, renderer: Optional[str] = None) -> str:
+        return "data:image/svg+xml;charset=utf-8;base64,{}".format(
+            base64.b64encode(self.render(renderer=renderer)).decode('utf-8'))
+
+
+@functools.lru_cache(maxsize=256)
+def render_chart_svg(chart: StackedBarChart, renderer: str = "svg") -> bytes:
+    """
+    Renders (and caches) SVG bytes for the given chart.
+
+    The "svg" renderer is a lightweight template-based emitter which mimics
+    the pygal look (without the javascript tooltips); the "pygal" renderer
+    is the original, and much slower.
+    """
+    if renderer == "pygal":
+        return chart.to_pygal().render()
+    elif renderer == "svg":
+        return stacked_bar_svg(chart)
+    else:
+        raise ValueError("unknown chart renderer: {}".format(renderer))
+
+
+# style and layout mimic pygal's StackedBar with CleanStyle
+_SVG_STYLE = """
+.chart{font-family:Consolas,"Liberation Mono",Menlo,Courier,monospace;fill:rgba(0,0,0,0.9)}
+.plot>.background{fill:rgba(240,240,240,0.7)}
+.title{font-size:16px;text-anchor:middle}
+.legend text{font-size:14px}
+.axis text{font-size:10px}
+.axis.x text{text-anchor:middle}
+.axis.x text[transform]{text-anchor:start}
+.axis.y text{text-anchor:end}
+.axis .line{stroke:rgba(0,0,0,0.9)}
+.guide.line{stroke:rgba(0,0,0,0.5);stroke-dasharray:4,4}
+.major.line{stroke:rgba(0,0,0,0.9);stroke-dasharray:6,6}
+.axis.major.line{stroke-dasharray:0}
+.bar rect{fill-opacity:.7;stroke-opacity:.8;stroke-width:1}
+.bar rect:hover{fill-opacity:.8;stroke-opacity:.9}
+.no_data{font-size:64px;text-anchor:middle}
+"""
+
+_PLOT_X = 120
+_PLOT_Y = 20
+_PLOT_MARGIN_RIGHT = 23
+_PLOT_MARGIN_BOTTOM = 66
+
+def _y_ticks(max_value: float, plot_height: float) -> List[Tuple[int, bool]]:
+    """
+    Returns a list of (value, is_major) tuples for y-axis guide lines, at
+    round-number intervals.
+    """
+    target = max(2, int(plot_height / 30))
+    raw = max(1.0, max_value / target)
+    mag = 10 ** int(math.floor(math.log10(raw)))
+    step = mag * 10
+    for m in (1, 2, 5):
+        if m * mag >= raw:
+            step = m * mag
+            break
+    major = step * 5 if step in (mag, mag * 2) else step * 2
+    return [(v, v % major == 0) for v in range(0, int(max_value) + 1, int(step))]
+
+def _major_label_indexes(count: int, major_count: int) -> List[int]:
+    if count <= major_count or major_count < 2:
+        return list(range(count))
+    return sorted(set([int(round(i * (count - 1) / (major_count - 1))) for i in range(major_count)]))
+
+def stacked_bar_svg(chart: StackedBarChart) -> bytes:
+    width = chart.width
+    height = chart.height
+    plot_w = width - _PLOT_X - _PLOT_MARGIN_RIGHT
+    plot_h = height - _PLOT_Y - _PLOT_MARGIN_BOTTOM
+    n = len(chart.x_labels)
+
+    out = [
+        "<?xml version='1.0' encoding='utf-8'?>\n",
+        '<svg xmlns="http://www.w3.org/2000/svg" class="chart" viewBox="0 0 {} {}">'.format(width, height),
+        '<defs><style type="text/css">{}</style></defs>'.format(_SVG_STYLE),
+        '<rect x="0" y="0" width="{}" height="{}" fill="transparent"/>'.format(width, height),
+        '<g transform="translate({}, {})" class="plot">'.format(_PLOT_X, _PLOT_Y),
+        '<rect x="0" y="0" width="{:.2f}" height="{}" class="background"/>'.format(plot_w, plot_h),
+    ]
+
+    totals = [sum([s[2][i] for s in chart.series]) for i in range(n)]
+    max_total = max(totals) if totals else 0
+    if max_total <= 0:
+        out.append('</g><text x="{}" y="{}" class="no_data">No data</text></svg>'.format(
+            width / 2, height / 2))
+        return "".join(out).encode('utf-8')
+
+    # y axis: value zero sits a bit above the bottom of the plot, and the
+    # largest stack a bit below the top
+    y_bottom = plot_h - 8
+    y_top = 14
+    def y_pos(value: float) -> float:
+        return y_bottom - (value / max_total) * (y_bottom - y_top)
+
+    out.append('<g class="axis y">')
+    for (value, is_major) in _y_ticks(max_total, plot_h):
+        y = y_pos(value)
+        if value == 0:
+            cls = "axis major line"
+        elif is_major:
+            cls = "major guide line"
+        else:
+            cls = "guide line"
+        out.append('<path d="M0 {y:.2f} h{w:.2f}" class="{cls}"/><text x="-5" y="{ty:.2f}"{major}>{v}</text>'.format(
+            y=y, w=plot_w, cls=cls, ty=y + 3.5, v=value, major=' class="major"' if is_major else ''))
+    out.append('</g>')
+
+    # x axis: bars are centered in equal slots, with some padding at the ends
+    pad = plot_w * 0.02
+    slot = (plot_w - 2 * pad) / n
+    bar_w = slot * 0.88
+    def x_center(i: int) -> float:
+        return pad + slot * (i + 0.5)
+
+    out.append('<g class="axis x"><path d="M0 0 v{}" class="line"/>'.format(plot_h))
+    label_y = plot_h + 15
+    for i in _major_label_indexes(n, chart.x_labels_major_count):
+        x = x_center(i)
+        if chart.x_label_rotation:
+            transform = ' transform="rotate({} {:.2f} {})"'.format(chart.x_label_rotation, x, label_y)
+        else:
+            transform = ''
+        out.append('<path d="M{x:.2f} 0 v{h}" class="major guide line"/><text x="{x:.2f}" y="{y}"{t}>{label}</text>'.format(
+            x=x, h=plot_h, y=label_y, t=transform, label=escape(chart.x_labels[i])))
+    out.append('</g>')
+
+    bases = [0] * n
+    for (title, color, values) in chart.series:
+        out.append('<g class="series" fill="{c}" stroke="{c}">'.format(c=escape(color)))
+        for i in range(n):
+            value = values[i]
+            if not value:
+                continue
+            top = y_pos(bases[i] + value)
+            bar_h = y_pos(bases[i]) - top
+            bases[i] += value
+            out.append('<g class="bar"><rect x="{x:.2f}" y="{y:.2f}" width="{w:.2f}" height="{h:.2f}"/><title>{label} {title}: {value}</title></g>'.format(
+                x=x_center(i) - bar_w / 2, y=top, w=bar_w, h=bar_h,
+                label=escape(chart.x_labels[i]), title=escape(title), value=value))
+        out.append('</g>')
+    out.append('</g>')
+
+    out.append('<text x="{:.2f}" y="{}" class="title">{}</text>'.format(
+        _PLOT_X + plot_w / 2, height - 20, escape(chart.x_title)))
+
+    out.append('<g transform="translate(10, 30)" class="legend">')
+    for (i, (title, color, _values)) in enumerate(chart.series):
+        out.append('<rect x="0" y="{}" width="12" height="12" fill="{c}" stroke="{c}" fill-opacity=".7"/><text x="17" y="{:.1f}">{}</text>'.format(
+            1 + 21 * i, 11.2 + 21 * i, escape(title), c=escape(color)))
+    out.append('</g></svg>')
+    return "".join(out).encode('utf-8')
+
+
+def _preservation_series(rows: List[Dict], merge_shadows: bool) -> Tuple:
+    if merge_shadows:
+        return (
+            ('None', "red", tuple([r['none'] + r['shadows_only'] for r in rows])),
+            ('Dark', "darkolivegreen", tuple([r['dark'] for r in rows])),
+            ('Bright', "limegreen", tuple([r['bright'] for r in rows])),
+        )
+    else:
+        return (
+            ('None', "red", tuple([r['none'] for r in rows])),
+            ('Shadow', "darkred", tuple([r['shadows_only'] for r in rows])),
+            ('Dark', "darkolivegreen", tuple([r['dark'] for r in rows])),
+            ('Bright', "limegreen", tuple([r['bright'] for r in rows])),
+        )
+
+def ia_coverage_histogram(rows: List[Tuple]) -> StackedBarChart:
     """
-    Note: this returns a raw pygal chart; it does not render it to SVG/PNG
+    Note: this returns a chart description; it does not render it to SVG
 
     Rows are tuples of: (year: float or int, in_ia: bool, count: int)
     """
@@ -24,24 +240,24 @@ def ia_coverage_histogram(rows: List[Tuple]) -> pygal.Graph:
 
     years = sorted(years.values(), key=lambda x: x['year'])
 
-    CleanStyle.colors = ("green", "purple")
     label_count = len(years)
     if len(years) > 20:
         label_count = 10
-    chart = pygal.StackedBar(dynamic_print_values=True, style=CleanStyle,
-        width=1000, height=500, x_labels_major_count=label_count,
-        show_minor_x_labels=False)
     #chart.title = "Perpetual Access Coverage"
-    chart.x_title = "Year"
     #chart.y_title = "Releases"
-    chart.x_labels = [str(y['year']) for y in years]
-    chart.add('via Fatcat', [y['available'] for y in years])
-    chart.add('Missing', [y['missing'] for y in years])
-    return chart
+    return StackedBarChart(
+        x_title="Year",
+        x_labels=tuple([str(y['year']) for y in years]),
+        series=(
+            ('via Fatcat', "green", tuple([y['available'] for y in years])),
+            ('Missing', "purple", tuple([y['missing'] for y in years])),
+        ),
+        x_labels_major_count=label_count,
+    )
 
-def preservation_by_year_histogram(rows: List[Dict], merge_shadows: bool = False) -> pygal.Graph:
+def preservation_by_year_histogram(rows: List[Dict], merge_shadows: bool = False) -> StackedBarChart:
     """
-    Note: this returns a raw pygal chart; it does not render it to SVG/PNG
+    Note: this returns a chart description; it does not render it to SVG
 
     Rows are dict with keys as preservation types and values as counts (int).
     There is also a 'year' key with float/int value.
@@ -49,32 +265,22 @@ def preservation_by_year_histogram(rows: List[Dict], merge_shadows: bool = False
 
     years = sorted(rows, key=lambda x: x['year'])
 
-    if merge_shadows:
-        CleanStyle.colors = ("red", "darkolivegreen", "limegreen")
-    else:
-        CleanStyle.colors = ("red", "darkred", "darkolivegreen", "limegreen")
     label_count = len(years)
     if len(years) > 30:
         label_count = 10
-    chart = pygal.StackedBar(dynamic_print_values=True, style=CleanStyle,
-        width=1000, height=500, x_labels_major_count=label_count,
-        show_minor_x_labels=False, x_label_rotation=20)
     #chart.title = "Preservation by Year"
-    chart.x_title = "Year"
     #chart.y_title = "Count"
-    chart.x_labels = [str(y['year']) for y in years]
-    if merge_shadows:
-        chart.add('None', [y['none'] + y['shadows_only'] for y in years])
-    else:
-        chart.add('None', [y['none'] for y in years])
-        chart.add('Shadow', [y['shadows_only'] for y in years])
-    chart.add('Dark', [y['dark'] for y in years])
-    chart.add('Bright', [y['bright'] for y in years])
-    return chart
+    return StackedBarChart(
+        x_title="Year",
+        x_labels=tuple([str(y['year']) for y in years]),
+        series=_preservation_series(years, merge_shadows),
+        x_labels_major_count=label_count,
+        x_label_rotation=20,
+    )
 
-def preservation_by_date_histogram(rows: List[Dict], merge_shadows: bool = False) -> pygal.Graph:
+def preservation_by_date_histogram(rows: List[Dict], merge_shadows: bool = False) -> StackedBarChart:
     """
-    Note: this returns a raw pygal chart; it does not render it to SVG/PNG
+    Note: this returns a chart description; it does not render it to SVG
 
     Rows are dict with keys as preservation types and values as counts (int).
     There is also a 'date' key with str value.
@@ -82,32 +288,22 @@ def preservation_by_date_histogram(rows: List[Dict], merge_shadows: bool = False
 
     dates = sorted(rows, key=lambda x: x['date'])
 
-    if merge_shadows:
-        CleanStyle.colors = ("red", "darkolivegreen", "limegreen")
-    else:
-        CleanStyle.colors = ("red", "darkred", "darkolivegreen", "limegreen")
     label_count = len(dates)
     if len(dates) > 30:
         label_count = 10
-    chart = pygal.StackedBar(dynamic_print_values=True, style=CleanStyle,
-        width=1000, height=500, x_labels_major_count=label_count,
-        show_minor_x_labels=False, x_label_rotation=20)
     #chart.title = "Preservation by Date"
-    chart.x_title = "Date"
     #chart.y_title = "Count"
-    chart.x_labels = [str(y['date']) for y in dates]
-    if merge_shadows:
-        chart.add('None', [y['none'] + y['shadows_only'] for y in dates])
-    else:
-        chart.add('None', [y['none'] for y in dates])
-        chart.add('Shadow', [y['shadows_only'] for y in dates])
-    chart.add('Dark', [y['dark'] for y in dates])
-    chart.add('Bright', [y['bright'] for y in dates])
-    return chart
+    return StackedBarChart(
+        x_title="Date",
+        x_labels=tuple([str(y['date']) for y in dates]),
+        series=_preservation_series(dates, merge_shadows),
+        x_labels_major_count=label_count,
+        x_label_rotation=20,
+    )
 
-def preservation_by_volume_histogram(rows: List[Dict], merge_shadows: bool = False) -> pygal.Graph:
+def preservation_by_volume_histogram(rows: List[Dict], merge_shadows: bool = False) -> StackedBarChart:
     """
-    Note: this returns a raw pygal chart; it does not render it to SVG/PNG
+    Note: this returns a chart description; it does not render it to SVG
 
     Rows are dict with keys as preservation types and values as counts (int).
     There is also a 'volume' key with str value.
@@ -115,25 +311,15 @@ def preservation_by_volume_histogram(rows: List[Dict], merge_shadows: bool = Fal
 
     volumes = sorted(rows, key=lambda x: x['volume'])
 
-    if merge_shadows:
-        CleanStyle.colors = ("red", "darkolivegreen", "limegreen")
-    else:
-        CleanStyle.colors = ("red", "darkred", "darkolivegreen", "limegreen")
     label_count = len(volumes)
     if len(volumes) >= 30:
         label_count = 10
-    chart = pygal.StackedBar(dynamic_print_values=True, style=CleanStyle,
-        width=1000, height=500, x_labels_major_count=label_count,
-        show_minor_x_labels=False, x_label_rotation=20)
     #chart.title = "Preservation by Volume"
-    chart.x_title = "Volume"
     #chart.y_title = "Count"
-    chart.x_labels = [str(y['volume']) for y in volumes]
-    if merge_shadows:
-        chart.add('None', [y['none'] + y['shadows_only'] for y in volumes])
-    else:
-        chart.add('None', [y['none'] for y in volumes])
-        chart.add('Shadow', [y['shadows_only'] for y in volumes])
-    chart.add('Dark', [y['dark'] for y in volumes])
-    chart.add('Bright', [y['bright'] for y in volumes])
-    return chart
+    return StackedBarChart(
+        x_title="Volume",
+        x_labels=tuple([str(y['volume']) for y in volumes]),
+        series=_preservation_series(volumes, merge_shadows),
+        x_labels_major_count=label_count,
+        x_label_rotation=20,
+    )
@@ -0,0 +1,79 @@
+
+"""
+Simple in-process rate limiting, for expensive endpoints (eg, bulk search
+export).
+
+State is per web worker process, so the effective limits are multiplied by
+the number of workers.
+"""
+
+import time
+import threading
+import collections
+from typing import Any, Dict
+
+
+class RateLimiter:
+    """
+    Allows up to `max_requests` requests per `period` seconds for each key
+    (eg, client address), and at most `max_concurrent` requests in progress at
+    a time overall (zero for no limit).
+
+    acquire() returns False if a request should be rejected; every successful
+    acquire() must be followed by a release() once the request is done.
+    """
+
+    def __init__(self, max_requests: int, period: float = 60.0, max_concurrent: int = 0):
+        self.max_requests = max_requests
+        self.period = period
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.counts: collections.Counter = collections.Counter()
+        # key -> timestamps of recent (accepted) requests
+        self._recent: Dict[Any, collections.deque] = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Any) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            # forget clients with no recent requests, so this doesn't grow
+            # without bound
+            for k in [k for (k, q) in self._recent.items() if not q or q[-1] <= now - self.period]:
+                del self._recent[k]
+            recent = self._recent.setdefault(key, collections.deque())
+            while recent and recent[0] <= now - self.period:
+                recent.popleft()
+            if len(recent) >= self.max_requests:
+                self.counts['rate'] += 1
+                return False
+            if self.max_concurrent and self.active >= self.max_concurrent:
+                self.counts['concurrent'] += 1
+                return False
+            recent.append(now)
+            self.active += 1
+            self.counts['accepted'] += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+
+
+def test_rate_limiter():
+
+    limiter = RateLimiter(max_requests=2, period=0.2, max_concurrent=3)
+    assert limiter.acquire("a")
+    assert limiter.acquire("a")
+    assert not limiter.acquire("a")
+    assert limiter.acquire("b")
+    # concurrency limit applies across keys
+    assert not limiter.acquire("c")
+    limiter.release()
+    assert limiter.acquire("c")
+    assert limiter.counts == dict(accepted=4, rate=1, concurrent=1)
+
+    for _ in range(3):
+        limiter.release()
+    time.sleep(0.3)
+    assert limiter.acquire("a")
+    assert list(limiter._recent.keys()) == ["a"]
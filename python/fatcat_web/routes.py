@@ -3,7 +3,7 @@ import os
 import json
 import citeproc_styles
 from flask import render_template, make_response, send_from_directory, \
-    request, url_for, abort, redirect, jsonify, session, flash, Response
+    request, url_for, abort, redirect, jsonify, session, flash, Response, stream_with_context
 from flask_login import login_required
 from flask_wtf.csrf import CSRFError
 
@@ -11,7 +11,7 @@ from fatcat_openapi_client import EditgroupAnnotation
 from fatcat_openapi_client.rest import ApiException
 from fatcat_tools.transforms import *
 from fatcat_tools.normal import *
-from fatcat_web import app, api, auth_api, priv_api, mwoauth, Config
+from fatcat_web import app, api, auth_api, priv_api, mwoauth, Config, response_cache, backend_pool, export_limiter
 from fatcat_web.auth import handle_token_login, handle_logout, load_user, handle_ia_xauth, handle_wmoauth
 from fatcat_web.cors import crossdomain
 from fatcat_web.search import *
@@ -189,8 +189,28 @@ def work_lookup():
 ### More Generic Entity Views ###############################################
 
 def generic_entity_view(entity_type, ident, view_template):
-    entity = generic_get_entity(entity_type, ident)
 
+    # elasticsearch queries only depend on the ident, so they are started
+    # before (and run concurrently with) the API fetch
+    queries = dict()
+    if view_template == "container_view.html":
+        queries['_stats'] = backend_pool.submit(get_elastic_container_stats, ident)
+        queries['_random_releases'] = backend_pool.submit(get_elastic_container_random_releases, ident)
+    if view_template == "container_view_coverage.html":
+        queries['_stats'] = backend_pool.submit(get_elastic_container_stats, ident)
+        queries['_type_preservation'] = backend_pool.submit(
+            get_elastic_preservation_by_type,
+            ReleaseQuery(container_id=ident),
+        )
+
+    try:
+        entity = generic_get_entity(entity_type, ident)
+    except Exception:
+        cancel_futures(queries.values())
+        raise
+
+    if entity.state in ("redirect", "deleted"):
+        cancel_futures(queries.values())
     if entity.state == "redirect":
         return redirect('/{}/{}'.format(entity_type, entity.redirect))
     elif entity.state == "deleted":
@@ -200,17 +220,37 @@ def generic_entity_view(entity_type, ident, view_template):
     metadata.pop('extra')
     entity._metadata = metadata
 
-    if view_template == "container_view.html":
-        entity._stats = get_elastic_container_stats(entity.ident, issnl=entity.issnl)
-        entity._random_releases = get_elastic_container_random_releases(entity.ident)
-    if view_template == "container_view_coverage.html":
-        entity._stats = get_elastic_container_stats(entity.ident, issnl=entity.issnl)
-        entity._type_preservation = get_elastic_preservation_by_type(
-            ReleaseQuery(container_id=ident),
-        )
+    for (attr, fut) in queries.items():
+        setattr(entity, attr, fut.result())
+    if '_stats' in queries:
+        entity._stats['issnl'] = entity.issnl
 
     return render_template(view_template, entity_type=entity_type, entity=entity, editgroup_id=None)
 
+def cancel_futures(futures):
+    """
+    Cancels any of the given backend requests which haven't started yet
+    """
+    for fut in futures:
+        fut.cancel()
+
+def get_container_with_queries(ident, *queries):
+    """
+    Fetches a container entity from the API, while concurrently running
+    `queries` (functions of no arguments, eg elasticsearch queries which only
+    depend on the ident) in the backend thread pool.
+
+    Aborts (with the API status code) if the container fetch fails. Returns
+    the container and a list of Futures for the query results.
+    """
+    futures = [backend_pool.submit(q) for q in queries]
+    try:
+        container = api.get_container(ident)
+    except ApiException as ae:
+        cancel_futures(futures)
+        abort(ae.status)
+    return (container, futures)
+
 def generic_entity_revision_view(entity_type, revision_id, view_template):
     entity = generic_get_entity_revision(entity_type, revision_id)
 
@@ -719,6 +759,40 @@ def release_search():
         return render_template('release_search.html', query=query, es_error=fse), fse.status_code
     return render_template('release_search.html', query=query, found=found)
 
+@app.route('/release/search.jsonl', methods=['GET'])
+def release_search_export():
+    """
+    Streams releases matching a search query (the elasticsearch documents) as
+    JSON lines, up to FATCAT_WEB_EXPORT_MAX_RESULTS. The X-Total-Count header
+    has the total number of matches, which may be more than were returned.
+
+    Exports are rate-limited per client address, and in number running at
+    once (see RateLimiter).
+    """
+
+    if 'q' not in request.args.keys():
+        abort(400, "Search query ('q') required")
+
+    if not export_limiter.acquire(request.remote_addr):
+        abort(429, "Too many search exports; please try again later")
+    query = ReleaseQuery.from_args(request.args)
+    try:
+        (count_found, results) = export_release_search(query,
+            max_results=Config.FATCAT_WEB_EXPORT_MAX_RESULTS)
+    except FatcatSearchError as fse:
+        export_limiter.release()
+        abort(fse.status_code, fse.description or fse.name)
+
+    def generate():
+        for doc in results:
+            yield json.dumps(doc, sort_keys=True) + "\n"
+
+    resp = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    resp.headers['X-Total-Count'] = str(count_found)
+    # called once the response is finished, or the client went away
+    resp.call_on_close(export_limiter.release)
+    return resp
+
 @app.route('/container/search', methods=['GET', 'POST'])
 def container_search():
 
@@ -762,15 +836,21 @@ def coverage_search():
     date_histogram_svg = None
     coverage_type_preservation = None
     if coverage_stats['total'] > 1:
-        coverage_type_preservation = get_elastic_preservation_by_type(query)
+        # the type and year/date breakdowns are independent of each other
+        type_preservation = backend_pool.submit(get_elastic_preservation_by_type, query)
         if query.recent:
-            date_histogram = get_elastic_preservation_by_date(query)
+            histogram = backend_pool.submit(get_elastic_preservation_by_date, query)
+        else:
+            histogram = backend_pool.submit(get_elastic_preservation_by_year, query)
+        coverage_type_preservation = type_preservation.result()
+        if query.recent:
+            date_histogram = histogram.result()
             date_histogram_svg = preservation_by_date_histogram(
                 date_histogram,
                 merge_shadows=Config.FATCAT_MERGE_SHADOW_PRESERVATION,
             ).render_data_uri()
         else:
-            year_histogram = get_elastic_preservation_by_year(query)
+            year_histogram = histogram.result()
             year_histogram_svg = preservation_by_year_histogram(
                 year_histogram,
                 merge_shadows=Config.FATCAT_MERGE_SHADOW_PRESERVATION,
@@ -816,6 +896,13 @@ def stats_json():
         abort(503)
     return jsonify(stats)
 
+@app.route('/stats/cache.json', methods=['GET'])
+def stats_cache_json():
+    """
+    Hit/miss counters for the (per-process) elasticsearch response cache
+    """
+    return jsonify(response_cache.stats())
+
 @app.route('/container/issnl/<issnl>/stats.json', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_issnl_stats(issnl):
@@ -826,7 +913,9 @@ def container_issnl_stats(issnl):
     except ApiException as ae:
         raise ae
     try:
-        stats = get_elastic_container_stats(container.ident, issnl=container.issnl)
+        # same call (and cache entry) as container_ident_stats()
+        stats = get_elastic_container_stats(container.ident)
+        stats = dict(stats, issnl=container.issnl)
     except (ValueError, IOError) as ae:
         app.log.error(ae)
         abort(503)
@@ -835,12 +924,11 @@ def container_issnl_stats(issnl):
 @app.route('/container/<string(length=26):ident>/stats.json', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_stats(ident):
+    (container, (stats,)) = get_container_with_queries(ident,
+        lambda: get_elastic_container_stats(ident))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    try:
-        stats = get_elastic_container_stats(container.ident, issnl=container.issnl)
+        # copy, so the cached stats aren't modified
+        stats = dict(stats.result(), issnl=container.issnl)
     except Exception as ae:
         app.log.error(ae)
         abort(503)
@@ -849,12 +937,10 @@ def container_ident_stats(ident):
 @app.route('/container/<string(length=26):ident>/ia_coverage_years.json', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_ia_coverage_years_json(ident):
+    (container, (histogram,)) = get_container_with_queries(ident,
+        lambda: get_elastic_container_histogram_legacy(ident))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    try:
-        histogram = get_elastic_container_histogram_legacy(container.ident)
+        histogram = histogram.result()
     except Exception as ae:
         app.log.error(ae)
         abort(503)
@@ -864,12 +950,10 @@ def container_ident_ia_coverage_years_json(ident):
 @app.route('/container/<string(length=26):ident>/ia_coverage_years.svg', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_ia_coverage_years_svg(ident):
+    (container, (histogram,)) = get_container_with_queries(ident,
+        lambda: get_elastic_container_histogram_legacy(ident))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    try:
-        histogram = get_elastic_container_histogram_legacy(container.ident)
+        histogram = histogram.result()
     except Exception as ae:
         app.log.error(ae)
         abort(503)
@@ -878,13 +962,10 @@ def container_ident_ia_coverage_years_svg(ident):
 @app.route('/container/<string(length=26):ident>/preservation_by_year.json', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_preservation_by_year_json(ident):
+    (container, (histogram,)) = get_container_with_queries(ident,
+        lambda: get_elastic_preservation_by_year(ReleaseQuery(container_id=ident)))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    query = ReleaseQuery(container_id=container.ident)
-    try:
-        histogram = get_elastic_preservation_by_year(query)
+        histogram = histogram.result()
     except Exception as ae:
         app.log.error(ae)
         abort(503)
@@ -893,13 +974,10 @@ def container_ident_preservation_by_year_json(ident):
 @app.route('/container/<string(length=26):ident>/preservation_by_year.svg', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_preservation_by_year_svg(ident):
+    (container, (histogram,)) = get_container_with_queries(ident,
+        lambda: get_elastic_preservation_by_year(ReleaseQuery(container_id=ident)))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    query = ReleaseQuery(container_id=container.ident)
-    try:
-        histogram = get_elastic_preservation_by_year(query)
+        histogram = histogram.result()
     except Exception as ae:
         app.log.error(ae)
         abort(503)
@@ -911,12 +989,10 @@ def container_ident_preservation_by_year_svg(ident):
 @app.route('/container/<string(length=26):ident>/preservation_by_volume.json', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_preservation_by_volume_json(ident):
+    (container, (histogram,)) = get_container_with_queries(ident,
+        lambda: get_elastic_container_preservation_by_volume(ident))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    try:
-        histogram = get_elastic_container_preservation_by_volume(container.ident)
+        histogram = histogram.result()
     except Exception as ae:
         app.log.error(ae)
         abort(503)
@@ -925,12 +1001,10 @@ def container_ident_preservation_by_volume_json(ident):
 @app.route('/container/<string(length=26):ident>/preservation_by_volume.svg', methods=['GET', 'OPTIONS'])
 @crossdomain(origin='*',headers=['access-control-allow-origin','Content-Type'])
 def container_ident_preservation_by_volume_svg(ident):
+    (container, (histogram,)) = get_container_with_queries(ident,
+        lambda: get_elastic_container_preservation_by_volume(ident))
     try:
-        container = api.get_container(ident)
-    except ApiException as ae:
-        abort(ae.status)
-    try:
-        histogram = get_elastic_container_preservation_by_volume(container.ident)
+        histogram = histogram.result()
     except Exception as ae:
         app.log.error(ae)
         abort(503)
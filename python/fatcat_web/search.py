@@ -5,15 +5,17 @@ the formal API)
 """
 
 import sys
+import json
+import base64
 import datetime
 from dataclasses import dataclass
-from typing import List, Optional, Any
+from typing import List, Optional, Any, Iterator, Tuple
 
 import elasticsearch
 from elasticsearch_dsl import Search, Q
 import elasticsearch_dsl.response
 
-from fatcat_web import app
+from fatcat_web import app, response_cache
 
 class FatcatSearchError(Exception):
 
@@ -32,6 +34,7 @@ class ReleaseQuery:
     fulltext_only: bool = False
     container_id: Optional[str] = None
     recent: bool = False
+    after: Optional[str] = None
 
     @classmethod
     def from_args(cls, args) -> 'ReleaseQuery':
@@ -57,6 +60,19 @@ class ReleaseQuery:
             fulltext_only=bool(args.get('fulltext_only')),
             container_id=container_id,
             recent=bool(args.get('recent')),
+            after=args.get('after') or None,
+        )
+
+    def cache_key(self) -> dict:
+        """
+        Normalized form of the query for caching aggregations, which don't
+        depend on pagination.
+        """
+        return dict(
+            q=self.q,
+            fulltext_only=self.fulltext_only,
+            container_id=self.container_id,
+            recent=self.recent,
         )
 
 @dataclass
@@ -64,6 +80,7 @@ class GenericQuery:
     q: Optional[str] = None
     limit: Optional[int] = None
     offset: Optional[int] = None
+    after: Optional[str] = None
 
     @classmethod
     def from_args(cls, args) -> 'GenericQuery':
@@ -76,6 +93,7 @@ class GenericQuery:
         return GenericQuery(
             q=query_str,
             offset=offset,
+            after=args.get('after') or None,
         )
 
 @dataclass
@@ -87,28 +105,102 @@ class SearchHits:
     deep_page_limit: int
     query_time_ms: int
     results: List[Any]
+    # cursor for fetching the next page with search_after (if there are more
+    # results)
+    next_after: Optional[str] = None
 
 
-def results_to_dict(response: elasticsearch_dsl.response.Response) -> List[dict]:
+def hit_to_dict(hit: Any) -> dict:
     """
-    Takes a response returns all the hits as JSON objects.
+    Takes a single search hit and returns it as a JSON object.
 
     Also handles surrogate strings that elasticsearch returns sometimes,
     probably due to mangled data processing in some pipeline. "Crimes against
     Unicode"; production workaround
     """
+    h = hit._d_
+    for key in h:
+        if type(h[key]) is str:
+            h[key] = h[key].encode("utf8", "ignore").decode("utf8")
+    return h
+
+def results_to_dict(response: elasticsearch_dsl.response.Response) -> List[dict]:
+    """
+    Takes a response returns all the hits as JSON objects.
+    """
+    return [hit_to_dict(h) for h in response]
 
-    results = []
-    for h in response:
-        r = h._d_
-        # print(h.meta._d_)
-        results.append(r)
+def clean_release_hit(h: dict) -> dict:
+    # Ensure 'contrib_names' is a list, not a single string
+    if type(h['contrib_names']) is not list:
+        h['contrib_names'] = [h['contrib_names'], ]
+    h['contrib_names'] = [name.encode('utf8', 'ignore').decode('utf8') for name in h['contrib_names']]
+    return h
 
-    for h in results:
-        for key in h:
-            if type(h[key]) is str:
-                h[key] = h[key].encode("utf8", "ignore").decode("utf8")
-    return results
+def encode_search_after(sort_values: List[Any]) -> str:
+    """
+    Encodes the sort values of the last hit of a page as an opaque (URL-safe)
+    cursor string
+    """
+    raw = json.dumps(sort_values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+def decode_search_after(cursor: str) -> List[Any]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_values = json.loads(raw.decode('utf-8'))
+    except ValueError:
+        sort_values = None
+    if type(sort_values) is not list or not sort_values:
+        raise FatcatSearchError(400, "Invalid pagination cursor", cursor)
+    return sort_values
+
+def sort_tiebreaker() -> str:
+    """
+    Field for a stable sort (search_after paging and export). `ident` is cheap
+    to sort on, but only has doc values in indexes built from the current
+    schemas; `_id` works on any index, but loads fielddata into heap.
+    """
+    if app.config['ELASTICSEARCH_SORT_IDENT']:
+        return "ident"
+    return "_id"
+
+def paginate_search(search: Search, query: Any, deep_page_limit: int) -> Tuple[Any, int, int]:
+    """
+    Applies pagination to a search, executes it, and returns the response
+    along with the (sanitized) offset and limit.
+
+    Shallow pages use from/size, with the offset capped at deep_page_limit.
+    Beyond that, pages are fetched with search_after, using the `after`
+    cursor from the query (the offset then only matters for display). The
+    cursor mode needs a stable sort: by score, with sort_tiebreaker() as a
+    tie-breaker. It is also used for the last from/size page, so that a
+    cursor can be handed out for the page after it. Other pages are sorted by
+    score only, so they work on any index.
+    """
+    limit = min((int(query.limit or 25), 100))
+    offset = max((int(query.offset or 0), 0))
+    if query.after or offset + limit >= deep_page_limit:
+        search = search.sort({"_score": {"order": "desc"}}, {sort_tiebreaker(): {"order": "asc"}})
+    if query.after:
+        search = search.extra(search_after=decode_search_after(query.after))
+        search = search[:limit]
+    else:
+        if offset > deep_page_limit:
+            # Avoid deep paging problem.
+            offset = deep_page_limit
+        search = search[offset : (offset + limit)]
+
+    resp = wrap_es_execution(search)
+    return (resp, offset, limit)
+
+def next_search_after(resp: Any, offset: int, limit: int) -> Optional[str]:
+    if len(resp.hits) < limit or offset + limit >= int(resp.hits.total):
+        return None
+    sort_values = resp.hits[-1].meta.to_dict().get('sort')
+    if not sort_values:
+        return None
+    return encode_search_after(list(sort_values))
 
 def wrap_es_execution(search: Search) -> Any:
     """
@@ -165,16 +257,7 @@ def do_container_search(
         fields=["biblio"],
     )
 
-    # Sanity checks
-    limit = min((int(query.limit or 25), 100))
-    offset = max((int(query.offset or 0), 0))
-    if offset > deep_page_limit:
-        # Avoid deep paging problem.
-        offset = deep_page_limit
-
-    search = search[offset : (offset + limit)]
-
-    resp = wrap_es_execution(search)
+    (resp, offset, limit) = paginate_search(search, query, deep_page_limit)
     results = results_to_dict(resp)
 
     return SearchHits(
@@ -185,6 +268,7 @@ def do_container_search(
         deep_page_limit=deep_page_limit,
         query_time_ms=int(resp.took),
         results=results,
+        next_after=next_search_after(resp, offset, limit),
     )
 
 def do_release_search(
@@ -233,23 +317,8 @@ def do_release_search(
         negative_boost=0.5,
     )
 
-    # Sanity checks
-    limit = min((int(query.limit or 25), 100))
-    offset = max((int(query.offset or 0), 0))
-    if offset > deep_page_limit:
-        # Avoid deep paging problem.
-        offset = deep_page_limit
-
-    search = search[offset : (offset + limit)]
-
-    resp = wrap_es_execution(search)
-    results = results_to_dict(resp)
-
-    for h in results:
-        # Ensure 'contrib_names' is a list, not a single string
-        if type(h['contrib_names']) is not list:
-            h['contrib_names'] = [h['contrib_names'], ]
-        h['contrib_names'] = [name.encode('utf8', 'ignore').decode('utf8') for name in h['contrib_names']]
+    (resp, offset, limit) = paginate_search(search, query, deep_page_limit)
+    results = [clean_release_hit(h) for h in results_to_dict(resp)]
 
     return SearchHits(
         count_returned=len(results),
@@ -259,7 +328,58 @@ def do_release_search(
         deep_page_limit=deep_page_limit,
         query_time_ms=int(resp.took),
         results=results,
+        next_after=next_search_after(resp, offset, limit),
+    )
+
+def export_release_search(query: ReleaseQuery, max_results: int,
+        batch_size: int = 1000) -> Tuple[int, Iterator[dict]]:
+    """
+    Returns the total number of releases matching a query, and an iterator
+    over (up to `max_results` of) them as elasticsearch documents, for bulk
+    export.
+
+    Pages through results with search_after, sorted by sort_tiebreaker(), so
+    memory use is constant and there is no deep paging limit. Matching is done
+    in filter context (no scoring). The first page is fetched before
+    returning, so query errors get raised here and not half-way through a
+    streaming response.
+    """
+    batch_size = max(min(batch_size, max_results), 1)
+
+    search = Search(using=app.es_client, index=app.config['ELASTICSEARCH_RELEASE_INDEX'])
+    if query.fulltext_only:
+        search = search.filter("term", in_ia=True)
+    search = search.filter(
+        "query_string",
+        query=query.q,
+        default_operator="AND",
+        analyze_wildcard=True,
+        allow_leading_wildcard=False,
+        lenient=True,
+        fields=[
+            "title^2",
+            "biblio",
+        ],
     )
+    search = search.sort({sort_tiebreaker(): {"order": "asc"}})
+    search = search[:batch_size]
+
+    first = wrap_es_execution(search)
+
+    def iterate(resp: Any) -> Iterator[dict]:
+        count = 0
+        while True:
+            for h in resp:
+                if count >= max_results:
+                    return
+                count += 1
+                yield clean_release_hit(hit_to_dict(h))
+            if len(resp.hits) < batch_size or count >= max_results:
+                break
+            after = list(resp.hits[-1].meta.sort)
+            resp = wrap_es_execution(search.extra(search_after=after))
+
+    return (int(first.hits.total), iterate(first))
 
 def get_elastic_container_random_releases(ident: str, limit=5) -> dict:
     """
@@ -285,6 +405,7 @@ def get_elastic_container_random_releases(ident: str, limit=5) -> dict:
 
     return results
 
+@response_cache.cached("entity_stats")
 def get_elastic_entity_stats() -> dict:
     """
     TODO: files, filesets, webcaptures (no schema yet)
@@ -368,6 +489,7 @@ def get_elastic_entity_stats() -> dict:
 
     return stats
 
+@response_cache.cached("search_coverage")
 def get_elastic_search_coverage(query: ReleaseQuery) -> dict:
 
     search = Search(using=app.es_client, index=app.config['ELASTICSEARCH_RELEASE_INDEX'])
@@ -412,6 +534,7 @@ def get_elastic_search_coverage(query: ReleaseQuery) -> dict:
 
     return stats
 
+@response_cache.cached("container_stats")
 def get_elastic_container_stats(ident, issnl=None):
     """
     Returns dict:
@@ -484,6 +607,7 @@ def get_elastic_container_stats(ident, issnl=None):
 
     return stats
 
+@response_cache.cached("container_histogram_legacy")
 def get_elastic_container_histogram_legacy(ident) -> List:
     """
     Fetches a stacked histogram of {year, in_ia}. This is for the older style
@@ -541,6 +665,7 @@ def get_elastic_container_histogram_legacy(ident) -> List:
     return vals
 
 
+@response_cache.cached("preservation_by_year")
 def get_elastic_preservation_by_year(query) -> List[dict]:
     """
     Fetches a stacked histogram of {year, preservation}.
@@ -616,6 +741,7 @@ def get_elastic_preservation_by_year(query) -> List[dict]:
     return sorted(year_dicts.values(), key=lambda x: x['year'])
 
 
+@response_cache.cached("preservation_by_date")
 def get_elastic_preservation_by_date(query) -> List[dict]:
     """
     Fetches a stacked histogram of {date, preservation}.
@@ -692,6 +818,7 @@ def get_elastic_preservation_by_date(query) -> List[dict]:
             date_dicts[k]['shadows_only'] = 0
     return sorted(date_dicts.values(), key=lambda x: x['date'])
 
+@response_cache.cached("container_preservation_by_volume")
 def get_elastic_container_preservation_by_volume(container_id: str) -> List[dict]:
     """
     Fetches a stacked histogram of {volume, preservation}.
@@ -749,6 +876,7 @@ def get_elastic_container_preservation_by_volume(container_id: str) -> List[dict
             volume_dicts[k]['shadows_only'] = 0
     return sorted(volume_dicts.values(), key=lambda x: x['volume'])
 
+@response_cache.cached("preservation_by_type")
 def get_elastic_preservation_by_type(query: ReleaseQuery) -> List[dict]:
     """
     Fetches preservation coverage by release type
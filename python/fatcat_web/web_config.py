@@ -27,6 +27,10 @@ class Config(object):
     ELASTICSEARCH_BACKEND = os.environ.get("ELASTICSEARCH_BACKEND", default="http://localhost:9200")
     ELASTICSEARCH_RELEASE_INDEX = os.environ.get("ELASTICSEARCH_RELEASE_INDEX", default="fatcat_release")
     ELASTICSEARCH_CONTAINER_INDEX = os.environ.get("ELASTICSEARCH_CONTAINER_INDEX", default="fatcat_container")
+    # set (to any value) once the release and container indexes have doc
+    # values on `ident` (see extra/elasticsearch/README.md); deep paging and
+    # export then sort on `ident` instead of `_id`
+    ELASTICSEARCH_SORT_IDENT = bool(os.environ.get("ELASTICSEARCH_SORT_IDENT", default=None))
 
     # for save-paper-now. set to None if not configured, so we don't display forms/links
     KAFKA_PIXY_ENDPOINT = os.environ.get("KAFKA_PIXY_ENDPOINT", default=None) or None
@@ -55,6 +59,33 @@ class Config(object):
     # controls granularity of "shadow_only" preservation category
     FATCAT_MERGE_SHADOW_PRESERVATION = os.environ.get("FATCAT_MERGE_SHADOW_PRESERVATION", default=False)
 
+    # caching of elasticsearch aggregation results (coverage stats and
+    # histograms). Entries are served as-is for TTL seconds, then served stale
+    # (while being refreshed in the background) for a further STALE_TTL
+    # seconds. Setting SIZE to zero disables the in-process cache; REDIS_URL
+    # adds a cache tier shared between web workers.
+    FATCAT_WEB_CACHE_SIZE = int(os.environ.get("FATCAT_WEB_CACHE_SIZE", default=1024))
+    FATCAT_WEB_CACHE_TTL = int(os.environ.get("FATCAT_WEB_CACHE_TTL", default=300))
+    FATCAT_WEB_CACHE_STALE_TTL = int(os.environ.get("FATCAT_WEB_CACHE_STALE_TTL", default=3600))
+    FATCAT_WEB_CACHE_REDIS_URL = os.environ.get("FATCAT_WEB_CACHE_REDIS_URL", default=None) or None
+
+    # SVG charts (coverage histograms) are rendered by the pygal library
+    # ("pygal"), or optionally by a faster, lightweight built-in emitter
+    # ("svg"), which omits pygal's hover tooltips
+    FATCAT_WEB_CHART_RENDERER = os.environ.get("FATCAT_WEB_CHART_RENDERER", default="pygal")
+
+    # bulk search export (/release/search.jsonl): max number of results per
+    # export, and per-process limits on exports per client address per minute
+    # and on concurrent exports
+    FATCAT_WEB_EXPORT_MAX_RESULTS = int(os.environ.get("FATCAT_WEB_EXPORT_MAX_RESULTS", default=100000))
+    FATCAT_WEB_EXPORT_RATE_LIMIT = int(os.environ.get("FATCAT_WEB_EXPORT_RATE_LIMIT", default=6))
+    FATCAT_WEB_EXPORT_CONCURRENCY = int(os.environ.get("FATCAT_WEB_EXPORT_CONCURRENCY", default=2))
+
+    # size of the (per-process) thread pool used to run the independent
+    # backend requests for a single page (eg, container stats and histogram
+    # queries) concurrently
+    FATCAT_WEB_BACKEND_WORKERS = int(os.environ.get("FATCAT_WEB_BACKEND_WORKERS", default=16))
+
     # CSRF on by default, but only for WTF forms (not, eg, search, lookups, GET
     # forms)
     WTF_CSRF_CHECK_DEFAULT = False
@@ -24,13 +24,17 @@ def run_entity_updates(args):
     container_topic = "fatcat-{}.container-updates".format(args.env)
     work_ident_topic = "fatcat-{}.work-ident-updates".format(args.env)
     ingest_file_request_topic = "sandcrawler-{}.ingest-file-requests".format(args.env)
-    worker = EntityUpdatesWorker(args.api, args.kafka_hosts,
+    # dedicated API client, with a connection per fetch thread
+    api = public_api(args.api_host_url, pool_maxsize=args.fetch_workers)
+    worker = EntityUpdatesWorker(api, args.kafka_hosts,
         changelog_topic,
         release_topic=release_topic,
         file_topic=file_topic,
         container_topic=container_topic,
         work_ident_topic=work_ident_topic,
         ingest_file_request_topic=ingest_file_request_topic,
+        fetch_workers=args.fetch_workers,
+        batch_size=args.batch_size,
     )
     worker.run()
 
@@ -38,21 +42,27 @@ def run_elasticsearch_release(args):
     consume_topic = "fatcat-{}.release-updates-v03".format(args.env)
     worker = ElasticsearchReleaseWorker(args.kafka_hosts, consume_topic,
         elasticsearch_backend=args.elasticsearch_backend,
-        elasticsearch_index=args.elasticsearch_index)
+        elasticsearch_index=args.elasticsearch_index,
+        transform_workers=args.transform_workers,
+        bulk_concurrency=args.bulk_concurrency)
     worker.run()
 
 def run_elasticsearch_container(args):
     consume_topic = "fatcat-{}.container-updates".format(args.env)
     worker = ElasticsearchContainerWorker(args.kafka_hosts, consume_topic,
         elasticsearch_backend=args.elasticsearch_backend,
-        elasticsearch_index=args.elasticsearch_index)
+        elasticsearch_index=args.elasticsearch_index,
+        transform_workers=args.transform_workers,
+        bulk_concurrency=args.bulk_concurrency)
     worker.run()
 
 def run_elasticsearch_changelog(args):
     consume_topic = "fatcat-{}.changelog".format(args.env)
     worker = ElasticsearchChangelogWorker(args.kafka_hosts, consume_topic,
         elasticsearch_backend=args.elasticsearch_backend,
-        elasticsearch_index=args.elasticsearch_index)
+        elasticsearch_index=args.elasticsearch_index,
+        transform_workers=args.transform_workers,
+        bulk_concurrency=args.bulk_concurrency)
     worker.run()
 
 def main():
@@ -79,6 +89,12 @@ def main():
     sub_entity_updates = subparsers.add_parser('entity-updates',
         help="poll kafka for changelog entries; push entity changes to various kafka topics")
     sub_entity_updates.set_defaults(func=run_entity_updates)
+    sub_entity_updates.add_argument('--fetch-workers',
+        help="number of concurrent API fetches per changelog entry",
+        default=8, type=int)
+    sub_entity_updates.add_argument('--batch-size',
+        help="max number of changelog entries to consume and publish at a time",
+        default=1, type=int)
 
     sub_elasticsearch_release = subparsers.add_parser('elasticsearch-release',
         help="consume kafka feed of new/updated releases, transform and push to search")
@@ -89,6 +105,12 @@ def main():
     sub_elasticsearch_release.add_argument('--elasticsearch-index',
         help="elasticsearch index to push into",
         default="fatcat_release_v03")
+    sub_elasticsearch_release.add_argument('--transform-workers',
+        help="number of processes for transforming entities (0 for inline)",
+        default=0, type=int)
+    sub_elasticsearch_release.add_argument('--bulk-concurrency',
+        help="max number of elasticsearch bulk requests in flight",
+        default=1, type=int)
 
     sub_elasticsearch_container = subparsers.add_parser('elasticsearch-container',
         help="consume kafka feed of new/updated containers, transform and push to search")
@@ -99,6 +121,12 @@ def main():
     sub_elasticsearch_container.add_argument('--elasticsearch-index',
         help="elasticsearch index to push into",
         default="fatcat_container")
+    sub_elasticsearch_container.add_argument('--transform-workers',
+        help="number of processes for transforming entities (0 for inline)",
+        default=0, type=int)
+    sub_elasticsearch_container.add_argument('--bulk-concurrency',
+        help="max number of elasticsearch bulk requests in flight",
+        default=1, type=int)
 
     sub_elasticsearch_changelog = subparsers.add_parser('elasticsearch-changelog',
         help="consume changelog kafka feed, transform and push to search")
@@ -109,6 +137,12 @@ def main():
     sub_elasticsearch_changelog.add_argument('--elasticsearch-index',
         help="elasticsearch index to push into",
         default="fatcat_changelog")
+    sub_elasticsearch_changelog.add_argument('--transform-workers',
+        help="number of processes for transforming entities (0 for inline)",
+        default=0, type=int)
+    sub_elasticsearch_changelog.add_argument('--bulk-concurrency',
+        help="max number of elasticsearch bulk requests in flight",
+        default=1, type=int)
 
     args = parser.parse_args()
     if not args.__dict__.get("func"):
@@ -1,9 +1,13 @@
 
+import io
 import copy
+import json
 import pytest
 
 from fatcat_tools.cleanups import FileCleaner
+from fatcat_tools.transforms import entity_from_dict
 from fatcat_openapi_client import *
+from fatcat_openapi_client.rest import ApiException
 from fixtures import *
 
 
@@ -57,3 +61,110 @@ def test_url_cleanups(file_cleaner):
 
     assert f == file_cleaner.clean_entity(f)
     assert f == file_cleaner.clean_entity(copy.deepcopy(f))
+
+
+class FakeFileApi(FakeApi):
+    """
+    Serves file entities from memory, and records updates
+    """
+
+    def __init__(self, files):
+        super().__init__()
+        self.files = dict([(f['ident'], entity_from_dict(f, FileEntity)) for f in files])
+        self.fetched = []
+        self.updates = []
+
+    def get_file(self, ident):
+        with self.lock:
+            self.fetched.append(ident)
+        if ident not in self.files:
+            raise ApiException(status=404)
+        return self.files[ident]
+
+    def update_file(self, editgroup_id, ident, entity):
+        self.updates.append((editgroup_id, ident, [u.url for u in entity.urls]))
+
+def make_file_records(n):
+    with open('tests/files/file_bcah4zp5tvdhjl5bqci2c2lgfa.json', 'r') as f:
+        base = json.loads(f.read())
+    records = []
+    for i in range(n):
+        rec = copy.deepcopy(base)
+        rec['ident'] = fake_ident(i)
+        if i % 3 == 0:
+            # needs cleaning
+            rec['urls'].append({"url": "https://web.archive.org/web/None/https://example.com/{}.pdf".format(i), "rel": "webarchive"})
+        if i % 7 == 0:
+            rec['state'] = 'deleted'
+        records.append(rec)
+    return records
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_file_cleaner_bulk(workers):
+
+    records = make_file_records(100)
+    # one of the entities to be cleaned is missing from the API
+    api = FakeFileApi(records[:3] + records[4:])
+    cleaner = FileCleaner(api, dry_run_mode=False, edit_batch_size=10,
+        workers=workers, chunk_size=7, fetch_batch_size=4, fetch_threads=3)
+    for rec in records:
+        cleaner.push_record(rec)
+    counts = cleaner.finish()
+
+    needs_cleaning = [r for r in records if r['state'] == 'active' and 'None' in r['urls'][-1]['url']]
+    assert counts['lines'] == 100
+    assert counts['cleaned'] == len(needs_cleaning)
+    assert counts['skip-inactive'] == len([r for r in records if r['state'] != 'active'])
+    assert counts['skip-clean'] == 100 - counts['cleaned'] - counts['skip-inactive']
+    assert counts['skip-not-found'] == 1
+    assert counts['updated'] == len(needs_cleaning) - 1
+    # only entities which needed cleaning were fetched
+    assert sorted(api.fetched) == sorted([r['ident'] for r in needs_cleaning])
+    # updates happen in input order, without the bad URL
+    assert [u[1] for u in api.updates] == [r['ident'] for r in needs_cleaning if r['ident'] in api.files]
+    assert all([len(u[2]) == 2 for u in api.updates])
+    assert len(api.accepted) == (counts['updated'] + 9) // 10
+
+def test_file_cleaner_dry_run():
+
+    records = make_file_records(30)
+    api = FakeFileApi(records)
+    output = io.StringIO()
+    cleaner = FileCleaner(api, dry_run_mode=True, output=output, workers=2, chunk_size=4)
+    for rec in records:
+        cleaner.push_record(rec)
+    counts = cleaner.finish()
+
+    lines = output.getvalue().splitlines()
+    assert len(lines) == counts['cleaned'] > 0
+    for line in lines:
+        cleaned = json.loads(line)
+        assert len(cleaned['urls']) == 2
+    assert api.fetched == []
+    assert api.updates == []
+
+    # the entities as they were before cleaning
+    output = io.StringIO()
+    cleaner = FileCleaner(api, dry_run_mode=True, dry_run_output='original', output=output,
+        workers=2, chunk_size=4)
+    for rec in records:
+        cleaner.push_record(rec)
+    cleaner.finish()
+    originals = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [o['ident'] for o in originals] == [json.loads(line)['ident'] for line in lines]
+    assert all([len(o['urls']) == 3 for o in originals])
+
+def test_file_cleaner_want():
+
+    cleaner = FileCleaner(FakeFileApi([]))
+    records = make_file_records(30)
+    records[1]['urls'].append({"url": "https://archive.org/download/item/file.pdf", "rel": "repository"})
+    records[2]['urls'].append({"url": "https://web.archive.org/web/2018/https://www.zhros.ru/jour/article/download/811/542", "rel": "webarchive"})
+    for rec in records:
+        entity = entity_from_dict(rec, FileEntity)
+        changed = cleaner.clean_entity(entity_from_dict(rec, FileEntity)) != entity
+        # the pre-filter never skips a record which would get cleaned
+        if changed:
+            assert cleaner.want(rec)
+    assert cleaner.want(records[1]) and cleaner.want(records[2])
+    assert not cleaner.want(records[4])
@@ -1,4 +1,7 @@
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 from dotenv import load_dotenv
 import elasticsearch
@@ -6,7 +9,7 @@ import elasticsearch
 import fatcat_web
 import fatcat_openapi_client
 from fatcat_openapi_client import *
-from fatcat_tools import authenticated_api
+from fatcat_tools import authenticated_api, uuid2fcid
 
 
 ES_CONTAINER_STATS_RESP = {
@@ -62,6 +65,11 @@ def full_app(mocker):
     # mock out ES client requests, so they at least fail fast
     fatcat_web.app.es_client = elasticsearch.Elasticsearch("mockbackend")
     mocker.patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    # don't leak cached (mock) responses between tests
+    fatcat_web.response_cache.clear()
+    # mocked ES responses are handed out in order, so run concurrent backend
+    # requests one at a time, in the order they were submitted
+    mocker.patch('fatcat_web.routes.backend_pool', ThreadPoolExecutor(max_workers=1))
     return fatcat_web.app
 
 @pytest.fixture
@@ -132,3 +140,53 @@ def test_get_changelog_entry(api):
 def quick_eg(api_inst):
     eg = api_inst.create_editgroup(fatcat_openapi_client.Editgroup())
     return eg
+
+def fake_ident(n):
+    """
+    A valid (made up) fatcat identifier, for in-memory fakes
+    """
+    return uuid2fcid("00000000-0000-0000-0000-{:012x}".format(n))
+
+class FakeApi:
+    """
+    Base for in-memory stand-ins for the fatcat API client; tests subclass it
+    with the entity methods they need. Hands out editgroups, and keeps a log
+    (in order) of every call which would mutate the catalog.
+    """
+
+    def __init__(self):
+        self.api_client = ApiClient()
+        self.log = []
+        self.editgroup_count = 0
+        self.accepted = []
+        self.lock = threading.Lock()
+
+    def create_editgroup(self, eg):
+        with self.lock:
+            self.editgroup_count += 1
+            eg_id = fake_ident(self.editgroup_count)
+            self.log.append(('create_editgroup', eg_id))
+        return fatcat_openapi_client.Editgroup(editgroup_id=eg_id)
+
+    def accept_editgroup(self, eg_id):
+        with self.lock:
+            self.accepted.append(eg_id)
+            self.log.append(('accept_editgroup', eg_id))
+
+class FakeKafkaMessage:
+    """
+    Just enough of confluent_kafka.Message
+    """
+
+    def __init__(self, offset, value):
+        self._offset = offset
+        self._value = value
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
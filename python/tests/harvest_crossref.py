@@ -1,8 +1,15 @@
 
 import json
 import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import pytest
 import responses
 from fatcat_tools.harvest import *
+from fatcat_tools.harvest.harvest_common import split_json_items
 
 
 @responses.activate
@@ -42,3 +49,126 @@ def test_crossref_harvest_date(mocker):
     assert harvester.producer.produce.call_count == 3
     assert harvester.producer.flush.call_count == 1
     assert harvester.producer.poll.called_once_with(0)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeCrossrefAPI:
+    """
+    Local HTTP server replaying recorded API response pages, keyed by cursor.
+    Pages are served pretty-printed, so re-encoded records can be told apart
+    from the original text.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.cursors = []
+        self.requested = dict([(cursor, threading.Event()) for cursor in pages])
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                cursor = parse_qs(urlparse(self.path).query)['cursor'][0]
+                fake.cursors.append(cursor)
+                fake.requested[cursor].set()
+                body = fake.pages[cursor].encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.url = "http://localhost:{}/works".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def fake_crossref():
+    with open('tests/files/crossref_api_works.json', 'r') as f:
+        crossref_resp = json.loads(f.readline())
+    items = crossref_resp['message']['items']
+    pages = dict()
+    for (cursor, next_cursor, page_items) in [("*", "c1", items[:2]), ("c1", "c2", items[2:])]:
+        resp = json.loads(json.dumps(crossref_resp))
+        resp['message']['items'] = page_items
+        resp['message']['next-cursor'] = next_cursor
+        pages[cursor] = json.dumps(resp, indent=2)
+    api = FakeCrossrefAPI(pages)
+    yield api
+    api.close()
+
+class BlockingProducer:
+    """
+    Records messages; while producing the first page, waits for the request
+    for the next page to show up.
+    """
+
+    def __init__(self, wait_for):
+        self.wait_for = wait_for
+        self.overlapped = None
+        self.messages = []
+        self.flushes = 0
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        if self.overlapped is None:
+            self.overlapped = self.wait_for.wait(timeout=5.0)
+        self.messages.append((key, value))
+
+    def poll(self, timeout):
+        pass
+
+    def flush(self):
+        self.flushes += 1
+
+def test_crossref_harvest_pipelined(mocker, fake_crossref):
+
+    mocker.patch('fatcat_tools.harvest.harvest_common.HarvestState.initialize_from_kafka')
+    harvester = HarvestCrossrefWorker(
+        kafka_hosts="dummy",
+        produce_topic="dummy-produce-topic",
+        state_topic="dummy-state-topic",
+        contact_email="test@fatcat.wiki",
+        api_host_url=fake_crossref.url,
+    )
+    harvester.api_batch_size = 2
+    harvester.producer = BlockingProducer(fake_crossref.requested["c1"])
+
+    harvester.fetch_date(datetime.date(2019, 2, 3))
+
+    assert fake_crossref.cursors == ["*", "c1"]
+    # the second page was requested while the first was being produced
+    assert harvester.producer.overlapped is True
+    assert harvester.producer.flushes == 1
+
+    with open('tests/files/crossref_api_works.json', 'r') as f:
+        items = json.loads(f.readline())['message']['items']
+    assert [m[0] for m in harvester.producer.messages] == [i['DOI'].encode('utf-8') for i in items]
+    for ((key, value), item) in zip(harvester.producer.messages, items):
+        assert json.loads(value.decode('utf-8')) == item
+        # original (pretty-printed) text, not re-encoded
+        assert b'\n' in value
+
+def test_split_json_items():
+
+    body = ' { "message": {"a": [1, 2], "items": [ {"DOI": "10.123/abc", "x": "\\u00e9"} ,[]\n], "next-cursor": "c1"} } '
+    doc, raw_items = split_json_items(body, ('message', 'items'))
+    assert doc == json.loads(body)
+    assert raw_items == [b'{"DOI": "10.123/abc", "x": "\\u00e9"}', b'[]']
+
+    doc, raw_items = split_json_items('{"data": [], "links": {}}', ('data',))
+    assert doc == {"data": [], "links": {}}
+    assert raw_items == []
+
+    for bad in ['{"data": [1,]}', '{"data": {}}', '{"data": [1]} x', '[]', '']:
+        with pytest.raises(ValueError):
+            split_json_items(bad, ('data',))
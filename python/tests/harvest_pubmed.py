@@ -3,74 +3,195 @@ Test pubmed FTP harvest.
 """
 
 import os
+import time
 import datetime
+import threading
+import socketserver
+
 import pytest
 
 from fatcat_tools.harvest import *
-
-
-def test_pubmed_harvest_date(mocker):
-
+from fatcat_tools.harvest.pubmed import FTPStreamReader, generate_date_file_map
+
+
+class FakeFTPServer:
+    """
+    Local FTP server, implementing just enough of the protocol (anonymous
+    login, passive mode, NLST and RETR) for ftplib. `files` maps absolute
+    paths to contents (bytes).
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.retrieved = []
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode('utf-8'))
+                self.wfile.flush()
+
+            def send_data(self, data):
+                with socketserver.socket.create_server(('127.0.0.1', 0)) as listener:
+                    port = listener.getsockname()[1]
+                    self.reply("227 Entering Passive Mode (127,0,0,1,{},{})".format(port >> 8, port & 0xff))
+                    # ftplib sends the command after connecting
+                    conn, _ = listener.accept()
+                    cmd = self.rfile.readline().decode('utf-8').strip()
+                    with conn:
+                        (verb, _, arg) = cmd.partition(' ')
+                        if verb == "NLST":
+                            body = "".join([p + "\r\n" for p in fake.files if p.startswith(arg)]).encode('utf-8')
+                        elif verb == "RETR" and arg in fake.files:
+                            fake.retrieved.append(arg)
+                            body = fake.files[arg]
+                        else:
+                            self.reply("550 not found")
+                            return
+                        self.reply("150 opening data connection")
+                        conn.sendall(body)
+                self.reply("226 transfer complete")
+
+            def handle(self):
+                self.reply("220 fake ftp")
+                for raw in self.rfile:
+                    (verb, _, _) = raw.decode('utf-8').strip().partition(' ')
+                    if verb == "USER":
+                        self.reply("331 password please")
+                    elif verb == "PASS":
+                        self.reply("230 logged in")
+                    elif verb == "TYPE":
+                        self.reply("200 ok")
+                    elif verb == "PASV":
+                        self.send_data(None)
+                    elif verb == "QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("502 not implemented")
+
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.host = "127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def read_file(name):
+    with open(os.path.join(os.path.dirname(__file__), 'files', name), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def fake_ftp():
+    server = FakeFTPServer({
+        # $ zcat tests/files/pubmedsample_2019.xml.gz | grep -c '<PubmedArticle>'
+        # 176
+        '/pubmed/updatefiles/pubmed20n1016.xml.gz': read_file('pubmedsample_2019.xml.gz'),
+        '/pubmed/updatefiles/pubmed20n1017.xml.gz': read_file('pubmedsample_2019.xml.gz'),
+        '/pubmed/updatefiles/pubmed20n1018.xml.gz': read_file('pubmedsample_no_pmid_2019.xml.gz'),
+        '/pubmed/updatefiles/pubmed20n1016_stats.html': b"<h4>Filename: pubmed20n1016.xml -- Created: Thu Feb 20 14:31:09 EST 2020</h4>",
+        '/pubmed/updatefiles/pubmed20n1017_stats.html': b"<h4>Filename: pubmed20n1017.xml -- Created: Thu Feb 20 15:31:09 EST 2020</h4>",
+    })
+    yield server
+    server.close()
+
+def make_harvester(mocker, fake_ftp, date_file_map):
     # mock out the harvest state object so it doesn't try to actually connect
     # to Kafka
     mocker.patch('fatcat_tools.harvest.harvest_common.HarvestState.initialize_from_kafka')
-
-    # Mocking a file fetched from FTP, should contain some 'PubmedArticle' elements.
-    # $ zcat tests/files/pubmedsample_2019.xml.gz | grep -c '<PubmedArticle>'
-    # 176
-    file_to_retrieve = os.path.join(os.path.dirname(__file__), 'files/pubmedsample_2019.xml.gz')
-    ftpretr = mocker.patch('fatcat_tools.harvest.pubmed.ftpretr')
-    ftpretr.return_value = file_to_retrieve
-
-    test_date = '2020-02-20'
-
-    # We'll need one entry in the date_file_map.
-    generate_date_file_map = mocker.patch('fatcat_tools.harvest.pubmed.generate_date_file_map')
-    generate_date_file_map.return_value = {test_date: set(['dummy'])}
-
-    # For cleanup.
-    os.remove = mocker.Mock()
-
     harvester = PubmedFTPWorker(
         kafka_hosts="dummy",
         produce_topic="dummy-produce-topic",
         state_topic="dummy-state-topic",
     )
-
+    harvester.host = fake_ftp.host
     harvester.producer = mocker.Mock()
-    harvester.date_file_map = generate_date_file_map()
-    # Since we mock out the FTP fetch, the concrete date does not matter here.
+    harvester.date_file_map = date_file_map
+    return harvester
+
+def test_pubmed_date_file_map(fake_ftp):
+
+    mapping = generate_date_file_map(host=fake_ftp.host)
+    assert dict(mapping) == {'2020-02-20': set([
+        '/pubmed/updatefiles/pubmed20n1016.xml.gz',
+        '/pubmed/updatefiles/pubmed20n1017.xml.gz',
+    ])}
+
+def test_pubmed_harvest_date(mocker, fake_ftp):
+
+    test_date = '2020-02-20'
+    harvester = make_harvester(mocker, fake_ftp,
+        {test_date: set(['/pubmed/updatefiles/pubmed20n1016.xml.gz'])})
     harvester.fetch_date(datetime.datetime.strptime(test_date, '%Y-%m-%d'))
 
     # check that we published the expected number of DOI objects were published
     # to the (mock) kafka topic
     assert harvester.producer.produce.call_count == 176
     assert harvester.producer.flush.call_count == 1
-    assert os.remove.call_count == 2
+    (topic, blob), kwargs = harvester.producer.produce.call_args_list[0]
+    assert topic == "dummy-produce-topic"
+    assert blob.startswith(b"<PubmedArticle>")
+    assert kwargs["key"] == "973217"
 
-def test_pubmed_harvest_date_no_pmid(mocker):
-    # mock out the harvest state object so it doesn't try to actually connect
-    # to Kafka
-    mocker.patch('fatcat_tools.harvest.harvest_common.HarvestState.initialize_from_kafka')
-
-    file_to_retrieve = os.path.join(os.path.dirname(__file__), 'files/pubmedsample_no_pmid_2019.xml.gz')
-    ftpretr = mocker.patch('fatcat_tools.harvest.pubmed.ftpretr')
-    ftpretr.return_value = file_to_retrieve
+def test_pubmed_harvest_date_multiple_files(mocker, fake_ftp):
 
     test_date = '2020-02-20'
+    paths = ['/pubmed/updatefiles/pubmed20n1017.xml.gz', '/pubmed/updatefiles/pubmed20n1016.xml.gz']
+    harvester = make_harvester(mocker, fake_ftp, {test_date: set(paths)})
+    harvester.fetch_date(datetime.datetime.strptime(test_date, '%Y-%m-%d'))
 
-    # We'll need one entry in the date_file_map.
-    generate_date_file_map = mocker.patch('fatcat_tools.harvest.pubmed.generate_date_file_map')
-    generate_date_file_map.return_value = {test_date: set(['dummy'])}
+    # one flush per file; the second download overlaps processing of the first
+    assert harvester.producer.produce.call_count == 2 * 176
+    assert harvester.producer.flush.call_count == 2
+    assert sorted(fake_ftp.retrieved) == sorted(paths)
 
-    harvester = PubmedFTPWorker(
-        kafka_hosts="dummy",
-        produce_topic="dummy-produce-topic",
-        state_topic="dummy-state-topic",
-    )
+def test_pubmed_harvest_date_no_pmid(mocker, fake_ftp):
 
-    harvester.producer = mocker.Mock()
+    test_date = '2020-02-20'
+    harvester = make_harvester(mocker, fake_ftp,
+        {test_date: set(['/pubmed/updatefiles/pubmed20n1018.xml.gz'])})
 
     # The file has not PMID, not importable.
     with pytest.raises(ValueError):
         harvester.fetch_date(datetime.datetime.strptime(test_date, '%Y-%m-%d'))
+
+def test_ftp_stream_reader(fake_ftp):
+
+    expected = read_file('pubmedsample_2019.xml.gz')
+    url = "ftp://{}/pubmed/updatefiles/pubmed20n1016.xml.gz".format(fake_ftp.host)
+    # tiny buffer, so the download has to wait on the reader
+    with FTPStreamReader(url, buffer_size=1024, block_size=512) as reader:
+        assert reader.read() == expected
+
+    # closing early aborts the transfer
+    reader = FTPStreamReader(url, buffer_size=1024, block_size=512)
+    assert len(reader.read(100)) == 100
+    reader.close()
+
+    with FTPStreamReader("ftp://{}/missing.xml.gz".format(fake_ftp.host)) as reader:
+        with pytest.raises(IOError):
+            reader.read()
+
+def test_ftp_stream_reader_full_buffer(fake_ftp):
+
+    # download finishes with the buffer full, before the consumer starts
+    # reading (as when prefetching the next file)
+    data = os.urandom(4 * 512)
+    fake_ftp.files['/pubmed/exact.bin'] = data
+    reader = FTPStreamReader("ftp://{}/pubmed/exact.bin".format(fake_ftp.host),
+        buffer_size=4 * 512, block_size=512)
+    while not reader._queue.full():
+        time.sleep(0.01)
+    time.sleep(1.0)
+    result = []
+    t = threading.Thread(target=lambda: result.append(reader.read()), daemon=True)
+    t.start()
+    t.join(timeout=10)
+    assert result == [data]
+    reader.close()
@@ -1,6 +1,14 @@
 
+import json
+import time
 import datetime
+import threading
+
+import pytest
+import fatcat_tools.harvest.harvest_common
 from fatcat_tools.harvest import *
+from fatcat_tools.harvest.harvest_common import date_ranges
+from fixtures import FakeKafkaMessage
 
 
 def test_harvest_state():
@@ -36,3 +44,178 @@ def test_harvest_state():
     assert len(hs.to_process) == 3
     hs.update('{"completed-date": "2000-01-02"}')
     assert len(hs.to_process) == 2
+
+def test_harvest_state_ordered_completion():
+
+    hs = HarvestState(
+        start_date=datetime.date(2000,1,1),
+        end_date=datetime.date(2000,1,4),
+    )
+    d1 = hs.start_span()
+    d2 = hs.start_span()
+    d3 = hs.start_span()
+    assert (d1, d2, d3) == (datetime.date(2000,1,1), datetime.date(2000,1,2), datetime.date(2000,1,3))
+    assert len(hs.in_progress) == 3
+
+    # later dates finishing first don't get marked completed
+    assert hs.finish(d3) == []
+    assert hs.finish(d2) == []
+    assert hs.completed == set()
+
+    # a failed date gets handed out again
+    hs.fail(d1)
+    assert hs.start_span() == d1
+    published = hs.finish(d1)
+    assert [json.loads(p)['completed-date'] for p in published] == ["2000-01-01", "2000-01-02", "2000-01-03"]
+    assert hs.completed == set([d1, d2, d3])
+    assert hs.start_span() == datetime.date(2000,1,4)
+    assert hs.start_span() is None
+
+def test_harvest_concurrently():
+
+    hs = HarvestState(
+        start_date=datetime.date(2000,1,1),
+        end_date=datetime.date(2000,1,8),
+    )
+    lock = threading.Lock()
+    active = [0, 0]
+    completed_order = []
+    orig_complete = hs.complete
+
+    def complete(date, **kwargs):
+        completed_order.append(date)
+        return orig_complete(date, **kwargs)
+    hs.complete = complete
+
+    def fetch_date(date):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[0], active[1])
+        # earlier dates are slower
+        time.sleep(0.01 * (10 - date.day))
+        with lock:
+            active[0] -= 1
+
+    hs.harvest_concurrently(fetch_date, 3)
+    assert active[1] == 3
+    assert completed_order == sorted(completed_order)
+    assert len(completed_order) == 8
+    assert hs.next_span() is None
+
+    # on error, nothing after the gap gets marked completed
+    hs = HarvestState(
+        start_date=datetime.date(2000,1,1),
+        end_date=datetime.date(2000,1,8),
+    )
+
+    def flaky_fetch_date(date):
+        time.sleep(0.01)
+        if date.day == 3:
+            raise IOError("oops")
+
+    with pytest.raises(IOError):
+        hs.harvest_concurrently(flaky_fetch_date, 3)
+    assert hs.completed == set([datetime.date(2000,1,1), datetime.date(2000,1,2)])
+    assert datetime.date(2000,1,3) in hs.to_process
+    assert hs.next_span() == datetime.date(2000,1,3)
+    assert not hs.in_progress
+
+class FakeStateTopic:
+    """
+    In-memory, single-partition state topic, with just enough of the
+    Consumer and Producer interfaces for HarvestState
+    """
+
+    def __init__(self, values=()):
+        self.values = [v.encode('utf-8') if isinstance(v, str) else v for v in values]
+        self.read_offsets = []
+        self.producers = 0
+        self.position = 0
+
+    # Consumer
+    def get_watermark_offsets(self, partition, timeout=None, cached=False):
+        return (0, len(self.values))
+
+    def assign(self, partitions):
+        self.position = partitions[0].offset
+
+    def poll(self, timeout=None):
+        if self.position >= len(self.values):
+            return None
+        msg = FakeKafkaMessage(self.position, self.values[self.position])
+        self.read_offsets.append(self.position)
+        self.position += 1
+        return msg
+
+    def close(self):
+        pass
+
+    # Producer
+    def produce(self, topic, value, on_delivery=None):
+        self.values.append(value)
+
+    def flush(self):
+        pass
+
+@pytest.fixture
+def state_topic(monkeypatch):
+    topic = FakeStateTopic()
+
+    def make_producer(conf):
+        topic.producers += 1
+        return topic
+
+    monkeypatch.setattr(fatcat_tools.harvest.harvest_common, 'Consumer', lambda conf: topic)
+    monkeypatch.setattr(fatcat_tools.harvest.harvest_common, 'Producer', make_producer)
+    return topic
+
+def test_date_ranges():
+
+    d = datetime.date
+    assert date_ranges([]) == []
+    assert date_ranges([d(2000,1,3), d(2000,1,1), d(2000,1,2), d(2000,1,5), d(2000,2,1)]) == [
+        (d(2000,1,1), d(2000,1,3)), (d(2000,1,5), d(2000,1,5)), (d(2000,2,1), d(2000,2,1))]
+
+def test_harvest_state_snapshot(state_topic):
+
+    kafka_config = {'bootstrap.servers': "dummy"}
+    hs = HarvestState(start_date=datetime.date(2000,1,1), end_date=datetime.date(2000,3,31))
+    hs.snapshot_interval = 10
+    for d in sorted(hs.to_process)[:25]:
+        hs.complete(d, kafka_topic="state", kafka_config=kafka_config)
+    # one long-lived producer
+    assert state_topic.producers == 1
+    values = [json.loads(v) for v in state_topic.values]
+    snapshots = [v for v in values if 'completed-ranges' in v]
+    assert len(values) == 25 + 2
+    assert snapshots[-1] == {'completed-ranges': [["2000-01-01", "2000-01-20"]]}
+
+    # startup only reads the latest snapshot, plus the tail
+    hs2 = HarvestState(start_date=datetime.date(2000,1,1), end_date=datetime.date(2000,3,31))
+    hs2.snapshot_interval = 10
+    hs2.initialize_from_kafka("state", kafka_config)
+    assert hs2.completed == hs.completed
+    assert hs2.to_process == hs.to_process
+    assert min(state_topic.read_offsets) > len(values) - 2 * hs2.snapshot_interval - 1
+    assert hs2.since_snapshot == 5
+    assert len(state_topic.values) == 27
+
+def test_harvest_state_legacy_topic(state_topic):
+
+    # topic without any snapshots is replayed in full, then compacted
+    state_topic.values = [json.dumps({'completed-date': str(datetime.date(2000,1,1) + datetime.timedelta(days=n))}).encode('utf-8')
+        for n in range(100)]
+    hs = HarvestState(start_date=datetime.date(2000,1,1), end_date=datetime.date(2000,12,31))
+    hs.initialize_from_kafka("state", {'bootstrap.servers': "dummy"})
+    assert len(hs.completed) == 100
+    assert min(hs.to_process) == datetime.date(2000,4,10)
+    assert sorted(state_topic.read_offsets) == list(range(100))
+    assert json.loads(state_topic.values[-1]) == {'completed-ranges': [["2000-01-01", "2000-04-09"]]}
+    assert hs.since_snapshot == 0
+
+    hs = HarvestState(start_date=datetime.date(2000,1,1), end_date=datetime.date(2000,12,31))
+    state_topic.read_offsets = []
+    hs.initialize_from_kafka("state", {'bootstrap.servers': "dummy"})
+    # the snapshot turns up in the first (last) window
+    assert state_topic.read_offsets == list(range(101 - 2 * hs.snapshot_interval, 101))
+    assert len(hs.completed) == 100
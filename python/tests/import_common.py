@@ -10,6 +10,8 @@ from fatcat_openapi_client import ReleaseEntity, ReleaseExtIds
 import fuzzycat.matching
 
 from fatcat_tools.importers import EntityImporter
+from fatcat_tools.importers.cache import LookupCache, SqliteLookupStore, MISSING, DEFAULT_STORE_TTL
+from fatcat_tools.importers.fuzzy import FuzzyReleaseMatcher, FUZZY_EXTID_FIELDS
 from fatcat_tools.transforms import entity_to_dict
 from fixtures import *
 
@@ -76,3 +78,395 @@ def test_fuzzy_match_different(entity_importer, mocker) -> None:
     match_raw.side_effect = [[]]
     resp = entity_importer.match_existing_release_fuzzy(r1)
     assert resp == None
+
+def test_lookup_bulk() -> None:
+    """
+    Bulk lookups should fill the same caches as one-at-a-time lookups, with
+    one API call per distinct (uncached) identifier
+    """
+
+    class LookupApi:
+        def __init__(self):
+            self.calls = []
+
+        def lookup_release(self, doi=None, pmid=None, hide=None):
+            self.calls.append(("release", doi or pmid))
+            if (doi or pmid) in ("10.123/abc", "12345"):
+                return ReleaseEntity(ident="aaaaaaaaaaaaarceaaaaaaaaai", ext_ids=ReleaseExtIds())
+            raise fatcat_openapi_client.rest.ApiException(status=404)
+
+        def lookup_creator(self, orcid=None):
+            self.calls.append(("creator", orcid))
+            raise fatcat_openapi_client.rest.ApiException(status=404)
+
+        def lookup_container(self, issnl=None):
+            self.calls.append(("container", issnl))
+            raise fatcat_openapi_client.rest.ApiException(status=500)
+
+    api = LookupApi()
+    ei = EntityImporter(api, es_client="dummy", lookup_threads=4)
+    ei._pmid_id_map["999"] = None
+
+    ei.lookup_bulk(
+        dois=["10.123/ABC", "10.123/abc", "10.123/xyz", "bogus", None],
+        pmids=["12345", "999", "12345"],
+        orcids=["0000-0003-3118-6591", "0000-00x3-3118-659"],
+    )
+    assert sorted(api.calls) == sorted([
+        ("release", "10.123/abc"),
+        ("release", "10.123/xyz"),
+        ("release", "12345"),
+        ("creator", "0000-0003-3118-6591"),
+    ])
+
+    # everything is cached now
+    api.calls = []
+    assert ei.lookup_doi("10.123/abc") == "aaaaaaaaaaaaarceaaaaaaaaai"
+    assert ei.lookup_doi("10.123/xyz") is None
+    assert ei.lookup_pmid("12345") == "aaaaaaaaaaaaarceaaaaaaaaai"
+    assert ei.lookup_orcid("0000-0003-3118-6591") is None
+    ei.lookup_bulk(dois=["10.123/abc"], pmids=["12345", "999"])
+    assert api.calls == []
+
+    # non-404 errors are passed through
+    with pytest.raises(fatcat_openapi_client.rest.ApiException):
+        ei.lookup_bulk(issnls=["1234-5678", "1234-0000"])
+
+def test_lookup_cache_store(tmp_path) -> None:
+    """
+    Lookups persisted to a sqlite3 file are picked up by a fresh importer
+    (eg, after a restart)
+    """
+
+    class NoApi:
+        def lookup_release(self, **kwargs):
+            raise NotImplementedError("should have been cached")
+
+    cache_file = str(tmp_path / "lookups.sqlite3")
+    ei = EntityImporter(NoApi(), es_client="dummy", lookup_cache_file=cache_file)
+    ei._doi_id_map.put_lookup("10.123/abc", "aaaaaaaaaaaaarceaaaaaaaaai")
+    ei._pmid_id_map.put_lookup("12345", "aaaaaaaaaaaaarceaaaaaaaaai")
+    ei.finish()
+
+    ei = EntityImporter(NoApi(), es_client="dummy", lookup_cache_file=cache_file, lookup_cache_size=10)
+    assert ei.lookup_doi("10.123/ABC") == "aaaaaaaaaaaaarceaaaaaaaaai"
+    assert ei.lookup_pmid("12345") == "aaaaaaaaaaaaarceaaaaaaaaai"
+    stats = ei.lookup_cache_stats()
+    assert stats['doi']['hit'] == 1
+    assert stats['doi']['store-hit'] == 1
+    assert stats['pmid']['size'] == 1
+
+    # stale entries are ignored
+    ei = EntityImporter(NoApi(), es_client="dummy", lookup_cache_file=cache_file, lookup_cache_ttl=-1)
+    with pytest.raises(NotImplementedError):
+        ei.lookup_doi("10.123/abc")
+
+def test_lookup_cache_store_local_entries(tmp_path) -> None:
+    """
+    "Not found" lookups, and idents of entities created by the importer
+    itself (eg, containers in a not-yet-accepted editgroup), are not persisted
+    """
+
+    class NotFoundApi:
+        def lookup_release(self, **kwargs):
+            raise fatcat_openapi_client.rest.ApiException(status=404)
+
+    store = SqliteLookupStore(str(tmp_path / "lookups.sqlite3"))
+    with pytest.raises(ValueError):
+        LookupCache("doi", store=store)
+
+    cache_file = str(tmp_path / "lookups.sqlite3")
+    ei = EntityImporter(NotFoundApi(), es_client="dummy", lookup_cache_file=cache_file)
+    assert ei._doi_id_map.ttl == DEFAULT_STORE_TTL
+    assert ei.lookup_doi("10.123/abc") is None
+    ei._issnl_id_map["1234-5678"] = "aaaaaaaaaaaaarceaaaaaaaaai"
+    assert ei.lookup_issnl("1234-5678") == "aaaaaaaaaaaaarceaaaaaaaaai"
+    ei.finish()
+    assert store.get("doi", "10.123/abc") is MISSING
+    assert store.get("issnl", "1234-5678") is MISSING
+
+def test_json_line_pusher_inputs() -> None:
+    """
+    JsonLinePusher should parse the same records from text files, binary
+    files, and lists of lines
+    """
+    from fatcat_tools.importers import JsonLinePusher
+
+    class RecordingImporter:
+        def __init__(self):
+            self.records = []
+
+        def push_record(self, raw_record):
+            self.records.append(raw_record)
+
+        def finish(self):
+            return len(self.records)
+
+    path = 'tests/files/crossref-works.2018-01-21.badsample.json'
+    with open(path, 'r') as f:
+        expected = [json.loads(line) for line in f]
+
+    for mode in ('r', 'rb'):
+        importer = RecordingImporter()
+        with open(path, mode) as f:
+            JsonLinePusher(importer, f).run()
+        assert importer.records == expected
+
+    importer = RecordingImporter()
+    with open(path, 'r') as f:
+        JsonLinePusher(importer, f.readlines()).run()
+    assert importer.records == expected
+
+    # already partially read: the rest of the lines, none skipped
+    importer = RecordingImporter()
+    with open(path, 'r') as f:
+        f.readline()
+        JsonLinePusher(importer, f).run()
+    assert importer.records == expected[1:]
+
+def test_json_line_pusher_encoding(tmp_path) -> None:
+    """
+    Non-UTF-8 text files are decoded with their own encoding
+    """
+    from fatcat_tools.importers import JsonLinePusher
+
+    class RecordingImporter:
+        def __init__(self):
+            self.records = []
+
+        def push_record(self, raw_record):
+            self.records.append(raw_record)
+
+        def finish(self):
+            return len(self.records)
+
+    path = tmp_path / "latin1.json"
+    path.write_bytes('{"title": "Caf\u00e9"}\n'.encode('latin-1'))
+    importer = RecordingImporter()
+    with open(path, 'r', encoding='latin-1') as f:
+        JsonLinePusher(importer, f).run()
+    assert importer.records == [{"title": "Caf\u00e9"}]
+
+class FakeCatalog:
+    """
+    Tiny in-memory "catalog" of releases, with just enough of the
+    elasticsearch client (search and msearch) and API (get_release) interfaces
+    for fuzzy matching
+    """
+
+    def __init__(self, releases):
+        self.releases = dict([(r.ident, r) for r in releases])
+        self.api_client = None
+        self.searches = 0
+        self.msearches = 0
+        self.fetches = []
+
+    def _query(self, body):
+        query = body['query']
+        if 'term' in query:
+            ((field, value),) = query['term'].items()
+            attr = dict([(f, a) for (a, f) in FUZZY_EXTID_FIELDS])[field]
+            hits = [r for r in self.releases.values() if getattr(r.ext_ids, attr) == value]
+        else:
+            title = query['match']['title']
+            words = set(title['query'].lower().split())
+            if title.get('fuzziness'):
+                hits = [r for r in self.releases.values() if words & set(r.title.lower().split())]
+            else:
+                hits = [r for r in self.releases.values() if words <= set(r.title.lower().split())]
+        hits = sorted(hits, key=lambda r: r.ident)[:body['size']]
+        return {"hits": {"total": len(hits), "hits": [
+            {"_index": "fatcat_release", "_type": "release", "_id": r.ident, "_source": {"ident": r.ident}}
+            for r in hits]}}
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+        return self._query(body)
+
+    def msearch(self, body=None, **kwargs):
+        self.msearches += 1
+        return {"responses": [self._query(b) for b in body[1::2]]}
+
+    def get_release(self, ident, hide=None, expand=None):
+        self.fetches.append(ident)
+        if ident not in self.releases:
+            raise fatcat_openapi_client.rest.ApiException(status=404)
+        return self.releases[ident]
+
+def make_fuzzy_releases():
+    def rev(n):
+        return "00000000-0000-0000-0000-{:012x}".format(n)
+    catalog = [
+        ReleaseEntity(ident="aaaaaaaaaaaaarceaaaaaaaaai", revision=rev(1), title="example title: novel work",
+            contribs=[ReleaseContrib(raw_name="robin hood")], ext_ids=ReleaseExtIds(doi="10.1234/abcdefg")),
+        ReleaseEntity(ident="aaaaaaaaaaaaarceaaaaaaaaam", revision=rev(2), title="Example Title: Novel Work?",
+            contribs=[ReleaseContrib(raw_name="robin hood")], ext_ids=ReleaseExtIds()),
+        ReleaseEntity(ident="aaaaaaaaaaaaarceaaaaaaaaaq", revision=rev(3), title="entirely different",
+            contribs=[ReleaseContrib(raw_name="king tut")], ext_ids=ReleaseExtIds(pmid="12345")),
+    ]
+    inputs = [
+        ReleaseEntity(title="example title: novel work", contribs=[ReleaseContrib(raw_name="robin hood")],
+            ext_ids=ReleaseExtIds(doi="10.1234/abcdefg")),
+        ReleaseEntity(title="Example Title: Novel Work?", contribs=[ReleaseContrib(raw_name="robin hood")],
+            ext_ids=ReleaseExtIds(pmid="999")),
+        ReleaseEntity(title="entirely different", contribs=[ReleaseContrib(raw_name="someone else")],
+            ext_ids=ReleaseExtIds(pmid="12345")),
+        ReleaseEntity(title="nothing like this exists", ext_ids=ReleaseExtIds()),
+        ReleaseEntity(title="entirely novel", contribs=[ReleaseContrib(raw_name="king tut")],
+            ext_ids=ReleaseExtIds()),
+    ]
+    return catalog, inputs
+
+def test_fuzzy_match_batch(mocker) -> None:
+    """
+    Batched fuzzy matching should give the same results as the per-record path
+    """
+
+    catalog, inputs = make_fuzzy_releases()
+    fake = FakeCatalog(catalog)
+    # the per-record path fetches candidates from the public API
+    mocker.patch('fuzzycat.matching.public_api').return_value = fake
+    ei = EntityImporter(fake, es_client=fake)
+    expected = [ei.match_existing_release_fuzzy(r) for r in inputs]
+    assert expected[0][0] == "EXACT"
+    assert expected[3] is None
+    assert fake.msearches == 0
+
+    fake.fetches = []
+    matcher = FuzzyReleaseMatcher(fake, api=fake, fetch_threads=3)
+    assert matcher.match_batch(inputs) == expected
+    # one msearch per step of the query cascade (longest here is: pmid,
+    # title, fuzzy title)
+    assert fake.msearches == 2
+    # each candidate only fetched once
+    assert len(fake.fetches) == len(set(fake.fetches))
+    assert len(matcher._dict_cache) == 3
+
+    matcher = FuzzyReleaseMatcher(fake, api=fake, verify_workers=2)
+    assert matcher.match_batch(inputs) == expected
+    matcher.close()
+
+class RecordedElasticsearch:
+    """
+    Replays recorded elasticsearch responses, looked up by query body, for
+    both search() and msearch(); queries without a recorded response get no
+    hits. Keeps a log of all queries.
+    """
+
+    def __init__(self, recorded):
+        self.responses = dict([(json.dumps(q, sort_keys=True), r) for (q, r) in recorded])
+        self.queries = []
+
+    def _respond(self, body):
+        self.queries.append(body)
+        resp = self.responses.get(json.dumps(body, sort_keys=True))
+        if resp is None:
+            resp = {"took": 1, "timed_out": False, "hits": {"total": 0, "max_score": None, "hits": []}}
+        return json.loads(json.dumps(resp))
+
+    def search(self, index=None, body=None, **kwargs):
+        return self._respond(body)
+
+    def msearch(self, body=None, **kwargs):
+        return {"responses": [self._respond(b) for b in body[1::2]]}
+
+    def get_release(self, ident, hide=None, expand=None):
+        return ReleaseEntity(ident=ident, ext_ids=ReleaseExtIds())
+
+def test_fuzzy_queries_match_fuzzycat() -> None:
+    """
+    The query cascade in fatcat_tools.importers.fuzzy is a copy of the one in
+    fuzzycat.matching.match_release_fuzzy(); check that it sends the same
+    queries, in the same order, and ends up with the same candidates
+    """
+
+    with open('tests/files/elastic_release_search.json') as f:
+        recorded = json.loads(f.read())
+
+    def with_hits(hits):
+        resp = json.loads(json.dumps(recorded))
+        resp['hits']['hits'] = hits
+        resp['hits']['total'] = len(hits)
+        return resp
+
+    hits = recorded['hits']['hits']
+    title = hits[0]['_source']['title']
+    size = 10
+    es = RecordedElasticsearch([
+        ({"query": {"term": {"doi": hits[0]['_source']['doi']}}, "size": size}, with_hits(hits[:1])),
+        ({"query": {"term": {"jstor_id": "1234"}}, "size": size}, with_hits(hits[7:9])),
+        # more than 5 title hits
+        ({"query": {"match": {"title": {"query": title, "operator": "AND"}}}, "size": size}, recorded),
+        ({"query": {"match": {"title": {"query": "quantum studys", "operator": "AND",
+            "fuzziness": "AUTO"}}}, "size": size}, with_hits(hits[3:6])),
+    ])
+    releases = [
+        ReleaseEntity(title=title, ext_ids=ReleaseExtIds(doi=hits[0]['_source']['doi'])),
+        ReleaseEntity(title=title, ext_ids=ReleaseExtIds(doi="10.1234/nothing", pmid="999")),
+        ReleaseEntity(title="quantum studys", ext_ids=ReleaseExtIds()),
+        ReleaseEntity(title="nothing like this", ext_ids=ReleaseExtIds(wikidata_qid="Q1", arxiv="1234.5678")),
+        ReleaseEntity(title="nothing like this", ext_ids=ReleaseExtIds(pmcid="PMC123", jstor="1234")),
+    ]
+
+    matcher = FuzzyReleaseMatcher(es, api=es, size=size)
+    expected = []
+    for release in releases:
+        es.queries = []
+        candidates = fuzzycat.matching.match_release_fuzzy(release, size=size, es=es, api=es)
+        fuzzycat_queries = es.queries
+        expected.append([c.ident for c in candidates])
+
+        es.queries = []
+        assert matcher.candidate_idents([release]) == [expected[-1]]
+        assert es.queries == fuzzycat_queries
+
+    assert [len(e) for e in expected] == [1, 5, 3, 0, 2]
+    # all at once
+    assert matcher.candidate_idents(releases) == expected
+
+def test_fuzzy_match_window(mocker) -> None:
+    """
+    In batched mode, push_record() collects a window of releases and
+    try_update() gets pre-computed fuzzy match results
+    """
+
+    catalog, inputs = make_fuzzy_releases()
+    fake = FakeCatalog(catalog)
+    mocker.patch('fuzzycat.matching.public_api').return_value = fake
+
+    class FuzzyImporter(EntityImporter):
+        def __init__(self, **kwargs):
+            super().__init__(fake, es_client=fake, **kwargs)
+            self.fuzzy_results = []
+            self.pushed = []
+
+        def want(self, raw_record):
+            return True
+
+        def parse_record(self, raw_record):
+            return raw_record
+
+        def try_update(self, re):
+            self.fuzzy_results.append(self.match_existing_release_fuzzy(re))
+            return self.fuzzy_results[-1] is None
+
+        def push_entity(self, entity):
+            self.pushed.append(entity)
+
+    importer = FuzzyImporter()
+    for r in inputs:
+        importer.push_record(r)
+    expected = importer.fuzzy_results
+    expected_pushed = importer.pushed
+    assert fake.msearches == 0
+
+    importer = FuzzyImporter(fuzzy_match_batch_size=3)
+    importer._fuzzy_matcher = FuzzyReleaseMatcher(fake, api=fake)
+    for r in inputs:
+        importer.push_record(r)
+    assert len(importer.fuzzy_results) == 3
+    importer.finish()
+    assert importer.fuzzy_results == expected
+    assert importer.pushed == expected_pushed
+    assert inputs[3] in importer.pushed
+    assert 0 < fake.msearches <= 6
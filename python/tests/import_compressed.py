@@ -0,0 +1,147 @@
+
+import os
+import csv
+import gzip
+import lzma
+import shutil
+import subprocess
+
+import pytest
+
+from fatcat_tools.importers import JsonLinePusher, LinePusher, CsvPusher, Bs4XmlLargeFilePusher, CompressedFileType
+from fatcat_tools.importers.compressed import open_compressed, input_position, InputProgress
+
+
+class Recorder:
+    """
+    Stands in for an importer in a pusher; just keeps the raw records
+    """
+
+    def __init__(self, convert=None):
+        self.records = []
+        self.convert = convert
+
+    def push_record(self, raw_record):
+        if self.convert:
+            raw_record = self.convert(raw_record)
+        self.records.append(raw_record)
+
+    def finish(self):
+        return dict(total=len(self.records))
+
+def zstandard_available():
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+@pytest.fixture
+def compressed_files(tmp_path):
+    """
+    datacite sample (JSON lines) as uncompressed, .gz, .xz and .zst (if the
+    zstd command is available) files
+    """
+    with gzip.open('tests/files/datacite_1k_records.jsonl.gz', 'rb') as f:
+        raw = f.read()
+    paths = dict(raw=tmp_path / "datacite.json", gz='tests/files/datacite_1k_records.jsonl.gz',
+        xz=tmp_path / "datacite.json.xz")
+    paths['raw'].write_bytes(raw)
+    paths['xz'].write_bytes(lzma.compress(raw, preset=0))
+    if shutil.which("zstd"):
+        paths['zst'] = tmp_path / "datacite.json.zst"
+        subprocess.run(["zstd", "-q", str(paths['raw']), "-o", str(paths['zst'])], check=True)
+    return (raw, paths)
+
+def test_open_compressed(compressed_files):
+
+    (raw, paths) = compressed_files
+    for (fmt, path) in paths.items():
+        for external in (True, False):
+            if fmt == 'zst' and not external and not zstandard_available():
+                continue
+            with open_compressed(path, 'rb', external=external) as f:
+                assert f.readline() == raw.split(b'\n')[0] + b'\n'
+                assert f.read() == raw[raw.index(b'\n') + 1:]
+                (pos, size) = input_position(f)
+                assert pos == size and size > 0
+            with open_compressed(path, 'r', external=external) as f:
+                assert len(list(f)) == raw.count(b'\n')
+
+    # closing before the end stops decompression
+    f = open_compressed(paths['xz'], 'rb')
+    f.read(10)
+    f.close()
+    assert f.closed
+
+def test_open_compressed_corrupt(tmp_path):
+
+    path = tmp_path / "broken.json.gz"
+    blob = gzip.compress(os.urandom(100000).hex().encode('ascii'))
+    path.write_bytes(blob[:len(blob) // 2])
+    for external in (True, False):
+        with pytest.raises((IOError, EOFError)):
+            with open_compressed(path, 'rb', external=external) as f:
+                f.read()
+
+def test_compressed_pushers(compressed_files, tmp_path):
+
+    (raw, paths) = compressed_files
+    for path in paths.values():
+        importer = Recorder()
+        counts = JsonLinePusher(importer, str(path)).run()
+        assert counts['total'] == 1000
+        assert importer.records[0]['id'] == "10.25921/9y9k-z931"
+
+        importer = Recorder()
+        LinePusher(importer, path).run()
+        assert importer.records == [l.decode('utf-8') + '\n' for l in raw.split(b'\n') if l]
+
+    csv_path = tmp_path / "rows.tsv.gz"
+    with gzip.open(csv_path, 'wt') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(["doi", "title"])
+        writer.writerow(["10.123/abc", "multi\nline title"])
+        writer.writerow(["10.123/def", "other"])
+    importer = Recorder()
+    CsvPusher(importer, str(csv_path), delimiter='\t').run()
+    assert importer.records == [
+        dict(doi="10.123/abc", title="multi\nline title"),
+        dict(doi="10.123/def", title="other"),
+    ]
+
+def test_compressed_xml_pusher():
+
+    def pmid(record):
+        return record.PMID.string
+
+    results = []
+    for path in ('tests/files/pubmedsample_2019.xml', 'tests/files/pubmedsample_2019.xml.gz'):
+        for lxml_records in (False, True):
+            importer = Recorder(convert=pmid)
+            Bs4XmlLargeFilePusher(importer, path, ["PubmedArticle"], lxml_records=lxml_records).run()
+            results.append(importer.records)
+    assert len(results[0]) > 100
+    assert all([r == results[0] for r in results])
+
+def test_compressed_progress(compressed_files, capsys):
+
+    (_raw, paths) = compressed_files
+    JsonLinePusher(Recorder(), str(paths['xz']), progress_interval=0.000001).run()
+    err = capsys.readouterr().err
+    assert "progress: " in err
+    assert "of {} bytes".format(paths['xz'].stat().st_size) in err
+
+    with open(paths['raw'], 'r') as f:
+        progress = InputProgress(f, interval=0.000001)
+        f.readline()
+        progress.tick()
+    assert "progress: " in capsys.readouterr().err
+
+def test_compressed_file_type(compressed_files):
+
+    (raw, paths) = compressed_files
+    with CompressedFileType('r')(str(paths['xz'])) as f:
+        assert f.read() == raw.decode('utf-8')
+    with CompressedFileType('r')(str(paths['raw'])) as f:
+        assert f.read() == raw.decode('utf-8')
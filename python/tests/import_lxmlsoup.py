@@ -0,0 +1,206 @@
+
+import lxml.etree
+import pytest
+from bs4 import BeautifulSoup
+from fatcat_openapi_client import ApiClient
+from fatcat_openapi_client.rest import ApiException
+
+from fatcat_tools.importers import *
+from fatcat_tools.importers.lxmlsoup import LxmlTag, iter_xml_records, parse_xml_document
+from fatcat_tools.transforms import entity_to_dict
+
+
+class NoApi:
+    """
+    API stand-in where every lookup misses; enough for parse_record()
+    """
+
+    api_client = ApiClient()
+
+    def __getattr__(self, name):
+        def not_found(*args, **kwargs):
+            raise ApiException(status=404)
+        return not_found
+
+class ParseOnly:
+    """
+    Stands in for an importer in a pusher, and just records parse_record()
+    results
+    """
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.parsed = []
+
+    def push_record(self, raw_record):
+        if not self.importer.want(raw_record):
+            self.parsed.append("skip")
+            return
+        entity = self.importer.parse_record(raw_record)
+        self.parsed.append(entity and entity_to_dict(entity))
+
+    def finish(self):
+        return dict(parsed=len(self.parsed))
+
+SAMPLE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<root xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <record key="a/1" type="journal">
+    <dc:title xml:lang="en">Some <i>italic</i>   <b>bold</b> title</dc:title>
+    <id>  </id>
+    <id>
+    </id>
+    <empty/>
+    <nested><inner>only string</inner></nested>
+    <mixed>text<!-- comment -->more</mixed>
+    <ArticleId IdType="doi">10.1234/abc</ArticleId>
+    <ArticleId IdType="pubmed">1234</ArticleId>
+    <type>Retraction of Publication</type>
+    <group><item n="1">one</item><item>two</item></group>
+  </record>
+</root>
+"""
+
+def test_lxmlsoup_tag_api():
+
+    soup = BeautifulSoup(SAMPLE_XML, "xml").find("record")
+    root = lxml.etree.fromstring(SAMPLE_XML.encode('utf-8'))
+    tag = LxmlTag(root.find("record"))
+
+    for t in (soup, tag):
+        assert t.name == "record"
+        assert t['key'] == "a/1"
+        assert t.get('missing') is None
+        assert t.get('missing', 'x') == 'x'
+        with pytest.raises(KeyError):
+            t['missing']
+        assert t.missing is None
+        assert t.empty
+        assert t.empty.string is None
+        assert t.group.item['n'] == "1"
+        assert t.find("item", n=True).string == "one"
+        assert t.find("item", n=False).string == "two"
+        # (not a find() argument; an attribute filter, as used by the pubmed importer)
+        assert t.find("item", recurse=False).string == "one"
+        assert t.find("item", {"n": "1"}).string == "one"
+        assert t.find("ArticleId", IdType="pubmed").string == "1234"
+        assert t.find("ArticleId", IdType="pmc") is None
+        assert t.find("group", recursive=False) and not t.find("item", recursive=False)
+        assert t.find(string="Retraction of Publication")
+        assert not t.find(string="Retraction")
+        assert len(t.find_all()) == len(soup.find_all())
+
+    assert tag.title.prefix == soup.title.prefix == "dc"
+    assert tag.title['xml:lang'] == "en"
+    assert tag.find("dc:title").get_text() == soup.find("dc:title").get_text()
+    assert [i.string for i in tag.find_all("id")] == [i.string for i in soup.find_all("id")] == [" ", "\n"]
+    for name in ("title", "nested", "mixed", "group", "i"):
+        assert tag.find(name).string == soup.find(name).string
+        assert tag.find(name).text == soup.find(name).text
+        assert tag.find(name).get_text() == soup.find(name).get_text()
+        assert list(tag.find(name).stripped_strings) == list(soup.find(name).stripped_strings)
+    assert tag.get_text() == soup.get_text()
+    assert tag.attrs == soup.attrs
+    assert str(tag.find("i")) == str(soup.find("i")) == "<i>italic</i>"
+    assert str(tag.group) == str(soup.group)
+
+def test_lxmlsoup_document():
+
+    line = '<rdf:Description rdf:about="x"><dc:title>Title</dc:title><prism:doi>10.1/x</prism:doi></rdf:Description>'
+    soup = BeautifulSoup(line, "xml")
+    doc = parse_xml_document(line)
+    for d in (soup, doc):
+        assert d.name == "[document]"
+        assert d.find_all("Description")[0]['about'] == "x"
+        assert d.Description.title.string == "Title"
+        assert d.doi.string == "10.1/x"
+        assert d.string == "Title10.1/x" or d.string is None
+        assert d.get_text() == "Title10.1/x"
+    assert doc.find("Description").prefix == soup.find("Description").prefix
+    assert parse_xml_document(line.encode('utf-8')).get_text() == doc.get_text()
+
+def bs4_reparse(record):
+    # what Bs4XmlLargeFilePusher(use_lxml=True) passes to importers
+    soup = BeautifulSoup(lxml.etree.tostring(record.element), "xml")
+    return soup.find(record.name)
+
+@pytest.mark.parametrize("make_importer,path,record_tags", [
+    (lambda: PubmedImporter(NoApi(), open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r'), lookup_refs=True, create_containers=False),
+        'tests/files/pubmedsample_2019.xml', ["PubmedArticle"]),
+    (lambda: PubmedImporter(NoApi(), open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r'), lookup_refs=True, create_containers=False),
+        'tests/files/pubmed_19129924.xml', ["PubmedArticle"]),
+    (lambda: ArxivRawImporter(NoApi()),
+        'tests/files/arxivraw_1810.09584.xml', ["record"]),
+    (lambda: JstorImporter(NoApi(), open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r')),
+        'tests/files/jstor-article-10.2307_111039.xml', ["article"]),
+    (lambda: JalcImporter(NoApi(), open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r'), extid_map_file='tests/files/example_map.sqlite3'),
+        'tests/files/jalc_lod_sample.xml', ["Description"]),
+    (lambda: DblpReleaseImporter(NoApi(), open('tests/files/dblp_container_map.tsv', 'r')),
+        'tests/files/example_dblp.xml', DblpReleaseImporter.ELEMENT_TYPES),
+])
+def test_lxmlsoup_importer_equivalence(make_importer, path, record_tags):
+    """
+    Importers give identical results for lxml records and BeautifulSoup
+    re-parses of the same elements
+    """
+
+    importer = make_importer()
+    count = 0
+    with open(path, 'rb') as xml_file:
+        for record in iter_xml_records(xml_file, record_tags):
+            soup_record = bs4_reparse(record)
+            assert importer.want(record) == importer.want(soup_record)
+            if not importer.want(record):
+                continue
+            expected = importer.parse_record(soup_record)
+            assert importer.parse_record(record) == expected
+            count += 1
+    assert count > 0
+
+def test_lxml_records_pushers(tmp_path):
+
+    def parse_all(pusher_cls, make_importer, path, *args, mode='r', **kwargs):
+        results = []
+        for lxml_records in (False, True):
+            importer = ParseOnly(make_importer())
+            with open(path, mode) as f:
+                pusher_cls(importer, f, *args, lxml_records=lxml_records, **kwargs).run()
+            results.append(importer.parsed)
+        return results
+
+    def jalc_importer():
+        with open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r') as issn_file:
+            return JalcImporter(NoApi(), issn_file, extid_map_file='tests/files/example_map.sqlite3')
+
+    (soup, lxml_parsed) = parse_all(Bs4XmlLinesPusher, jalc_importer,
+        'tests/files/jalc_rdf_sample_100.xml', "<rdf:Description")
+    assert len(soup) == 93
+    assert soup == lxml_parsed
+
+    (soup, lxml_parsed) = parse_all(Bs4XmlFilePusher, jalc_importer,
+        'tests/files/jalc_lod_sample.xml', "Description")
+    assert len(soup) == 2
+    assert soup == lxml_parsed
+
+    (soup, lxml_parsed) = parse_all(Bs4XmlFilePusher, lambda: ArxivRawImporter(NoApi()),
+        'tests/files/arxivraw_1810.09584.xml', "record", mode='rb')
+    assert len(soup) == 1
+    assert soup == lxml_parsed
+
+    def pubmed_importer():
+        with open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r') as issn_file:
+            return PubmedImporter(NoApi(), issn_file, lookup_refs=True, create_containers=False)
+
+    (soup, lxml_parsed) = parse_all(Bs4XmlLargeFilePusher, pubmed_importer,
+        'tests/files/pubmed_19129924.xml', ["PubmedArticle"])
+    assert len(soup) == 1
+    assert soup == lxml_parsed
+
+    def jstor_importer():
+        with open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r') as issn_file:
+            return JstorImporter(NoApi(), issn_file)
+
+    list_file = tmp_path / "jstor_files.txt"
+    list_file.write_text("# comment\ntests/files/jstor-article-10.2307_111039.xml\n")
+    (soup, lxml_parsed) = parse_all(Bs4XmlFileListPusher, jstor_importer, str(list_file), "article")
+    assert len(soup) == 1
+    assert soup == lxml_parsed
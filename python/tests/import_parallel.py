@@ -0,0 +1,339 @@
+
+import time
+import random
+
+import pytest
+import fatcat_openapi_client
+from fatcat_openapi_client import ReleaseEntity, ReleaseExtIds, ContainerEntity
+
+from fatcat_tools.importers import EntityImporter, ParallelImporter, Bs4XmlFileListPusher
+from fixtures import fake_ident, FakeApi
+
+
+class FakeImportApi(FakeApi):
+    """
+    Records (in order) every API call which would mutate the catalog
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.created_dois = set()
+
+    def create_container(self, eg_id, ce):
+        self.log.append(('create_container', eg_id, ce.name))
+        return fatcat_openapi_client.EntityEdit(
+            edit_id="00000000-0000-0000-1111-fff000000001",
+            ident=fake_ident(len(self.log)),
+            revision="00000000-0000-0000-1111-fff000000002",
+            editgroup_id=eg_id,
+        )
+
+    def update_release(self, eg_id, ident, re):
+        self.log.append(('update_release', eg_id, ident))
+
+    def create_release_auto_batch(self, batch):
+        self.log.append(('create_release_auto_batch', [re.title for re in batch]))
+        self.created_dois.update([re.ext_ids.doi for re in batch])
+
+
+class ToyImporter(EntityImporter):
+
+    def __init__(self, api, **kwargs):
+        super().__init__(api, es_client="dummy", **kwargs)
+        self.fail_on = kwargs.get('fail_on')
+
+    def want(self, raw_record):
+        if raw_record.get('skip'):
+            self.counts['skip-flag'] += 1
+            return False
+        return True
+
+    def parse_record(self, raw_record):
+        if raw_record.get('blank'):
+            return None
+        container_id = None
+        if raw_record.get('container'):
+            edit = self.create_container(ContainerEntity(name=raw_record['container']))
+            container_id = edit.ident
+        return ReleaseEntity(
+            title="release {}".format(raw_record['n']),
+            container_id=container_id,
+            ext_ids=ReleaseExtIds(doi="10.123/{}".format(raw_record['n'])),
+        )
+
+    def try_update(self, re):
+        # "lookup" latency, to shuffle thread completion order
+        time.sleep(random.random() * 0.002)
+        n = int(re.ext_ids.doi.split('/')[1])
+        if n == self.fail_on:
+            raise ValueError("broken record")
+        if n % 5 == 0:
+            self.api.update_release(self.get_editgroup_id(), str(n), re)
+            self.counts['update'] += 1
+            return False
+        if n % 3 == 0:
+            self.counts['exists'] += 1
+            return False
+        return True
+
+    def insert_batch(self, batch):
+        self.api.create_release_auto_batch(batch)
+
+
+def toy_records(count=200):
+    records = []
+    for n in range(count):
+        raw = dict(n=n)
+        if n % 17 == 0:
+            raw['skip'] = True
+        if n % 23 == 0:
+            raw['blank'] = True
+        if n % 29 == 0:
+            raw['container'] = "journal {}".format(n)
+        records.append(raw)
+    return records
+
+def run_import(importer, records):
+    for raw in records:
+        importer.push_record(raw)
+    return importer.finish()
+
+def test_parallel_importer_matches_serial():
+
+    for bezerk_mode in (False, True):
+        serial = ToyImporter(FakeImportApi(), edit_batch_size=7, bezerk_mode=bezerk_mode)
+        serial_counts = run_import(serial, toy_records())
+        parallel = ToyImporter(FakeImportApi(), edit_batch_size=7, bezerk_mode=bezerk_mode)
+        parallel_counts = run_import(
+            ParallelImporter(parallel, workers=3, update_threads=5, chunk_size=4),
+            toy_records(),
+        )
+        assert parallel_counts == serial_counts
+        assert parallel.api.log == serial.api.log
+        assert serial_counts['total'] == 200
+        assert serial_counts['inserted.container'] > 0
+
+def test_parallel_importer_resume():
+    """
+    Records can be pushed after finish(); pools get re-created
+    """
+
+    records = toy_records(60)
+    serial = ToyImporter(FakeImportApi(), edit_batch_size=7)
+    run_import(serial, records[:30])
+    serial_counts = run_import(serial, records[30:])
+
+    parallel = ToyImporter(FakeImportApi(), edit_batch_size=7)
+    pi = ParallelImporter(parallel, workers=2, chunk_size=5)
+    run_import(pi, records[:30])
+    parallel_counts = run_import(pi, records[30:])
+
+    assert parallel_counts == serial_counts
+    assert parallel.api.log == serial.api.log
+
+def test_parallel_importer_error():
+
+    importer = ToyImporter(FakeImportApi(), edit_batch_size=7, fail_on=101)
+    pi = ParallelImporter(importer, workers=2, chunk_size=4)
+    with pytest.raises(ValueError):
+        run_import(pi, toy_records())
+    assert pi._pool is None
+    assert pi._executor is None
+    assert importer._editgroup_gate is None
+
+
+class ToyXmlImporter(ToyImporter):
+    """
+    ToyImporter over `<rec>` XML elements (bs4 or lxmlsoup)
+    """
+
+    def _raw(self, xml_record):
+        raw = dict(n=int(xml_record['n']))
+        for key in ('skip', 'blank', 'container'):
+            if xml_record.get(key):
+                raw[key] = xml_record[key]
+        return raw
+
+    def want(self, xml_record):
+        return super().want(self._raw(xml_record))
+
+    def parse_record(self, xml_record):
+        return super().parse_record(self._raw(xml_record))
+
+def toy_xml_files(tmp_path, count=200, per_file=9):
+    """
+    Writes toy_records() out as XML files; returns the list file path
+    """
+    records = toy_records(count)
+    paths = []
+    for i in range(0, count, per_file):
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<recs>']
+        for raw in records[i:i+per_file]:
+            attrs = " ".join(['{}="{}"'.format(k, v) for (k, v) in raw.items()])
+            lines.append('  <rec {}/>'.format(attrs))
+        lines.append('</recs>')
+        path = tmp_path / "recs_{:04d}.xml".format(i)
+        path.write_text("\n".join(lines))
+        paths.append(str(path))
+    list_file = tmp_path / "files.txt"
+    list_file.write_text("\n".join(["# toy files"] + paths + [""]))
+    return str(list_file)
+
+def run_xml_import(list_path, **kwargs):
+    importer = ToyXmlImporter(FakeImportApi(), edit_batch_size=7)
+    with open(list_path, 'r') as list_file:
+        counts = Bs4XmlFileListPusher(importer, list_file, "rec", **kwargs).run()
+    return (counts, importer.api.log)
+
+def test_parallel_xml_file_list_pusher(tmp_path):
+
+    list_path = toy_xml_files(tmp_path)
+    for lxml_records in (False, True):
+        (serial_counts, serial_log) = run_xml_import(list_path, lxml_records=lxml_records)
+        (parallel_counts, parallel_log) = run_xml_import(list_path,
+            lxml_records=lxml_records, workers=3)
+        assert serial_counts['total'] == 200
+        assert serial_counts['inserted.container'] > 0
+        assert parallel_counts == serial_counts
+        assert parallel_log == serial_log
+
+def test_parallel_xml_file_list_pusher_unordered(tmp_path):
+    """
+    Unordered collection does the same edits, though not in the same order
+    or editgroups
+    """
+
+    def edits(log):
+        found = []
+        for entry in log:
+            if entry[0] == 'create_release_auto_batch':
+                found.extend(entry[1])
+            elif entry[0] == 'update_release':
+                found.append(entry[2])
+            elif entry[0] == 'create_container':
+                found.append(entry[2])
+        return sorted(found)
+
+    list_path = toy_xml_files(tmp_path)
+    (serial_counts, serial_log) = run_xml_import(list_path)
+    (parallel_counts, parallel_log) = run_xml_import(list_path, workers=3, ordered=False)
+    assert parallel_counts == serial_counts
+    assert edits(parallel_log) == edits(serial_log)
+
+
+class DedupImporter(ToyImporter):
+    """
+    Looks up existing releases by DOI, like the real release importers
+    """
+
+    def parse_record(self, raw_record):
+        re = super().parse_record(raw_record)
+        if re and raw_record.get('doi'):
+            re.ext_ids.doi = raw_record['doi']
+        return re
+
+    def try_update(self, re):
+        time.sleep(random.random() * 0.002)
+        if re.ext_ids.doi in self.api.created_dois:
+            self.counts['exists'] += 1
+            return False
+        return True
+
+def test_parallel_importer_duplicate_lookups():
+    """
+    Records with the same DOI a few records apart (across insert batch
+    flushes) are only created once, same as in serial mode
+    """
+
+    records = toy_records(200)
+    for raw in records:
+        if raw['n'] % 10 == 3:
+            raw['doi'] = "10.123/dupe-{}".format(raw['n'] // 40)
+    serial = DedupImporter(FakeImportApi(), edit_batch_size=7)
+    serial_counts = run_import(serial, records)
+    assert serial_counts['exists'] > 10
+
+    parallel = DedupImporter(FakeImportApi(), edit_batch_size=7)
+    parallel_counts = run_import(
+        ParallelImporter(parallel, workers=3, update_threads=8, chunk_size=4),
+        records,
+    )
+    assert parallel_counts == serial_counts
+    assert parallel.api.log == serial.api.log
+
+
+class VisibilityApi(FakeImportApi):
+    """
+    Release updates only become visible (to lookups) once their editgroup is
+    accepted, like in the real catalog
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pending = dict()
+        self.visible = set()
+
+    def update_release(self, eg_id, ident, re):
+        super().update_release(eg_id, ident, re)
+        self.pending.setdefault(eg_id, set()).add(ident)
+
+    def accept_editgroup(self, eg_id):
+        super().accept_editgroup(eg_id)
+        self.visible.update(self.pending.pop(eg_id, set()))
+
+class UpdateImporter(ToyImporter):
+    """
+    Updates every release whose DOI hasn't been updated (visibly) before
+    """
+
+    def parse_record(self, raw_record):
+        return ReleaseEntity(
+            title="release {}".format(raw_record['n']),
+            ext_ids=ReleaseExtIds(doi=raw_record['doi']),
+            extra=dict(slow=raw_record.get('slow', False)),
+        )
+
+    def try_update(self, re):
+        if re.extra['slow']:
+            time.sleep(0.2)
+        if re.ext_ids.doi in self.api.visible:
+            self.counts['exists'] += 1
+            return False
+        self.api.update_release(self.get_editgroup_id(), re.ext_ids.doi, re)
+        self.counts['update'] += 1
+        return False
+
+class SlowSubmitter(ParallelImporter):
+
+    def _submit_next(self):
+        # the record's try_update() thread already has the turn, and gets to
+        # make its edit before the submitter looks at the importer
+        time.sleep(0.05)
+        super()._submit_next()
+
+def test_parallel_importer_edit_before_submit():
+    """
+    try_update() edits made before the submitter reaches a record still hold
+    back later lookups of the same key, until the edit is visible
+    """
+
+    # the fourth record's edit rolls over (accepts) the first editgroup; the
+    # last record only sees the first record's update after that
+    records = [
+        dict(n=0, doi="10.123/x"),
+        dict(n=1, doi="10.123/y"),
+        dict(n=2, doi="10.123/z"),
+        dict(n=3, doi="10.123/w", slow=True),
+        dict(n=4, doi="10.123/x"),
+    ]
+    serial = UpdateImporter(VisibilityApi(), edit_batch_size=3)
+    serial_counts = run_import(serial, records)
+    assert serial_counts['exists'] == 1
+
+    parallel = UpdateImporter(VisibilityApi(), edit_batch_size=3)
+    parallel_counts = run_import(
+        SlowSubmitter(parallel, workers=2, update_threads=4, chunk_size=1, max_pending_updates=1),
+        records,
+    )
+    assert parallel_counts == serial_counts
+    assert parallel.api.log == serial.api.log
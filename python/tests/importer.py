@@ -30,3 +30,23 @@ def test_identifiers(api):
     assert oi.is_orcid("0000-00x3-3118-659") == False
     assert oi.is_orcid("0000-00033118-659") == False
     assert oi.is_orcid("0000-0003-3118-659.") == False
+
+def test_issnl_index_file(tmp_path):
+    from fatcat_tools.importers import EntityImporter
+    from fatcat_tools.importers.issn_index import build_issn_index
+
+    index_path = str(tmp_path / "issnl.idx")
+    with open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r') as issn_file:
+        assert build_issn_index(issn_file, index_path) == 19
+
+    text_importer = EntityImporter(None, es_client="dummy")
+    with open('tests/files/ISSN-to-ISSN-L.snip.txt', 'r') as issn_file:
+        text_importer.read_issn_map_file(issn_file)
+    index_importer = EntityImporter(None, es_client="dummy")
+    with open(index_path, 'r') as issn_file:
+        index_importer.read_issn_map_file(issn_file)
+
+    assert len(index_importer._issn_issnl_map) == len(text_importer._issn_issnl_map)
+    for issn in list(text_importer._issn_issnl_map.keys()) + ['9999-0027', '0000-002X', 'blah', None]:
+        assert index_importer.issn2issnl(issn) == text_importer.issn2issnl(issn)
+    assert index_importer.issn2issnl('0000-0027') == '0002-0027'
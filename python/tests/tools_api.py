@@ -15,3 +15,10 @@ def test_public_api():
     api.get_changelog()
     with pytest.raises(ApiException):
         api.auth_check()
+
+def test_public_api_pool_maxsize():
+    # doesn't connect
+    api = public_api("http://localhost:9411/v0", pool_maxsize=13)
+    assert api.api_client.rest_client.pool_manager.connection_pool_kw['maxsize'] == 13
+    other = public_api("http://localhost:9411/v0")
+    assert other.api_client.rest_client.pool_manager.connection_pool_kw['maxsize'] != 13
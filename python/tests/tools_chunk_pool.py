@@ -0,0 +1,61 @@
+
+import os
+import time
+
+import pytest
+
+from fatcat_tools.chunk_pool import ChunkPool
+
+
+class Multiplier:
+    def __init__(self, factor):
+        self.factor = factor
+        self.pid = None
+
+def start_worker(state):
+    state.pid = os.getpid()
+
+def multiply_chunk(state, chunk):
+    # later chunks finish first
+    time.sleep(0.05 * (2 - (chunk[0] // 4) % 3))
+    return [(state.factor * n, state.pid) for n in chunk]
+
+def sum_chunk(chunk):
+    if None in chunk:
+        raise ValueError("bad chunk")
+    return sum(chunk)
+
+def test_chunk_pool_ordered():
+
+    chunks = [list(range(i, i + 4)) for i in range(0, 40, 4)]
+    handled = []
+    with ChunkPool(multiply_chunk, lambda tag, result: handled.append((tag, result)), workers=3,
+            state=Multiplier(10), initializer=start_worker) as pool:
+        for (i, chunk) in enumerate(chunks):
+            pool.submit(chunk, tag=i)
+            assert len(pool) <= 6
+        pool.drain()
+    assert [tag for (tag, _result) in handled] == list(range(10))
+    assert [n for (_tag, result) in handled for (n, _pid) in result] == [10 * n for n in range(40)]
+    # state was set up in the workers, not here
+    pids = set([pid for (_tag, result) in handled for (_n, pid) in result])
+    assert os.getpid() not in pids and None not in pids
+
+def test_chunk_pool_unordered():
+
+    handled = []
+    with ChunkPool(sum_chunk, lambda tag, result: handled.append((tag, result)), workers=2,
+            ordered=False, max_inflight=3) as pool:
+        for i in range(10):
+            pool.submit([i, i], tag=i)
+        pool.drain()
+    assert sorted(handled) == [(i, 2 * i) for i in range(10)]
+
+def test_chunk_pool_error():
+
+    for ordered in (True, False):
+        with pytest.raises(ValueError):
+            with ChunkPool(sum_chunk, lambda tag, result: None, workers=2, ordered=ordered) as pool:
+                pool.submit([1, 2])
+                pool.submit([None])
+                pool.drain()
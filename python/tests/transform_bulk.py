@@ -0,0 +1,81 @@
+
+import io
+import json
+
+import pytest
+
+from fatcat_openapi_client import ReleaseEntity, ChangelogEntry
+from fatcat_tools import entity_from_json, release_to_elasticsearch, changelog_to_elasticsearch
+from fatcat_tools.transforms import BulkTransformer
+from fixtures import fake_ident
+
+
+def release_lines():
+    """
+    Release JSON lines (with a few blank and non-active lines)
+    """
+    lines = []
+    with open('tests/files/example_releases_pubmed19n0972.json', 'r') as f:
+        releases = [json.loads(l) for l in f]
+    for n in range(60):
+        release = dict(releases[n % len(releases)])
+        release['ident'] = fake_ident(n)
+        release['state'] = 'active' if n % 7 else 'deleted'
+        lines.append(json.dumps(release) + '\n')
+        if n % 11 == 0:
+            lines.append('\n')
+    return lines
+
+def serial_release_docs(lines):
+    # the original fatcat_transform.py loop
+    out = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entity = entity_from_json(line, ReleaseEntity)
+        if entity.state != 'active':
+            continue
+        out.append(json.dumps(release_to_elasticsearch(entity)) + '\n')
+    return "".join(out)
+
+def run_transform(kind, lines, **kwargs):
+    output = io.StringIO()
+    counts = BulkTransformer(kind, **kwargs).run(lines, output)
+    return (counts, output.getvalue())
+
+def test_bulk_transform_releases():
+
+    lines = release_lines()
+    expected = serial_release_docs(lines)
+    for kwargs in (dict(), dict(chunk_size=4), dict(workers=3, chunk_size=4)):
+        (counts, output) = run_transform('releases', lines, **kwargs)
+        assert output == expected
+        assert counts['lines'] == len(lines)
+        assert counts['docs'] == expected.count('\n') == 51
+
+    (counts, output) = run_transform('releases', lines, workers=3, chunk_size=4, ordered=False)
+    assert sorted(output.splitlines()) == sorted(expected.splitlines())
+    assert counts['docs'] == 51
+
+def test_bulk_transform_changelogs():
+
+    with open('tests/files/changelog_3469683.json', 'r') as f:
+        line = json.dumps(json.load(f)) + '\n'
+    expected = json.dumps(changelog_to_elasticsearch(entity_from_json(line, ChangelogEntry))) + '\n'
+    (counts, output) = run_transform('changelogs', [line] * 5, workers=2, chunk_size=2)
+    assert output == expected * 5
+    assert counts['docs'] == 5
+
+def test_bulk_transform_errors(capsys):
+
+    with pytest.raises(ValueError):
+        BulkTransformer('works')
+
+    lines = release_lines()
+    lines.insert(30, '{"ext_ids": {}, "state": "active", "release_year": "not a year"}\n')
+    with pytest.raises(ValueError):
+        run_transform('releases', lines, workers=2, chunk_size=4)
+
+    run_transform('releases', release_lines(), chunk_size=4, progress_interval=0.000001)
+    assert "lines/sec" in capsys.readouterr().err
@@ -0,0 +1,88 @@
+
+import json
+import collections
+
+import pytest
+import dateutil.parser
+from fatcat_openapi_client import *
+from fatcat_openapi_client.rest import ApiException
+
+from fatcat_tools import entity_from_json, entity_from_dict, entity_to_dict
+from fatcat_tools.transforms.deserialize import get_deserializer, _deserialize_date, _deserialize_datetime
+
+
+def apiclient_from_json(json_str, entity_type):
+    """
+    The old (code-generated) deserialization path, for comparison
+    """
+    thing = collections.namedtuple('Thing', ['data'])
+    thing.data = json_str
+    return ApiClient().deserialize(thing, entity_type)
+
+def test_deserialize_matches_apiclient():
+
+    fixtures = [
+        ('release_3mssw2qnlnblbk7oqyv2dafgey.json', ReleaseEntity),
+        ('release_etodop5banbndg3faecnfm6ozi.json', ReleaseEntity),
+        ('release_mjtqtuyhwfdr7j2c3l36uor7uy.json', ReleaseEntity),
+        ('file_bcah4zp5tvdhjl5bqci2c2lgfa.json', FileEntity),
+        ('changelog_3469683.json', ChangelogEntry),
+    ]
+    for (fname, entity_type) in fixtures:
+        with open('tests/files/' + fname, 'r') as f:
+            json_str = f.read()
+        expected = apiclient_from_json(json_str, entity_type)
+        assert entity_from_json(json_str, entity_type) == expected
+        assert entity_from_json(json_str.encode('utf-8'), entity_type) == expected
+        assert entity_from_dict(json.loads(json_str), entity_type) == expected
+        assert entity_to_dict(entity_from_json(json_str, entity_type)) == entity_to_dict(expected)
+
+def test_deserialize_types():
+
+    obj = {
+        "ident": "aaaaaaaaaaaaarceaaaaaaaaai",
+        "title": "some title",
+        "release_year": "2001",
+        "release_date": "2001-02-03",
+        "ext_ids": {"doi": "10.123/abc"},
+        "contribs": [{"index": 0, "raw_name": "Bob", "extra": {"x": [1, 2]}}],
+        "extra": {"nested": {"list": [1, "two", None]}},
+        "not_a_field": "blah",
+    }
+    expected = apiclient_from_json(json.dumps(obj), ReleaseEntity)
+    re = entity_from_dict(obj, ReleaseEntity)
+    assert re == expected
+    assert re.release_year == 2001
+    assert type(re.release_date) == type(expected.release_date)
+    assert re.ext_ids.doi == "10.123/abc"
+    assert re.contribs[0].extra == {"x": [1, 2]}
+
+    # returned entity shouldn't share mutable state with the input
+    re.extra['nested']['list'].append(4)
+    re.contribs[0].extra['x'].append(3)
+    assert obj['extra']['nested']['list'] == [1, "two", None]
+    assert obj['contribs'][0]['extra']['x'] == [1, 2]
+
+    # type strings work too
+    refs = get_deserializer("list[ReleaseRef]")([{"index": 3, "title": "ref"}])
+    assert refs[0].index == 3
+
+def test_deserialize_errors():
+
+    # required fields still get validated by model constructors
+    with pytest.raises(ValueError):
+        entity_from_dict({"url": "http://example.com"}, FileUrl)
+    with pytest.raises(ApiException):
+        entity_from_dict({"ext_ids": {}, "release_date": "not-a-date"}, ReleaseEntity)
+
+def test_deserialize_datetimes():
+
+    for val in ("2020-01-30T05:04:39.738601Z", "2020-01-30T05:04:39Z",
+            "2020-01-30T05:04:39.7Z", "2020-01-30T05:04:39", "2020-01-30 05:04"):
+        expected = dateutil.parser.parse(val)
+        assert _deserialize_datetime(val) == expected
+        assert repr(_deserialize_datetime(val)) == repr(expected)
+    for val in ("2020-01-30", "2020-1-3", "20200130"):
+        assert _deserialize_date(val) == dateutil.parser.parse(val).date()
+    with pytest.raises(ApiException):
+        _deserialize_datetime("2020-02-30T05:04:39Z")
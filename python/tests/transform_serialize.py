@@ -0,0 +1,75 @@
+
+import json
+import datetime
+
+from fatcat_openapi_client import *
+
+from fatcat_tools import entity_from_json, entity_to_dict, entity_to_json
+from fatcat_tools.transforms.serialize import sanitize
+from import_crossref import crossref_importer
+from fixtures import *
+
+
+def apiclient_to_dict(entity):
+    """
+    The old (code-generated) serialization path, for comparison
+    """
+    return ApiClient().sanitize_for_serialization(entity)
+
+def check_equivalent(entity):
+    expected = apiclient_to_dict(entity)
+    assert entity_to_dict(entity) == expected
+    assert sanitize(entity) == expected
+    assert entity_to_json(entity) == json.dumps(expected).encode('utf-8')
+    # key order matters for JSON output
+    assert json.dumps(entity_to_dict(entity)) == json.dumps(expected)
+
+def test_serialize_matches_apiclient():
+
+    fixtures = [
+        ('release_3mssw2qnlnblbk7oqyv2dafgey.json', ReleaseEntity),
+        ('release_etodop5banbndg3faecnfm6ozi.json', ReleaseEntity),
+        ('release_mjtqtuyhwfdr7j2c3l36uor7uy.json', ReleaseEntity),
+        ('file_bcah4zp5tvdhjl5bqci2c2lgfa.json', FileEntity),
+        ('changelog_3469683.json', ChangelogEntry),
+    ]
+    for (fname, entity_type) in fixtures:
+        with open('tests/files/' + fname, 'r') as f:
+            entity = entity_from_json(f.read(), entity_type)
+        check_equivalent(entity)
+
+def test_serialize_importer_output(crossref_importer):
+
+    with open('tests/files/crossref-works.2018-01-21.badsample.json', 'r') as f:
+        for line in f:
+            re = crossref_importer.parse_record(json.loads(line))
+            if re:
+                check_equivalent(re)
+
+def test_serialize_unusual_values():
+
+    re = ReleaseEntity(
+        title="some title",
+        ext_ids=ReleaseExtIds(doi="10.123/abc"),
+        release_date=datetime.date(2001, 2, 3),
+        release_year=2001,
+        contribs=[ReleaseContrib(raw_name="Bob", extra=dict(when=datetime.date(2000, 1, 1)))],
+        extra=dict(
+            nested=dict(list=[1, "two", None, (3, 4)]),
+            model=FileUrl(url="http://example.com", rel="web"),
+        ),
+    )
+    check_equivalent(re)
+
+    # values which don't match the declared openapi types
+    re.release_date = "2001-02-03"
+    re.release_year = True
+    re.refs = (ReleaseRef(index=0),)
+    re.abstracts = [None, ReleaseAbstract(content="blah")]
+    re.container = dict(name="not a model")
+    check_equivalent(re)
+
+    # non-entity values
+    assert entity_to_dict(None) is None
+    assert entity_to_dict([FileUrl(url="http://example.com", rel="web")]) == [dict(url="http://example.com", rel="web")]
+    assert entity_to_dict(datetime.date(2000, 1, 2)) == "2000-01-02"
@@ -1,5 +1,6 @@
 
 import json
+import time
 import pytest
 import datetime
 
@@ -168,6 +169,86 @@ def test_coverage_search(app, mocker):
     assert rv.status_code == 200
 
 
+def test_coverage_search_cached(app, mocker):
+
+    # preservation by year histogram
+    elastic_resp1 = {
+        'took': 294,
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'skipped': 0, 'failed': 0},
+        'hits': {'total': 4327, 'max_score': 0.0, 'hits': []},
+        'aggregations': {
+            'year_preservation': {
+              'buckets': [
+                {'key': {'year': 2004.0, 'preservation': 'bright'}, 'doc_count': 444},
+              ],
+              'sum_other_doc_count': 0,
+            },
+        },
+    }
+
+    # preservation by type histogram
+    elastic_resp2 = {
+        'took': 294,
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'skipped': 0, 'failed': 0},
+        'hits': {'total': 4327, 'max_score': 0.0, 'hits': []},
+        'aggregations': {
+            'type_preservation': {
+              'buckets': [
+                {'key': {'release_type': 'book', 'preservation': 'dark'}, 'doc_count': 111},
+              ],
+              'sum_other_doc_count': 0,
+            },
+        },
+    }
+
+    es_raw = mocker.patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    es_raw.side_effect = [
+        (200, {}, json.dumps(ES_CONTAINER_STATS_RESP)),
+        (200, {}, json.dumps(elastic_resp2)),
+        (200, {}, json.dumps(elastic_resp1)),
+    ]
+
+    rv = app.get('/coverage/search?q=blah')
+    assert rv.status_code == 200
+    assert es_raw.call_count == 3
+
+    # pagination isn't part of the cache key, so this is served from cache
+    rv2 = app.get('/coverage/search?q=blah&offset=20')
+    assert rv2.status_code == 200
+    assert es_raw.call_count == 3
+
+    rv = app.get('/stats/cache.json')
+    assert rv.status_code == 200
+    assert rv.json['hit'] >= 3
+    assert rv.json['miss'] >= 3
+
+
+def test_container_stats_concurrent(app, mocker):
+
+    def slow_get_container(ident):
+        time.sleep(0.5)
+        return ContainerEntity(ident=ident, name="some journal", issnl="1234-5678", state="active")
+
+    def slow_es_request(*args, **kwargs):
+        time.sleep(0.5)
+        return (200, {}, json.dumps(ES_CONTAINER_STATS_RESP))
+
+    mocker.patch('fatcat_web.routes.api.get_container', side_effect=slow_get_container)
+    es_raw = mocker.patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    es_raw.side_effect = slow_es_request
+
+    # API fetch and ES query happen at the same time
+    start = time.time()
+    rv = app.get('/container/aaaaaaaaaaaaaeiraaaaaaaaam/stats.json')
+    assert time.time() - start < 0.9
+    assert rv.status_code == 200
+    assert rv.json['ident'] == "aaaaaaaaaaaaaeiraaaaaaaaam"
+    assert rv.json['issnl'] == "1234-5678"
+    assert rv.json['total'] == 461939
+
+
 def test_legacy_container_coverage(app, mocker):
 
     # legacy preservation by year
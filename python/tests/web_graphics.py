@@ -0,0 +1,65 @@
+
+import xml.etree.ElementTree as ET
+
+import pytest
+from pygal.style import CleanStyle
+
+from fatcat_web.graphics import *
+
+
+def year_rows(start=1990, end=2020):
+    return [dict(year=y, none=y % 7 * 10, shadows_only=3, dark=y % 5, bright=y % 11 * 20)
+            for y in range(start, end + 1)]
+
+def test_chart_renderers():
+
+    orig_colors = CleanStyle.colors
+    for renderer in ("svg", "pygal"):
+        chart = preservation_by_year_histogram(year_rows())
+        svg = chart.render(renderer=renderer)
+        root = ET.fromstring(svg)
+        assert root.tag == "{http://www.w3.org/2000/svg}svg"
+        assert b"2020" in svg and b"Bright" in svg and b"Shadow" in svg
+
+        chart = preservation_by_year_histogram(year_rows(), merge_shadows=True)
+        assert b"Shadow" not in chart.render(renderer=renderer)
+
+        chart = ia_coverage_histogram([(2001, True, 5), (2001, False, 2), (2004.0, True, 10)])
+        svg = chart.render(renderer=renderer)
+        ET.fromstring(svg)
+        assert b"2003" in svg and b"via Fatcat" in svg
+
+        chart = preservation_by_volume_histogram([])
+        ET.fromstring(chart.render(renderer=renderer))
+        assert chart.render_data_uri(renderer=renderer).startswith("data:image/svg+xml;charset=utf-8;base64,")
+
+    # the shared pygal style doesn't get clobbered
+    assert CleanStyle.colors == orig_colors
+
+    with pytest.raises(ValueError):
+        ia_coverage_histogram([]).render(renderer="png")
+
+def test_chart_render_cache():
+
+    svg = preservation_by_year_histogram(year_rows()).render(renderer="svg")
+    # equal data (but different objects) hits the cache
+    assert preservation_by_year_histogram(year_rows()).render(renderer="svg") is svg
+    assert preservation_by_year_histogram(year_rows(end=2019)).render(renderer="svg") != svg
+    assert preservation_by_year_histogram(year_rows()).render(renderer="pygal") != svg
+
+def test_svg_chart_layout():
+
+    chart = preservation_by_year_histogram(year_rows())
+    root = ET.fromstring(chart.render(renderer="svg"))
+    ns = {'svg': 'http://www.w3.org/2000/svg'}
+    x_labels = [t.text for t in root.findall(".//svg:g[@class='axis x']/svg:text", ns)]
+    # label count is limited for long histograms
+    assert len(x_labels) == 10
+    assert x_labels[0] == "1990" and x_labels[-1] == "2020"
+    bars = root.findall(".//svg:g[@class='bar']", ns)
+    nonzero = sum([1 for r in year_rows() for k in ('none', 'shadows_only', 'dark', 'bright') if r[k]])
+    assert len(bars) == nonzero
+    y_labels = [int(t.text) for t in root.findall(".//svg:g[@class='axis y']/svg:text", ns)]
+    assert y_labels[0] == 0
+    assert y_labels == sorted(y_labels)
+    assert y_labels[-1] <= max([r['none'] + r['shadows_only'] + r['dark'] + r['bright'] for r in year_rows()])
@@ -2,7 +2,9 @@
 import json
 import pytest
 
-from fatcat_web.search import get_elastic_container_random_releases
+import fatcat_web
+from fatcat_web.search import get_elastic_container_random_releases, encode_search_after, \
+    export_release_search, ReleaseQuery
 from fatcat_openapi_client.rest import ApiException
 from fixtures import *
 
@@ -168,3 +170,152 @@ def test_container_stats(app, mocker):
 
     rv = app.get('/container/aaaaaaaaaaaaaeiraaaaaaaaam/stats.json')
     assert rv.status_code == 200
+
+def es_request_body(call):
+    (args, kwargs) = call
+    body = kwargs.get('body', args[3] if len(args) > 3 else None)
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return json.loads(body)
+
+def test_release_search_cursor(app, mocker):
+
+    with open('tests/files/elastic_release_search.json') as f:
+        elastic_resp = json.loads(f.read())
+    # a full page of hits (default page size is 25)
+    hits = elastic_resp['hits']['hits']
+    elastic_resp['hits']['hits'] = (hits * 3)[:25]
+    for hit in elastic_resp['hits']['hits']:
+        hit['sort'] = [hit['_score'], hit['_source']['ident']]
+
+    es_raw = mocker.patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    es_raw.side_effect = [
+        (200, {}, json.dumps(elastic_resp)),
+        (200, {}, json.dumps(elastic_resp)),
+    ]
+
+    sort = [{"_score": {"order": "desc"}}, {"_id": {"order": "asc"}}]
+
+    # regular (shallow) pages are sorted by score only (so they work on any
+    # index), and don't get a cursor
+    rv = app.get('/release/search?q=blood&offset=25')
+    assert rv.status_code == 200
+    body = es_request_body(es_raw.call_args)
+    assert body['from'] == 25
+    assert 'sort' not in body
+    assert b"after=" not in rv.data
+
+    # last page before the deep paging limit hands out a cursor
+    rv = app.get('/release/search?q=blood&offset=1990')
+    assert rv.status_code == 200
+    body = es_request_body(es_raw.call_args)
+    assert body['from'] == 1990
+    assert body['sort'] == sort
+    last_hit = elastic_resp['hits']['hits'][-1]
+    cursor = encode_search_after(last_hit['sort'])
+    assert "offset=2015&amp;after={}".format(cursor).encode('utf-8') in rv.data
+
+    # cursor pages use search_after instead of from/size
+    es_raw.side_effect = [
+        (200, {}, json.dumps(elastic_resp)),
+    ]
+    rv = app.get('/release/search?q=blood&offset=2015&after={}'.format(cursor))
+    assert rv.status_code == 200
+    assert b"Quantum Studies of Acetylene Adsorption on Ice Surface" in rv.data
+    body = es_request_body(es_raw.call_args)
+    assert body.get('from', 0) == 0
+    assert body['search_after'] == last_hit['sort']
+    assert body['sort'] == sort
+    assert b"offset=2040&amp;after=" in rv.data
+
+    # sort on ident, once the index has doc values for it
+    mocker.patch.dict(fatcat_web.app.config, {'ELASTICSEARCH_SORT_IDENT': True})
+    es_raw.side_effect = [
+        (200, {}, json.dumps(elastic_resp)),
+        (200, {}, json.dumps(elastic_resp)),
+    ]
+    rv = app.get('/release/search?q=blood&offset=25')
+    assert 'sort' not in es_request_body(es_raw.call_args)
+    rv = app.get('/release/search?q=blood&offset=2015&after={}'.format(cursor))
+    assert rv.status_code == 200
+    assert es_request_body(es_raw.call_args)['sort'] == \
+        [{"_score": {"order": "desc"}}, {"ident": {"order": "asc"}}]
+
+    # garbage cursor
+    rv = app.get('/release/search?q=blood&after=blah')
+    assert rv.status_code == 400
+
+def test_release_search_export(app, mocker):
+
+    with open('tests/files/elastic_release_search.json') as f:
+        elastic_resp = json.loads(f.read())
+    ten_hits = elastic_resp['hits']['hits']
+    for hit in ten_hits:
+        hit['sort'] = [hit['_source']['ident']]
+    page1 = json.loads(json.dumps(elastic_resp))
+    page1['hits']['hits'] = ten_hits[:6]
+    page2 = json.loads(json.dumps(elastic_resp))
+    page2['hits']['hits'] = ten_hits[6:]
+
+    es_raw = mocker.patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    es_raw.side_effect = [
+        (200, {}, json.dumps(page1)),
+        (200, {}, json.dumps(page2)),
+    ]
+
+    (count, docs) = export_release_search(ReleaseQuery(q="blood"), max_results=100, batch_size=6)
+    docs = list(docs)
+    assert count == elastic_resp['hits']['total']
+    assert [d['ident'] for d in docs] == [h['_source']['ident'] for h in ten_hits]
+    assert es_raw.call_count == 2
+    body = es_request_body(es_raw.call_args)
+    assert body['sort'] == [{"_id": {"order": "asc"}}]
+    assert body['search_after'] == [ten_hits[5]['_source']['ident']]
+
+    mocker.patch.dict(fatcat_web.app.config, {'ELASTICSEARCH_SORT_IDENT': True})
+    es_raw.side_effect = [
+        (200, {}, json.dumps(page2)),
+    ]
+    (count, docs) = export_release_search(ReleaseQuery(q="blood"), max_results=100, batch_size=6)
+    assert len(list(docs)) == 4
+    assert es_request_body(es_raw.call_args)['sort'] == [{"ident": {"order": "asc"}}]
+
+    # results are capped
+    es_raw.side_effect = [
+        (200, {}, json.dumps(page1)),
+    ]
+    (count, docs) = export_release_search(ReleaseQuery(q="blood"), max_results=4, batch_size=6)
+    assert len(list(docs)) == 4
+    assert es_request_body(es_raw.call_args)['size'] == 4
+
+    es_raw.side_effect = [
+        (200, {}, json.dumps(elastic_resp)),
+    ]
+    rv = app.get('/release/search.jsonl?q=blood')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+    assert rv.headers['X-Total-Count'] == str(elastic_resp['hits']['total'])
+    lines = rv.data.decode('utf-8').splitlines()
+    assert len(lines) == 10
+    assert json.loads(lines[0])['ident'] == ten_hits[0]['_source']['ident']
+
+    rv = app.get('/release/search.jsonl')
+    assert rv.status_code == 400
+
+def test_release_search_export_rate_limit(app, mocker):
+
+    with open('tests/files/elastic_release_search.json') as f:
+        elastic_resp = f.read()
+    es_raw = mocker.patch('elasticsearch.connection.Urllib3HttpConnection.perform_request')
+    es_raw.return_value = (200, {}, elastic_resp)
+    mocker.patch.object(fatcat_web.export_limiter, '_recent', dict())
+    mocker.patch.object(fatcat_web.export_limiter, 'max_requests', 2)
+
+    for _ in range(2):
+        rv = app.get('/release/search.jsonl?q=blood')
+        assert rv.status_code == 200
+        rv.close()
+    rv = app.get('/release/search.jsonl?q=blood')
+    assert rv.status_code == 429
+    # finished exports don't count against the concurrency limit
+    assert fatcat_web.export_limiter.active == 0
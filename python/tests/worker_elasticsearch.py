@@ -0,0 +1,247 @@
+
+import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+from fatcat_openapi_client import *
+
+from fatcat_tools import release_to_elasticsearch, entity_from_json
+import fatcat_tools.workers.elasticsearch
+from fatcat_tools.workers import ElasticsearchReleaseWorker
+from fatcat_tools.workers.elasticsearch import ElasticsearchBulkIndexer, ElasticsearchBulkError
+from fixtures import FakeKafkaMessage
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeElasticsearch:
+    """
+    Local HTTP server implementing just enough of the _bulk API.
+
+    `behavior` is a list of per-request responses: "ok", "429" (whole
+    request rejected), "reject-first" (first item rejected with 429),
+    "error" (first item fails with a mapping error), or "slow" (delayed
+    "ok"). After the list runs out, all requests succeed.
+    """
+
+    def __init__(self, behavior=None):
+        self.behavior = list(behavior or [])
+        self.requests = []
+        self.docs = dict()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+                lines = [l for l in body.split('\n') if l]
+                actions = [(json.loads(lines[i])['index']['_id'], json.loads(lines[i+1]))
+                    for i in range(0, len(lines), 2)]
+                with fake.lock:
+                    fake.requests.append((self.path, actions))
+                    mode = fake.behavior.pop(0) if fake.behavior else "ok"
+                if mode == "slow":
+                    time.sleep(0.3)
+                if mode == "429":
+                    self.send_response(429)
+                    self.end_headers()
+                    return
+                items = []
+                for (n, (doc_id, doc)) in enumerate(actions):
+                    if n == 0 and mode == "reject-first":
+                        items.append({"index": {"_id": doc_id, "status": 429,
+                            "error": {"type": "es_rejected_execution_exception"}}})
+                    elif n == 0 and mode == "error":
+                        items.append({"index": {"_id": doc_id, "status": 400,
+                            "error": {"type": "mapper_parsing_exception"}}})
+                    else:
+                        with fake.lock:
+                            fake.docs[doc_id] = doc
+                        items.append({"index": {"_id": doc_id, "status": 201}})
+                resp = json.dumps({
+                    "took": 1,
+                    "errors": any(['error' in list(i.values())[0] for i in items]),
+                    "items": items,
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(resp)))
+                self.end_headers()
+                self.wfile.write(resp)
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.url = "http://localhost:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def fake_es():
+    es = FakeElasticsearch()
+    yield es
+    es.close()
+
+def test_bulk_indexer_concurrent(fake_es):
+
+    indexer = ElasticsearchBulkIndexer(fake_es.url + "/fatcat_release/release/_bulk",
+        concurrency=4, backoff=0.01)
+    futures = []
+    for batch in range(10):
+        futures.append(indexer.submit([("doc{}-{}".format(batch, i), {"n": i}) for i in range(5)]))
+    for f in futures:
+        f.result()
+    indexer.close()
+    assert len(fake_es.docs) == 50
+    assert len(fake_es.requests) == 10
+    assert fake_es.requests[0][0] == "/fatcat_release/release/_bulk"
+    assert indexer.counts['indexed'] == 50
+
+def test_bulk_indexer_retry(fake_es):
+
+    fake_es.behavior = ["429", "reject-first", "ok"]
+    indexer = ElasticsearchBulkIndexer(fake_es.url + "/_bulk", backoff=0.01)
+    indexer.index([("a", {}), ("b", {}), ("c", {})])
+    assert sorted(fake_es.docs.keys()) == ["a", "b", "c"]
+    # only the rejected item gets re-sent
+    assert [len(r[1]) for r in fake_es.requests] == [3, 3, 1]
+    assert indexer.counts['retried'] == 4
+
+    # retries run out
+    fake_es.behavior = ["429"] * 5
+    indexer = ElasticsearchBulkIndexer(fake_es.url + "/_bulk", backoff=0.01, max_retries=2)
+    with pytest.raises(ElasticsearchBulkError):
+        indexer.index([("d", {})])
+
+def test_bulk_indexer_ordering(fake_es):
+
+    # duplicate ids within a batch: only the last is sent, even on retry
+    fake_es.behavior = ["reject-first"]
+    indexer = ElasticsearchBulkIndexer(fake_es.url + "/_bulk", backoff=0.01)
+    indexer.index([("a", {"v": 1}), ("b", {"v": 1}), ("a", {"v": 2})])
+    assert fake_es.docs == {"a": {"v": 2}, "b": {"v": 1}}
+    assert [r[1] for r in fake_es.requests] == [
+        [("b", {"v": 1}), ("a", {"v": 2})],
+        [("b", {"v": 1})],
+    ]
+
+    # an older batch being retried (slowly) isn't overtaken by a newer batch
+    # with the same ids; unrelated batches still run concurrently
+    fake_es.docs.clear()
+    fake_es.behavior = ["slow", "429", "ok"]
+    indexer = ElasticsearchBulkIndexer(fake_es.url + "/_bulk", concurrency=4, backoff=0.2)
+    first = indexer.submit([("x", {"v": 1}), ("y", {"v": 1})])
+    other = indexer.submit([("z", {"v": 1})])
+    second = indexer.submit([("x", {"v": 2})])
+    assert first.done() and second.result() is None and other.result() is None
+    indexer.close()
+    assert fake_es.docs == {"x": {"v": 2}, "y": {"v": 1}, "z": {"v": 1}}
+    assert indexer.counts['ordering_waits'] == 1
+
+def test_bulk_indexer_error(fake_es):
+
+    fake_es.behavior = ["error"]
+    indexer = ElasticsearchBulkIndexer(fake_es.url + "/_bulk", backoff=0.01)
+    with pytest.raises(ElasticsearchBulkError):
+        indexer.submit([("a", {}), ("b", {})]).result()
+    assert indexer.counts['failed'] == 1
+
+def test_worker_transform_batch():
+
+    with open('./tests/files/release_3mssw2qnlnblbk7oqyv2dafgey.json', 'rb') as f:
+        release_json = f.read()
+    container_json = json.dumps({"ident": "aaaaaaaaaaaaaeiraaaaaaaaai", "name": "some journal"}).encode('utf-8')
+    values = [release_json, container_json, release_json]
+    expected = release_to_elasticsearch(entity_from_json(release_json, ReleaseEntity))
+
+    worker = ElasticsearchReleaseWorker("localhost:9092", "release-updates")
+    actions = worker.transform_batch(values)
+    # container got skipped
+    assert len(actions) == 2
+    assert actions[0] == ("3mssw2qnlnblbk7oqyv2dafgey", expected)
+
+    worker = ElasticsearchReleaseWorker("localhost:9092", "release-updates", transform_workers=2)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        assert worker.transform_batch(values * 3, pool=pool) == actions * 3
+
+class StopWorker(Exception):
+    pass
+
+class FakeConsumer:
+    """
+    Hands out the given batches, then a few empty polls, then stops the worker
+    """
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.empty_polls = 3
+        self.stored = []
+
+    def subscribe(self, topics, on_assign=None, on_revoke=None):
+        pass
+
+    def assignment(self):
+        return ["partition"]
+
+    def consume(self, num_messages=1, timeout=None):
+        if self.batches:
+            return self.batches.pop(0)
+        if self.empty_polls > 0:
+            self.empty_polls -= 1
+            time.sleep(0.2)
+            return []
+        raise StopWorker()
+
+    def store_offsets(self, message=None):
+        self.stored.append(message.offset())
+
+def test_worker_offsets(fake_es, monkeypatch):
+
+    with open('./tests/files/release_3mssw2qnlnblbk7oqyv2dafgey.json', 'rb') as f:
+        release_json = f.read()
+    batches = [[FakeKafkaMessage(b * 10 + i, release_json) for i in range(3)] for b in range(4)]
+    consumer = FakeConsumer(batches)
+    monkeypatch.setattr(fatcat_tools.workers.elasticsearch, 'Consumer', lambda conf: consumer)
+
+    # first batch is slow; later batches finish first, but offsets must still
+    # be stored in order
+    fake_es.behavior = ["slow", "ok", "ok", "ok"]
+    worker = ElasticsearchReleaseWorker("localhost:9092", "release-updates",
+        elasticsearch_backend=fake_es.url, bulk_concurrency=3)
+    with pytest.raises(StopWorker):
+        worker.run()
+    assert consumer.stored == [m.offset() for batch in batches for m in batch]
+    assert len(fake_es.requests) == 4
+
+def test_worker_forks_before_threads(fake_es, monkeypatch):
+
+    with open('./tests/files/release_3mssw2qnlnblbk7oqyv2dafgey.json', 'rb') as f:
+        release_json = f.read()
+    consumer = FakeConsumer([[FakeKafkaMessage(i, release_json) for i in range(4)]])
+    children = []
+
+    def make_consumer(conf):
+        # transform workers are all forked by the time the consumer is created
+        children.append(len(multiprocessing.active_children()))
+        return consumer
+
+    monkeypatch.setattr(fatcat_tools.workers.elasticsearch, 'Consumer', make_consumer)
+    fake_es.behavior = ["ok"]
+    worker = ElasticsearchReleaseWorker("localhost:9092", "release-updates",
+        elasticsearch_backend=fake_es.url, transform_workers=2)
+    with pytest.raises(StopWorker):
+        worker.run()
+    assert children == [2]
+    assert consumer.stored == [0, 1, 2, 3]
@@ -0,0 +1,170 @@
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fatcat_openapi_client import *
+
+from fatcat_tools import entity_from_json
+from fatcat_tools.workers import EntityUpdatesWorker
+from fixtures import fake_ident, FakeApi
+
+
+RELEASE_FIXTURES = [
+    'release_3mssw2qnlnblbk7oqyv2dafgey.json',
+    'release_etodop5banbndg3faecnfm6ozi.json',
+    'release_mjtqtuyhwfdr7j2c3l36uor7uy.json',
+]
+
+class FakeFetchApi(FakeApi):
+    """
+    Serves entities from test fixtures, slowly, and keeps track of fetches
+    """
+
+    def __init__(self, fail_release=None):
+        super().__init__()
+        self.fail_release = fail_release
+        self.fetched = []
+        self.active = 0
+        self.max_active = 0
+        self.releases = dict()
+        for fname in RELEASE_FIXTURES:
+            with open('tests/files/' + fname, 'r') as f:
+                re = entity_from_json(f.read(), ReleaseEntity)
+            self.releases[re.ident] = re
+
+    def _fetch(self, entity_type, ident):
+        with self.lock:
+            self.fetched.append((entity_type, ident))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.02)
+        with self.lock:
+            self.active -= 1
+
+    def get_release(self, ident, expand=None):
+        self._fetch('release', ident)
+        if ident == self.fail_release:
+            raise ApiException(status=500)
+        return self.releases[ident]
+
+    def get_file(self, ident, expand=None):
+        self._fetch('file', ident)
+        # every file links to the same two releases
+        return FileEntity(ident=ident, release_ids=list(self.releases.keys())[:2])
+
+    def get_fileset(self, ident, expand=None):
+        self._fetch('fileset', ident)
+        return FilesetEntity(ident=ident, release_ids=list(self.releases.keys())[2:])
+
+    def get_webcapture(self, ident, expand=None):
+        self._fetch('webcapture', ident)
+        return WebcaptureEntity(ident=ident, release_ids=[],
+            cdx=[], archive_urls=[], original_url="http://example.com", timestamp="2020-01-01T00:00:00Z")
+
+    def get_container(self, ident):
+        self._fetch('container', ident)
+        return ContainerEntity(ident=ident, name="some journal")
+
+class FakeProducer:
+
+    def __init__(self):
+        self.messages = []
+
+    def produce(self, topic, value, key=None, on_delivery=None):
+        self.messages.append((topic, key, json.loads(value.decode('utf-8'))))
+
+def make_worker(api):
+    return EntityUpdatesWorker(api, "localhost:9092", "changelog",
+        release_topic="release-updates",
+        file_topic="file-updates",
+        container_topic="container-updates",
+        ingest_file_request_topic="ingest-file-requests",
+        work_ident_topic="work-ident-updates",
+        fetch_workers=4,
+    )
+
+def make_changelog_entry(api):
+    release_ids = list(api.releases.keys())
+    edits = dict(containers=[], creators=[], files=[], filesets=[], webcaptures=[], releases=[], works=[])
+    for n in range(6):
+        edits['files'].append(dict(ident=fake_ident(n)))
+    # duplicate edit to same file
+    edits['files'].append(dict(ident=fake_ident(0)))
+    edits['filesets'].append(dict(ident=fake_ident(100)))
+    edits['webcaptures'].append(dict(ident=fake_ident(101)))
+    edits['containers'].append(dict(ident=fake_ident(102)))
+    edits['releases'].append(dict(ident=release_ids[0], prev_revision="00000000-0000-0000-0000-000000000001"))
+    edits['works'].append(dict(ident="aaaaaaaaaaaaavkvaaaaaaaaai"))
+    return dict(
+        index=1234,
+        timestamp="2020-01-30T05:04:39.738601Z",
+        editgroup=dict(edits=edits),
+    )
+
+def test_entity_updates_publish():
+
+    api = FakeFetchApi()
+    worker = make_worker(api)
+    producer = FakeProducer()
+    cle = make_changelog_entry(api)
+    with ThreadPoolExecutor(max_workers=worker.fetch_workers) as executor:
+        worker.publish_changelog_entry(cle, producer, executor)
+
+    # each entity only fetched once, including releases linked from files
+    assert len(api.fetched) == len(set(api.fetched))
+    assert len([f for f in api.fetched if f[0] == 'file']) == 6
+    assert sorted([f[1] for f in api.fetched if f[0] == 'release']) == sorted(api.releases.keys())
+    assert api.max_active > 1
+
+    topics = [m[0] for m in producer.messages]
+    assert topics.count('file-updates') == 6
+    assert topics.count('container-updates') == 1
+    assert topics.count('release-updates') == 3
+    for (topic, key, value) in producer.messages:
+        if topic == 'release-updates':
+            assert value['ident'] == key.decode('utf-8')
+            assert value == json.loads(json.dumps(worker.api.api_client.sanitize_for_serialization(api.releases[value['ident']])))
+    work_ids = sorted([m[2]['work_ident'] for m in producer.messages if m[0] == 'work-ident-updates'])
+    assert work_ids == sorted(["aaaaaaaaaaaaavkvaaaaaaaaai"] + [re.work_id for re in api.releases.values()])
+    assert all([m[2]['fatcat_changelog_index'] == 1234 for m in producer.messages if m[0] == 'work-ident-updates'])
+
+def test_entity_updates_fetch_error():
+
+    api = FakeFetchApi()
+    api.fail_release = list(api.releases.keys())[1]
+    worker = make_worker(api)
+    producer = FakeProducer()
+    with ThreadPoolExecutor(max_workers=worker.fetch_workers) as executor:
+        with pytest.raises(ApiException):
+            worker.publish_changelog_entry(make_changelog_entry(api), producer, executor)
+    # work idents are only published once all fetches have succeeded
+    assert 'work-ident-updates' not in [m[0] for m in producer.messages]
+
+def test_entity_updates_batch():
+
+    api = FakeFetchApi()
+    worker = make_worker(api)
+    producer = FakeProducer()
+    release_ids = list(api.releases.keys())
+    older = make_changelog_entry(api)
+    newer = dict(
+        index=1240,
+        timestamp="2020-01-30T06:00:00.000000Z",
+        editgroup=dict(edits=dict(containers=[], creators=[], files=[], filesets=[],
+            webcaptures=[], works=[], releases=[dict(ident=release_ids[1])])),
+    )
+    with ThreadPoolExecutor(max_workers=worker.fetch_workers) as executor:
+        worker.publish_changelog_entries([newer, older], producer, executor)
+
+    # releases touched by both entries are only fetched (and published) once
+    assert len(api.fetched) == len(set(api.fetched))
+    assert [m[0] for m in producer.messages].count('release-updates') == 3
+
+    work_updates = dict([(m[2]['work_ident'], m[2]) for m in producer.messages if m[0] == 'work-ident-updates'])
+    assert len(work_updates) == 4
+    assert work_updates[api.releases[release_ids[1]].work_id]['fatcat_changelog_index'] == 1240
+    assert work_updates[api.releases[release_ids[1]].work_id]['updated'] == newer['timestamp']
+    assert work_updates[api.releases[release_ids[0]].work_id]['fatcat_changelog_index'] == 1234
+    assert work_updates["aaaaaaaaaaaaavkvaaaaaaaaai"]['fatcat_changelog_index'] == 1234